@@ -0,0 +1,148 @@
+"""
+Concurrency benchmark for inventory reservation.
+
+N buyers (one connection and thread each) try to buy the same product at the
+same instant through services.inventory.reserve_stock. The run happens in a
+throw-away schema, so it is safe against a development database.
+
+Usage:
+    DATABASE_URL=... python -m backend.benchmarks.inventory_reservation --buyers 100 --stock 50
+
+Checks:
+- successful reservations * quantity + final stock == initial stock
+- final stock never goes negative (no oversell)
+"""
+import argparse
+import os
+import threading
+import time
+
+import psycopg2
+
+from backend.database import create_connection_with_keepalive
+from backend.services.inventory import reserve_stock, InsufficientStockError
+
+SCHEMA = f"bench_inventory_{os.getpid()}"
+
+
+def setup(stock: int) -> int:
+    conn = create_connection_with_keepalive()
+    cur = conn.cursor()
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+    cur.execute(f"""
+        CREATE TABLE {SCHEMA}.agricultural_produce (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(25) NOT NULL,
+            price INTEGER NOT NULL,
+            total_quantity INTEGER NOT NULL,
+            category VARCHAR(15) NOT NULL,
+            upload_date DATE NOT NULL,
+            off_shelf_date DATE NOT NULL,
+            img_link VARCHAR(255) NOT NULL,
+            img_id VARCHAR(36) NOT NULL,
+            seller_id INTEGER NOT NULL,
+            unit VARCHAR(10) NOT NULL,
+            location VARCHAR(100) NOT NULL DEFAULT 'unknown'
+        )
+    """)
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.agricultural_produce
+        (name, price, total_quantity, category, upload_date, off_shelf_date, img_link, img_id, seller_id, unit)
+        VALUES ('bench', 100, %s, 'bench', CURRENT_DATE, CURRENT_DATE + 7, '', '', 1, 'kg')
+        RETURNING id
+    """, (stock,))
+    produce_id = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    conn.close()
+    return produce_id
+
+
+def teardown():
+    conn = create_connection_with_keepalive()
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def run(buyers: int, stock: int, quantity: int):
+    produce_id = setup(stock)
+    connections = []
+    for _ in range(buyers):
+        conn = create_connection_with_keepalive()
+        cur = conn.cursor()
+        cur.execute(f"SET search_path TO {SCHEMA}")
+        conn.commit()
+        cur.close()
+        connections.append(conn)
+
+    results = {"reserved": 0, "insufficient": 0, "errors": 0}
+    latencies = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(buyers + 1)
+
+    def buyer(conn):
+        barrier.wait()
+        started = time.perf_counter()
+        cur = conn.cursor()
+        outcome = "reserved"
+        try:
+            reserve_stock(cur, produce_id, quantity)
+            conn.commit()
+        except InsufficientStockError:
+            conn.rollback()
+            outcome = "insufficient"
+        except psycopg2.Error:
+            conn.rollback()
+            outcome = "errors"
+        finally:
+            cur.close()
+        elapsed = time.perf_counter() - started
+        with lock:
+            results[outcome] += 1
+            latencies.append(elapsed)
+
+    threads = [threading.Thread(target=buyer, args=(conn,)) for conn in connections]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    conn = connections[0]
+    cur = conn.cursor()
+    cur.execute("SELECT total_quantity FROM agricultural_produce WHERE id = %s", (produce_id,))
+    final_stock = cur.fetchone()[0]
+    cur.close()
+    for conn in connections:
+        conn.close()
+
+    latencies.sort()
+    consistent = results["reserved"] * quantity + final_stock == stock and final_stock >= 0
+    print(f"buyers={buyers} initial_stock={stock} quantity={quantity}")
+    print(f"reserved={results['reserved']} insufficient={results['insufficient']} errors={results['errors']}")
+    print(f"final_stock={final_stock} oversold={max(0, results['reserved'] * quantity - stock)} consistent={consistent}")
+    print(f"wall={wall * 1000:.1f}ms throughput={buyers / wall:.0f} attempts/s "
+          f"p50={latencies[len(latencies) // 2] * 1000:.1f}ms p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f}ms")
+    return consistent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buyers", type=int, default=100)
+    parser.add_argument("--stock", type=int, default=50)
+    parser.add_argument("--quantity", type=int, default=1)
+    args = parser.parse_args()
+    try:
+        ok = run(args.buyers, args.stock, args.quantity)
+    finally:
+        teardown()
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+Concurrency benchmark for order claiming.
+
+N drivers (one connection and thread each) race for M unaccepted orders at
+the same instant. Each driver tries the orders in a random order until it
+wins one. Two claim paths are compared:
+
+- legacy: the former accept_order sequence (driver lookup, overdue count,
+  SELECT ... FOR UPDATE, status check, UPDATE, INSERT driver_orders: six
+  round trips with the order row locked from the SELECT to the commit)
+- single: services.order_claim.claim_order (one statement)
+
+The run happens in a throw-away schema, so it is safe against a
+development database.
+
+Usage:
+    DATABASE_URL=... python -m backend.benchmarks.order_claim --drivers 50 --orders 10
+
+Checks:
+- every order is claimed exactly once (one status change, one driver_orders row)
+- exactly min(drivers, orders) drivers win
+"""
+import argparse
+import os
+import random
+import threading
+import time
+
+import psycopg2
+
+from backend.database import create_connection_with_keepalive
+from backend.services.order_claim import claim_order, ClaimError
+
+SCHEMA = f"bench_order_claim_{os.getpid()}"
+
+
+def setup(drivers: int):
+    conn = create_connection_with_keepalive()
+    cur = conn.cursor()
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+    cur.execute(f"SET search_path TO {SCHEMA}")
+    cur.execute("""
+        CREATE TABLE drivers (
+            id SERIAL PRIMARY KEY,
+            user_id INT,
+            driver_name VARCHAR(255) NOT NULL,
+            driver_phone VARCHAR(20) NOT NULL
+        );
+        CREATE TABLE orders (
+            id SERIAL PRIMARY KEY,
+            buyer_id INT,
+            location VARCHAR(255) NOT NULL,
+            total_price FLOAT NOT NULL,
+            order_status VARCHAR(50) DEFAULT '未接單'
+        );
+        CREATE TABLE order_items (
+            id SERIAL PRIMARY KEY,
+            order_id INT REFERENCES orders(id),
+            item_name VARCHAR(255),
+            price FLOAT,
+            quantity INT
+        );
+        CREATE TABLE agricultural_produce (id SERIAL PRIMARY KEY, name VARCHAR(25), price INT);
+        CREATE TABLE agricultural_product_order (
+            id SERIAL PRIMARY KEY,
+            buyer_id INT,
+            produce_id INT,
+            quantity INT,
+            end_point VARCHAR(255),
+            status VARCHAR(50) DEFAULT '未接單'
+        );
+        CREATE TABLE driver_orders (
+            id SERIAL PRIMARY KEY,
+            driver_id INT,
+            order_id INT,
+            action VARCHAR(50),
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            previous_driver_id INT,
+            previous_driver_name VARCHAR(255),
+            previous_driver_phone VARCHAR(20),
+            service VARCHAR(20)
+        );
+        CREATE INDEX ON driver_orders (driver_id);
+    """)
+    cur.execute(
+        "INSERT INTO drivers (user_id, driver_name, driver_phone) SELECT 1000 + g, 'driver ' || g, '09' || g FROM generate_series(1, %s) g",
+        (drivers,)
+    )
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def reset(orders: int):
+    conn = create_connection_with_keepalive()
+    cur = conn.cursor()
+    cur.execute(f"SET search_path TO {SCHEMA}")
+    cur.execute("TRUNCATE driver_orders, order_items, orders RESTART IDENTITY CASCADE")
+    cur.execute(
+        "INSERT INTO orders (buyer_id, location, total_price) SELECT 1, 'bench ' || g, 100 FROM generate_series(1, %s) g",
+        (orders,)
+    )
+    cur.execute("INSERT INTO order_items (order_id, item_name, price, quantity) SELECT id, 'item', 50, 2 FROM orders")
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def teardown():
+    conn = create_connection_with_keepalive()
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def legacy_claim(cur, order_id: int, driver_id: int):
+    cur.execute("SELECT user_id FROM drivers WHERE id = %s", (driver_id,))
+    driver_user_id = cur.fetchone()[0]
+    cur.execute("""
+        SELECT COUNT(*)
+        FROM driver_orders dro
+        LEFT JOIN orders o ON dro.order_id = o.id AND dro.service = 'necessities'
+        LEFT JOIN agricultural_product_order apo ON dro.order_id = apo.id AND dro.service = 'agricultural_product'
+        WHERE dro.driver_id = %s
+          AND dro.action = '接單'
+          AND dro.timestamp < NOW() - INTERVAL '2 hours'
+          AND (
+            (dro.service = 'necessities' AND o.order_status NOT IN ('已送達', '已完成'))
+            OR (dro.service = 'agricultural_product' AND apo.status NOT IN ('已送達'))
+          )
+    """, (driver_id,))
+    if cur.fetchone()[0] > 0:
+        raise ClaimError(403, "overdue", "overdue_orders")
+    cur.execute("""
+        SELECT o.id, o.buyer_id, o.order_status, oi.item_name, oi.quantity, oi.price
+        FROM orders o LEFT JOIN order_items oi ON o.id = oi.order_id
+        WHERE o.id = %s
+        FOR UPDATE OF o
+    """, (order_id,))
+    rows = cur.fetchall()
+    if not rows:
+        raise ClaimError(404, "訂單未找到", "order_not_found")
+    if rows[0][2] != '未接單':
+        raise ClaimError(400, "訂單已被接", "already_accepted")
+    if rows[0][1] == driver_user_id:
+        raise ClaimError(400, "無法接取自己的訂單", "own_order")
+    cur.execute("UPDATE orders SET order_status = %s WHERE id = %s", ('接單', order_id))
+    cur.execute(
+        "INSERT INTO driver_orders (driver_id, order_id, action, service) VALUES (%s, %s, %s, %s)",
+        (driver_id, order_id, '接單', 'necessities')
+    )
+
+
+def single_claim(cur, order_id: int, driver_id: int):
+    claim_order(cur, 'necessities', order_id, driver_id)
+
+
+def run(mode: str, drivers: int, orders: int, seed: int) -> bool:
+    reset(orders)
+    claim = legacy_claim if mode == "legacy" else single_claim
+    connections = []
+    for _ in range(drivers):
+        conn = create_connection_with_keepalive()
+        cur = conn.cursor()
+        cur.execute(f"SET search_path TO {SCHEMA}")
+        conn.commit()
+        cur.close()
+        connections.append(conn)
+
+    results = {"won": 0, "lost": 0, "errors": 0}
+    latencies = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(drivers + 1)
+    rng = random.Random(seed)
+    plans = [rng.sample(range(1, orders + 1), orders) for _ in range(drivers)]
+
+    def driver(driver_id, conn, plan):
+        barrier.wait()
+        cur = conn.cursor()
+        try:
+            for order_id in plan:
+                started = time.perf_counter()
+                outcome = "won"
+                try:
+                    claim(cur, order_id, driver_id)
+                    conn.commit()
+                except ClaimError:
+                    conn.rollback()
+                    outcome = "lost"
+                except psycopg2.Error:
+                    conn.rollback()
+                    outcome = "errors"
+                elapsed = time.perf_counter() - started
+                with lock:
+                    results[outcome] += 1
+                    latencies.append(elapsed)
+                if outcome == "won":
+                    break
+        finally:
+            cur.close()
+
+    threads = [
+        threading.Thread(target=driver, args=(index + 1, conn, plans[index]))
+        for index, conn in enumerate(connections)
+    ]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    cur = connections[0].cursor()
+    cur.execute("SELECT COUNT(*) FILTER (WHERE order_status = '接單'), COUNT(*) FROM orders")
+    accepted, total = cur.fetchone()
+    cur.execute("SELECT COUNT(*), COUNT(DISTINCT order_id), COUNT(DISTINCT driver_id) FROM driver_orders")
+    logged, distinct_orders, distinct_drivers = cur.fetchone()
+    cur.close()
+    for conn in connections:
+        conn.close()
+
+    expected = min(drivers, orders)
+    consistent = (
+        accepted == expected and logged == expected and distinct_orders == expected
+        and distinct_drivers == expected and results["won"] == expected and results["errors"] == 0
+    )
+    latencies.sort()
+    attempts = len(latencies)
+    print(f"[{mode}] drivers={drivers} orders={orders} attempts={attempts}")
+    print(f"[{mode}] won={results['won']} lost={results['lost']} errors={results['errors']} "
+          f"accepted={accepted}/{total} driver_orders={logged} consistent={consistent}")
+    print(f"[{mode}] wall={wall * 1000:.1f}ms throughput={attempts / wall:.0f} attempts/s "
+          f"p50={latencies[attempts // 2] * 1000:.1f}ms p99={latencies[max(0, int(attempts * 0.99) - 1)] * 1000:.1f}ms")
+    return consistent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drivers", type=int, default=50)
+    parser.add_argument("--orders", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    setup(args.drivers)
+    try:
+        ok = True
+        for mode in ("legacy", "single"):
+            ok &= run(mode, args.drivers, args.orders, args.seed)
+    finally:
+        teardown()
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Benchmark for order creation: one statement (services.order_store.insert_order)
+versus the previous row-by-row order_items loop.
+
+Runs in a throw-away schema with the orders / order_items columns used by
+create_order, so it is safe against a development database.
+
+Usage:
+    DATABASE_URL=... python -m backend.benchmarks.order_insert --iterations 200 --sizes 1 10 30
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+from backend.database import create_connection_with_keepalive
+from backend.models.models import DetailedOrder
+from backend.services.order_store import insert_order
+
+SCHEMA = f"bench_orders_{os.getpid()}"
+
+
+def setup(conn):
+    cur = conn.cursor()
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+    cur.execute(f"""
+        CREATE TABLE {SCHEMA}.orders (
+            id SERIAL PRIMARY KEY,
+            buyer_id INT, buyer_name VARCHAR(255) NOT NULL, buyer_phone VARCHAR(20) NOT NULL,
+            seller_id INT, seller_name VARCHAR(255) NOT NULL, seller_phone VARCHAR(20) NOT NULL,
+            date DATE NOT NULL, time TIME NOT NULL, location VARCHAR(255) NOT NULL,
+            is_urgent BOOLEAN NOT NULL DEFAULT FALSE, total_price FLOAT NOT NULL,
+            order_type VARCHAR(50) DEFAULT '購買類', order_status VARCHAR(50) DEFAULT '未接單', note TEXT,
+            shipment_count INT, required_orders_count INT,
+            previous_driver_id INT, previous_driver_name VARCHAR(255), previous_driver_phone VARCHAR(20),
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute(f"""
+        CREATE TABLE {SCHEMA}.order_items (
+            id SERIAL PRIMARY KEY,
+            order_id INT REFERENCES {SCHEMA}.orders(id) ON DELETE CASCADE,
+            item_id VARCHAR(50), item_name VARCHAR(255), price FLOAT, quantity INT, img VARCHAR(255),
+            location VARCHAR(255), category VARCHAR(50), selected_options JSONB DEFAULT NULL
+        )
+    """)
+    cur.execute(f"CREATE INDEX ON {SCHEMA}.order_items (order_id)")
+    cur.execute(f"SET search_path TO {SCHEMA}")
+    conn.commit()
+    cur.close()
+
+
+def teardown(conn):
+    conn.rollback()
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    conn.commit()
+    cur.close()
+
+
+def make_order(item_count: int) -> DetailedOrder:
+    items = [{
+        "item_id": f"item-{i}",
+        "item_name": f"商品 {i}",
+        "price": 10.5 + i,
+        "quantity": 1,
+        "img": "/img/placeholder.png",
+        "location": "家樂福",
+        "category": "生鮮",
+        "selectedOptions": {"sweetness": ["半糖"]} if i % 2 else None
+    } for i in range(item_count)]
+    return DetailedOrder(
+        buyer_id=1, buyer_name="bench", buyer_phone="0900000000",
+        seller_id=1, seller_name="bench", seller_phone="0900000000",
+        date="2025-01-01", time="12:00", location="bench", is_urgent=False,
+        total_price=sum(item["price"] for item in items), items=items
+    )
+
+
+def insert_order_rowwise(cur, order) -> int:
+    """Previous implementation: one INSERT per item."""
+    cur.execute(
+        "INSERT INTO orders (buyer_id, buyer_name, buyer_phone, seller_id, seller_name, seller_phone, date, time, location, is_urgent, total_price, order_type, order_status, note, shipment_count, required_orders_count, previous_driver_id, previous_driver_name, previous_driver_phone) "
+        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id",
+        (order.buyer_id, order.buyer_name, order.buyer_phone, order.seller_id, order.seller_name, order.seller_phone, order.date,
+         order.time, order.location, order.is_urgent, order.total_price, order.order_type, order.order_status, order.note, order.shipment_count, order.required_orders_count, order.previous_driver_id,
+         order.previous_driver_name, order.previous_driver_phone)
+    )
+    order_id = cur.fetchone()[0]
+    for item in order.items:
+        selected_options_json = json.dumps(item.selectedOptions) if item.selectedOptions else None
+        cur.execute(
+            "INSERT INTO order_items (order_id, item_id, item_name, price, quantity, img, location, category, selected_options) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+            (order_id, item.item_id, item.item_name, item.price, item.quantity, item.img, item.location, item.category, selected_options_json)
+        )
+    return order_id
+
+
+def measure(conn, insert, order, iterations: int) -> list:
+    timings = []
+    cur = conn.cursor()
+    for _ in range(iterations):
+        started = time.perf_counter()
+        insert(cur, order)
+        conn.commit()
+        timings.append((time.perf_counter() - started) * 1000)
+    cur.close()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 30])
+    args = parser.parse_args()
+
+    conn = create_connection_with_keepalive()
+    setup(conn)
+    try:
+        print(f"{'items':>5} {'method':>9} {'mean ms':>8} {'p50 ms':>7} {'p95 ms':>7} {'orders/s':>9}")
+        for size in args.sizes:
+            order = make_order(size)
+            for name, insert in (("row-loop", insert_order_rowwise), ("cte", insert_order)):
+                measure(conn, insert, order, min(20, args.iterations))  # warm-up
+                timings = sorted(measure(conn, insert, order, args.iterations))
+                mean = statistics.mean(timings)
+                p95 = timings[max(0, int(len(timings) * 0.95) - 1)]
+                print(f"{size:>5} {name:>9} {mean:>8.2f} {timings[len(timings) // 2]:>7.2f} {p95:>7.2f} {1000 / mean:>9.0f}")
+
+        # Every order must have been written with its items
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT COUNT(*), COUNT(*) FILTER (WHERE NOT EXISTS (SELECT 1 FROM order_items i WHERE i.order_id = o.id))
+            FROM orders o
+        """)
+        written, missing_items = cur.fetchone()
+        print(f"orders written: {written}, orders without items: {missing_items}")
+        cur.close()
+    finally:
+        teardown(conn)
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,537 @@
+"""
+Query plan regression check for the hot SQL statements.
+
+Every statement in hot_queries() is run with EXPLAIN (ANALYZE, BUFFERS):
+the module-level SQL of routers/orders.py, routers/drivers.py and
+routers/history_management.py, the services they use, and every statement in
+the prepared statement registry. The scratch database is built from
+createtable.sql, seeded with production-like volumes (a year of orders,
+skewed towards a few heavy buyers, sellers and drivers), then upgraded
+with the numbered migrations and analyzed. For each plan the harness reports:
+
+- sequential scans of tables with at least --large-table-rows rows
+- row-estimate blowups: nodes whose actual row count is off from the
+  planner's estimate by a factor of --estimate-factor or more
+- a fingerprint of the plan shape: node types, join strategies, tables and
+  indexes, without costs or row counts. Monthly partitions of one table
+  count once (in any order), so the fingerprint doesn't change as months
+  are added; for months expected to return at most one row the index name
+  is left out, since the planner picks between tied indexes there.
+
+Fingerprints and accepted findings are stored in query_plans.json next to
+this file. A run fails when a fingerprint differs from the stored one or a
+new finding shows up, so a dropped index or a rewritten query is caught here
+instead of as a 504 in production. After reviewing an intended plan change,
+record it with --update and commit the file.
+
+Prepared statements are explained with their generic plan
+(plan_cache_mode = force_generic_plan), the plan a pooled connection settles
+on. Statements that write (order claims, status transitions) run in a
+transaction that is rolled back.
+
+The scratch database (bench_query_plans_<pid>) is created on the server of
+DATABASE_URL and dropped afterwards, so the role needs CREATEDB.
+
+Usage:
+    DATABASE_URL=... python -m backend.benchmarks.query_plans [--scale 1] [--only history] [--update]
+
+Checks:
+- the baseline file exists (a missing one fails the run; create it with --update)
+- every migration applies to the scratch database
+- every prepared statement has sample parameters here
+- no fingerprint changed and no new finding appeared since the stored baseline
+"""
+import argparse
+import difflib
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import time
+from dataclasses import dataclass
+from datetime import date, time as clock
+from typing import Callable, Dict, List, Optional, Tuple
+
+import psycopg2
+from psycopg2.extensions import make_dsn
+
+from backend.database import database_url
+from backend.handlers import send_message  # noqa: F401 (registers users_line_id_by_id)
+from backend.routers import drivers, history_management, orders, users  # noqa: F401 (users registers the login statement)
+from backend.services import availability, catalog_cache, dispatch, order_claim, order_index, route_planner
+from backend.services.order_state import CANCELLED, sources, transition_sql
+from backend.services.prepared_statements import registry
+
+DATABASE = f"bench_query_plans_{os.getpid()}"
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_plans.json")
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "database")
+
+# Row counts at --scale 1
+VOLUMES = {
+    "users": 20000,
+    "drivers": 500,
+    "slots": 20000,
+    "produce": 3000,
+    "orders": 200000,
+    "agri_orders": 100000,
+}
+PLACES = ['木柵', '政大', '景美', '公館', '信義', '大安', '中山', '內湖', '士林', '北投']
+
+# Deterministic data keeps the statistics, and so the plans, stable between runs
+SEED_SQL = [
+    "SELECT setseed(0.42)",
+    """
+    INSERT INTO users (name, phone, location, is_driver, line_user_id)
+    SELECT 'user ' || g, '09' || lpad(g::text, 8, '0'), (%(places)s::text[])[1 + g %% 10],
+           g <= %(drivers)s, 'U' || md5(g::text)
+    FROM generate_series(1, %(users)s) g
+    """,
+    """
+    INSERT INTO drivers (user_id, driver_name, driver_phone)
+    SELECT g, 'driver ' || g, '08' || lpad(g::text, 8, '0')
+    FROM generate_series(1, %(drivers)s) g
+    """,
+    """
+    INSERT INTO driver_time (driver_id, date, start_time, locations)
+    SELECT 1 + g %% %(drivers)s, CURRENT_DATE + (g %% 60 - 30), make_time(6 + g %% 14, (g %% 4) * 15, 0),
+           (%(places)s::text[])[1 + g %% 10] || '、' || (%(places)s::text[])[1 + (g / 10) %% 10]
+    FROM generate_series(1, %(slots)s) g
+    """,
+    """
+    INSERT INTO agricultural_produce (name, price, total_quantity, category, upload_date, off_shelf_date,
+                                      img_link, img_id, seller_id, unit, location)
+    SELECT 'produce ' || g, 20 + g %% 300, 100, (ARRAY['蔬菜', '水果', '米', '茶', '其他'])[1 + g %% 5],
+           CURRENT_DATE - (g %% 365), CURRENT_DATE - (g %% 365) + 30,
+           'https://example.invalid/' || g || '.jpg', md5(g::text), 1 + floor(power(random(), 2) * %(users)s)::int,
+           '斤', (%(places)s::text[])[1 + g %% 10]
+    FROM generate_series(1, %(produce)s) g
+    """,
+    # Uniform over a year; orders of the last day are still on the board or on the way
+    """
+    INSERT INTO orders (buyer_id, buyer_name, buyer_phone, seller_id, seller_name, seller_phone, date, time,
+                        location, is_urgent, total_price, order_type, order_status, timestamp)
+    SELECT buyer, 'user ' || buyer, '09' || lpad(buyer::text, 8, '0'),
+           seller, 'user ' || seller, '09' || lpad(seller::text, 8, '0'),
+           ts::date, ts::time, (%(places)s::text[])[1 + g %% 10] || ' ' || g, random() < 0.1,
+           round((50 + random() * 950)::numeric), '購買類',
+           CASE WHEN ts > NOW() - INTERVAL '1 day'
+                THEN (ARRAY['未接單', '未接單', '接單', '配送中', '已送達'])[1 + floor(random() * 5)::int]
+                ELSE (ARRAY['已完成', '已完成', '已完成', '已送達', '已送達', '已取消', '已過期'])[1 + floor(random() * 7)::int]
+           END,
+           ts
+    FROM (
+        SELECT g, 1 + floor(power(random(), 3) * %(users)s)::int AS buyer,
+               1 + floor(power(random(), 2) * %(users)s)::int AS seller,
+               NOW() - random() * INTERVAL '365 days' AS ts
+        FROM generate_series(1, %(orders)s) g
+    ) s
+    """,
+    """
+    INSERT INTO order_items (order_id, item_id, item_name, price, quantity, img, location, category)
+    SELECT o.id, ((o.id * 7 + i) %% 5000)::text, 'item ' || ((o.id * 7 + i) %% 5000), 10 + (o.id + i) %% 200,
+           1 + i %% 3, 'item.jpg', (%(places)s::text[])[1 + (o.id + i) %% 10],
+           (ARRAY['生活用品', '食品', '飲料'])[1 + i %% 3]
+    FROM orders o
+    CROSS JOIN LATERAL generate_series(1, 1 + o.id %% 4) i
+    """,
+    """
+    INSERT INTO agricultural_product_order (seller_id, buyer_id, buyer_name, buyer_phone, produce_id, quantity,
+                                            starting_point, end_point, timestamp, status)
+    SELECT p.seller_id, s.buyer, 'user ' || s.buyer, '09' || lpad(s.buyer::text, 8, '0'), p.id, 1 + s.g %% 5,
+           p.location, (%(places)s::text[])[1 + s.g %% 10], s.ts,
+           CASE WHEN s.ts > NOW() - INTERVAL '1 day'
+                THEN (ARRAY['未接單', '未接單', '接單', '已送達'])[1 + floor(random() * 4)::int]
+                ELSE (ARRAY['已送達', '已送達', '已送達', '已送達', '已取消'])[1 + floor(random() * 5)::int]
+           END
+    FROM (
+        SELECT g, 1 + floor(power(random(), 3) * %(users)s)::int AS buyer,
+               1 + floor(random() * %(produce)s)::int AS produce,
+               NOW() - random() * INTERVAL '365 days' AS ts
+        FROM generate_series(1, %(agri_orders)s) g
+    ) s
+    JOIN agricultural_produce p ON p.id = s.produce
+    """,
+    # One acceptance per order a driver touched, skewed towards busy drivers
+    """
+    INSERT INTO driver_orders (driver_id, order_id, action, timestamp, service)
+    SELECT 1 + floor(power(random(), 2) * %(drivers)s)::int, id, '接單', timestamp + INTERVAL '10 minutes', 'necessities'
+    FROM orders
+    WHERE order_status NOT IN ('未接單', '已取消', '已過期')
+    UNION ALL
+    SELECT 1 + floor(power(random(), 2) * %(drivers)s)::int, id, '接單', timestamp + INTERVAL '10 minutes', 'agricultural_product'
+    FROM agricultural_product_order
+    WHERE status NOT IN ('未接單', '已取消')
+    """,
+]
+
+# Parameter values picked from the seeded data: the heaviest buyer, seller
+# and driver, so the plans are the ones the biggest accounts get
+SAMPLES_SQL = {
+    "buyer_id": "SELECT buyer_id FROM orders GROUP BY buyer_id ORDER BY COUNT(*) DESC, buyer_id LIMIT 1",
+    "seller_id": "SELECT seller_id FROM orders GROUP BY seller_id ORDER BY COUNT(*) DESC, seller_id LIMIT 1",
+    "driver_id": "SELECT driver_id FROM driver_orders GROUP BY driver_id ORDER BY COUNT(*) DESC, driver_id LIMIT 1",
+    "phone": "SELECT phone FROM users ORDER BY id DESC LIMIT 1",
+    "order_id": "SELECT MAX(id) FROM orders",
+    "open_order_id": "SELECT id FROM orders WHERE order_status = '未接單' ORDER BY timestamp DESC LIMIT 1",
+    "open_agri_order_id": "SELECT id FROM agricultural_product_order WHERE status = '未接單' ORDER BY timestamp DESC LIMIT 1",
+}
+
+# Sample parameters for every statement in the prepared statement registry
+PREPARED_PARAMS: Dict[str, Callable[[dict], tuple]] = {
+    "users_line_id_by_id": lambda s: (s["buyer_id"],),
+    "users_login_by_phone": lambda s: (s["phone"],),
+    "orders_board_unaccepted": lambda s: (),
+    "drivers_exists_by_id": lambda s: (s["driver_id"],),
+    "drivers_by_user_id": lambda s: (s["driver_user_id"],),
+}
+
+_PARTITION_RE = re.compile(r'_p\d{4}_\d{2}')
+
+
+@dataclass
+class HotQuery:
+    name: str
+    sql: str
+    params: Callable[[dict], object] = lambda s: None
+    prepared: bool = False
+
+
+def claim_params(service: str, order_key: str):
+    return lambda s: {
+        **order_claim.STATUS_PARAMS,
+        "order_id": s[order_key], "driver_id": s["driver_id"], "timestamp": None, "previous_driver_id": None,
+        "previous_driver_name": None, "previous_driver_phone": None, "service": service,
+    }
+
+
+def cancel_params(order_key: str):
+    return lambda s: {
+        "order_id": s[order_key], "to_status": CANCELLED, "from_statuses": sorted(sources(CANCELLED)),
+        "note": None, "guard_buyer_id": s["buyer_id"],
+    }
+
+
+def hot_queries() -> List[HotQuery]:
+    day = date.today()
+    queries = [
+        HotQuery(f"prepared.{name}", statement.server_sql, PREPARED_PARAMS[name], prepared=True)
+        for name, statement in registry.statements.items() if name in PREPARED_PARAMS
+    ]
+    queries += [
+        HotQuery("orders.AGRI_ORDER_BOARD", orders.AGRI_ORDER_BOARD),
+        HotQuery("orders.SELLER_ORDERS_QUERY", orders.SELLER_ORDERS_QUERY, lambda s: (s["seller_id"],)),
+        HotQuery("orders.SELLER_AGRI_ORDERS_QUERY", orders.SELLER_AGRI_ORDERS_QUERY, lambda s: (s["seller_id"],)),
+        HotQuery("orders.BUYER_ORDERS_QUERY", orders.BUYER_ORDERS_QUERY, lambda s: (s["buyer_id"],)),
+        HotQuery("orders.BUYER_ACTIVE_ORDERS_QUERY", orders.BUYER_ACTIVE_ORDERS_QUERY, lambda s: (s["buyer_id"],)),
+        HotQuery("orders.BUYER_AGRI_ORDERS_QUERY", orders.BUYER_AGRI_ORDERS_QUERY, lambda s: (s["buyer_id"],)),
+        HotQuery("orders.BUYER_ACTIVE_AGRI_ORDERS_QUERY", orders.BUYER_ACTIVE_AGRI_ORDERS_QUERY, lambda s: (s["buyer_id"],)),
+        HotQuery("drivers.DRIVER_ORDERS_QUERY", drivers.DRIVER_ORDERS_QUERY, lambda s: (s["driver_id"], 'necessities')),
+        HotQuery("drivers.ORDER_ITEMS_QUERY", drivers.ORDER_ITEMS_QUERY, lambda s: (s["order_id"],)),
+        HotQuery("drivers.DRIVER_AGRI_ORDERS_QUERY", drivers.DRIVER_AGRI_ORDERS_QUERY,
+                 lambda s: (s["driver_id"], 'agricultural_product')),
+        HotQuery("drivers.OVERDUE_ORDERS_QUERY", drivers.OVERDUE_ORDERS_QUERY,
+                 lambda s: {"driver_id": s["driver_id"], **order_claim.STATUS_PARAMS}),
+        HotQuery("history_management.DRIVER_HISTORY_QUERY", history_management.DRIVER_HISTORY_QUERY,
+                 lambda s: (s["driver_id"], s["driver_id"])),
+        HotQuery("history_management.BUYER_HISTORY_QUERY", history_management.BUYER_HISTORY_QUERY,
+                 lambda s: (s["buyer_id"], s["buyer_id"])),
+        HotQuery("history_management.SELLER_HISTORY_QUERY", history_management.SELLER_HISTORY_QUERY,
+                 lambda s: (s["seller_id"], s["seller_id"])),
+        HotQuery("history_management.HISTORY_STATS_QUERY", history_management.HISTORY_STATS_QUERY),
+        HotQuery("order_claim.CLAIM_NECESSITIES_SQL", order_claim.CLAIM_NECESSITIES_SQL,
+                 claim_params('necessities', "open_order_id")),
+        HotQuery("order_claim.CLAIM_AGRICULTURAL_SQL", order_claim.CLAIM_AGRICULTURAL_SQL,
+                 claim_params('agricultural_product', "open_agri_order_id")),
+        HotQuery("order_claim.CLAIM_BATCH_SQL", order_claim.CLAIM_BATCH_SQL, lambda s: {
+            **order_claim.STATUS_PARAMS, "services": ['necessities', 'agricultural_product'],
+            "order_ids": [s["open_order_id"], s["open_agri_order_id"]], "driver_ids": [s["driver_id"], s["driver_id"]],
+        }),
+        HotQuery("order_state.transition_sql(necessities)", transition_sql('necessities', guard=['buyer_id']),
+                 cancel_params("open_order_id")),
+        HotQuery("order_state.transition_sql(agricultural_product)",
+                 transition_sql('agricultural_product', guard=['buyer_id']), cancel_params("open_agri_order_id")),
+        HotQuery("order_index.OPEN_ORDERS_QUERY", order_index.OPEN_ORDERS_QUERY),
+        HotQuery("dispatch.OPEN_ORDERS_SQL", dispatch.OPEN_ORDERS_SQL, lambda s: {"min_age": 120, "limit": 200}),
+        HotQuery("dispatch.AVAILABLE_DRIVERS_SQL", dispatch.AVAILABLE_DRIVERS_SQL,
+                 lambda s: {**order_claim.STATUS_PARAMS, "day": day, "slot_from": clock(8, 0), "slot_to": clock(12, 0)}),
+        HotQuery("route_planner.ACTIVE_ORDER_STOPS_QUERY", route_planner.ACTIVE_ORDER_STOPS_QUERY,
+                 lambda s: (s["driver_id"], s["driver_id"])),
+        HotQuery("availability.DAY_SLOTS_QUERY", availability.DAY_SLOTS_QUERY, lambda s: (day,)),
+        HotQuery("catalog_cache.CATALOG_QUERY", catalog_cache.CATALOG_QUERY, lambda s: (day,)),
+    ]
+    return queries
+
+
+def load_migrate():
+    # backend/database.py shadows the backend/database directory, so load the runner by path
+    spec = importlib.util.spec_from_file_location("migrate", os.path.join(SCHEMA_DIR, "migrate.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build(conn, scale: float):
+    """
+    Base schema, seed data, then every migration.
+
+    Raises:
+        RuntimeError: A migration failed; the plans would not match production.
+    """
+    migrate = load_migrate()
+    volumes = {name: max(1, int(count * scale)) for name, count in VOLUMES.items()}
+    cur = conn.cursor()
+    with open(os.path.join(SCHEMA_DIR, "createtable.sql"), encoding="utf-8") as f:
+        for statement in migrate.split_statements(f.read()):
+            cur.execute(statement)
+
+    started = time.perf_counter()
+    for statement in SEED_SQL:
+        cur.execute(statement, {**volumes, "places": PLACES})
+    print(f"Seeded {volumes['orders']} orders, {volumes['agri_orders']} agricultural orders and "
+          f"{volumes['users']} users in {time.perf_counter() - started:.1f}s")
+
+    for migration in migrate.load_migrations():
+        try:
+            for statement in migration.statements:
+                cur.execute(statement)
+            # Nobody else uses the scratch database, plain builds are fine
+            for index in migration.indexes:
+                cur.execute(index.create_sql(concurrently=False))
+        except psycopg2.Error as e:
+            conn.rollback()
+            raise RuntimeError(f"Migration {migration.label} failed: {str(e).strip().splitlines()[0]}") from e
+    conn.commit()
+
+    conn.autocommit = True
+    cur.execute("VACUUM ANALYZE")
+    conn.autocommit = False
+    cur.close()
+
+
+def load_samples(conn) -> Tuple[dict, dict]:
+    """
+    Sample parameters, and the row count of every table (partitions included).
+    """
+    cur = conn.cursor()
+    samples = {}
+    for name, sql in SAMPLES_SQL.items():
+        cur.execute(sql)
+        samples[name] = cur.fetchone()[0]
+    cur.execute("SELECT user_id FROM drivers WHERE id = %s", (samples["driver_id"],))
+    samples["driver_user_id"] = cur.fetchone()[0]
+    cur.execute("SELECT relname, reltuples::bigint FROM pg_class WHERE relkind = 'r'")
+    table_rows = dict(cur.fetchall())
+    cur.close()
+    conn.rollback()
+    return samples, table_rows
+
+
+def explain(conn, query: HotQuery, samples: dict) -> dict:
+    """
+    EXPLAIN (ANALYZE, BUFFERS) one statement in a transaction that is rolled back.
+    """
+    params = query.params(samples)
+    cur = conn.cursor()
+    try:
+        if query.prepared:
+            cur.execute("SET LOCAL plan_cache_mode = force_generic_plan")
+            cur.execute(f"PREPARE query_plan AS {query.sql}", ())
+            placeholders = ", ".join(["%s"] * len(params))
+            cur.execute(
+                "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) EXECUTE query_plan" + (f" ({placeholders})" if params else ""),
+                tuple(params)
+            )
+        else:
+            cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query.sql, params)
+        result = cur.fetchone()[0]
+    finally:
+        conn.rollback()
+        if query.prepared:
+            # Prepared statements outlive the rollback
+            cur.execute("DEALLOCATE ALL")
+            conn.commit()
+        cur.close()
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result[0]
+
+
+def walk(node: dict):
+    yield node
+    for child in node.get("Plans", []):
+        yield from walk(child)
+
+
+def node_label(node: dict, with_index: bool = True) -> str:
+    parts = [node["Node Type"]]
+    for key in ("Strategy", "Join Type", "Parent Relationship", "Subplan Name", "CTE Name"):
+        if node.get(key):
+            parts.append(f"{key.lower()}={node[key]}")
+    if node.get("Relation Name"):
+        parts.append(f"on {_PARTITION_RE.sub('_p*', node['Relation Name'])}")
+    if node.get("Index Name") and with_index:
+        parts.append(f"using {_PARTITION_RE.sub('_p*', node['Index Name'])}")
+    return " ".join(parts)
+
+
+def plan_shape(node: dict, depth: int = 0, with_index: bool = True) -> List[str]:
+    lines = ["  " * depth + node_label(node, with_index)]
+    blocks = []
+    for child in node.get("Plans", []):
+        # A month expected to return at most one row is planned at the estimate
+        # clamp, where indexes of that table tie; keep its node types only
+        member_tie = node["Node Type"] in ("Append", "Merge Append") and child.get("Plan Rows", 0) <= 1
+        block = plan_shape(child, depth + 1, with_index and not member_tie)
+        # The months of a partitioned table plan alike; count that shape once
+        if node["Node Type"] in ("Append", "Merge Append") and block in blocks:
+            continue
+        blocks.append(block)
+    if node["Node Type"] in ("Append", "Merge Append"):
+        # Which month gets which scan shifts with the current date; compare the set
+        blocks.sort()
+    for block in blocks:
+        lines.extend(block)
+    return lines
+
+
+def fingerprint(shape: List[str]) -> str:
+    return hashlib.sha1("\n".join(shape).encode()).hexdigest()[:12]
+
+
+def find_problems(root: dict, table_rows: dict, args) -> Dict[str, str]:
+    """
+    finding key (stable between runs, stored in the baseline) -> details
+    """
+    problems = {}
+    for node in walk(root):
+        relation = node.get("Relation Name")
+        if node["Node Type"] == "Seq Scan" and relation and table_rows.get(relation, 0) >= args.large_table_rows:
+            problems[f"seq scan on {_PARTITION_RE.sub('_p*', relation)}"] = f"{table_rows[relation]} rows"
+        if not node.get("Actual Loops"):
+            continue  # never executed
+        actual, estimated = node.get("Actual Rows", 0), node.get("Plan Rows", 0)
+        high, low = max(actual, estimated), max(min(actual, estimated), 1)
+        if high >= args.estimate_min_rows and high / low >= args.estimate_factor:
+            problems[f"row estimate off at {node_label(node)}"] = (
+                f"estimated {estimated}, actual {actual} ({high / low:.0f}x)"
+            )
+    return problems
+
+
+def load_baseline(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def check(conn, query: HotQuery, samples: dict, table_rows: dict, baseline: Optional[dict], args) -> Optional[dict]:
+    try:
+        explain(conn, query, samples)  # warm the cache
+        result = explain(conn, query, samples)
+    except psycopg2.Error as e:
+        print(f"{query.name:<50} ❌ {str(e).strip().splitlines()[0]}")
+        return None
+
+    root = result["Plan"]
+    shape = plan_shape(root)
+    entry = {"fingerprint": fingerprint(shape), "shape": shape}
+    problems = find_problems(root, table_rows, args)
+    entry["findings"] = sorted(problems)
+
+    buffers = root.get("Shared Hit Blocks", 0) + root.get("Shared Read Blocks", 0)
+    if baseline is None:
+        status = "new"
+    elif baseline["fingerprint"] != entry["fingerprint"]:
+        status = "PLAN CHANGED"
+    elif set(entry["findings"]) - set(baseline.get("findings", [])):
+        status = "NEW FINDINGS"
+    else:
+        status = "ok"
+    entry["status"] = status
+    print(f"{query.name:<50} {result['Execution Time']:>9.2f}ms {buffers:>8} buf  {entry['fingerprint']}  {status}")
+    for key, details in sorted(problems.items()):
+        known = baseline is not None and key in baseline.get("findings", [])
+        print(f"    {'·' if known else '⚠️ '} {key}: {details}")
+    if status == "PLAN CHANGED":
+        for line in difflib.unified_diff(baseline["shape"], shape, "stored", "current", lineterm="", n=1):
+            print(f"    {line}")
+    return entry
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for the seeded row counts")
+    parser.add_argument("--only", nargs="+", default=[], help="check only queries whose name contains one of these")
+    parser.add_argument("--large-table-rows", type=int, default=10000)
+    parser.add_argument("--estimate-factor", type=float, default=10.0)
+    parser.add_argument("--estimate-min-rows", type=int, default=100)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--update", action="store_true", help="store the current plans as the baseline")
+    parser.add_argument("--keep", action="store_true", help=f"keep the scratch database {DATABASE}")
+    args = parser.parse_args()
+
+    ok = True
+    uncovered = sorted(set(registry.statements) - set(PREPARED_PARAMS))
+    for name in uncovered:
+        print(f"❌ Prepared statement {name} has no sample parameters in PREPARED_PARAMS")
+        ok = False
+    queries = [q for q in hot_queries() if not args.only or any(part in q.name for part in args.only)]
+    if not args.update and not os.path.exists(args.baseline):
+        print(f"❌ No baseline at {args.baseline}: run with --update against a real database, review and commit it")
+        raise SystemExit(1)
+    baseline = load_baseline(args.baseline)
+
+    admin = psycopg2.connect(database_url)
+    admin.autocommit = True
+    admin_cur = admin.cursor()
+    admin_cur.execute(f"CREATE DATABASE {DATABASE}")
+    entries = {}
+    try:
+        conn = psycopg2.connect(make_dsn(database_url, dbname=DATABASE))
+        try:
+            try:
+                build(conn, args.scale)
+            except RuntimeError as e:
+                print(f"❌ {str(e)}")
+                raise SystemExit(1)
+            samples, table_rows = load_samples(conn)
+            print(f"{'query':<50} {'time':>11} {'buffers':>12}  {'plan':<12}  status")
+            for query in queries:
+                entry = check(conn, query, samples, table_rows, baseline.get(query.name), args)
+                if entry is None:
+                    ok = False
+                    continue
+                entries[query.name] = entry
+        finally:
+            conn.close()
+    finally:
+        if not args.keep:
+            admin_cur.execute(f"DROP DATABASE IF EXISTS {DATABASE}")
+        admin_cur.close()
+        admin.close()
+
+    regressions = [name for name, entry in entries.items() if entry["status"] in ("PLAN CHANGED", "NEW FINDINGS")]
+    if args.update:
+        # A full run also forgets queries that no longer exist
+        stored = {} if not args.only else baseline
+        stored.update({
+            name: {key: entry[key] for key in ("fingerprint", "shape", "findings")}
+            for name, entry in entries.items()
+        })
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(stored, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"✅ Stored {len(entries)} plans in {args.baseline}")
+    elif regressions:
+        print(f"❌ {len(regressions)} plan regressions: {', '.join(regressions)} (review, then --update)")
+        ok = False
+    new = [name for name, entry in entries.items() if entry["status"] == "new"]
+    if new and not args.update:
+        print(f"⚠️  {len(new)} queries have no stored plan yet; record them with --update")
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmark for the multi-stop route planner.
+
+Random driver workloads (orders with one or two pickups and a delivery,
+scattered over a ~10 km square) are planned with services.route_planner and
+compared with the order a driver would follow without planning: each
+order's pickups and delivery in acceptance order. No database is needed.
+
+Usage:
+    python -m backend.benchmarks.route_planner --stops 5 10 20 50 --runs 50
+
+Checks:
+- every plan visits each stop once, with pickups before their delivery
+- a cached plan is returned while the order set is unchanged
+"""
+import argparse
+import random
+import statistics
+import time
+
+import numpy as np
+
+from backend.services.route_planner import Stop, RouteCache, plan_route, distance_matrix
+
+CENTER = (25.0330, 121.5654)
+SPREAD_DEGREES = 0.09
+
+
+def make_stops(stop_count: int, rng: random.Random):
+    stops = []
+    order_id = 0
+    while len(stops) < stop_count:
+        order_id += 1
+        service = 'necessities' if rng.random() < 0.7 else 'agricultural_product'
+        pickups = 1 if service == 'agricultural_product' else rng.choice((1, 1, 2))
+        pickups = min(pickups, stop_count - len(stops) - 1)
+        for kind in ['pickup'] * pickups + ['delivery']:
+            lat = CENTER[0] + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES) / 2
+            lng = CENTER[1] + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES) / 2
+            stops.append(Stop(service, order_id, kind, f"{lat:.5f},{lng:.5f}", lat, lng))
+    return stops
+
+
+def path_km(stops, start) -> float:
+    coords = np.array([start] + [(stop.lat, stop.lng) for stop in stops])
+    dist = distance_matrix(coords)
+    return float(sum(dist[i, i + 1] for i in range(len(stops))))
+
+
+def valid(plan, stops) -> bool:
+    if sorted(map(id, plan.stops)) != sorted(map(id, stops)):
+        return False
+    delivered = set()
+    for stop in plan.stops:
+        if stop.kind == 'delivery':
+            delivered.add(stop.order_key)
+        elif stop.order_key in delivered:
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stops", type=int, nargs="+", default=[5, 10, 20, 30, 50])
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    ok = True
+    print(f"{'stops':>5} {'mean ms':>8} {'p95 ms':>7} {'max ms':>7} {'naive km':>9} {'planned km':>11} {'saved':>6}")
+    for stop_count in args.stops:
+        timings, naive, planned = [], [], []
+        for _ in range(args.runs):
+            stops = make_stops(stop_count, rng)
+            start = (CENTER[0] + rng.uniform(-0.03, 0.03), CENTER[1] + rng.uniform(-0.03, 0.03))
+            started = time.perf_counter()
+            plan = plan_route(stops, start)
+            timings.append((time.perf_counter() - started) * 1000)
+            ok &= valid(plan, stops)
+            naive.append(path_km(stops, start))
+            planned.append(plan.total_km)
+        timings.sort()
+        p95 = timings[max(0, int(len(timings) * 0.95) - 1)]
+        saved = 1 - statistics.mean(planned) / statistics.mean(naive)
+        print(f"{stop_count:>5} {statistics.mean(timings):>8.2f} {p95:>7.2f} {timings[-1]:>7.2f} "
+              f"{statistics.mean(naive):>9.1f} {statistics.mean(planned):>11.1f} {saved:>6.0%}")
+
+    # Cache: unchanged rows return the stored plan
+    cache = RouteCache()
+    rows = [('necessities', 1, '接單', '25.03,121.56', ['25.04,121.55']),
+            ('agricultural_product', 2, '配送中', '25.02,121.57', ['25.05,121.54'])]
+    first, cached_first = cache.get(1, rows, CENTER)
+    second, cached_second = cache.get(1, rows, CENTER)
+    ok &= not cached_first and cached_second and first is second and len(first.stops) == 3
+    print(f"valid plans and cache: {'ok' if ok else 'FAILED'}")
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
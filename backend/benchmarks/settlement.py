@@ -0,0 +1,249 @@
+"""
+Benchmark for daily driver settlement: the set-based engine
+(services.settlement.settle_range) versus the previous per-driver loop
+(SELECT every order, sum in Python, three INSERTs per driver).
+
+Runs in a throw-away schema with the orders / payments / driver_payouts /
+ledger_entries / settlement_checkpoints columns the settlement uses, so it is
+safe against a development database.
+
+Usage:
+    DATABASE_URL=... python -m backend.benchmarks.settlement --drivers 10000 --orders-per-driver 5 --days 3
+
+Checks:
+- sum of payouts == sum of escrowed payments delivered in the window
+- escrow and wallet legs cancel out and the wallet legs equal the payouts
+- a second run of the engine posts no ledger entries (idempotent)
+- account_balances matches the raw ledger entries
+"""
+import argparse
+import os
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from backend.database import create_connection_with_keepalive
+from backend.services.ledger import verify_balances
+from backend.services.settlement import settle_range, day_bounds, local_today
+
+SCHEMA = f"bench_settlement_{os.getpid()}"
+
+
+def setup(conn, drivers: int, orders_per_driver: int, days: int, first):
+    cur = conn.cursor()
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+    cur.execute(f"SET search_path TO {SCHEMA}")
+    cur.execute("""
+        CREATE TABLE orders (
+            id SERIAL PRIMARY KEY,
+            driver_id INT,
+            delivery_status VARCHAR(20) NOT NULL,
+            delivered_at TIMESTAMPTZ
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE payments (
+            id SERIAL PRIMARY KEY,
+            order_id INT UNIQUE NOT NULL,
+            amount NUMERIC(12, 2) NOT NULL,
+            status VARCHAR(30) NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE driver_payouts (
+            id BIGSERIAL PRIMARY KEY,
+            driver_id INT NOT NULL,
+            settle_date DATE NOT NULL,
+            amount NUMERIC(12, 2) NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'SCHEDULED',
+            UNIQUE (driver_id, settle_date)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE ledger_entries (
+            id BIGSERIAL PRIMARY KEY,
+            ref_type VARCHAR(20) NOT NULL,
+            ref_id BIGINT NOT NULL,
+            account VARCHAR(30) NOT NULL,
+            owner_id INT NOT NULL DEFAULT 0,
+            delta NUMERIC(14, 2) NOT NULL,
+            currency VARCHAR(3) NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE account_balances (
+            account VARCHAR(30) NOT NULL,
+            owner_id INT NOT NULL DEFAULT 0,
+            currency VARCHAR(3) NOT NULL DEFAULT 'TWD',
+            balance NUMERIC(14, 2) NOT NULL DEFAULT 0,
+            entries BIGINT NOT NULL DEFAULT 0,
+            last_entry_id BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (account, owner_id, currency)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE settlement_checkpoints (
+            settle_date DATE PRIMARY KEY,
+            drivers INT NOT NULL,
+            total_amount NUMERIC(14, 2) NOT NULL,
+            settled_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """)
+    start, _ = day_bounds(first, first)
+    # Deliveries spread over the window; every 10th order is not escrowed
+    cur.execute("""
+        INSERT INTO orders (driver_id, delivery_status, delivered_at)
+        SELECT 1 + (n %% %s), 'DELIVERED', %s + ((n %% (%s * 24)) * interval '1 hour') + interval '17 minutes'
+        FROM generate_series(0, %s - 1) AS n
+    """, (drivers, start, days, drivers * orders_per_driver))
+    cur.execute("""
+        INSERT INTO payments (order_id, amount, status)
+        SELECT id, 50 + (id %% 400), CASE WHEN id %% 10 = 0 THEN 'REFUNDED' ELSE 'PAID_ESCROW' END
+        FROM orders
+    """)
+    cur.execute("CREATE INDEX ON orders (delivered_at) WHERE delivery_status = 'DELIVERED'")
+    cur.execute("CREATE INDEX ON ledger_entries (ref_type, ref_id, account)")
+    cur.execute("""
+        CREATE TABLE ledger_snapshots (
+            id BIGSERIAL PRIMARY KEY, snapshot_at TIMESTAMPTZ NOT NULL, last_entry_id BIGINT NOT NULL,
+            account VARCHAR(30) NOT NULL, owner_id INT NOT NULL DEFAULT 0, currency VARCHAR(3) NOT NULL,
+            balance NUMERIC(14, 2) NOT NULL, entries BIGINT NOT NULL
+        )
+    """)
+    cur.execute("ANALYZE")
+    conn.commit()
+    cur.close()
+
+
+def reset(conn):
+    cur = conn.cursor()
+    cur.execute("TRUNCATE driver_payouts, ledger_entries, account_balances, settlement_checkpoints")
+    conn.commit()
+    cur.close()
+
+
+def legacy_settle(conn, first, last):
+    """
+    The previous implementation, one day at a time.
+    """
+    cur = conn.cursor()
+    day = first
+    while day <= last:
+        start, end = day_bounds(day, day)
+        cur.execute("""
+            SELECT o.id, o.driver_id, p.amount
+            FROM orders o
+            JOIN payments p ON p.order_id = o.id
+            WHERE o.delivery_status='DELIVERED'
+              AND o.delivered_at >= %s AND o.delivered_at < %s
+              AND p.status='PAID_ESCROW'
+        """, (start, end))
+        sums = defaultdict(lambda: 0.0)
+        for oid, did, amt in cur.fetchall():
+            sums[did] += float(amt)
+        for driver_id, total in sums.items():
+            cur.execute("""
+              INSERT INTO driver_payouts(driver_id, settle_date, amount, status)
+              VALUES (%s, %s, %s, 'SCHEDULED')
+              ON CONFLICT (driver_id, settle_date)
+              DO UPDATE SET amount=EXCLUDED.amount, status='SCHEDULED'
+              RETURNING id
+            """, (driver_id, day, total))
+            payout_id = cur.fetchone()[0]
+            cur.execute("""INSERT INTO ledger_entries(ref_type, ref_id, account, delta, currency)
+                           VALUES ('PAYOUT', %s, 'PLATFORM_ESCROW', %s, 'TWD')""", (payout_id, -total))
+            cur.execute("""INSERT INTO ledger_entries(ref_type, ref_id, account, delta, currency)
+                           VALUES ('PAYOUT', %s, 'DRIVER_WALLET', %s, 'TWD')""", (payout_id, total))
+        conn.commit()
+        day += timedelta(days=1)
+    cur.close()
+
+
+def check(conn, first, last) -> bool:
+    start, end = day_bounds(first, last)
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT COALESCE(SUM(p.amount), 0) FROM orders o JOIN payments p ON p.order_id = o.id
+        WHERE o.delivery_status = 'DELIVERED' AND o.delivered_at >= %s AND o.delivered_at < %s
+          AND p.status = 'PAID_ESCROW'
+    """, (start, end))
+    expected = cur.fetchone()[0]
+    cur.execute("SELECT COALESCE(SUM(amount), 0) FROM driver_payouts")
+    payouts = cur.fetchone()[0]
+    cur.execute("SELECT COALESCE(SUM(delta), 0), COALESCE(SUM(delta) FILTER (WHERE account = 'DRIVER_WALLET'), 0) FROM ledger_entries")
+    ledger_sum, wallet = cur.fetchone()
+    conn.commit()
+    cur.close()
+    ok = expected == payouts == wallet and ledger_sum == 0
+    print(f"  escrowed={expected} payouts={payouts} wallet_legs={wallet} ledger_sum={ledger_sum} consistent={ok}")
+    return ok
+
+
+def check_balances(conn) -> bool:
+    mismatches = verify_balances(conn)
+    print(f"  account_balances mismatches={len(mismatches)}")
+    return not mismatches
+
+
+def count_ledger(conn) -> int:
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM ledger_entries")
+    count = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    return count
+
+
+def run(drivers: int, orders_per_driver: int, days: int, chunk_days: int) -> bool:
+    first = local_today() - timedelta(days=days)
+    last = first + timedelta(days=days - 1)
+    conn = create_connection_with_keepalive()
+    try:
+        setup(conn, drivers, orders_per_driver, days, first)
+        print(f"drivers={drivers} orders={drivers * orders_per_driver} days={days} ({first}..{last})")
+
+        started = time.perf_counter()
+        legacy_settle(conn, first, last)
+        legacy = time.perf_counter() - started
+        print(f"legacy per-driver loop: {legacy * 1000:.0f}ms")
+        ok = check(conn, first, last)
+        reset(conn)
+
+        started = time.perf_counter()
+        result = settle_range(conn, first, last, chunk_days=chunk_days)
+        engine = time.perf_counter() - started
+        print(f"set-based engine:       {engine * 1000:.0f}ms ({result.chunks} chunks, "
+              f"{result.ledger_entries} ledger entries, {legacy / engine:.1f}x faster)")
+        ok = check(conn, first, last) and check_balances(conn) and ok
+
+        before = count_ledger(conn)
+        started = time.perf_counter()
+        rerun = settle_range(conn, first, last, chunk_days=chunk_days)
+        elapsed = time.perf_counter() - started
+        idempotent = rerun.ledger_entries == 0 and count_ledger(conn) == before
+        print(f"rerun:                  {elapsed * 1000:.0f}ms, {rerun.ledger_entries} new ledger entries, idempotent={idempotent}")
+        return ok and idempotent
+    finally:
+        conn.rollback()
+        cur = conn.cursor()
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.commit()
+        cur.close()
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drivers", type=int, default=10000)
+    parser.add_argument("--orders-per-driver", type=int, default=5)
+    parser.add_argument("--days", type=int, default=3)
+    parser.add_argument("--chunk-days", type=int, default=7)
+    args = parser.parse_args()
+    ok = run(args.drivers, args.orders_per_driver, args.days, args.chunk_days)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
 import os
+import threading
+import time
+from contextvars import ContextVar
 import psycopg2
 from psycopg2 import pool
 from dotenv import load_dotenv
@@ -11,8 +14,43 @@ logger = logging.getLogger(__name__)
 # Fetch the DATABASE_URL from environment variables
 database_url = os.environ.get('DATABASE_URL')
 
-# Connection pool
+# Optional streaming replica for reads (see get_read_connection)
+replica_database_url = os.environ.get('REPLICA_DATABASE_URL')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_LAG_CHECK_SECONDS = float(os.environ.get('REPLICA_LAG_CHECK_SECONDS', '2'))
+# After a write, the client's reads stay on the primary this long (read-your-writes)
+REPLICA_STICKY_SECONDS = float(os.environ.get(
+    'REPLICA_STICKY_SECONDS', str(REPLICA_MAX_LAG_SECONDS + REPLICA_LAG_CHECK_SECONDS)
+))
+
+# Connection pools
 connection_pool = None
+replica_pool = None
+
+# Set per request by the routing middleware in main.py; everything else
+# (scheduler jobs, cache rebuilds, scripts) reads from the primary
+_replica_reads = ContextVar('replica_reads', default=False)
+
+# A server that is not in recovery (e.g. a second plain Postgres standing in
+# for the replica in local testing) reports no lag
+REPLICA_LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+class PooledConnection(psycopg2.extensions.connection):
+    """
+    Connection that remembers which server-side prepared statements exist
+    in its session (see backend/services/prepared_statements.py) and
+    whether it belongs to the replica pool.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+        self.replica = False
 
 def create_connection_with_keepalive():
     """
@@ -20,6 +58,7 @@ def create_connection_with_keepalive():
     """
     conn = psycopg2.connect(
         database_url,
+        connection_factory=PooledConnection,
         keepalives=1,  # Enable TCP keepalive
         keepalives_idle=30,  # Start keepalive after 30 seconds of idle
         keepalives_interval=10,  # Send keepalive every 10 seconds
@@ -27,27 +66,66 @@ def create_connection_with_keepalive():
     )
     return conn
 
+def _ping(conn):
+    """
+    Check that a connection is alive with `SELECT 1` outside a transaction,
+    so it is handed out idle (callers such as the prepared statement registry
+    look at the transaction status).
+    """
+    conn.autocommit = True
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+        cursor.close()
+    finally:
+        conn.autocommit = False
+
 def init_connection_pool():
     """
     Initialize the database connection pool.
-    Note: SimpleConnectionPool doesn't support connection factory, so keepalive
-    is applied when connections are created in fallback scenarios or when
-    connections are dead and need to be recreated.
+    Note: keepalive is applied when connections are created in fallback
+    scenarios or when connections are dead and need to be recreated.
+    Pooled connections use PooledConnection so prepared statements can be
+    tracked per session.
     """
     global connection_pool
     try:
-        # SimpleConnectionPool doesn't accept connection parameters directly
+        # Extra keyword arguments are passed to psycopg2.connect for every pooled connection
         # We'll validate connections when getting them from the pool and apply
         # keepalive settings when creating new connections in fallback scenarios
         connection_pool = psycopg2.pool.SimpleConnectionPool(
             minconn=1,
             maxconn=20,  # Maximum 20 connections
-            dsn=database_url
+            dsn=database_url,
+            connection_factory=PooledConnection
         )
         logger.info("✅ Database connection pool initialized")
     except Exception as e:
         logger.error(f"❌ Failed to initialize connection pool: {str(e)}")
         raise
+    init_replica_pool()
+
+def init_replica_pool():
+    """
+    Initialize the read replica pool when REPLICA_DATABASE_URL is set.
+    A replica that can't be reached is logged and reads stay on the primary.
+    """
+    global replica_pool
+    if not replica_database_url:
+        return
+    try:
+        replica_pool = psycopg2.pool.SimpleConnectionPool(
+            minconn=1,
+            maxconn=int(os.environ.get('REPLICA_POOL_MAX', '20')),
+            dsn=replica_database_url,
+            connection_factory=PooledConnection
+        )
+        logger.info("✅ Replica connection pool initialized")
+    except Exception as e:
+        replica_pool = None
+        replica_monitor.mark_unavailable(str(e))
+        logger.error(f"❌ Failed to initialize replica pool, reads use the primary: {str(e)}")
 
 def get_db_connection():
     """
@@ -70,12 +148,7 @@ def get_db_connection():
             conn = connection_pool.getconn()
             # Validate connection is still alive with timeout
             try:
-                # Set a timeout for the validation query (5 seconds)
-                conn.set_session(autocommit=False)
-                cursor = conn.cursor()
-                cursor.execute("SELECT 1")
-                cursor.fetchone()
-                cursor.close()
+                _ping(conn)
                 return conn
             except (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.DatabaseError) as e:
                 # Connection is dead, close it
@@ -117,15 +190,142 @@ def get_db_connection():
     # Final fallback
     return create_connection_with_keepalive()
 
+class ReplicaMonitor:
+    """
+    Tracks whether the replica is reachable and close enough to the primary.
+    Replication lag is measured on a replica connection at most once per
+    REPLICA_LAG_CHECK_SECONDS; in between, the last result is reused.
+    """
+
+    def __init__(self, max_lag_seconds: float = REPLICA_MAX_LAG_SECONDS,
+                 check_interval_seconds: float = REPLICA_LAG_CHECK_SECONDS):
+        self.max_lag_seconds = max_lag_seconds
+        self.check_interval_seconds = check_interval_seconds
+        self.lag_seconds = None
+        self.healthy = True
+        self.error = None
+        self.checked_at = None
+        self.replica_reads = 0
+        self.primary_fallbacks = 0
+        self._lock = threading.Lock()
+
+    def check_due(self) -> bool:
+        return self.checked_at is None or time.monotonic() - self.checked_at >= self.check_interval_seconds
+
+    def measure(self, conn) -> bool:
+        """
+        Measure lag on a replica connection; returns whether reads may use it.
+        """
+        with self._lock:
+            if not self.check_due():
+                return self.healthy
+            self.checked_at = time.monotonic()
+        cur = conn.cursor()
+        try:
+            cur.execute(REPLICA_LAG_QUERY)
+            lag = float(cur.fetchone()[0] or 0)
+        finally:
+            cur.close()
+        conn.rollback()
+        healthy = lag <= self.max_lag_seconds
+        if healthy != self.healthy:
+            logger.warning(f"Replica lag {lag:.1f}s, reads {'back on replica' if healthy else 'moved to primary'}")
+        self.lag_seconds, self.healthy, self.error = lag, healthy, None
+        return healthy
+
+    def mark_unavailable(self, error: str):
+        self.checked_at = time.monotonic()
+        self.healthy = False
+        self.error = error
+
+    def snapshot(self) -> dict:
+        return {
+            "configured": bool(replica_database_url),
+            "healthy": replica_pool is not None and self.healthy,
+            "lag_seconds": self.lag_seconds,
+            "max_lag_seconds": self.max_lag_seconds,
+            "error": self.error,
+            "replica_reads": self.replica_reads,
+            "primary_fallbacks": self.primary_fallbacks
+        }
+
+replica_monitor = ReplicaMonitor()
+
+def route_reads_to_replica(enabled: bool):
+    """
+    Allow (or forbid) get_read_connection to use the replica in the current
+    request context. Returns a token for reset_read_routing.
+    """
+    return _replica_reads.set(enabled)
+
+def reset_read_routing(token):
+    _replica_reads.reset(token)
+
+def get_read_connection():
+    """
+    Get a connection for read-only work.
+    Uses the replica only when the current request was marked replica-safe
+    (a GET from a client that hasn't written recently), the replica pool is
+    up and its lag is within REPLICA_MAX_LAG_SECONDS; otherwise returns a
+    primary connection from get_db_connection.
+    Return it with return_db_connection like any other connection.
+    """
+    if replica_pool is None or not _replica_reads.get():
+        return get_db_connection()
+    if not replica_monitor.healthy and not replica_monitor.check_due():
+        replica_monitor.primary_fallbacks += 1
+        return get_db_connection()
+
+    conn = None
+    try:
+        conn = replica_pool.getconn()
+        if not conn.replica:
+            conn.replica = True
+            conn.set_session(readonly=True, autocommit=False)
+        if replica_monitor.check_due():
+            usable = replica_monitor.measure(conn)
+        else:
+            _ping(conn)
+            usable = replica_monitor.healthy
+        if usable:
+            replica_monitor.replica_reads += 1
+            return conn
+        return_db_connection(conn)
+    except Exception as e:
+        logger.warning(f"Replica connection failed, reading from primary: {str(e)}")
+        replica_monitor.mark_unavailable(str(e))
+        if conn is not None:
+            try:
+                replica_pool.putconn(conn, close=True)
+            except Exception:
+                pass
+    replica_monitor.primary_fallbacks += 1
+    return get_db_connection()
+
 def return_db_connection(conn):
     """
-    Return a connection to the pool.
+    Return a connection to the pool it came from.
     Always ensures connection is closed if pool return fails.
     """
     global connection_pool
     
     if conn is None:
         return
+
+    if getattr(conn, 'replica', False):
+        try:
+            if replica_pool is not None and conn.closed == 0:
+                conn.rollback()
+                replica_pool.putconn(conn)
+            else:
+                conn.close()
+        except Exception as e:
+            logger.error(f"Error returning replica connection: {str(e)}")
+            try:
+                conn.close()
+            except:
+                pass
+        return
     
     if connection_pool is None:
         # If pool not initialized, just close the connection
@@ -162,10 +362,18 @@ def return_db_connection(conn):
 
 def close_connection_pool():
     """
-    Close all connections in the pool.
+    Close all connections in the pools.
     """
-    global connection_pool
+    global connection_pool, replica_pool
     
+    if replica_pool is not None:
+        try:
+            replica_pool.closeall()
+        except Exception as e:
+            logger.error(f"Error closing replica pool: {str(e)}")
+        finally:
+            replica_pool = None
+
     if connection_pool is not None:
         try:
             connection_pool.closeall()
@@ -0,0 +1,20 @@
+-- Migration script for catalog search indexes
+-- Indexes backing GET /api/consumer/search (catalog search and keyset paging).
+
+-- Trigram extension for substring (ILIKE '%q%') and fuzzy (name % q) name search
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Name search
+CREATE INDEX IF NOT EXISTS idx_agri_produce_name_trgm ON agricultural_produce USING gin (name gin_trgm_ops);
+
+-- On-sale filter (off_shelf_date >= today), also used by GET /api/consumer/
+CREATE INDEX IF NOT EXISTS idx_agri_produce_off_shelf_date ON agricultural_produce (off_shelf_date);
+
+-- Keyset paging per sort option: ORDER BY <column>, id
+CREATE INDEX IF NOT EXISTS idx_agri_produce_upload_date_id ON agricultural_produce (upload_date, id);
+CREATE INDEX IF NOT EXISTS idx_agri_produce_price_id ON agricultural_produce (price, id);
+CREATE INDEX IF NOT EXISTS idx_agri_produce_name_id ON agricultural_produce (name, id);
+
+-- Category filter combined with price sort / range
+CREATE INDEX IF NOT EXISTS idx_agri_produce_category_price_id ON agricultural_produce (category, price, id);
+CREATE INDEX IF NOT EXISTS idx_agri_produce_category_upload_date_id ON agricultural_produce (category, upload_date, id);
@@ -0,0 +1,20 @@
+-- Migration script to create idempotency_keys table
+-- Run this SQL script in your PostgreSQL database to enable Idempotency-Key support
+-- (POST /api/orders/, POST /api/consumer/order, POST /api/payments/intent)
+
+-- idempotency_keys table
+-- One row per (endpoint scope, client key); stores the response to replay on retry
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    id BIGSERIAL PRIMARY KEY,
+    scope VARCHAR(50) NOT NULL,
+    idempotency_key VARCHAR(255) NOT NULL,
+    request_hash CHAR(64) NOT NULL,
+    response_status INT,
+    response_body JSONB,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    expires_at TIMESTAMPTZ NOT NULL,
+    CONSTRAINT unique_idempotency_key UNIQUE(scope, idempotency_key)
+);
+
+-- Index for the background sweep of expired keys
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys(expires_at);
@@ -0,0 +1,70 @@
+-- Migration script for the set-based settlement engine (backend/services/settlement.py)
+-- Run this SQL script in your PostgreSQL database before enabling the daily settlement job
+-- Also creates what settlement reads and the payments router writes, for
+-- databases built from createtable.sql (no-ops where they already exist)
+
+-- orders: assigned driver, delivery and payment state
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS driver_id INT REFERENCES drivers(id);
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS delivery_status VARCHAR(20);
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS delivered_at TIMESTAMPTZ;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS payment_status VARCHAR(20) NOT NULL DEFAULT 'UNPAID';
+
+-- payments: one payment per order (backend/routers/payments.py)
+-- order_id has no foreign key: 0010 rebuilds orders as a partitioned table
+CREATE TABLE IF NOT EXISTS payments (
+    id SERIAL PRIMARY KEY,
+    order_id INT NOT NULL UNIQUE,
+    method_code VARCHAR(20) NOT NULL,
+    amount NUMERIC(12, 2) NOT NULL,
+    currency VARCHAR(3) NOT NULL DEFAULT 'TWD',
+    status VARCHAR(30) NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS payment_proofs (
+    id SERIAL PRIMARY KEY,
+    payment_id INT NOT NULL REFERENCES payments(id) ON DELETE CASCADE,
+    image_url TEXT NOT NULL,
+    note TEXT,
+    uploaded_by INT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- ledger_entries: append-only postings (backend/services/ledger.py)
+CREATE TABLE IF NOT EXISTS ledger_entries (
+    id BIGSERIAL PRIMARY KEY,
+    ref_type VARCHAR(20) NOT NULL,
+    ref_id BIGINT NOT NULL,
+    account VARCHAR(30) NOT NULL,
+    delta NUMERIC(14, 2) NOT NULL,
+    currency VARCHAR(3) NOT NULL DEFAULT 'TWD'
+);
+
+-- driver_payouts: one payout per driver per settlement date
+CREATE TABLE IF NOT EXISTS driver_payouts (
+    id BIGSERIAL PRIMARY KEY,
+    driver_id INT NOT NULL REFERENCES drivers(id),
+    settle_date DATE NOT NULL,
+    amount NUMERIC(12, 2) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'SCHEDULED',
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- ON CONFLICT (driver_id, settle_date) target, for tables created before this script
+CREATE UNIQUE INDEX IF NOT EXISTS idx_driver_payouts_driver_date ON driver_payouts(driver_id, settle_date);
+CREATE INDEX IF NOT EXISTS idx_driver_payouts_settle_date ON driver_payouts(settle_date);
+
+-- settlement_checkpoints: one row per settled date (backfill resume point and daily totals)
+CREATE TABLE IF NOT EXISTS settlement_checkpoints (
+    settle_date DATE PRIMARY KEY,
+    drivers INT NOT NULL,
+    total_amount NUMERIC(14, 2) NOT NULL,
+    settled_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Candidate orders for a settlement window
+CREATE INDEX IF NOT EXISTS idx_orders_delivered_at ON orders(delivered_at) WHERE delivery_status = 'DELIVERED';
+
+-- Already-posted amount per payout leg
+CREATE INDEX IF NOT EXISTS idx_ledger_entries_ref ON ledger_entries(ref_type, ref_id, account);
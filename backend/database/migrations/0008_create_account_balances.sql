@@ -0,0 +1,48 @@
+-- Migration script for materialized ledger balances (backend/services/ledger.py)
+-- Runs after 0007_create_settlement_tables.sql
+
+-- ledger_entries: owner of the account (driver id for DRIVER_WALLET, 0 for platform accounts)
+ALTER TABLE ledger_entries ADD COLUMN IF NOT EXISTS owner_id INT NOT NULL DEFAULT 0;
+ALTER TABLE ledger_entries ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+
+UPDATE ledger_entries le
+SET owner_id = dp.driver_id
+FROM driver_payouts dp
+WHERE le.ref_type = 'PAYOUT' AND le.account = 'DRIVER_WALLET' AND le.ref_id = dp.id AND le.owner_id = 0;
+
+-- Per-account history (snapshot verification, point-in-time balances)
+CREATE INDEX IF NOT EXISTS idx_ledger_entries_account_owner ON ledger_entries(account, owner_id, currency, id);
+
+-- account_balances: running balance per account, updated in the same statement as each posting
+CREATE TABLE IF NOT EXISTS account_balances (
+    account VARCHAR(30) NOT NULL,
+    owner_id INT NOT NULL DEFAULT 0,
+    currency VARCHAR(3) NOT NULL DEFAULT 'TWD',
+    balance NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    entries BIGINT NOT NULL DEFAULT 0,
+    last_entry_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (account, owner_id, currency)
+);
+
+-- Initial balances from the existing history
+INSERT INTO account_balances (account, owner_id, currency, balance, entries, last_entry_id, updated_at)
+SELECT account, owner_id, currency, SUM(delta), COUNT(*), MAX(id), NOW()
+FROM ledger_entries
+GROUP BY account, owner_id, currency
+ON CONFLICT (account, owner_id, currency) DO NOTHING;
+
+-- ledger_snapshots: balances as of last_entry_id, one row per account changed since the previous snapshot
+CREATE TABLE IF NOT EXISTS ledger_snapshots (
+    id BIGSERIAL PRIMARY KEY,
+    snapshot_at TIMESTAMPTZ NOT NULL,
+    last_entry_id BIGINT NOT NULL,
+    account VARCHAR(30) NOT NULL,
+    owner_id INT NOT NULL DEFAULT 0,
+    currency VARCHAR(3) NOT NULL DEFAULT 'TWD',
+    balance NUMERIC(14, 2) NOT NULL,
+    entries BIGINT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_ledger_snapshots_account_time ON ledger_snapshots(account, owner_id, currency, snapshot_at DESC);
+CREATE INDEX IF NOT EXISTS idx_ledger_snapshots_snapshot_at ON ledger_snapshots(snapshot_at);
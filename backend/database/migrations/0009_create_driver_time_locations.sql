@@ -0,0 +1,30 @@
+-- Migration script for the driver availability index (backend/services/availability.py)
+-- Run this SQL script in your PostgreSQL (13+) database; it backfills existing driver_time rows
+
+-- driver_time_locations: one row per place in a slot's free-text locations, normalized
+CREATE TABLE IF NOT EXISTS driver_time_locations (
+    slot_id INT NOT NULL REFERENCES driver_time(id) ON DELETE CASCADE,
+    date DATE NOT NULL,
+    start_time TIME,
+    location_key VARCHAR(255) NOT NULL,
+    PRIMARY KEY (slot_id, location_key)
+);
+
+-- "Who drives to <place> on <date>": equality on date, prefix range on location_key
+CREATE INDEX IF NOT EXISTS idx_driver_time_locations_lookup
+    ON driver_time_locations (date, location_key varchar_pattern_ops, start_time);
+
+-- Per-day availability snapshot
+CREATE INDEX IF NOT EXISTS idx_driver_time_date_start ON driver_time (date, start_time);
+
+-- Backfill, mirroring availability.location_keys: split on 、,，;；/| then
+-- NFKC, drop whitespace and punctuation, lower case
+INSERT INTO driver_time_locations (slot_id, date, start_time, location_key)
+SELECT dt.id, dt.date, dt.start_time, keys.location_key
+FROM driver_time dt
+CROSS JOIN LATERAL (
+    SELECT lower(translate(normalize(part, NFKC), ' ,，、。．·-_/()（）[]【】' || chr(9) || chr(10) || chr(13), '')) AS location_key
+    FROM regexp_split_to_table(dt.locations, '[、,，;；/|]+') AS part
+) keys
+WHERE dt.date IS NOT NULL AND keys.location_key <> ''
+ON CONFLICT DO NOTHING;
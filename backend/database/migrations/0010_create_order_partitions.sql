@@ -0,0 +1,96 @@
+-- Migration script for monthly partitioning of the order tables (backend/services/partitions.py)
+-- Needs PostgreSQL 13+ and a maintenance window: it copies orders, order_items,
+-- agricultural_product_order and driver_orders into tables partitioned by
+-- month on "timestamp" (in one transaction) and keeps the originals as
+-- <table>_legacy. Restart the backend afterwards.
+--
+-- After verifying the row counts, drop the copies:
+--   DROP TABLE order_items_legacy, orders_legacy, agricultural_product_order_legacy, driver_orders_legacy;
+
+-- order_items carries its order's timestamp so its partitions line up with orders
+ALTER TABLE orders ALTER COLUMN timestamp SET DEFAULT CURRENT_TIMESTAMP;
+UPDATE orders SET timestamp = '-infinity' WHERE timestamp IS NULL;
+ALTER TABLE order_items ADD COLUMN IF NOT EXISTS timestamp TIMESTAMP;
+UPDATE order_items oi SET timestamp = o.timestamp FROM orders o WHERE o.id = oi.order_id AND oi.timestamp IS NULL;
+UPDATE order_items SET timestamp = '-infinity' WHERE timestamp IS NULL;
+ALTER TABLE order_items ALTER COLUMN timestamp SET DEFAULT CURRENT_TIMESTAMP;
+UPDATE agricultural_product_order SET timestamp = '-infinity' WHERE timestamp IS NULL;
+UPDATE driver_orders SET timestamp = '-infinity' WHERE timestamp IS NULL;
+
+-- Rebuild one table as <table> PARTITION BY RANGE (timestamp), keeping the
+-- original as <table>_legacy. Secondary indexes and foreign keys are
+-- recreated on the partitioned table (except foreign keys to orders, which
+-- must include the partition key); the primary key becomes (id, timestamp).
+CREATE FUNCTION pg_temp.partition_by_month(tbl text) RETURNS void AS $$
+DECLARE
+    index_defs text[];
+    fk_defs text[];
+    def text;
+    idx record;
+    month_start date;
+    last_month date;
+BEGIN
+    SELECT COALESCE(array_agg(pg_get_indexdef(i.indexrelid)), '{}') INTO index_defs
+    FROM pg_index i
+    WHERE i.indrelid = tbl::regclass AND NOT i.indisprimary AND NOT i.indisunique;
+
+    SELECT COALESCE(array_agg(pg_get_constraintdef(c.oid)), '{}') INTO fk_defs
+    FROM pg_constraint c
+    WHERE c.conrelid = tbl::regclass AND c.contype = 'f' AND c.confrelid <> 'orders'::regclass;
+
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', tbl, tbl || '_legacy');
+    FOR idx IN
+        SELECT ic.relname FROM pg_index i JOIN pg_class ic ON ic.oid = i.indexrelid
+        WHERE i.indrelid = (tbl || '_legacy')::regclass
+    LOOP
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', idx.relname, left(idx.relname, 55) || '_legacy');
+    END LOOP;
+
+    EXECUTE format(
+        'CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE) PARTITION BY RANGE ("timestamp")',
+        tbl, tbl || '_legacy'
+    );
+    EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (id, "timestamp")', tbl);
+
+    -- One partition per month from the oldest row to three months ahead;
+    -- the default partition takes '-infinity' rows and anything out of range
+    EXECUTE format('SELECT date_trunc(''month'', MIN(timestamp))::date FROM %I WHERE timestamp > ''-infinity''', tbl || '_legacy')
+        INTO month_start;
+    month_start := COALESCE(month_start, date_trunc('month', CURRENT_DATE)::date);
+    last_month := (date_trunc('month', CURRENT_DATE) + INTERVAL '3 months')::date;
+    WHILE month_start <= last_month LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+            tbl || '_p' || to_char(month_start, 'YYYY_MM'), tbl, month_start, (month_start + INTERVAL '1 month')::date
+        );
+        month_start := (month_start + INTERVAL '1 month')::date;
+    END LOOP;
+    EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', tbl || '_default', tbl);
+
+    EXECUTE format('INSERT INTO %I SELECT * FROM %I', tbl, tbl || '_legacy');
+
+    FOREACH def IN ARRAY index_defs LOOP
+        EXECUTE def;
+    END LOOP;
+    FOREACH def IN ARRAY fk_defs LOOP
+        EXECUTE format('ALTER TABLE %I ADD %s', tbl, def);
+    END LOOP;
+
+    -- Keep the id sequence when the legacy table is dropped
+    IF pg_get_serial_sequence(tbl || '_legacy', 'id') IS NOT NULL THEN
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.id', pg_get_serial_sequence(tbl || '_legacy', 'id'), tbl);
+    END IF;
+    EXECUTE format('ANALYZE %I', tbl);
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT pg_temp.partition_by_month('order_items');
+SELECT pg_temp.partition_by_month('orders');
+SELECT pg_temp.partition_by_month('agricultural_product_order');
+SELECT pg_temp.partition_by_month('driver_orders');
+
+-- Items follow their order's partition; ON UPDATE CASCADE keeps them aligned
+-- if an order's timestamp ever changes
+ALTER TABLE order_items
+    ADD CONSTRAINT order_items_order_fkey FOREIGN KEY (order_id, timestamp)
+    REFERENCES orders (id, timestamp) ON DELETE CASCADE ON UPDATE CASCADE;
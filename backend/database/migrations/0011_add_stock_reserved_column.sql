@@ -0,0 +1,6 @@
+-- Migration script to mark agricultural orders that took stock (backend/services/inventory.py)
+-- Run this SQL script in your PostgreSQL database before deploying the reservation-aware cancel
+
+-- agricultural_product_order: TRUE when the purchase decremented agricultural_produce.total_quantity
+-- Orders placed before stock reservation keep FALSE, so cancelling them gives nothing back
+ALTER TABLE agricultural_product_order ADD COLUMN IF NOT EXISTS stock_reserved BOOLEAN NOT NULL DEFAULT FALSE;
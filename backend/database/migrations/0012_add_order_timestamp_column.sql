@@ -0,0 +1,19 @@
+-- Migration script for the driver workload, driver order list and seller order list queries
+-- Run this SQL script in your PostgreSQL database before deploying the matching backend
+
+-- driver_orders: the accepted order's own timestamp, so GET /api/drivers/{driver_id}/orders
+-- reads each order from its partition by primary key (id, timestamp)
+ALTER TABLE driver_orders ADD COLUMN IF NOT EXISTS order_timestamp TIMESTAMP;
+UPDATE driver_orders dro SET order_timestamp = o.timestamp
+FROM orders o
+WHERE dro.service = 'necessities' AND o.id = dro.order_id AND dro.order_timestamp IS NULL;
+UPDATE driver_orders dro SET order_timestamp = apo.timestamp
+FROM agricultural_product_order apo
+WHERE dro.service = 'agricultural_product' AND apo.id = dro.order_id AND dro.order_timestamp IS NULL;
+
+-- driver_orders: a driver's accepted orders in accept order (order_claim.DRIVER_WORK_CTE,
+-- GET /api/drivers/{driver_id}/overdue-orders), read index-only
+CREATE INDEX IF NOT EXISTS idx_driver_orders_driver_action_timestamp ON driver_orders (driver_id, action, timestamp) INCLUDE (order_id, service);
+
+-- orders: a seller's necessities orders, newest first (GET /api/orders/seller/{seller_id})
+CREATE INDEX IF NOT EXISTS idx_orders_seller_id_date_time ON orders (seller_id, date DESC, time DESC);
@@ -9,6 +9,9 @@ from linebot.v3.messaging import (
 from fastapi import HTTPException
 import os
 from backend.database import get_db_connection, return_db_connection  # Adjust the import path as necessary
+from backend.services.prepared_statements import prepared
+
+USER_LINE_ID = prepared("users_line_id_by_id", "SELECT line_user_id FROM users WHERE id = %s")
 
 class LineMessageService:
     def __init__(self):
@@ -29,10 +32,7 @@ class LineMessageService:
             # Get LINE user ID from database
             conn = get_db_connection()
             cur = conn.cursor()
-            cur.execute(
-                "SELECT line_user_id FROM users WHERE id = %s",
-                (user_id,)
-            )
+            USER_LINE_ID.execute(cur, (user_id,))
             result = cur.fetchone()
             cur.close()
             
@@ -10,7 +10,7 @@ from datetime import datetime
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
-from backend.routers import orders, drivers, users, seller, consumer, history_management
+from backend.routers import orders, drivers, users, seller, consumer, history_management, media, payments, settlements, ledger
 from collections import defaultdict
 import re
 
@@ -40,7 +40,14 @@ from .handlers.customer_service import handle_customer_service
 from .handlers.send_message import LineMessageService
 
 # Import database connection function
-from backend.database import get_db_connection, init_connection_pool, close_connection_pool, return_db_connection
+from backend.database import (
+    get_db_connection, init_connection_pool, close_connection_pool, return_db_connection,
+    route_reads_to_replica, reset_read_routing, replica_monitor, replica_database_url, REPLICA_STICKY_SECONDS
+)
+from backend.scheduler import scheduler, start_scheduler, stop_scheduler
+from backend.services.prepared_statements import registry as statement_registry
+from backend.services.image_variants import shutdown as shutdown_image_workers
+from backend.services.dispatch import AUTO_DISPATCH_ENABLED, recent_runs as dispatch_recent_runs
 
 
 from pathlib import Path
@@ -66,6 +73,10 @@ app.include_router(users.router, prefix="/api/users", tags=["users"])
 app.include_router(seller.router, prefix="/api/seller", tags=["seller"])
 app.include_router(consumer.router, prefix="/api/consumer", tags=["consumer"])
 app.include_router(history_management.router, prefix="/api/history", tags=["history"])
+app.include_router(media.router, prefix="/api/media", tags=["media"])
+app.include_router(payments.router)
+app.include_router(settlements.router)
+app.include_router(ledger.router)
 
 # Setup CORS - Allow access from network devices
 import socket
@@ -102,6 +113,27 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Read replica routing: GET requests may read from REPLICA_DATABASE_URL, but
+# a client that just wrote keeps reading from the primary for a while so it
+# sees its own changes
+READ_METHODS = ("GET", "HEAD")
+PRIMARY_STICKY_COOKIE = "ct_read_primary"
+
+@app.middleware("http")
+async def route_database_reads(request: Request, call_next):
+    wrote_recently = PRIMARY_STICKY_COOKIE in request.cookies
+    token = route_reads_to_replica(request.method in READ_METHODS and not wrote_recently)
+    try:
+        response = await call_next(request)
+    finally:
+        reset_read_routing(token)
+    if replica_database_url and request.method not in READ_METHODS and response.status_code < 400:
+        response.set_cookie(
+            PRIMARY_STICKY_COOKIE, "1",
+            max_age=max(1, int(REPLICA_STICKY_SECONDS + 0.999)), httponly=True, samesite="lax"
+        )
+    return response
+
 
 # setup Line Bot API
 configuration = Configuration(
@@ -137,6 +169,8 @@ async def startup_event():
     try:
         # Initialize database connection pool
         init_connection_pool()
+        # Start background jobs (cleanup, order expiry) in this event loop
+        start_scheduler()
         logger.info(f"📡 Server running on port 8001")
         logger.info("✅ Startup complete")
     except Exception as e:
@@ -151,6 +185,8 @@ async def shutdown_event():
     """
     logger.info("🛑 CloudTribe Backend API Server shutting down...")
     try:
+        await stop_scheduler()
+        shutdown_image_workers()
         # Close database connection pool
         close_connection_pool()
         logger.info("✅ Shutdown complete")
@@ -395,6 +431,36 @@ async def root():
     """
     return {"message": "Server is running"}
 
+@app.get("/api/scheduler/jobs")
+async def scheduler_jobs():
+    """
+    Background job status, schedules and recent run history.
+
+    Returns:
+    - dict: Leader status of this worker and per-job run history.
+    """
+    return scheduler.snapshot()
+
+@app.get("/api/dispatch/runs")
+async def dispatch_runs():
+    """
+    Metrics of recent automatic dispatch runs on this worker.
+
+    Returns:
+    - dict: Whether auto dispatch is enabled and per-run metrics, newest last.
+    """
+    return {"enabled": AUTO_DISPATCH_ENABLED, "runs": list(dispatch_recent_runs)}
+
+@app.get("/api/db/prepared-statements")
+async def prepared_statement_stats():
+    """
+    Prepared statement usage for this worker.
+
+    Returns:
+    - dict: Per-statement prepare / execute counts and estimated planning time saved.
+    """
+    return statement_registry.stats()
+
 @app.get("/health")
 async def health_check():
     """
@@ -421,5 +487,6 @@ async def health_check():
     return {
         "status": "healthy" if db_status == "healthy" else "degraded",
         "database": db_status,
+        "replica": replica_monitor.snapshot(),
         "timestamp": datetime.now().isoformat()
     }
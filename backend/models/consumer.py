@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+from typing import List, Optional
 class ProductInfo(BaseModel):
     """
     the class extends UploadItemRequest:
@@ -15,6 +16,7 @@ class ProductInfo(BaseModel):
     seller_id: int
     unit: str
     upload_date: str
+    thumb_link: Optional[str] = None
     
 class AddCartRequest(BaseModel):
     buyer_id: int
@@ -54,6 +56,14 @@ class PurchasedProduct(BaseModel):
     status: str
     unit: str
 
+class CategoryFacet(BaseModel):
+    category: str
+    count: int
 
-
-
+class ProductSearchResponse(BaseModel):
+    """
+    One page of catalog search results.
+    """
+    items: List[ProductInfo]
+    next_cursor: Optional[str] = None
+    facets: List[CategoryFacet]
@@ -4,7 +4,7 @@ This module defines the Pydantic models used in the application.
 It includes models for UploadImage,.
 These models help in validating and serializing the data exchanged between the API and the database.
 """
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
 
 class UploadImageRequset(BaseModel):
@@ -48,6 +48,7 @@ class ProductInfo(BaseModel):
     img_id: str
     unit: str
     location: str #the location seller put items
+    thumb_link: Optional[str] = None
 
 class ProductOrderInfo(BaseModel):
     order_id: int
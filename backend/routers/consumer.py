@@ -1,6 +1,7 @@
 '''
 Endpoints:
 - GET /: Get on sell items
+- GET /search: Search on sell items with filters, sorting and paging
 - POST /cart: Add item to shopping cart
 - GET /cart/{userId}:  Get user shopping cart items 
 - DELETE /cart/{itemId}: Delete specific item in shopping cart
@@ -11,14 +12,21 @@ Endpoints:
 - PATCH /order/status_confirm/{orderId}: Update status to '已確認' with id {orderId}
 
 '''
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Response
 from psycopg2.extensions import connection as Connection
-from backend.models.consumer import ProductInfo, AddCartRequest, CartItem, UpdateCartQuantityRequest, PurchaseProductRequest, PurchasedProduct
-from backend.database import get_db_connection, return_db_connection
+from backend.models.consumer import ProductInfo, AddCartRequest, CartItem, UpdateCartQuantityRequest, PurchaseProductRequest, PurchasedProduct, ProductSearchResponse
+from backend.database import get_read_connection, return_db_connection
 from backend.handlers.send_message import LineMessageService
+from backend.services.catalog_cache import catalog_cache, etag_matches
+from backend.services.order_index import order_index
+from backend.services.order_state import transition, TransitionError, DELIVERED, CONFIRMED
+from backend.services.image_variants import variant_url
+from backend.services.inventory import reserve_stock, InsufficientStockError, ProductUnavailableError
+from backend.services.idempotency import claim_key, store_response, request_fingerprint, REPLAY_HEADER
+import base64
 import logging
 import json
-from typing import List
+from typing import List, Optional
 from datetime import datetime
 import datetime as dt
 router = APIRouter()
@@ -120,56 +128,191 @@ def log_event(event_type: str, data: dict):
 def get_db():
     """
     Get a database connection.
+    GET requests may be served by the read replica (database.get_read_connection).
     
     Yields:
         psycopg2.extensions.connection: A PostgreSQL database connection.
     """
-    conn = get_db_connection()
+    conn = get_read_connection()
     try:
         yield conn
     finally:
         return_db_connection(conn)
 @router.get('/', response_model=List[ProductInfo])
-async def get_on_sell_item(conn: Connection=Depends(get_db)):
+def get_on_sell_item(if_none_match: Optional[str] = Header(None)):
     """
-    Get agricultural_product which off_shelf_date is larger than today_date
+    Get agricultural_product which off_shelf_date is larger than today_date.
+    Served from the in-memory catalog cache with an ETag; returns
+    304 Not Modified when the client's If-None-Match still matches.
 
     Args:
-        today_date(str):today date
-        conn(Connection): The database connection.
+        if_none_match(Optional[str]): ETag from the client's cached copy.
 
     Returns:
         List[ProductInfo]: A list of agricultural_product information.
     """
-    today = dt.date.today()
+    try:
+        snapshot = catalog_cache.get()
+    except Exception as e:
+        logging.error("Error occurred: %s", str(e))
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, snapshot.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
+# Search sort options: (ORDER BY columns, direction). Every order ends with id
+# so the keyset cursor is unique and matches an index.
+SEARCH_SORTS = {
+    "newest": (("upload_date", "id"), "DESC"),
+    "price_asc": (("price", "id"), "ASC"),
+    "price_desc": (("price", "id"), "DESC"),
+    "name": (("name", "id"), "ASC"),
+}
+
+def encode_search_cursor(sort: str, values: list) -> str:
+    payload = json.dumps({"s": sort, "v": values}, separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_search_cursor(cursor: str, sort: str) -> list:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        values = payload["v"]
+        if payload["s"] != sort or len(values) != 2:
+            raise ValueError("cursor does not match sort")
+        return values
+    except Exception as e:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from e
+
+@router.get('/search', response_model=ProductSearchResponse)
+def search_products(
+    q: Optional[str] = Query(None, max_length=25, description="Product name (substring / fuzzy match)"),
+    category: Optional[str] = Query(None),
+    min_price: Optional[int] = Query(None, ge=0),
+    max_price: Optional[int] = Query(None, ge=0),
+    sort: str = Query("newest", description="newest | price_asc | price_desc | name"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    limit: int = Query(20, ge=1, le=100),
+    conn: Connection = Depends(get_db)
+):
+    """
+    Search on-sale agricultural products with keyset paging.
+
+    Name search uses the pg_trgm GIN index (substring ILIKE plus trigram
+    similarity for typos). Category facet counts come from the catalog cache
+    unless a name or price filter narrows the result set.
+
+    Args:
+        q(Optional[str]): Name search text.
+        category(Optional[str]): Exact category filter.
+        min_price(Optional[int]): Minimum price.
+        max_price(Optional[int]): Maximum price.
+        sort(str): Sort option.
+        cursor(Optional[str]): Opaque paging cursor.
+        limit(int): Page size.
+        conn(Connection): The database connection.
+
+    Returns:
+        ProductSearchResponse: Matching products, next page cursor and category facets.
+    """
+    if sort not in SEARCH_SORTS:
+        raise HTTPException(status_code=400, detail=f"Invalid sort option: {sort}")
+    if min_price is not None and max_price is not None and min_price > max_price:
+        raise HTTPException(status_code=400, detail="min_price cannot be greater than max_price")
+
+    columns, direction = SEARCH_SORTS[sort]
+    q = q.strip() if q else None
+
+    # Filters shared by the page query and the facet query (everything but category)
+    conditions = ["off_shelf_date >= %s"]
+    params: list = [dt.date.today()]
+    if q:
+        escaped = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append("(name ILIKE %s OR name %% %s)")
+        params.extend([f"%{escaped}%", q])
+    if min_price is not None:
+        conditions.append("price >= %s")
+        params.append(min_price)
+    if max_price is not None:
+        conditions.append("price <= %s")
+        params.append(max_price)
+
+    page_conditions = list(conditions)
+    page_params = list(params)
+    if category:
+        page_conditions.append("category = %s")
+        page_params.append(category)
+    if cursor:
+        comparison = '<' if direction == "DESC" else '>'
+        page_conditions.append(f"({columns[0]}, {columns[1]}) {comparison} (%s, %s)")
+        page_params.extend(decode_search_cursor(cursor, sort))
+
+    order_by = ", ".join(f"{column} {direction}" for column in columns)
     cur = conn.cursor()
     try:
-        logging.info("Get agricultural_product.(today_date: %s)", today)
-        cur.execute("SELECT * FROM agricultural_produce WHERE off_shelf_date >= %s", (today,))
-        products = cur.fetchall()
-        logging.info('start create product list')
-        product_list:List[ProductInfo] = []
-        for product in products:
-            product_list.append({
-                "id":product[0],
-                "name":product[1],
-                "price": str(product[2]),
-                "total_quantity": str(product[3]),
-                "category": product[4],
-                "upload_date":str(product[5]),
-                "off_shelf_date":str(product[6]),
-                "img_link": product[7],
-                "img_id": product[8],
-                "seller_id": product[9],
-                "unit": product[10],   
-            })
-        return product_list
+        cur.execute(
+            f"""
+            SELECT id, name, price, total_quantity, category, upload_date, off_shelf_date,
+                   img_link, img_id, seller_id, unit
+            FROM agricultural_produce
+            WHERE {' AND '.join(page_conditions)}
+            ORDER BY {order_by}
+            LIMIT %s
+            """,
+            page_params + [limit + 1]
+        )
+        rows = cur.fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        items = [{
+            "id": row[0],
+            "name": row[1],
+            "price": str(row[2]),
+            "total_quantity": str(row[3]),
+            "category": row[4],
+            "upload_date": str(row[5]),
+            "off_shelf_date": str(row[6]),
+            "img_link": row[7],
+            "img_id": row[8],
+            "seller_id": row[9],
+            "unit": row[10],
+            "thumb_link": variant_url(row[7]),
+        } for row in rows]
+
+        next_cursor = None
+        if has_more:
+            last = rows[-1]
+            sort_value = {"upload_date": last[5], "price": last[2], "name": last[1]}[columns[0]]
+            next_cursor = encode_search_cursor(sort, [sort_value, last[0]])
+
+        if q or min_price is not None or max_price is not None:
+            cur.execute(
+                f"""
+                SELECT category, COUNT(*)
+                FROM agricultural_produce
+                WHERE {' AND '.join(conditions)}
+                GROUP BY category
+                ORDER BY COUNT(*) DESC, category
+                """,
+                params
+            )
+            facets = [{"category": row[0], "count": row[1]} for row in cur.fetchall()]
+        else:
+            facets = catalog_cache.get().facets
+
+        conn.commit()
+        return {"items": items, "next_cursor": next_cursor, "facets": facets}
+    except HTTPException:
+        conn.rollback()
+        raise
     except Exception as e:
         conn.rollback()
         logging.error("Error occurred: %s", str(e))
         raise HTTPException(status_code=500, detail=str(e)) from e
     finally:
         cur.close()
+
 @router.post('/cart')
 async def add_cart(req: AddCartRequest, conn: Connection = Depends(get_db)):
     """
@@ -329,13 +472,15 @@ async def update_cart_quantity(itemId: int, req: UpdateCartQuantityRequest, conn
         cur.close()
 
 @router.post('/order')
-async def purchase_product(req: PurchaseProductRequest, conn: Connection = Depends(get_db)):
+async def purchase_product(req: PurchaseProductRequest, response: Response, conn: Connection = Depends(get_db),
+                           idempotency_key: Optional[str] = Header(None)):
     """
     Add product order
 
     Args:
         req(PurchaseProductRequest):The order information
         conn(Connection): The database connection.
+        idempotency_key(Optional[str]): Idempotency-Key header; a retry with the same key returns the first order id.
 
     Returns:
         orderId(int):The id of added order.
@@ -352,6 +497,8 @@ async def purchase_product(req: PurchaseProductRequest, conn: Connection = Depen
     try:
         # Validate quantity - limit to 30 products per order
         MAX_PRODUCTS_PER_ORDER = 30
+        if req.quantity < 1:
+            raise HTTPException(status_code=400, detail="訂購數量至少為 1。")
         if req.quantity > MAX_PRODUCTS_PER_ORDER:
             log_event("PURCHASE_FAILED", {
                 "buyer_id": req.buyer_id,
@@ -369,19 +516,45 @@ async def purchase_product(req: PurchaseProductRequest, conn: Connection = Depen
         if result is None:
             raise HTTPException(status_code=404, detail="Buyer not found")
         buyer_phone = result[0] 
+
+        claim = claim_key(cur, "consumer:purchase", idempotency_key, request_fingerprint(req))
+        if claim and claim.replay:
+            conn.rollback()
+            response.headers[REPLAY_HEADER] = "true"
+            return claim.body
+
+        # Take the stock first; the order insert below commits or rolls back with it
+        try:
+            remaining = reserve_stock(cur, req.produce_id, req.quantity)
+        except InsufficientStockError as e:
+            log_event("PURCHASE_FAILED", {
+                "buyer_id": req.buyer_id,
+                "produce_id": req.produce_id,
+                "quantity": req.quantity,
+                "available": e.available,
+                "reason": "Insufficient stock"
+            })
+            raise HTTPException(status_code=409, detail=f"庫存不足，目前剩餘 {e.available} 個。") from e
+        except ProductUnavailableError as e:
+            raise HTTPException(status_code=409, detail="商品已下架或不存在。") from e
+
         logging.info("Inserting agricultural_product order")
         cur.execute(
             """INSERT INTO agricultural_product_order 
-            (seller_id, buyer_id, buyer_name, buyer_phone, produce_id, quantity, starting_point, end_point, status) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id""",
+            (seller_id, buyer_id, buyer_name, buyer_phone, produce_id, quantity, starting_point, end_point, status, stock_reserved) 
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, TRUE) RETURNING id""",
             (req.seller_id, req.buyer_id, req.buyer_name, buyer_phone, req.produce_id, req.quantity, req.starting_point, req.end_point, '未接單')
         )
         order_id = cur.fetchone()[0]
+        store_response(cur, claim, order_id)
         conn.commit()
+        catalog_cache.set_stock(req.produce_id, remaining)
+        order_index.invalidate()
         log_event("PURCHASE_COMPLETED", {
             "order_id": order_id,
             "buyer_id": req.buyer_id,
             "seller_id": req.seller_id,
+            "remaining_stock": remaining,
             "status": "success"
         })
         
@@ -393,6 +566,9 @@ async def purchase_product(req: PurchaseProductRequest, conn: Connection = Depen
             # Don't fail the order creation if notification fails
         
         return order_id
+    except HTTPException:
+        conn.rollback()
+        raise
     except Exception as e:
         conn.rollback()
         log_event("PURCHASE_ERROR", {
@@ -489,15 +665,17 @@ async def update_cart_item_status(orderId: int, conn: Connection = Depends(get_d
     """
     cur = conn.cursor()
     try:
-        cur.execute(
-            "UPDATE agricultural_product_order SET status = %s WHERE id = %s",
-            ( '已確認', orderId )
-        )
-        if cur.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Item not found")
+        try:
+            transition(cur, 'agricultural_product', orderId, CONFIRMED, from_statuses=(DELIVERED,))
+        except TransitionError as te:
+            detail = "Item not found" if te.reason == "order_not_found" else te.detail
+            raise HTTPException(status_code=te.status_code, detail=detail) from te
         
         conn.commit()
         return {"status": "success"}
+    except HTTPException as he:
+        conn.rollback()
+        raise he
     except Exception as e:
         conn.rollback()
         logging.error("Error updating cart item status: %s", str(e))
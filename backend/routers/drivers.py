@@ -9,8 +9,10 @@ Endpoints:
 - GET /user/{user_id}: Get driver information by user ID.
 - GET /{driver_id}: Get driver information by driver ID.
 - GET /{driver_id}/orders: Get orders assigned to a driver.
+- GET /{driver_id}/route: Plan the pickup / drop-off order of a driver's active orders.
 - POST /time: Add a new available time slot for a driver.
 - GET /all/times: Retrieve available time slots for all driver.
+- GET /availability: Find driver time slots by date range, location and start time.
 - GET /{driver_id}/times: Retrieve available time slots for a specific driver.
 - DELETE /time/{id}: Delete an available time slot for a driver.
 - DELETE /drop_agricultural_order/{driver_id}/{order_id}:Delete received agricultural product order.
@@ -18,17 +20,72 @@ Endpoints:
 
 import logging
 import json
-from datetime import datetime
-from fastapi import APIRouter, HTTPException, Depends
+from datetime import datetime, date, time as dtime, timedelta
+from fastapi import APIRouter, HTTPException, Depends, Query
 from psycopg2.extensions import connection as Connection
 from backend.models.models import Driver
 from backend.models.models import DriverTime, DriverTimeDetail
-from backend.database import get_db_connection, return_db_connection
-from typing import List
+from backend.database import get_read_connection, return_db_connection
+from backend.services.prepared_statements import prepared
+from backend.services.route_planner import route_cache, ACTIVE_ORDER_STOPS_QUERY
+from backend.services.availability import availability_cache, index_slot, match_slots
+from backend.services.order_index import order_index
+from backend.services.order_claim import HELD_ORDERS, STATUS_PARAMS
+from backend.services.order_state import transition, TransitionError, UNACCEPTED, ACCEPTED
+from typing import List, Optional
 import os 
 
 router = APIRouter()
 
+# Hot-path statements, prepared once per pooled connection
+DRIVER_EXISTS = prepared("drivers_exists_by_id", "SELECT id FROM drivers WHERE id = %s")
+DRIVER_BY_USER = prepared("drivers_by_user_id", "SELECT id, user_id, driver_name, driver_phone FROM drivers WHERE user_id = %s")
+
+# Hot reads of the driver pages; backend/benchmarks/query_plans.py checks their plans
+# Each order is read by primary key from its own partition (driver_orders
+# carries order_timestamp); OFFSET 0 keeps that per-row lookup, which the
+# planner would otherwise cost as a probe of every partition and replace
+# with a scan of all orders
+DRIVER_ORDERS_QUERY = """
+    SELECT orders.*, driver_orders.previous_driver_name, driver_orders.previous_driver_phone
+    FROM driver_orders
+    JOIN LATERAL (
+        SELECT * FROM orders
+        WHERE orders.id = driver_orders.order_id AND orders.timestamp = driver_orders.order_timestamp
+        OFFSET 0
+    ) orders ON TRUE
+    WHERE driver_orders.driver_id = %s and driver_orders.service = %s
+"""
+
+ORDER_ITEMS_QUERY = "SELECT item_id, item_name, price, quantity, img, location, category, selected_options FROM order_items WHERE order_id = %s"
+
+DRIVER_AGRI_ORDERS_QUERY = """
+    SELECT agri_p_o.id, agri_p_o.buyer_id, agri_p_o.buyer_name, agri_p_o.buyer_phone, agri_p_o.end_point, agri_p_o.status, agri_p_o.note,
+            driver_o.previous_driver_id, driver_o.previous_driver_name, driver_o.previous_driver_phone,
+            agri_p.id, agri_p.name, agri_p.price, agri_p_o.quantity, agri_p.img_link, agri_p_o.starting_point, agri_p.category, agri_p_o.timestamp
+    FROM agricultural_product_order as agri_p_o
+    JOIN driver_orders as driver_o ON agri_p_o.id = driver_o.order_id
+    JOIN agricultural_produce as agri_p on agri_p.id = agri_p_o.produce_id
+    WHERE driver_o.driver_id = %s and driver_o.service = %s
+"""
+
+# Orders held by the driver that were accepted more than 2 hours ago
+OVERDUE_ORDERS_QUERY = f"""
+    SELECT dro.order_id, dro.service, dro.timestamp, held.status as order_status
+    FROM driver_orders dro
+    JOIN ({HELD_ORDERS}) held ON held.service = dro.service AND held.id = dro.order_id
+    WHERE dro.driver_id = %(driver_id)s
+      AND dro.action = %(accepted)s
+      AND dro.timestamp < NOW() - INTERVAL '2 hours'
+    ORDER BY dro.timestamp ASC
+"""
+
+# Bounds for availability responses
+AVAILABILITY_MAX_DAYS = 31
+AVAILABILITY_DEFAULT_LIMIT = 50
+AVAILABILITY_MAX_LIMIT = 200
+ALL_TIMES_MAX_ROWS = int(os.getenv('DRIVER_ALL_TIMES_MAX_ROWS', '1000'))
+
 log_dir = os.path.join(os.getcwd(), 'backend', 'logs')
 
 if not os.path.exists(log_dir):
@@ -55,8 +112,9 @@ def log_event(event_type: str, data: dict):
 def get_db():
     """
     Dependency function to get a database connection.
+    GET requests may be served by the read replica (database.get_read_connection).
     """
-    conn = get_db_connection()
+    conn = get_read_connection()
     try:
         yield conn
     finally:
@@ -173,14 +231,7 @@ async def get_driver_by_user(user_id: int, conn: Connection = Depends(get_db)):
     """
     cur = conn.cursor()
     try:
-        cur.execute(
-            """
-            SELECT id, user_id, driver_name, driver_phone
-            FROM drivers
-            WHERE user_id = %s
-            """,
-            (user_id,)
-        )
+        DRIVER_BY_USER.execute(cur, (user_id,))
         driver = cur.fetchone()
         if not driver:
             raise HTTPException(status_code=404, detail="該使用者不是司機或不存在")
@@ -201,6 +252,48 @@ async def get_driver_by_user(user_id: int, conn: Connection = Depends(get_db)):
     finally:
         cur.close()
 
+@router.get("/availability")
+def get_driver_availability(
+    date_from: date,
+    date_to: Optional[date] = None,
+    location: Optional[str] = Query(None, max_length=255),
+    time_from: Optional[dtime] = None,
+    time_to: Optional[dtime] = None,
+    limit: int = Query(AVAILABILITY_DEFAULT_LIMIT, ge=1, le=AVAILABILITY_MAX_LIMIT),
+    offset: int = Query(0, ge=0)
+):
+    """
+    Find driver time slots by date range, location and start time, served
+    from cached per-day availability snapshots.
+
+    Args:
+        date_from (date): First day.
+        date_to (Optional[date]): Last day (defaults to date_from, at most AVAILABILITY_MAX_DAYS days).
+        location (Optional[str]): Place the slot covers; matches slot locations starting with it.
+        time_from (Optional[time]): Earliest start time.
+        time_to (Optional[time]): Latest start time.
+        limit (int): Page size.
+        offset (int): Page offset.
+
+    Returns:
+        dict: The total number of matching slots and one page of them, by date and start time.
+    """
+    date_to = date_to or date_from
+    if date_to < date_from:
+        raise HTTPException(status_code=422, detail="date_to 不可早於 date_from")
+    if (date_to - date_from).days >= AVAILABILITY_MAX_DAYS:
+        raise HTTPException(status_code=422, detail=f"查詢區間最多 {AVAILABILITY_MAX_DAYS} 天")
+    try:
+        matches = []
+        day = date_from
+        while day <= date_to:
+            matches.extend(match_slots(availability_cache.get(day), location, time_from, time_to))
+            day += timedelta(days=1)
+    except Exception as e:
+        logging.error("Error fetching driver availability: %s", str(e))
+        raise HTTPException(status_code=500, detail="伺服器內部錯誤") from e
+    return {"total": len(matches), "limit": limit, "offset": offset, "slots": matches[offset:offset + limit]}
+
 @router.get("/{driver_id}")
 async def get_driver_by_id(driver_id: int, conn: Connection = Depends(get_db)):
     """
@@ -258,17 +351,12 @@ async def get_driver_orders(driver_id: int, conn: Connection = Depends(get_db)):
     cur = conn.cursor()
     try:
         # Check if driver_id exists
-        cur.execute("SELECT id FROM drivers WHERE id = %s", (driver_id,))
+        DRIVER_EXISTS.execute(cur, (driver_id,))
         if not cur.fetchone():
             raise HTTPException(status_code=404, detail="司機不存在")
 
         # Retrieve accepted orders
-        cur.execute("""
-            SELECT orders.*, driver_orders.previous_driver_name, driver_orders.previous_driver_phone
-            FROM orders 
-            JOIN driver_orders ON orders.id = driver_orders.order_id 
-            WHERE driver_orders.driver_id = %s and driver_orders.service = %s 
-        """, (driver_id, 'necessities'))
+        cur.execute(DRIVER_ORDERS_QUERY, (driver_id, 'necessities'))
         orders = cur.fetchall()
         order_list = []
         for order in orders:
@@ -298,7 +386,7 @@ async def get_driver_orders(driver_id: int, conn: Connection = Depends(get_db)):
                 "timestamp": order[20]
             }
             # Retrieve order items
-            cur.execute("SELECT item_id, item_name, price, quantity, img, location, category, selected_options FROM order_items WHERE order_id = %s", (order[0],))
+            cur.execute(ORDER_ITEMS_QUERY, (order[0],))
             items = cur.fetchall()
             # Parse selectedOptions from JSON if present
             parsed_items = []
@@ -323,15 +411,7 @@ async def get_driver_orders(driver_id: int, conn: Connection = Depends(get_db)):
             order_list.append(order_dict)
 
         #add
-        cur.execute("""
-            SELECT agri_p_o.id, agri_p_o.buyer_id, agri_p_o.buyer_name, agri_p_o.buyer_phone, agri_p_o.end_point, agri_p_o.status, agri_p_o.note, 
-                    driver_o.previous_driver_id, driver_o.previous_driver_name, driver_o.previous_driver_phone, 
-                    agri_p.id, agri_p.name, agri_p.price, agri_p_o.quantity, agri_p.img_link, agri_p_o.starting_point, agri_p.category, agri_p_o.timestamp
-            FROM agricultural_product_order as agri_p_o
-            JOIN driver_orders as driver_o ON agri_p_o.id = driver_o.order_id
-            JOIN agricultural_produce as agri_p on agri_p.id = agri_p_o.produce_id
-            WHERE driver_o.driver_id = %s and driver_o.service = %s 
-        """, (driver_id, 'agricultural_product'))
+        cur.execute(DRIVER_AGRI_ORDERS_QUERY, (driver_id, 'agricultural_product'))
         agri_orders = cur.fetchall()
         for agri_order in agri_orders:
             total_price = agri_order[12] * agri_order[13] #price*quantity
@@ -371,10 +451,55 @@ async def get_driver_orders(driver_id: int, conn: Connection = Depends(get_db)):
     finally:
         cur.close()
 
+@router.get("/{driver_id}/route")
+async def get_driver_route(
+    driver_id: int,
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lng: Optional[float] = Query(None, ge=-180, le=180),
+    conn: Connection = Depends(get_db)
+):
+    """
+    Plan the stop order for a driver's active orders: every pickup before its
+    order's drop-off, shortest path first (nearest insertion + 2-opt).
+    The plan is cached until the driver's order set changes.
+
+    Args:
+        driver_id (int): The driver's ID.
+        lat (Optional[float]): Driver's current latitude; the route starts here when given with lng.
+        lng (Optional[float]): Driver's current longitude.
+        conn (Connection): The database connection.
+
+    Returns:
+        dict: Ordered stops with leg and cumulative distances, the total
+        distance, and stops whose locations could not be geocoded.
+    """
+    if (lat is None) != (lng is None):
+        raise HTTPException(status_code=422, detail="lat 與 lng 需同時提供")
+    cur = conn.cursor()
+    try:
+        DRIVER_EXISTS.execute(cur, (driver_id,))
+        if not cur.fetchone():
+            raise HTTPException(status_code=404, detail="司機不存在")
+
+        cur.execute(ACTIVE_ORDER_STOPS_QUERY, (driver_id, driver_id))
+        rows = cur.fetchall()
+        conn.rollback()
+
+        start = (lat, lng) if lat is not None else None
+        plan, cached = route_cache.get(driver_id, rows, start)
+        return {"driver_id": driver_id, "orders": len(rows), "cached": cached, **plan.describe()}
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logging.error("Error planning driver route: %s", str(e))
+        raise HTTPException(status_code=500, detail="伺服器內部錯誤") from e
+    finally:
+        cur.close()
+
 @router.get("/{driver_id}/overdue-orders")
 async def get_overdue_orders(driver_id: int, conn: Connection = Depends(get_db)):
     """
-    Get overdue orders for a driver (orders accepted more than 2 hours ago and not completed).
+    Get overdue orders for a driver (orders accepted more than 2 hours ago and not delivered yet).
     
     Args:
         driver_id (int): The driver's ID.
@@ -386,29 +511,12 @@ async def get_overdue_orders(driver_id: int, conn: Connection = Depends(get_db))
     cur = conn.cursor()
     try:
         # Check if driver_id exists
-        cur.execute("SELECT id FROM drivers WHERE id = %s", (driver_id,))
+        DRIVER_EXISTS.execute(cur, (driver_id,))
         if not cur.fetchone():
             raise HTTPException(status_code=404, detail="司機不存在")
 
-        # Get overdue orders (more than 2 hours since acceptance and not completed)
-        cur.execute("""
-            SELECT dro.order_id, dro.service, dro.timestamp,
-                   CASE 
-                     WHEN dro.service = 'necessities' THEN o.order_status
-                     WHEN dro.service = 'agricultural_product' THEN apo.status
-                   END as order_status
-            FROM driver_orders dro
-            LEFT JOIN orders o ON dro.order_id = o.id AND dro.service = 'necessities'
-            LEFT JOIN agricultural_product_order apo ON dro.order_id = apo.id AND dro.service = 'agricultural_product'
-            WHERE dro.driver_id = %s 
-              AND dro.action = '接單'
-              AND dro.timestamp < NOW() - INTERVAL '2 hours'
-              AND (
-                (dro.service = 'necessities' AND o.order_status NOT IN ('已送達', '已完成'))
-                OR (dro.service = 'agricultural_product' AND apo.status NOT IN ('已送達'))
-              )
-            ORDER BY dro.timestamp ASC
-        """, (driver_id,))
+        # Get overdue orders (more than 2 hours since acceptance and not delivered yet)
+        cur.execute(OVERDUE_ORDERS_QUERY, {"driver_id": driver_id, **STATUS_PARAMS})
         
         overdue_orders = cur.fetchall()
         overdue_list = []
@@ -449,7 +557,7 @@ async def add_driver_time(driver_time: DriverTime, conn: Connection = Depends(ge
     cur = conn.cursor()
     try:
         # Check if driver_id exists
-        cur.execute("SELECT id FROM drivers WHERE id = %s", (driver_time.driver_id,))
+        DRIVER_EXISTS.execute(cur, (driver_time.driver_id,))
         if not cur.fetchone():
             raise HTTPException(status_code=404, detail="司機不存在")
 
@@ -458,12 +566,14 @@ async def add_driver_time(driver_time: DriverTime, conn: Connection = Depends(ge
             """
             INSERT INTO driver_time (driver_id, date, start_time, locations)
             VALUES (%s, %s, %s, %s)
-            RETURNING id;
+            RETURNING id, date, start_time;
             """,
             (driver_time.driver_id, driver_time.date, driver_time.start_time, driver_time.locations)
         )
-        new_id = cur.fetchone()[0]
+        new_id, slot_date, start_time = cur.fetchone()
+        index_slot(cur, new_id, slot_date, start_time, driver_time.locations)
         conn.commit()
+        availability_cache.invalidate(slot_date)
         return {"id": new_id, "status": "success"}
     except HTTPException as he:
         conn.rollback()
@@ -476,11 +586,15 @@ async def add_driver_time(driver_time: DriverTime, conn: Connection = Depends(ge
         cur.close()
 
 @router.get("/all/times", response_model=List[DriverTimeDetail])
-async def get_all_drivers_times(conn: Connection = Depends(get_db)):
+async def get_all_drivers_times(date_from: Optional[date] = None, date_to: Optional[date] = None, conn: Connection = Depends(get_db)):
     """
-    Retrieve available time slots for all driver.
+    Retrieve available time slots for all driver, from date_from (default
+    today) to date_to, by date and start time; at most ALL_TIMES_MAX_ROWS
+    slots. Use GET /availability to search by location.
 
     Args:
+        date_from (Optional[date]): First day, defaults to today.
+        date_to (Optional[date]): Last day, unbounded by default.
         conn (Connection): The database connection.
 
     Returns:
@@ -494,7 +608,11 @@ async def get_all_drivers_times(conn: Connection = Depends(get_db)):
             SELECT dt.id, dt.date, dt.start_time, dt.locations, d.driver_name, d.driver_phone
             FROM driver_time dt
             JOIN drivers d ON dt.driver_id = d.id
-            """
+            WHERE dt.date >= %s AND (%s::date IS NULL OR dt.date <= %s)
+            ORDER BY dt.date, dt.start_time, dt.id
+            LIMIT %s
+            """,
+            (date_from or date.today(), date_to, date_to, ALL_TIMES_MAX_ROWS)
         )
         times = cur.fetchall()
         logging.info('start create driver time list')
@@ -537,7 +655,7 @@ async def get_driver_times(driver_id: int, conn: Connection = Depends(get_db)):
     cur = conn.cursor()
     try:
         # Check if driver_id exists
-        cur.execute("SELECT id FROM drivers WHERE id = %s", (driver_id,))
+        DRIVER_EXISTS.execute(cur, (driver_id,))
         if not cur.fetchone():
             raise HTTPException(status_code=404, detail="司機不存在")
 
@@ -585,8 +703,9 @@ async def delete_driver_time(id: int, conn: Connection = Depends(get_db)):
     cur = conn.cursor()
     try:
         # Check if the time slot exists
-        cur.execute("SELECT id FROM driver_time WHERE id = %s", (id,))
-        if not cur.fetchone():
+        cur.execute("SELECT id, date FROM driver_time WHERE id = %s", (id,))
+        slot = cur.fetchone()
+        if not slot:
             raise HTTPException(status_code=404, detail="時間段不存在")
 
         cur.execute(
@@ -597,6 +716,7 @@ async def delete_driver_time(id: int, conn: Connection = Depends(get_db)):
             (id,)
         )
         conn.commit()
+        availability_cache.invalidate(slot[1])
         return {"status": "success", "message": f"Deleted time slot with ID {id}"}
     except HTTPException as he:
         conn.rollback()
@@ -624,13 +744,16 @@ async def delete_received_agricultural_product(driver_id: int, order_id: int, co
     cur = conn.cursor()
     try:
         # Check if the driver exists
-        cur.execute("SELECT id FROM drivers WHERE id = %s", (driver_id,))
+        DRIVER_EXISTS.execute(cur, (driver_id,))
         if not cur.fetchone():
             raise HTTPException(status_code=404, detail="司機不存在")
-        # Check if the agricultural order exists
-        cur.execute("SELECT id FROM agricultural_product_order WHERE id = %s", (order_id,))
-        if not cur.fetchone():
-            raise HTTPException(status_code=404, detail="農產品訂單不存在")
+        logging.info("Start change status")
+        #change agricultural product status from 接單 to 未接單
+        try:
+            transition(cur, 'agricultural_product', order_id, UNACCEPTED, from_statuses=(ACCEPTED,))
+        except TransitionError as te:
+            detail = "農產品訂單不存在" if te.reason == "order_not_found" else te.detail
+            raise HTTPException(status_code=te.status_code, detail=detail) from te
         logging.info("Start delete driver order")
         cur.execute(
             """
@@ -639,18 +762,8 @@ async def delete_received_agricultural_product(driver_id: int, order_id: int, co
             """,
             (driver_id, order_id, 'agricultural_product',)
         )
-
-        logging.info("Start change status")
-        #change agricultural product status from 接單 to 未接單
-        cur.execute(
-            """
-            UPDATE agricultural_product_order
-            SET status = %s
-            WHERE id = %s
-            """,
-            ('未接單', order_id)
-        )
         conn.commit()
+        order_index.invalidate()
         return {"status": "success", "message": f"Deleted driver agricultural order"}
     except HTTPException as he:
         conn.rollback()
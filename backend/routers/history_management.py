@@ -3,97 +3,201 @@ from datetime import datetime, timedelta
 import pandas as pd
 import io
 import json
-from typing import List, Dict, Any
-from backend.database import get_db_connection, return_db_connection
+from typing import List, Dict, Any, Optional
+from starlette.concurrency import run_in_threadpool
+from backend.database import get_read_connection, return_db_connection
+from backend.services.history_cleanup import run_history_cleanup, get_cleanup_status, BATCH_SIZE
 
 router = APIRouter()
 
+# Report queries; backend/benchmarks/query_plans.py checks their plans
+DRIVER_HISTORY_QUERY = """
+    SELECT
+        o.id as order_id,
+        o.timestamp,
+        o.location,
+        o.total_price,
+        o.order_status,
+        u.name as buyer_name,
+        u.phone as buyer_phone,
+        'store' as order_type
+    FROM orders o
+    JOIN users u ON o.buyer_id = u.id
+    WHERE o.order_status = '已送達'
+    AND EXISTS (
+        SELECT 1
+        FROM driver_orders dro
+        WHERE dro.order_id = o.id
+        AND dro.service = 'necessities'
+        AND dro.driver_id = %s
+    )
+
+    UNION ALL
+
+    SELECT
+        apo.id as order_id,
+        apo.timestamp,
+        apo.end_point as location,
+        (ap.price * apo.quantity) as total_price,
+        apo.status as order_status,
+        u.name as buyer_name,
+        u.phone as buyer_phone,
+        'agricultural' as order_type
+    FROM agricultural_product_order apo
+    JOIN agricultural_produce ap ON apo.produce_id = ap.id
+    JOIN users u ON apo.buyer_id = u.id
+    WHERE apo.status = '已送達'
+    AND EXISTS (
+        SELECT 1
+        FROM driver_orders dro
+        WHERE dro.order_id = apo.id
+        AND dro.service = 'agricultural_product'
+        AND dro.driver_id = %s
+    )
+
+    ORDER BY timestamp DESC
+"""
+
+BUYER_HISTORY_QUERY = """
+    SELECT
+        o.id as order_id,
+        o.timestamp,
+        o.location,
+        o.total_price,
+        o.order_status,
+        COALESCE(dr.driver_name, 'N/A') as driver_name,
+        COALESCE(dr.driver_phone, 'N/A') as driver_phone,
+        'store' as order_type
+    FROM orders o
+    LEFT JOIN driver_orders dro ON o.id = dro.order_id AND dro.service = 'necessities'
+    LEFT JOIN drivers dr ON dro.driver_id = dr.id
+    WHERE o.buyer_id = %s AND o.order_status = '已送達'
+
+    UNION ALL
+
+    SELECT
+        apo.id as order_id,
+        apo.timestamp,
+        apo.end_point as location,
+        (ap.price * apo.quantity) as total_price,
+        apo.status as order_status,
+        COALESCE(dr.driver_name, 'N/A') as driver_name,
+        COALESCE(dr.driver_phone, 'N/A') as driver_phone,
+        'agricultural' as order_type
+    FROM agricultural_product_order apo
+    JOIN agricultural_produce ap ON apo.produce_id = ap.id
+    LEFT JOIN driver_orders dro ON apo.id = dro.order_id AND dro.service = 'agricultural_product'
+    LEFT JOIN drivers dr ON dro.driver_id = dr.id
+    WHERE apo.buyer_id = %s AND apo.status = '已送達'
+
+    ORDER BY timestamp DESC
+"""
+
+HISTORY_STATS_QUERY = """
+    SELECT
+        'last_30_days' as period,
+        COUNT(*) as total_orders,
+        SUM(total_price) as total_revenue
+    FROM (
+        SELECT total_price, timestamp FROM orders WHERE order_status = '已送達'
+        UNION ALL
+        SELECT (ap.price * apo.quantity) as total_price, apo.timestamp
+        FROM agricultural_product_order apo
+        JOIN agricultural_produce ap ON apo.produce_id = ap.id
+        WHERE apo.status = '已送達'
+    ) combined
+    WHERE timestamp >= NOW() - INTERVAL '30 days'
+
+    UNION ALL
+
+    SELECT
+        'last_90_days' as period,
+        COUNT(*) as total_orders,
+        SUM(total_price) as total_revenue
+    FROM (
+        SELECT total_price, timestamp FROM orders WHERE order_status = '已送達'
+        UNION ALL
+        SELECT (ap.price * apo.quantity) as total_price, apo.timestamp
+        FROM agricultural_product_order apo
+        JOIN agricultural_produce ap ON apo.produce_id = ap.id
+        WHERE apo.status = '已送達'
+    ) combined
+    WHERE timestamp >= NOW() - INTERVAL '90 days'
+
+    UNION ALL
+
+    SELECT
+        'older_than_90_days' as period,
+        COUNT(*) as total_orders,
+        SUM(total_price) as total_revenue
+    FROM (
+        SELECT total_price, timestamp FROM orders WHERE order_status = '已送達'
+        UNION ALL
+        SELECT (ap.price * apo.quantity) as total_price, apo.timestamp
+        FROM agricultural_product_order apo
+        JOIN agricultural_produce ap ON apo.produce_id = ap.id
+        WHERE apo.status = '已送達'
+    ) combined
+    WHERE timestamp < NOW() - INTERVAL '90 days'
+"""
+
+SELLER_HISTORY_QUERY = """
+    SELECT
+        o.id as order_id,
+        o.timestamp,
+        o.location,
+        o.total_price,
+        o.order_status,
+        u.name as buyer_name,
+        u.phone as buyer_phone,
+        COALESCE(dr.driver_name, 'N/A') as driver_name,
+        'store' as order_type
+    FROM orders o
+    JOIN users u ON o.buyer_id = u.id
+    LEFT JOIN driver_orders dro ON o.id = dro.order_id AND dro.service = 'necessities'
+    LEFT JOIN drivers dr ON dro.driver_id = dr.id
+    WHERE o.seller_id = %s AND o.order_status = '已送達'
+
+    UNION ALL
+
+    SELECT
+        apo.id as order_id,
+        apo.timestamp,
+        apo.end_point as location,
+        (ap.price * apo.quantity) as total_price,
+        apo.status as order_status,
+        u.name as buyer_name,
+        u.phone as buyer_phone,
+        COALESCE(dr.driver_name, 'N/A') as driver_name,
+        'agricultural' as order_type
+    FROM agricultural_product_order apo
+    JOIN agricultural_produce ap ON apo.produce_id = ap.id
+    JOIN users u ON apo.buyer_id = u.id
+    LEFT JOIN driver_orders dro ON apo.id = dro.order_id AND dro.service = 'agricultural_product'
+    LEFT JOIN drivers dr ON dro.driver_id = dr.id
+    WHERE ap.seller_id = %s AND apo.status = '已送達'
+
+    ORDER BY timestamp DESC
+"""
+
 @router.post("/cleanup-old-history")
-async def cleanup_old_history():
+async def cleanup_old_history(batch_size: int = BATCH_SIZE, max_batches: Optional[int] = None):
     """
     Clean up transaction history older than 3 months (completed orders)
     Also cleans up cancelled orders older than 180 days (6 months)
+    Rows are archived and deleted in small batches; an interrupted run resumes
+    where it stopped (see /cleanup-status)
     Returns count of deleted records
     """
-    conn = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Calculate cutoff date for completed orders (3 months ago)
-        cutoff_date = datetime.now() - timedelta(days=90)
-        cutoff_str = cutoff_date.strftime('%Y-%m-%d %H:%M:%S')
-        
-        # Calculate cutoff date for cancelled orders (180 days / 6 months ago)
-        cancelled_cutoff_date = datetime.now() - timedelta(days=180)
-        cancelled_cutoff_str = cancelled_cutoff_date.strftime('%Y-%m-%d %H:%M:%S')
-        
-        # Count records to be deleted (completed orders)
-        count_query = """
-        SELECT 
-            (SELECT COUNT(*) FROM orders WHERE timestamp < %s AND order_status = '已送達') +
-            (SELECT COUNT(*) FROM agricultural_product_order WHERE timestamp < %s AND status = '已送達') as total_count
-        """
-        cursor.execute(count_query, (cutoff_str, cutoff_str))
-        total_count = cursor.fetchone()[0]
-        
-        # Count cancelled orders to be deleted
-        cancelled_count_query = """
-        SELECT 
-            (SELECT COUNT(*) FROM orders WHERE timestamp < %s AND order_status = '已取消') +
-            (SELECT COUNT(*) FROM agricultural_product_order WHERE timestamp < %s AND status = '已取消') as cancelled_count
-        """
-        cursor.execute(cancelled_count_query, (cancelled_cutoff_str, cancelled_cutoff_str))
-        cancelled_count = cursor.fetchone()[0]
-        
-        # Delete old completed orders
-        delete_orders_query = """
-        DELETE FROM orders 
-        WHERE timestamp < %s AND order_status = '已送達'
-        """
-        cursor.execute(delete_orders_query, (cutoff_str,))
-        
-        # Delete old completed agricultural orders
-        delete_agri_query = """
-        DELETE FROM agricultural_product_order 
-        WHERE timestamp < %s AND status = '已送達'
-        """
-        cursor.execute(delete_agri_query, (cutoff_str,))
-        
-        # Delete old cancelled orders (180 days old)
-        delete_cancelled_orders_query = """
-        DELETE FROM orders 
-        WHERE timestamp < %s AND order_status = '已取消'
-        """
-        cursor.execute(delete_cancelled_orders_query, (cancelled_cutoff_str,))
-        
-        # Delete old cancelled agricultural orders
-        delete_cancelled_agri_query = """
-        DELETE FROM agricultural_product_order 
-        WHERE timestamp < %s AND status = '已取消'
-        """
-        cursor.execute(delete_cancelled_agri_query, (cancelled_cutoff_str,))
-        
-        conn.commit()
-        cursor.close()
-        
-        return {
-            "success": True,
-            "deleted_completed": total_count,
-            "deleted_cancelled": cancelled_count,
-            "total_deleted": total_count + cancelled_count,
-            "cutoff_date_completed": cutoff_str,
-            "cutoff_date_cancelled": cancelled_cutoff_str,
-            "message": f"Successfully deleted {total_count} completed orders (90+ days) and {cancelled_count} cancelled orders (180+ days)"
-        }
-        
-    except Exception as e:
-        if conn:
-            conn.rollback()
-        return {"success": False, "error": str(e)}
-    finally:
-        if conn:
-            return_db_connection(conn)
+    # The engine is blocking (psycopg2 + throttle sleeps), keep it off the event loop
+    return await run_in_threadpool(run_history_cleanup, batch_size=batch_size, max_batches=max_batches)
+
+@router.get("/cleanup-status")
+async def cleanup_status():
+    """
+    Get progress and resume state of the batched history cleanup
+    """
+    return get_cleanup_status()
 
 @router.get("/export-driver-history/{driver_id}")
 async def export_driver_history(driver_id: int, format: str = "excel"):
@@ -103,60 +207,13 @@ async def export_driver_history(driver_id: int, format: str = "excel"):
     """
     conn = None
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         cursor = conn.cursor()
         
         # Get driver's completed orders
         # Use subquery to get the most recent driver_orders entry for each order
         # This ensures we get all completed orders even if there are multiple driver_orders entries
-        query = """
-        SELECT 
-            o.id as order_id,
-            o.timestamp,
-            o.location,
-            o.total_price,
-            o.order_status,
-            u.name as buyer_name,
-            u.phone as buyer_phone,
-            'store' as order_type
-        FROM orders o
-        JOIN users u ON o.buyer_id = u.id
-        WHERE o.order_status = '已送達'
-        AND EXISTS (
-            SELECT 1 
-            FROM driver_orders dro 
-            WHERE dro.order_id = o.id 
-            AND dro.service = 'necessities' 
-            AND dro.driver_id = %s
-        )
-        
-        UNION ALL
-        
-        SELECT 
-            apo.id as order_id,
-            apo.timestamp,
-            apo.end_point as location,
-            (ap.price * apo.quantity) as total_price,
-            apo.status as order_status,
-            u.name as buyer_name,
-            u.phone as buyer_phone,
-            'agricultural' as order_type
-        FROM agricultural_product_order apo
-        JOIN agricultural_produce ap ON apo.produce_id = ap.id
-        JOIN users u ON apo.buyer_id = u.id
-        WHERE apo.status = '已送達'
-        AND EXISTS (
-            SELECT 1 
-            FROM driver_orders dro 
-            WHERE dro.order_id = apo.id 
-            AND dro.service = 'agricultural_product' 
-            AND dro.driver_id = %s
-        )
-        
-        ORDER BY timestamp DESC
-        """
-        
-        cursor.execute(query, (driver_id, driver_id))
+        cursor.execute(DRIVER_HISTORY_QUERY, (driver_id, driver_id))
         results = cursor.fetchall()
         
         if not results:
@@ -224,46 +281,11 @@ async def export_buyer_history(user_id: int, format: str = "excel"):
     """
     conn = None
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         cursor = conn.cursor()
         
         # Get buyer's completed orders
-        query = """
-        SELECT 
-            o.id as order_id,
-            o.timestamp,
-            o.location,
-            o.total_price,
-            o.order_status,
-            COALESCE(dr.driver_name, 'N/A') as driver_name,
-            COALESCE(dr.driver_phone, 'N/A') as driver_phone,
-            'store' as order_type
-        FROM orders o
-        LEFT JOIN driver_orders dro ON o.id = dro.order_id AND dro.service = 'necessities'
-        LEFT JOIN drivers dr ON dro.driver_id = dr.id
-        WHERE o.buyer_id = %s AND o.order_status = '已送達'
-        
-        UNION ALL
-        
-        SELECT 
-            apo.id as order_id,
-            apo.timestamp,
-            apo.end_point as location,
-            (ap.price * apo.quantity) as total_price,
-            apo.status as order_status,
-            COALESCE(dr.driver_name, 'N/A') as driver_name,
-            COALESCE(dr.driver_phone, 'N/A') as driver_phone,
-            'agricultural' as order_type
-        FROM agricultural_product_order apo
-        JOIN agricultural_produce ap ON apo.produce_id = ap.id
-        LEFT JOIN driver_orders dro ON apo.id = dro.order_id AND dro.service = 'agricultural_product'
-        LEFT JOIN drivers dr ON dro.driver_id = dr.id
-        WHERE apo.buyer_id = %s AND apo.status = '已送達'
-        
-        ORDER BY timestamp DESC
-        """
-        
-        cursor.execute(query, (user_id, user_id))
+        cursor.execute(BUYER_HISTORY_QUERY, (user_id, user_id))
         results = cursor.fetchall()
         
         if not results:
@@ -330,59 +352,11 @@ async def get_history_stats():
     """
     conn = None
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         cursor = conn.cursor()
         
         # Get stats for different time periods
-        stats_query = """
-        SELECT 
-            'last_30_days' as period,
-            COUNT(*) as total_orders,
-            SUM(total_price) as total_revenue
-        FROM (
-            SELECT total_price, timestamp FROM orders WHERE order_status = '已送達'
-            UNION ALL
-            SELECT (ap.price * apo.quantity) as total_price, apo.timestamp 
-            FROM agricultural_product_order apo
-            JOIN agricultural_produce ap ON apo.produce_id = ap.id
-            WHERE apo.status = '已送達'
-        ) combined
-        WHERE timestamp >= NOW() - INTERVAL '30 days'
-        
-        UNION ALL
-        
-        SELECT 
-            'last_90_days' as period,
-            COUNT(*) as total_orders,
-            SUM(total_price) as total_revenue
-        FROM (
-            SELECT total_price, timestamp FROM orders WHERE order_status = '已送達'
-            UNION ALL
-            SELECT (ap.price * apo.quantity) as total_price, apo.timestamp 
-            FROM agricultural_product_order apo
-            JOIN agricultural_produce ap ON apo.produce_id = ap.id
-            WHERE apo.status = '已送達'
-        ) combined
-        WHERE timestamp >= NOW() - INTERVAL '90 days'
-        
-        UNION ALL
-        
-        SELECT 
-            'older_than_90_days' as period,
-            COUNT(*) as total_orders,
-            SUM(total_price) as total_revenue
-        FROM (
-            SELECT total_price, timestamp FROM orders WHERE order_status = '已送達'
-            UNION ALL
-            SELECT (ap.price * apo.quantity) as total_price, apo.timestamp 
-            FROM agricultural_product_order apo
-            JOIN agricultural_produce ap ON apo.produce_id = ap.id
-            WHERE apo.status = '已送達'
-        ) combined
-        WHERE timestamp < NOW() - INTERVAL '90 days'
-        """
-        
-        cursor.execute(stats_query)
+        cursor.execute(HISTORY_STATS_QUERY)
         results = cursor.fetchall()
         
         stats = {}
@@ -414,50 +388,11 @@ async def export_seller_history(seller_id: int, format: str = "excel"):
     """
     conn = None
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         cursor = conn.cursor()
         
         # Get seller's completed orders (both store and agricultural)
-        query = """
-        SELECT 
-            o.id as order_id,
-            o.timestamp,
-            o.location,
-            o.total_price,
-            o.order_status,
-            u.name as buyer_name,
-            u.phone as buyer_phone,
-            COALESCE(dr.driver_name, 'N/A') as driver_name,
-            'store' as order_type
-        FROM orders o
-        JOIN users u ON o.buyer_id = u.id
-        LEFT JOIN driver_orders dro ON o.id = dro.order_id AND dro.service = 'necessities'
-        LEFT JOIN drivers dr ON dro.driver_id = dr.id
-        WHERE o.seller_id = %s AND o.order_status = '已送達'
-        
-        UNION ALL
-        
-        SELECT 
-            apo.id as order_id,
-            apo.timestamp,
-            apo.end_point as location,
-            (ap.price * apo.quantity) as total_price,
-            apo.status as order_status,
-            u.name as buyer_name,
-            u.phone as buyer_phone,
-            COALESCE(dr.driver_name, 'N/A') as driver_name,
-            'agricultural' as order_type
-        FROM agricultural_product_order apo
-        JOIN agricultural_produce ap ON apo.produce_id = ap.id
-        JOIN users u ON apo.buyer_id = u.id
-        LEFT JOIN driver_orders dro ON apo.id = dro.order_id AND dro.service = 'agricultural_product'
-        LEFT JOIN drivers dr ON dro.driver_id = dr.id
-        WHERE ap.seller_id = %s AND apo.status = '已送達'
-        
-        ORDER BY timestamp DESC
-        """
-        
-        cursor.execute(query, (seller_id, seller_id))
+        cursor.execute(SELLER_HISTORY_QUERY, (seller_id, seller_id))
         results = cursor.fetchall()
         
         if not results:
@@ -0,0 +1,81 @@
+# backend/routers/ledger.py
+from fastapi import APIRouter, HTTPException, Header
+from datetime import datetime
+from typing import Optional
+from backend.database import get_db_connection, return_db_connection
+from backend.services.ledger import (
+    get_balance, balance_at, take_snapshot, verify_balances,
+    ESCROW_ACCOUNT, DRIVER_WALLET_ACCOUNT, PLATFORM_OWNER, DEFAULT_CURRENCY
+)
+from backend.routers.payments import require_admin
+
+router = APIRouter(prefix="/api/ledger", tags=["ledger"])
+
+def _read_balance(account: str, owner_id: int, currency: str, at: Optional[datetime]):
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        if at is None:
+            balance = get_balance(cur, account, owner_id, currency)
+        else:
+            balance = balance_at(cur, account, at, owner_id, currency)
+        conn.rollback()
+        cur.close()
+        return {
+            "account": account,
+            "owner_id": owner_id,
+            "currency": currency,
+            "balance": float(balance),
+            "at": at.isoformat() if at else None
+        }
+    except Exception as e:
+        raise HTTPException(500, f"Error reading balance: {str(e)}")
+    finally:
+        if conn:
+            return_db_connection(conn)
+
+@router.get("/balances/escrow")
+def get_escrow_balance(currency: str = DEFAULT_CURRENCY, at: Optional[datetime] = None, x_admin_key: Optional[str] = Header(None)):
+    """
+    Platform escrow balance, now or at a point in time (`at`).
+    """
+    require_admin(x_admin_key)
+    return _read_balance(ESCROW_ACCOUNT, PLATFORM_OWNER, currency, at)
+
+@router.get("/balances/drivers/{driver_id}")
+def get_driver_wallet_balance(driver_id: int, currency: str = DEFAULT_CURRENCY, at: Optional[datetime] = None):
+    """
+    A driver's wallet balance, now or at a point in time (`at`).
+    """
+    return _read_balance(DRIVER_WALLET_ACCOUNT, driver_id, currency, at)
+
+@router.post("/snapshots")
+def create_ledger_snapshot(x_admin_key: Optional[str] = Header(None)):
+    require_admin(x_admin_key)
+    conn = None
+    try:
+        conn = get_db_connection()
+        return {"snapshot_rows": take_snapshot(conn)}
+    except Exception as e:
+        raise HTTPException(500, f"Error taking ledger snapshot: {str(e)}")
+    finally:
+        if conn:
+            return_db_connection(conn)
+
+@router.get("/verify")
+def verify_ledger_balances(x_admin_key: Optional[str] = Header(None)):
+    """
+    Reconcile account_balances and the latest snapshot against the raw entries.
+    """
+    require_admin(x_admin_key)
+    conn = None
+    try:
+        conn = get_db_connection()
+        mismatches = verify_balances(conn)
+        return {"ok": not mismatches, "mismatches": [m.describe() for m in mismatches]}
+    except Exception as e:
+        raise HTTPException(500, f"Error verifying ledger balances: {str(e)}")
+    finally:
+        if conn:
+            return_db_connection(conn)
@@ -0,0 +1,66 @@
+"""
+Media file API.
+
+Serves files from the local content-addressed media store. File names are
+content hashes, so responses are cacheable forever.
+
+Endpoints:
+- GET /{filename}: Serve a stored file ('<sha256><ext>') or image variant ('<sha256>.thumb.webp')
+"""
+import os
+from fastapi import APIRouter, HTTPException, Response
+from fastapi.responses import FileResponse, RedirectResponse
+from backend.services.media_store import media_store, CONTENT_TYPES_BY_EXTENSION
+from backend.services.image_variants import parse_variant_filename, find_original, schedule_variants
+
+router = APIRouter()
+
+# Content-addressed: the bytes behind a URL never change
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+PENDING_VARIANT_CACHE_CONTROL = "public, max-age=60"
+
+# When set (e.g. "/protected-media/"), nginx serves the file via X-Accel-Redirect
+ACCEL_REDIRECT_PREFIX = os.getenv('MEDIA_ACCEL_REDIRECT_PREFIX')
+
+
+def serve_stored_file(store, filename: str, cache_control: str = IMMUTABLE_CACHE_CONTROL, accel_prefix=ACCEL_REDIRECT_PREFIX):
+    """
+    Build the response for a stored file: local file (optionally through
+    X-Accel-Redirect), or a redirect to its remote copy.
+    """
+    path = store.find(filename)
+    if path is None:
+        remote = store.remote_url(filename)
+        if remote:
+            return RedirectResponse(remote, status_code=302)
+        raise HTTPException(status_code=404, detail="File not found")
+
+    media_type = CONTENT_TYPES_BY_EXTENSION.get(os.path.splitext(filename)[1], "application/octet-stream")
+    headers = {"Cache-Control": cache_control}
+    if accel_prefix:
+        relative = os.path.relpath(path, store.root).replace(os.sep, '/')
+        headers["X-Accel-Redirect"] = accel_prefix.rstrip('/') + '/' + relative
+        return Response(media_type=media_type, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+@router.get("/{filename}")
+async def get_media(filename: str):
+    """
+    Serve a stored media file or one of its image variants.
+
+    Args:
+        filename (str): '<sha256><ext>' as returned by the upload endpoint,
+            or '<sha256>.<variant><ext>' (thumb / medium).
+
+    Returns:
+        The file.
+    """
+    variant = parse_variant_filename(filename)
+    if variant and media_store.find(filename) is None:
+        # Variant not generated yet: queue it and serve the original without long-term caching
+        original = find_original(variant[0])
+        if original is not None:
+            schedule_variants(variant[0], original)
+            return serve_stored_file(media_store, os.path.basename(original), cache_control=PENDING_VARIANT_CACHE_CONTROL)
+    return serve_stored_file(media_store, filename)
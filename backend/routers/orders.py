@@ -11,20 +11,111 @@ Endpoints:
 - POST /{service}/{order_id}/complete: Complete an order.
 """
 
-from typing import List
+from typing import List, Optional
 import logging
 from datetime import datetime
 import json
 from backend.handlers.send_message import LineMessageService
 from psycopg2.extensions import connection as Connection
-from fastapi import APIRouter, HTTPException, Depends, Request, Query
+from fastapi import APIRouter, HTTPException, Depends, Header, Request, Response, Query
 from backend.models.models import Order, DriverOrder, TransferOrderRequest, DetailedOrder, PendingTransfer, AcceptTransferRequest, CancelOrderRequest, CompleteOrderRequest
-from backend.database import get_db_connection, return_db_connection
+from backend.database import get_read_connection, return_db_connection
+from backend.services.catalog_cache import catalog_cache
+from backend.services.order_index import order_index
+from backend.services.order_claim import claim_order, ClaimError
+from backend.services.order_state import (
+    transition, TransitionError,
+    UNACCEPTED, ACCEPTED, IN_DELIVERY, DELIVERED, EXPIRED, DELIVERY_OVERDUE, CANCELLED,
+    RETURNED_TO_SELLER, DISPOSED, DONATED, COMPLETED
+)
+from backend.services.inventory import release_stock
+from backend.services.idempotency import claim_key, store_response, request_fingerprint, REPLAY_HEADER
+from backend.services.order_store import insert_order
+from backend.services.prepared_statements import prepared
+from backend.services.partitions import OPEN_ORDERS_SINCE
+from backend.services.geocode import distance_to_location, AUTHORITATIVE_MATCHES
 import os
 
 line_service = LineMessageService()
 router = APIRouter()
 
+# Order board query, prepared once per pooled connection
+ORDER_BOARD = prepared("orders_board_unaccepted", f"""
+    SELECT 
+        o.id, o.buyer_id, o.buyer_name, o.buyer_phone, o.location, o.is_urgent, 
+        o.total_price, o.order_type, o.order_status, o.note, o.timestamp,
+        oi.id as item_id, oi.item_id as item_product_id, oi.item_name, oi.price, 
+        oi.quantity, oi.img, oi.location as item_location, oi.category,
+        COALESCE(oi.selected_options, 'null') as selected_options
+    FROM orders o
+    LEFT JOIN order_items oi ON o.id = oi.order_id
+    WHERE o.order_status = '未接單' AND o.timestamp >= {OPEN_ORDERS_SINCE}
+    ORDER BY o.timestamp DESC, o.id, oi.id
+    LIMIT 200
+""")
+
+# Other hot reads; backend/benchmarks/query_plans.py checks the plans of all of them
+AGRI_ORDER_BOARD = """
+    SELECT agri_p_o.id, agri_p_o.buyer_id, agri_p_o.buyer_name, agri_p_o.buyer_phone, agri_p_o.end_point, agri_p_o.status, agri_p_o.note,
+            agri_p.id, agri_p.name, agri_p.price, agri_p_o.quantity, agri_p.img_link, agri_p_o.starting_point, agri_p.category, agri_p_o.is_put,agri_p_o.timestamp
+    FROM agricultural_product_order as agri_p_o
+    JOIN agricultural_produce as agri_p ON agri_p.id = agri_p_o.produce_id
+    WHERE agri_p_o.status = '未接單'
+    ORDER BY agri_p_o.timestamp DESC
+    LIMIT 200
+"""
+
+SELLER_ORDERS_QUERY = """
+    SELECT id, buyer_name, buyer_phone, order_status, date, time, location, total_price, order_type
+    FROM orders
+    WHERE seller_id = %s
+    ORDER BY date DESC, time DESC
+"""
+
+SELLER_AGRI_ORDERS_QUERY = """
+    SELECT apo.id, apo.buyer_name, apo.buyer_phone, apo.status, apo.timestamp,
+           apo.starting_point, apo.end_point, apo.quantity, p.name as product_name, p.price,
+           p.img_link, p.category
+    FROM agricultural_product_order apo
+    LEFT JOIN agricultural_produce p ON apo.produce_id = p.id
+    WHERE apo.seller_id = %s
+    ORDER BY apo.timestamp DESC
+"""
+
+# Items share their order's timestamp (order_items_order_fkey), so each
+# order's items are read from one partition; OFFSET 0 keeps that per-order
+# lookup instead of a scan of every order_items partition
+_BUYER_ORDERS = """
+    SELECT
+        o.id, o.buyer_id, o.buyer_name, o.buyer_phone, o.location, o.is_urgent,
+        o.total_price, o.order_type, o.order_status, o.note, o.timestamp,
+        oi.item_id, oi.item_name, oi.price, oi.quantity, oi.img, oi.location as item_location,
+        oi.category, COALESCE(oi.selected_options, 'null') as selected_options
+    FROM orders o
+    LEFT JOIN LATERAL (
+        SELECT * FROM order_items
+        WHERE order_items.order_id = o.id AND order_items.timestamp = o.timestamp
+        OFFSET 0
+    ) oi ON TRUE
+    WHERE o.buyer_id = %s{status_filter}
+    ORDER BY o.timestamp DESC, o.id, oi.id
+"""
+BUYER_ORDERS_QUERY = _BUYER_ORDERS.format(status_filter="")
+BUYER_ACTIVE_ORDERS_QUERY = _BUYER_ORDERS.format(status_filter=" AND o.order_status != '已取消'")
+
+_BUYER_AGRI_ORDERS = """
+    SELECT agri_p_o.id, agri_p_o.buyer_id, agri_p_o.buyer_name, agri_p_o.buyer_phone,
+           agri_p_o.end_point, agri_p_o.status, agri_p_o.note, agri_p_o.timestamp,
+           agri_p.id, agri_p.name, agri_p.price, agri_p_o.quantity, agri_p.img_link,
+           agri_p_o.starting_point, agri_p.category
+    FROM agricultural_product_order as agri_p_o
+    JOIN agricultural_produce as agri_p on agri_p.id = agri_p_o.produce_id
+    WHERE agri_p_o.buyer_id = %s{status_filter}
+    ORDER BY agri_p_o.timestamp DESC
+"""
+BUYER_AGRI_ORDERS_QUERY = _BUYER_AGRI_ORDERS.format(status_filter="")
+BUYER_ACTIVE_AGRI_ORDERS_QUERY = _BUYER_AGRI_ORDERS.format(status_filter=" AND agri_p_o.status != '已取消'")
+
 log_dir = os.path.join(os.getcwd(), 'backend', 'logs')
 
 if not os.path.exists(log_dir):
@@ -48,6 +139,112 @@ def log_event(event_type: str, data: dict):
     }
     logger.info(json.dumps(log_data))
 
+# Maximum distance between the driver's GPS fix and the delivery address when completing an order
+DELIVERY_RADIUS_KM = float(os.getenv('DELIVERY_RADIUS_KM', '0.5'))
+# A driver may complete an order it holds, picked up or not
+COMPLETABLE_STATUSES = (IN_DELIVERY, ACCEPTED)
+
+# Limits for GET /nearby
+NEARBY_DEFAULT_K = 20
+NEARBY_MAX_K = 200
+NEARBY_MAX_RADIUS_KM = 50.0
+
+def verify_delivery_location(order_id: int, gps_data: CompleteOrderRequest, delivery_address: str) -> dict:
+    """
+    Check the driver's GPS fix against the geocoded delivery address (local
+    gazetteer, no external call). Addresses that cannot be geocoded, or only
+    match a place name contained in them, are accepted unverified.
+
+    Raises:
+        HTTPException: 422 if the driver is farther than DELIVERY_RADIUS_KM
+        from coordinates or an exactly matched place.
+    """
+    check = distance_to_location(gps_data.latitude, gps_data.longitude, delivery_address)
+    if check is None:
+        logger.info(f"Order {order_id} completion - Driver GPS: ({gps_data.latitude}, {gps_data.longitude}), "
+                    f"delivery address '{delivery_address}' not geocoded; location not verified")
+        return {"verified": False, "distance_km": None, "radius_km": DELIVERY_RADIUS_KM}
+
+    distance_km, place = check
+    enforced = place.match in AUTHORITATIVE_MATCHES
+    within = distance_km <= DELIVERY_RADIUS_KM
+    result = {
+        "verified": enforced and within,
+        "distance_km": round(distance_km, 3),
+        "radius_km": DELIVERY_RADIUS_KM,
+        "place": place.place,
+        "match": place.match
+    }
+    log_event("ORDER_COMPLETION_LOCATION_CHECK", {
+        "order_id": order_id,
+        "gps_latitude": gps_data.latitude,
+        "gps_longitude": gps_data.longitude,
+        "delivery_address": delivery_address,
+        **result
+    })
+    if enforced and not within:
+        raise HTTPException(
+            status_code=422,
+            detail=f"您目前距離配送地點約 {distance_km:.2f} 公里，請確認已到達配送地點（{delivery_address}）後再完成訂單"
+        )
+    return result
+
+def expire_stale_orders(conn: Connection, batch_size: int = 100) -> dict:
+    """
+    Mark unaccepted orders older than 2 hours as '已過期' and accepted orders
+    older than 4 hours as '配送逾時'. Runs in small committed batches so the
+    row locks are short; called periodically by the background scheduler.
+    Args:
+        conn (Connection): The database connection.
+        batch_size (int): Maximum rows updated per transaction.
+    Returns:
+        dict: Number of orders marked per status.
+    """
+    expiry_rules = [
+        (UNACCEPTED, EXPIRED, '2 hours'),
+        (ACCEPTED, DELIVERY_OVERDUE, '4 hours'),
+    ]
+    counts = {}
+    cur = conn.cursor()
+    try:
+        for from_status, to_status, age in expiry_rules:
+            total = 0
+            while True:
+                cur.execute(
+                    f"""
+                    WITH expired_orders AS (
+                        SELECT id FROM orders
+                        WHERE order_status = %s
+                        AND timestamp < NOW() - INTERVAL '{age}'
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    UPDATE orders
+                    SET order_status = %s
+                    WHERE id IN (SELECT id FROM expired_orders)
+                    """,
+                    (from_status, batch_size, to_status)
+                )
+                updated = cur.rowcount
+                conn.commit()
+                total += updated
+                if updated < batch_size:
+                    break
+            counts[to_status] = total
+        if any(counts.values()):
+            order_index.invalidate()
+            log_event("AUTO_EXPIRED_ORDERS", {
+                "updated_unaccepted": counts[EXPIRED],
+                "updated_accepted": counts[DELIVERY_OVERDUE],
+                "during": "scheduler"
+            })
+        return counts
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
 async def notify_drivers_new_order(order_id: int, order: DetailedOrder, conn: Connection):
     """
     Notify all drivers with LINE accounts about a new unaccepted order.
@@ -115,21 +312,24 @@ async def notify_drivers_new_order(order_id: int, order: DetailedOrder, conn: Co
 def get_db():
     """
     Dependency function to get a database connection.
+    GET requests may be served by the read replica (database.get_read_connection).
     """
-    conn = get_db_connection()
+    conn = get_read_connection()
     try:
         yield conn
     finally:
         return_db_connection(conn)
 
 @router.post("/", response_model=Order)
-async def create_order(order: DetailedOrder, conn: Connection = Depends(get_db), request: Request = None):
+async def create_order(order: DetailedOrder, response: Response, conn: Connection = Depends(get_db), request: Request = None,
+                       idempotency_key: Optional[str] = Header(None)):
     """
     Create a new order.
     Args:
         order (DetailedOrder): The order data to be created.
         conn (Connection): The database connection.
         request (Request): The incoming request.
+        idempotency_key (Optional[str]): Idempotency-Key header; retries with the same key replay the first response.
     Returns:
         Order: The created order with its ID.
     """
@@ -161,65 +361,24 @@ async def create_order(order: DetailedOrder, conn: Connection = Depends(get_db),
             "client_ip": request.client.host if request else "N/A"
         })
         
-        # Check for duplicate orders (same buyer, same items, within last 5 seconds)
-        # This prevents accidental double-submission
-        duplicate_check_query = """
-        SELECT id FROM orders 
-        WHERE buyer_id = %s 
-        AND total_price = %s 
-        AND location = %s 
-        AND timestamp > NOW() - INTERVAL '5 seconds'
-        AND order_status = '未接單'
-        ORDER BY timestamp DESC
-        LIMIT 1
-        """
-        cur.execute(duplicate_check_query, (order.buyer_id, order.total_price, order.location))
-        duplicate_order = cur.fetchone()
-        
-        if duplicate_order:
-            duplicate_id = duplicate_order[0]
+        # Idempotency-Key: a retried submit replays the first response instead of creating a duplicate
+        claim = claim_key(cur, "orders:create", idempotency_key, request_fingerprint(order))
+        if claim and claim.replay:
+            conn.rollback()
             log_event("DUPLICATE_ORDER_PREVENTED", {
                 "buyer_id": order.buyer_id,
-                "duplicate_order_id": duplicate_id,
-                "new_order_attempt": True
+                "idempotency_key": claim.key,
+                "duplicate_order_id": (claim.body or {}).get("id")
             })
-            # Return the existing order instead of creating a duplicate
-            cur.execute("""
-                SELECT id, buyer_id, buyer_name, buyer_phone, location, is_urgent, total_price,
-                       order_type, order_status, note, timestamp
-                FROM orders WHERE id = %s
-            """, (duplicate_id,))
-            existing_order = cur.fetchone()
-            if existing_order:
-                # Get order items
-                cur.execute("SELECT item_id, item_name, price, quantity, img, location, category, selected_options FROM order_items WHERE order_id = %s", (duplicate_id,))
-                items = cur.fetchall()
-                # Return existing order
-                order.id = duplicate_id
-                return order
-            
-        cur.execute(
-            "INSERT INTO orders (buyer_id, buyer_name, buyer_phone, seller_id, seller_name, seller_phone, date, time, location, is_urgent, total_price, order_type, order_status, note, shipment_count, required_orders_count, previous_driver_id, previous_driver_name, previous_driver_phone) "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id",
-            (order.buyer_id, order.buyer_name, order.buyer_phone, order.seller_id, order.seller_name, order.seller_phone, order.date,
-             order.time, order.location, order.is_urgent, order.total_price, order.order_type, order.order_status, order.note, order.shipment_count, order.required_orders_count, order.previous_driver_id,
-             order.previous_driver_name, order.previous_driver_phone)
-        )
-        order_id = cur.fetchone()[0]
-        for item in order.items:
-            # Convert selectedOptions to JSON string if present
-            selected_options_json = None
-            if item.selectedOptions:
-                import json
-                selected_options_json = json.dumps(item.selectedOptions)
-            
-            cur.execute(
-                "INSERT INTO order_items (order_id, item_id, item_name, price, quantity, img, location, category, selected_options) "
-                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                (order_id, item.item_id, item.item_name, item.price, item.quantity, item.img, item.location, item.category, selected_options_json)
-            )
-        conn.commit()
+            response.headers[REPLAY_HEADER] = "true"
+            return claim.body
+
+        # Order and all items in one statement
+        order_id = insert_order(cur, order)
         order.id = order_id
+        store_response(cur, claim, order.model_dump(mode="json"))
+        conn.commit()
+        order_index.invalidate()
         log_event("ORDER_CREATED", {
             "order_id": order_id,
             "buyer_id": order.buyer_id,
@@ -235,6 +394,9 @@ async def create_order(order: DetailedOrder, conn: Connection = Depends(get_db),
             # Don't fail the order creation if notification fails
         
         return order
+    except HTTPException:
+        conn.rollback()
+        raise
     except Exception as e:
         log_event("ORDER_CREATION_ERROR", {
             "error": str(e),
@@ -256,14 +418,16 @@ async def cleanup_expired_orders(conn: Connection = Depends(get_db)):
         cur.execute(
             """
             UPDATE orders 
-            SET order_status = '已過期'
-            WHERE order_status = '未接單' 
+            SET order_status = %s
+            WHERE order_status = %s 
             AND timestamp < NOW() - INTERVAL '2 hours'
             RETURNING id, timestamp
-            """
+            """,
+            (EXPIRED, UNACCEPTED)
         )
         expired_orders = cur.fetchall()
         conn.commit()
+        order_index.invalidate()
         
         expired_count = len(expired_orders)
         if expired_count > 0:
@@ -303,29 +467,25 @@ async def handle_expired_order(
         
         # Update order status based on action
         status_mapping = {
-            'return_to_seller': '已退回賣家',
-            'dispose': '已丟棄',
-            'donate': '已捐贈',
-            'customer_still_wants': '已完成'
+            'return_to_seller': RETURNED_TO_SELLER,
+            'dispose': DISPOSED,
+            'donate': DONATED,
+            'customer_still_wants': COMPLETED
         }
         
         new_status = status_mapping[action]
         
-        cur.execute(
-            """
-            UPDATE orders 
-            SET order_status = %s, note = CONCAT(COALESCE(note, ''), ' [過期處理: ', %s, ' - ', %s, ']')
-            WHERE id = %s
-            RETURNING buyer_id, total_price
-            """,
-            (new_status, action, reason, order_id)
-        )
-        
-        result = cur.fetchone()
-        if not result:
-            raise HTTPException(status_code=404, detail="Order not found")
+        try:
+            moved = transition(
+                cur, 'necessities', order_id, new_status,
+                columns=('buyer_id', 'total_price'),
+                append_note=f" [過期處理: {action} - {reason}]"
+            )
+        except TransitionError as te:
+            detail = "Order not found" if te.reason == "order_not_found" else te.detail
+            raise HTTPException(status_code=te.status_code, detail=detail) from te
         
-        buyer_id, total_price = result
+        buyer_id, total_price = moved.row['buyer_id'], moved.row['total_price']
         
         # If disposing or donating, process refund
         if action in ['dispose', 'donate']:
@@ -338,6 +498,7 @@ async def handle_expired_order(
             })
         
         conn.commit()
+        order_index.invalidate()
         
         log_event("EXPIRED_ORDER_HANDLED", {
             "order_id": order_id,
@@ -370,32 +531,25 @@ async def confirm_pickup(service: str, order_id: int, conn: Connection = Depends
     cur = conn.cursor()
     try:
         # Update order status to indicate pickup confirmed
-        cur.execute(
-            """
-            UPDATE orders 
-            SET order_status = '配送中'
-            WHERE id = %s AND order_status = '接單'
-            RETURNING id, buyer_name
-            """,
-            (order_id,)
-        )
-        
-        result = cur.fetchone()
-        if not result:
-            raise HTTPException(status_code=404, detail="Order not found or not in correct status")
+        try:
+            transition(cur, service, order_id, IN_DELIVERY, from_statuses=(ACCEPTED,))
+        except TransitionError as te:
+            if te.reason == "invalid_service":
+                raise HTTPException(status_code=400, detail=te.detail) from te
+            raise HTTPException(status_code=404, detail="Order not found or not in correct status") from te
         
         conn.commit()
         
         log_event("ORDER_PICKUP_CONFIRMED", {
             "order_id": order_id,
             "service": service,
-            "status": "配送中"
+            "status": IN_DELIVERY
         })
         
         return {
             "status": "success",
             "message": f"Order {order_id} pickup confirmed - now in delivery",
-            "new_status": "配送中"
+            "new_status": IN_DELIVERY
         }
         
     except HTTPException as he:
@@ -425,74 +579,11 @@ async def get_orders(conn: Connection = Depends(get_db), request: Request = None
             "client_ip": request.client.host if request else "N/A"
         })
         
-        # OPTIMIZATION: Mark expired orders in a separate transaction to avoid blocking
-        # Use a quick check first to see if there are any expired orders
-        cur.execute("""
-            SELECT COUNT(*) FROM orders 
-            WHERE (order_status = '未接單' AND timestamp < NOW() - INTERVAL '2 hours')
-               OR (order_status = '接單' AND timestamp < NOW() - INTERVAL '4 hours')
-        """)
-        expired_count = cur.fetchone()[0]
-        
-        # Only run UPDATE if there are expired orders (avoids unnecessary locks)
-        # OPTIMIZATION: Batch update with LIMIT to reduce lock time
-        if expired_count > 0:
-            # Update expired unaccepted orders (batch of 100 at a time)
-            cur.execute(
-                """
-                WITH expired_orders AS (
-                    SELECT id FROM orders 
-                    WHERE order_status = '未接單' 
-                    AND timestamp < NOW() - INTERVAL '2 hours'
-                    LIMIT 100
-                )
-                UPDATE orders 
-                SET order_status = '已過期'
-                WHERE id IN (SELECT id FROM expired_orders)
-                """
-            )
-            updated_count_1 = cur.rowcount
-            
-            # Update expired accepted orders (batch of 100 at a time)
-            cur.execute(
-                """
-                WITH expired_orders AS (
-                    SELECT id FROM orders 
-                    WHERE order_status = '接單' 
-                    AND timestamp < NOW() - INTERVAL '4 hours'
-                    LIMIT 100
-                )
-                UPDATE orders 
-                SET order_status = '配送逾時'
-                WHERE id IN (SELECT id FROM expired_orders)
-                """
-            )
-            updated_count_2 = cur.rowcount
-            
-            if updated_count_1 > 0 or updated_count_2 > 0:
-                conn.commit()
-                log_event("AUTO_EXPIRED_ORDERS", {
-                    "expired_count": expired_count,
-                    "updated_unaccepted": updated_count_1,
-                    "updated_accepted": updated_count_2,
-                    "during": "fetch_orders"
-                })
-        
+        # Expired orders are marked by the background scheduler (expire_stale_orders),
+        # so fetching the board no longer takes row locks
         # OPTIMIZATION: Fetch unaccepted orders with LIMIT and better indexing
         # Use the composite index (order_status, timestamp) for faster queries
-        cur.execute("""
-            SELECT 
-                o.id, o.buyer_id, o.buyer_name, o.buyer_phone, o.location, o.is_urgent, 
-                o.total_price, o.order_type, o.order_status, o.note, o.timestamp,
-                oi.id as item_id, oi.item_id as item_product_id, oi.item_name, oi.price, 
-                oi.quantity, oi.img, oi.location as item_location, oi.category,
-                COALESCE(oi.selected_options, 'null') as selected_options
-            FROM orders o
-            LEFT JOIN order_items oi ON o.id = oi.order_id
-            WHERE o.order_status = '未接單'
-            ORDER BY o.timestamp DESC, o.id, oi.id
-            LIMIT 200
-        """)
+        ORDER_BOARD.execute(cur)
         rows = cur.fetchall()
         
         # Group items by order_id
@@ -540,15 +631,7 @@ async def get_orders(conn: Connection = Depends(get_db), request: Request = None
         
         order_list = list(order_dict.values())
         # OPTIMIZATION: Add agricultural_product orders with LIMIT and use index
-        cur.execute("""
-            SELECT agri_p_o.id, agri_p_o.buyer_id, agri_p_o.buyer_name, agri_p_o.buyer_phone, agri_p_o.end_point, agri_p_o.status, agri_p_o.note, 
-                    agri_p.id, agri_p.name, agri_p.price, agri_p_o.quantity, agri_p.img_link, agri_p_o.starting_point, agri_p.category, agri_p_o.is_put,agri_p_o.timestamp
-            FROM agricultural_product_order as agri_p_o
-            JOIN agricultural_produce as agri_p ON agri_p.id = agri_p_o.produce_id
-            WHERE agri_p_o.status = '未接單'
-            ORDER BY agri_p_o.timestamp DESC
-            LIMIT 200
-        """)
+        cur.execute(AGRI_ORDER_BOARD)
         agri_orders = cur.fetchall()
         for agri_order in agri_orders:
             try:
@@ -624,12 +707,7 @@ async def get_orders_by_seller(seller_id: int, conn: Connection = Depends(get_db
         order_list = []
 
         # Fetch regular orders for this seller
-        cur.execute("""
-            SELECT id, buyer_name, buyer_phone, order_status, date, time, location, total_price, order_type
-            FROM orders 
-            WHERE seller_id = %s
-            ORDER BY date DESC, time DESC
-        """, (seller_id,))
+        cur.execute(SELLER_ORDERS_QUERY, (seller_id,))
         regular_orders = cur.fetchall()
 
         for order in regular_orders:
@@ -649,15 +727,7 @@ async def get_orders_by_seller(seller_id: int, conn: Connection = Depends(get_db
             order_list.append(order_dict)
 
         # Fetch agricultural product orders for this seller
-        cur.execute("""
-            SELECT apo.id, apo.buyer_name, apo.buyer_phone, apo.status, apo.timestamp, 
-                   apo.starting_point, apo.end_point, apo.quantity, p.name as product_name, p.price,
-                   p.img_link, p.category
-            FROM agricultural_product_order apo
-            LEFT JOIN agricultural_produce p ON apo.produce_id = p.id
-            WHERE apo.seller_id = %s
-            ORDER BY apo.timestamp DESC
-        """, (seller_id,))
+        cur.execute(SELLER_AGRI_ORDERS_QUERY, (seller_id,))
         agri_orders = cur.fetchall()
 
         for agri_order in agri_orders:
@@ -717,50 +787,36 @@ async def update_order_status(order_id: str, status_update: dict, conn: Connecti
             "client_ip": request.client.host if request else "N/A"
         })
 
+        new_status = status_update.get("order_status")
+        if not new_status:
+            raise HTTPException(status_code=400, detail="缺少訂單狀態")
+
         # Check if it's an agricultural product order (starts with 'agri_')
         if str(order_id).startswith('agri_'):
-            agri_order_id = str(order_id).replace('agri_', '')
-            cur.execute("SELECT id, status FROM agricultural_product_order WHERE id = %s", (agri_order_id,))
-            order = cur.fetchone()
-            
-            if not order:
-                raise HTTPException(status_code=404, detail="農產品訂單不存在")
-            
-            new_status = status_update.get("order_status")
-            if not new_status:
-                raise HTTPException(status_code=400, detail="缺少訂單狀態")
-            
-            cur.execute(
-                "UPDATE agricultural_product_order SET status = %s WHERE id = %s",
-                (new_status, agri_order_id)
-            )
+            service, target_id, missing = 'agricultural_product', str(order_id).replace('agri_', ''), "農產品訂單不存在"
         else:
-            # Handle regular order
-            cur.execute("SELECT id, order_status FROM orders WHERE id = %s", (order_id,))
-            order = cur.fetchone()
-            
-            if not order:
-                raise HTTPException(status_code=404, detail="訂單不存在")
-            
-            new_status = status_update.get("order_status")
-            if not new_status:
-                raise HTTPException(status_code=400, detail="缺少訂單狀態")
-            
-            cur.execute(
-                "UPDATE orders SET order_status = %s WHERE id = %s",
-                (new_status, order_id)
-            )
+            service, target_id, missing = 'necessities', order_id, "訂單不存在"
+        if not target_id.isdigit():
+            raise HTTPException(status_code=404, detail=missing)
+
+        try:
+            moved = transition(cur, service, int(target_id), new_status)
+        except TransitionError as te:
+            raise HTTPException(status_code=te.status_code, detail=missing if te.reason == "order_not_found" else te.detail) from te
 
         conn.commit()
+        order_index.invalidate()
         
         log_event("UPDATE_ORDER_STATUS_SUCCESS", {
             "order_id": order_id,
+            "old_status": moved.old_status,
             "new_status": new_status
         })
         
         return {"message": "訂單狀態更新成功", "order_id": order_id, "new_status": new_status}
 
     except HTTPException as he:
+        conn.rollback()
         raise he
     except Exception as e:
         logging.error("Error updating order status: %s", str(e))
@@ -798,186 +854,57 @@ async def accept_order(service: str, order_id: int, driver_order: DriverOrder, c
             "client_ip": request.client.host if request else "N/A"
         })
 
-        # Get driver's user_id to check if driver is the same person who placed the order
-        cur.execute("SELECT user_id FROM drivers WHERE id = %s", (driver_order.driver_id,))
-        driver_user_result = cur.fetchone()
-        if not driver_user_result:
-            raise HTTPException(status_code=404, detail="司機不存在")
-        driver_user_id = driver_user_result[0]
-
-        # Check if driver has overdue orders (more than 2 hours since acceptance and not completed)
-        cur.execute("""
-            SELECT COUNT(*) 
-            FROM driver_orders dro
-            LEFT JOIN orders o ON dro.order_id = o.id AND dro.service = 'necessities'
-            LEFT JOIN agricultural_product_order apo ON dro.order_id = apo.id AND dro.service = 'agricultural_product'
-            WHERE dro.driver_id = %s 
-              AND dro.action = '接單'
-              AND dro.timestamp < NOW() - INTERVAL '2 hours'
-              AND (
-                (dro.service = 'necessities' AND o.order_status NOT IN ('已送達', '已完成'))
-                OR (dro.service = 'agricultural_product' AND apo.status NOT IN ('已送達'))
-              )
-        """, (driver_order.driver_id,))
-        overdue_count = cur.fetchone()[0]
-        if overdue_count > 0:
-            raise HTTPException(
-                status_code=403, 
-                detail=f"您有 {overdue_count} 筆訂單超過 2 小時未完成配送，請先完成已接受的訂單後再接受新訂單"
+        # Decide the winner in one statement: conditional UPDATE ... RETURNING plus the driver_orders insert
+        try:
+            claimed = claim_order(
+                cur, service, order_id, driver_order.driver_id, driver_order.timestamp,
+                driver_order.previous_driver_id, driver_order.previous_driver_name, driver_order.previous_driver_phone
             )
-
-        if service == 'necessities':
-            # Get order details with items
-            cur.execute("""
-                SELECT o.id, o.buyer_id, o.buyer_name, o.buyer_phone, o.location, 
-                       o.is_urgent, o.total_price, o.order_type, o.order_status, 
-                       o.note, o.timestamp,
-                       oi.item_name, oi.quantity, oi.price,
-                       d.driver_phone as driver_phone
-                FROM orders o 
-                LEFT JOIN order_items oi ON o.id = oi.order_id
-                LEFT JOIN drivers d ON d.id = %s
-                WHERE o.id = %s
-                FOR UPDATE OF o
-            """, (driver_order.driver_id, order_id))
-            order_data = cur.fetchall()
-
-            if not order_data:
-                raise HTTPException(status_code=404, detail="訂單未找到")
-
-            order = order_data[0]
-            if order[8] != '未接單':  # order_status index
-                raise HTTPException(status_code=400, detail="訂單已被接")
-
-            # Format message with order details
-            buyer_id = order[1]  # buyer_id index
-            
-            # Check if driver is trying to accept their own order
-            if driver_user_id == buyer_id:
-                raise HTTPException(status_code=400, detail="無法接取自己的訂單")
-            total_price = float(order[6])  # total_price index
-            delivery_address = order[4]  # location index
-            driver_phone = order[-1] if order[-1] else "無"
-
-            message = "司機已接取您的商品，請等待司機送貨👍🏻\n\n"
-            message += "📦 訂單明細 #" + str(order_id) + "\n"
-            message += f"📍 送貨地點：{delivery_address}\n"
-            message += f"📱 司機電話：{driver_phone}\n"
-            message += "─────────────\n"
-
-            for item in order_data:
-                item_name = item[11]  # item_name from join
-                quantity = int(item[12])  # quantity from join
-                price = float(item[13])  # price from join
-                subtotal = quantity * price
-                message += f"・{item_name}\n"
-                message += f"  ${price} x {quantity} = ${subtotal}\n"
-
-            message += "─────────────\n"
-            message += f"總計: ${total_price}"
-
-            # Send notification to buyer
-            success = await line_service.send_message_to_user(buyer_id, message)
-            if not success:
-                logger.warning(f"買家 (ID: {buyer_id}) 未綁定 LINE 帳號或發送通知失敗")
-
-            # Update order status
-            cur.execute("UPDATE orders SET order_status = %s WHERE id = %s", ('接單', order_id))
-
-        elif service == 'agricultural_product':
-            # Get order details with items
-            cur.execute("""
-                SELECT o.id, o.buyer_id, o.buyer_name, o.buyer_phone, o.end_point,
-                       o.status, o.note, 
-                       p.id, p.name, p.price, o.quantity,
-                       p.img_link, o.starting_point, p.category, o.is_put, o.timestamp,
-                       d.driver_phone as driver_phone
-                FROM agricultural_product_order o 
-                LEFT JOIN agricultural_produce p ON p.id = o.produce_id
-                LEFT JOIN drivers d ON d.id = %s
-                WHERE o.id = %s 
-                FOR UPDATE OF o
-            """, (driver_order.driver_id, order_id))
-            order_data = cur.fetchall()
-
-            if not order_data:
-                raise HTTPException(status_code=404, detail="訂單未找到")
-
-            order = order_data[0]
-            if order[5] != '未接單':  # status index
-                raise HTTPException(status_code=400, detail="訂單已被接")
-
-            # Format message with order details
-            buyer_id = order[1]
-            
-            # Check if driver is trying to accept their own order
-            if driver_user_id == buyer_id:
-                raise HTTPException(status_code=400, detail="無法接取自己的訂單")
-            price = float(order[9])  # price from agricultural_produce
-            quantity = int(order[10])  # quantity from order
-            total_price = price * quantity
-            delivery_address = order[4]  # end_point
-            driver_phone = order[16] if order[16] else "無"
-
-
-            message = "司機已接取您的農產品，請等待司機送貨👍🏻\n\n"
-            message += "📦 訂單明細 #" + str(order_id) + "\n"
-            message += f"📍 送貨地點：{delivery_address}\n"
-            message += f"📱 司機電話：{driver_phone}\n"
-            message += "─────────────\n"
-
-            
-            # Process items from order_data
-            item_name = order[8]  # 商品名稱 (p.name)
-            message += f"・{item_name}\n"
-            message += f"  ${price} x {quantity} = ${total_price}\n"
-            message += "─────────────\n"
-
-            message += f"總計: ${total_price} 元"
-
-
-            # Send notification to buyer
-            success = await line_service.send_message_to_user(buyer_id, message)
-            if not success:
-                logger.warning(f"買家 (ID: {buyer_id}) 未綁定 LINE 帳號或發送通知失敗")
-
-            # Update order status
-            cur.execute("UPDATE agricultural_product_order SET status = %s WHERE id = %s", ('接單', order_id))
-
-        # Insert driver_orders record
-        cur.execute(
-            "INSERT INTO driver_orders (driver_id, order_id, action, timestamp, previous_driver_id, previous_driver_name, previous_driver_phone, service) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-            (driver_order.driver_id, order_id, '接單', driver_order.timestamp, driver_order.previous_driver_id, 
-             driver_order.previous_driver_name, driver_order.previous_driver_phone, driver_order.service)
-        )
+        except ClaimError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail) from e
 
         conn.commit()
+        order_index.invalidate()
         log_event("ORDER_ACCEPTED", {
             "order_id": order_id,
             "driver_id": driver_order.driver_id,
             "service": service,
             "status": "success"
         })
+
+        # Notify the buyer after the commit, so the order row is not locked during the LINE call
+        goods = "商品" if service == 'necessities' else "農產品"
+        message = f"司機已接取您的{goods}，請等待司機送貨👍🏻\n\n"
+        message += "📦 訂單明細 #" + str(order_id) + "\n"
+        message += f"📍 送貨地點：{claimed.delivery_address}\n"
+        message += f"📱 司機電話：{claimed.driver_phone or '無'}\n"
+        message += "─────────────\n"
+        for item in claimed.items:
+            price = float(item["price"])
+            quantity = int(item["quantity"])
+            message += f"・{item['name']}\n"
+            message += f"  ${price} x {quantity} = ${price * quantity}\n"
+        message += "─────────────\n"
+        message += f"總計: ${claimed.total_price}" + (" 元" if service == 'agricultural_product' else "")
+
+        try:
+            success = await line_service.send_message_to_user(claimed.buyer_id, message)
+        except Exception as e:
+            logging.error("Error notifying buyer of accepted order: %s", str(e))
+            success = False
+        if not success:
+            logger.warning(f"買家 (ID: {claimed.buyer_id}) 未綁定 LINE 帳號或發送通知失敗")
         return {"status": "success", "message": f"訂單 {order_id} 已成功被接受"}
 
     except HTTPException as e:
         conn.rollback()
-        if e.status_code == 400:
-            logging.error("訂單已被接")
-            log_event("ORDER_ACCEPTANCE_FAILED", {
-                "order_id": order_id,
-                "driver_id": driver_order.driver_id,
-                "service": service,
-                "reason": "訂單已被接"
-            })
-        elif e.status_code == 404:
-            logging.error("訂單未找到")
-            log_event("ORDER_ACCEPTANCE_FAILED", {
-                "order_id": order_id,
-                "driver_id": driver_order.driver_id,
-                "service": service,
-                "reason": "訂單未找到"
-            })
+        logging.error(e.detail)
+        log_event("ORDER_ACCEPTANCE_FAILED", {
+            "order_id": order_id,
+            "driver_id": driver_order.driver_id,
+            "service": service,
+            "reason": e.detail
+        })
         raise e
     except Exception as e:
         conn.rollback()
@@ -1293,6 +1220,44 @@ async def reject_pending_transfer(transfer_id: int, reject_request: AcceptTransf
     finally:
         cur.close()
 
+@router.get("/nearby")
+def get_nearby_orders(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius_km: Optional[float] = Query(None, gt=0, le=NEARBY_MAX_RADIUS_KM),
+    k: int = Query(NEARBY_DEFAULT_K, ge=1, le=NEARBY_MAX_K)
+):
+    """
+    Unaccepted orders near a driver, nearest first, served from the in-memory
+    spatial index. An order's distance is to its nearest pickup or delivery point.
+
+    Args:
+        lat (float): Driver latitude.
+        lng (float): Driver longitude.
+        radius_km (Optional[float]): Only orders within this distance; without it, the k nearest.
+        k (int): Maximum number of orders.
+
+    Returns:
+        dict: Orders with `distance_km` and `nearest_point` ('pickup' | 'delivery'),
+        plus the number of open orders whose locations could not be geocoded.
+    """
+    try:
+        snapshot = order_index.get()
+    except Exception as e:
+        logging.error("Error building order index: %s", str(e))
+        raise HTTPException(status_code=500, detail="Failed to load nearby orders") from e
+
+    grid = snapshot.grid
+    if radius_km is not None:
+        matches = grid.within(lat, lng, radius_km, limit=k)
+    else:
+        matches = grid.nearest(lat, lng, k)
+    orders = [
+        {**grid.orders[owner].describe(), "distance_km": round(distance, 3), "nearest_point": kind}
+        for distance, owner, kind in matches
+    ]
+    return {"orders": orders, "unlocated": snapshot.unlocated}
+
 @router.get("/{order_id}")
 async def get_order(order_id: int, conn: Connection = Depends(get_db), request: Request = None):
     """
@@ -1542,154 +1507,70 @@ async def cancel_order(service: str, order_id: int, request: CancelOrderRequest,
     cur = conn.cursor()
     try:
         buyer_id = request.buyer_id
+        if service not in ('necessities', 'agricultural_product'):
+            raise HTTPException(status_code=400, detail="不支援的服務類型")
         
-        if service == 'necessities':
-            # Get order details and verify buyer
-            cur.execute("""
-                SELECT id, buyer_id, order_status
-                FROM orders
-                WHERE id = %s
-                FOR UPDATE
-            """, (order_id,))
-            
-            order = cur.fetchone()
-            if not order:
-                raise HTTPException(status_code=404, detail="訂單不存在")
-            
-            # Verify buyer owns the order
-            if order[1] != buyer_id:
-                raise HTTPException(status_code=403, detail="無權限取消此訂單")
-            
-            # Check if order can be cancelled (only if status is '未接單' or '接單')
-            if order[2] not in ['未接單', '接單']:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"訂單狀態為 '{order[2]}'，無法取消。只有未接單或已接單的訂單可以取消。"
-                )
-            
-            # Check if driver has already accepted the order
-            cur.execute("""
-                SELECT driver_id, d.driver_name, d.driver_phone, d.user_id
-                FROM driver_orders dro
-                JOIN drivers d ON dro.driver_id = d.id
-                WHERE dro.order_id = %s AND dro.action = '接單'
-            """, (order_id,))
-            
-            driver_info = cur.fetchone()
-            
-            # Update order status to cancelled
-            cur.execute("""
-                UPDATE orders
-                SET order_status = '已取消'
-                WHERE id = %s
-            """, (order_id,))
-            
-            # Delete driver_orders record if exists
-            if driver_info:
-                cur.execute("""
-                    DELETE FROM driver_orders
-                    WHERE order_id = %s AND action = '接單'
-                """, (order_id,))
-            
-            conn.commit()
-            
-            # Send notification to driver if order was already accepted
-            if driver_info:
-                driver_user_id = driver_info[3]
-                message = (
-                    f"⚠️ 訂單 #{order_id} 已被買家取消\n"
-                    f"買家已取消此訂單，無需再配送。"
-                )
-                success = await line_service.send_message_to_user(driver_user_id, message)
-                if not success:
-                    logging.warning(f"司機 (ID: {driver_user_id}) 未綁定 LINE 帳號或發送通知失敗")
-            
-            log_event("ORDER_CANCELLED", {
-                "order_id": order_id,
-                "buyer_id": buyer_id,
-                "service": service,
-                "had_driver": driver_info is not None
-            })
-            
-            return {
-                "status": "success",
-                "message": "訂單已成功取消"
-            }
-            
-        elif service == 'agricultural_product':
-            # Get order details and verify buyer
-            cur.execute("""
-                SELECT id, buyer_id, status
-                FROM agricultural_product_order
-                WHERE id = %s
-                FOR UPDATE
-            """, (order_id,))
-            
-            order = cur.fetchone()
-            if not order:
-                raise HTTPException(status_code=404, detail="訂單不存在")
-            
-            # Verify buyer owns the order
-            if order[1] != buyer_id:
-                raise HTTPException(status_code=403, detail="無權限取消此訂單")
-            
-            # Check if order can be cancelled (only if status is '未接單' or '接單')
-            if order[2] not in ['未接單', '接單']:
+        # Verify the buyer and cancel only from '未接單' or '接單', in one guarded update
+        try:
+            cancelled = transition(
+                cur, service, order_id, CANCELLED,
+                from_statuses=(UNACCEPTED, ACCEPTED),
+                guard={"buyer_id": buyer_id},
+                columns=('produce_id', 'quantity', 'stock_reserved') if service == 'agricultural_product' else ()
+            )
+        except TransitionError as te:
+            if te.reason == "guard_mismatch":
+                raise HTTPException(status_code=403, detail="無權限取消此訂單") from te
+            if te.reason == "illegal_transition":
                 raise HTTPException(
                     status_code=400, 
-                    detail=f"訂單狀態為 '{order[2]}'，無法取消。只有未接單或已接單的訂單可以取消。"
-                )
-            
-            # Check if driver has already accepted the order
-            cur.execute("""
-                SELECT driver_id, d.driver_name, d.driver_phone, d.user_id
-                FROM driver_orders dro
-                JOIN drivers d ON dro.driver_id = d.id
-                WHERE dro.order_id = %s AND dro.action = '接單'
-            """, (order_id,))
-            
-            driver_info = cur.fetchone()
-            
-            # Update order status to cancelled
-            cur.execute("""
-                UPDATE agricultural_product_order
-                SET status = '已取消'
-                WHERE id = %s
-            """, (order_id,))
-            
-            # Delete driver_orders record if exists
-            if driver_info:
-                cur.execute("""
-                    DELETE FROM driver_orders
-                    WHERE order_id = %s AND action = '接單'
-                """, (order_id,))
-            
-            conn.commit()
-            
-            # Send notification to driver if order was already accepted
-            if driver_info:
-                driver_user_id = driver_info[3]
-                message = (
-                    f"⚠️ 訂單 #{order_id} 已被買家取消\n"
-                    f"買家已取消此訂單，無需再配送。"
-                )
-                success = await line_service.send_message_to_user(driver_user_id, message)
-                if not success:
-                    logging.warning(f"司機 (ID: {driver_user_id}) 未綁定 LINE 帳號或發送通知失敗")
-            
-            log_event("ORDER_CANCELLED", {
-                "order_id": order_id,
-                "buyer_id": buyer_id,
-                "service": service,
-                "had_driver": driver_info is not None
-            })
-            
-            return {
-                "status": "success",
-                "message": "訂單已成功取消"
-            }
-        else:
-            raise HTTPException(status_code=400, detail="不支援的服務類型")
+                    detail=f"訂單狀態為 '{te.current_status}'，無法取消。只有未接單或已接單的訂單可以取消。"
+                ) from te
+            raise HTTPException(status_code=te.status_code, detail=te.detail) from te
+        
+        restocked = None
+        if service == 'agricultural_product' and cancelled.row['stock_reserved']:
+            # Give the reserved stock back in the same transaction (older orders never took any)
+            restocked = release_stock(cur, cancelled.row['produce_id'], cancelled.row['quantity'])
+        
+        # Drop the driver's acceptance, if any, and find who to notify
+        cur.execute("""
+            DELETE FROM driver_orders dro
+            USING drivers d
+            WHERE dro.order_id = %s AND dro.service = %s AND dro.action = '接單'
+              AND d.id = dro.driver_id
+            RETURNING d.user_id
+        """, (order_id, service))
+        driver_info = cur.fetchone()
+        
+        conn.commit()
+        if restocked is not None:
+            catalog_cache.set_stock(cancelled.row['produce_id'], restocked)
+        order_index.invalidate()
+        
+        # Send notification to driver if order was already accepted
+        if driver_info:
+            driver_user_id = driver_info[0]
+            message = (
+                f"⚠️ 訂單 #{order_id} 已被買家取消\n"
+                f"買家已取消此訂單，無需再配送。"
+            )
+            success = await line_service.send_message_to_user(driver_user_id, message)
+            if not success:
+                logging.warning(f"司機 (ID: {driver_user_id}) 未綁定 LINE 帳號或發送通知失敗")
+        
+        log_event("ORDER_CANCELLED", {
+            "order_id": order_id,
+            "buyer_id": buyer_id,
+            "service": service,
+            "previous_status": cancelled.old_status,
+            "had_driver": driver_info is not None
+        })
+        
+        return {
+            "status": "success",
+            "message": "訂單已成功取消"
+        }
             
     except HTTPException as he:
         conn.rollback()
@@ -1722,30 +1603,7 @@ async def get_buyer_orders(
         
         # Get regular orders with items using LEFT JOIN (fixes N+1 query problem)
         # This single query replaces the loop with individual queries, dramatically improving performance
-        if include_cancelled:
-            cur.execute("""
-                SELECT 
-                    o.id, o.buyer_id, o.buyer_name, o.buyer_phone, o.location, o.is_urgent, 
-                    o.total_price, o.order_type, o.order_status, o.note, o.timestamp,
-                    oi.item_id, oi.item_name, oi.price, oi.quantity, oi.img, oi.location as item_location, 
-                    oi.category, COALESCE(oi.selected_options, 'null') as selected_options
-                FROM orders o
-                LEFT JOIN order_items oi ON o.id = oi.order_id
-                WHERE o.buyer_id = %s
-                ORDER BY o.timestamp DESC, o.id, oi.id
-            """, (buyer_id,))
-        else:
-            cur.execute("""
-                SELECT 
-                    o.id, o.buyer_id, o.buyer_name, o.buyer_phone, o.location, o.is_urgent, 
-                    o.total_price, o.order_type, o.order_status, o.note, o.timestamp,
-                    oi.item_id, oi.item_name, oi.price, oi.quantity, oi.img, oi.location as item_location, 
-                    oi.category, COALESCE(oi.selected_options, 'null') as selected_options
-                FROM orders o
-                LEFT JOIN order_items oi ON o.id = oi.order_id
-                WHERE o.buyer_id = %s AND o.order_status != '已取消'
-                ORDER BY o.timestamp DESC, o.id, oi.id
-            """, (buyer_id,))
+        cur.execute(BUYER_ORDERS_QUERY if include_cancelled else BUYER_ACTIVE_ORDERS_QUERY, (buyer_id,))
         
         rows = cur.fetchall()
         
@@ -1798,28 +1656,7 @@ async def get_buyer_orders(
         order_list = list(order_dict.values())
         
         # Get agricultural product orders (exclude cancelled by default)
-        if include_cancelled:
-            cur.execute("""
-                SELECT agri_p_o.id, agri_p_o.buyer_id, agri_p_o.buyer_name, agri_p_o.buyer_phone,
-                       agri_p_o.end_point, agri_p_o.status, agri_p_o.note, agri_p_o.timestamp,
-                       agri_p.id, agri_p.name, agri_p.price, agri_p_o.quantity, agri_p.img_link,
-                       agri_p_o.starting_point, agri_p.category
-                FROM agricultural_product_order as agri_p_o
-                JOIN agricultural_produce as agri_p on agri_p.id = agri_p_o.produce_id
-                WHERE agri_p_o.buyer_id = %s
-                ORDER BY agri_p_o.timestamp DESC
-            """, (buyer_id,))
-        else:
-            cur.execute("""
-                SELECT agri_p_o.id, agri_p_o.buyer_id, agri_p_o.buyer_name, agri_p_o.buyer_phone,
-                       agri_p_o.end_point, agri_p_o.status, agri_p_o.note, agri_p_o.timestamp,
-                       agri_p.id, agri_p.name, agri_p.price, agri_p_o.quantity, agri_p.img_link,
-                       agri_p_o.starting_point, agri_p.category
-                FROM agricultural_product_order as agri_p_o
-                JOIN agricultural_produce as agri_p on agri_p.id = agri_p_o.produce_id
-                WHERE agri_p_o.buyer_id = %s AND agri_p_o.status != '已取消'
-                ORDER BY agri_p_o.timestamp DESC
-            """, (buyer_id,))
+        cur.execute(BUYER_AGRI_ORDERS_QUERY if include_cancelled else BUYER_ACTIVE_AGRI_ORDERS_QUERY, (buyer_id,))
         
         agri_orders = cur.fetchall()
         for agri_order in agri_orders:
@@ -1882,6 +1719,7 @@ async def complete_order(
         dict: A success message.
     """
     cur = conn.cursor()
+    location_check = None
     try:
         log_event("ORDER_COMPLETION_STARTED", {
             "order_id": order_id,
@@ -1892,21 +1730,6 @@ async def complete_order(
             "client_ip": request.client.host if request else "N/A"
         })
         
-        # Helper function to calculate distance between two GPS coordinates (Haversine formula)
-        def calculate_distance(lat1, lon1, lat2, lon2):
-            """Calculate distance between two GPS coordinates in kilometers"""
-            from math import radians, sin, cos, sqrt, atan2
-            R = 6371  # Earth's radius in kilometers
-            lat1_rad = radians(lat1)
-            lat2_rad = radians(lat2)
-            delta_lat = radians(lat2 - lat1)
-            delta_lon = radians(lon2 - lon1)
-            
-            a = sin(delta_lat/2)**2 + cos(lat1_rad) * cos(lat2_rad) * sin(delta_lon/2)**2
-            c = 2 * atan2(sqrt(a), sqrt(1-a))
-            distance = R * c
-            return distance
-        
         if service == 'necessities':
             # Check if order exists and get driver info
             cur.execute("""
@@ -1930,7 +1753,7 @@ async def complete_order(
                 
             order = order_data[0]
             # Allow completion from '配送中' status (delivery in progress)
-            if order[13] not in ['配送中', '接單']:  # order_status
+            if order[13] not in COMPLETABLE_STATUSES:  # order_status
                 raise HTTPException(status_code=400, detail=f"訂單狀態為 '{order[13]}'，無法完成訂單。只有配送中或已接單的訂單可以完成。")
             
             # Format order details message
@@ -1939,10 +1762,8 @@ async def complete_order(
             delivery_address = order[9]  # location
             driver_phone = order[-1] if order[-1] else "無"  # driver_phone
             
-            # Verify GPS location (optional - if we have geocoding service, verify address matches)
-            # For now, we'll log the GPS coordinates and trust frontend verification
-            # In production, you might want to geocode the delivery address and verify distance
-            logger.info(f"Order {order_id} completion - Driver GPS: ({gps_data.latitude}, {gps_data.longitude}), Delivery address: {delivery_address}")
+            # Verify GPS location against the geocoded delivery address
+            location_check = verify_delivery_location(order_id, gps_data, delivery_address)
             
             message = "🎉 您的訂單已送達！\n\n"
             message += "司機已確認送達目的地，請盡快到指定地點領取您的商品。\n\n"
@@ -1963,14 +1784,8 @@ async def complete_order(
             message += f"總計: ${total_price} 元\n\n"
             message += "💡 請記得確認商品無誤後，在系統中確認收貨。"
             
-            success = await line_service.send_message_to_user(buyer_id, message)
-            if not success:
-                logger.warning(f"買家 (ID: {buyer_id}) 未綁定 LINE 帳號或發送通知失敗")
-            else:
-                logger.info(f"LINE notification sent to buyer {buyer_id} for order {order_id}")
-            
             # Update status to '已送達' (delivered) so it appears in delivery history
-            cur.execute("UPDATE orders SET order_status = '已送達' WHERE id = %s", (order_id,))
+            transition(cur, service, order_id, DELIVERED, from_statuses=COMPLETABLE_STATUSES)
             
             cur.execute("""
                 UPDATE driver_orders dro
@@ -2000,7 +1815,7 @@ async def complete_order(
                 
             order = order_data[0]
             # Allow completion from '配送中' status (delivery in progress)
-            if order[5] not in ['配送中', '接單']:  # status
+            if order[5] not in COMPLETABLE_STATUSES:  # status
                 raise HTTPException(status_code=400, detail=f"訂單狀態為 '{order[5]}'，無法完成訂單。只有配送中或已接單的訂單可以完成。")
             
             # Format order details message
@@ -2008,8 +1823,8 @@ async def complete_order(
             delivery_address = order[4]  # end_point
             driver_phone = order[-1] if order[-1] else "無"  # driver_phone
             
-            # Verify GPS location
-            logger.info(f"Agricultural order {order_id} completion - Driver GPS: ({gps_data.latitude}, {gps_data.longitude}), Delivery address: {delivery_address}")
+            # Verify GPS location against the geocoded delivery address
+            location_check = verify_delivery_location(order_id, gps_data, delivery_address)
             
             message = "🎉 您的農產品已送達！\n\n"
             message += "司機已確認送達目的地，請盡快到指定地點領取您的農產品。\n\n"
@@ -2029,28 +1844,42 @@ async def complete_order(
             message += f"總計: ${total_price} 元\n\n"
             message += "💡 請記得確認商品無誤後，在系統中確認收貨。"
             
-            success = await line_service.send_message_to_user(buyer_id, message)
-            if not success:
-                logger.warning(f"買家 (ID: {buyer_id}) 未綁定 LINE 帳號或發送通知失敗")
-            else:
-                logger.info(f"LINE notification sent to buyer {buyer_id} for agricultural order {order_id}")
-            
-            cur.execute("UPDATE agricultural_product_order SET status = '已送達' WHERE id = %s", (order_id,))
+            transition(cur, service, order_id, DELIVERED, from_statuses=COMPLETABLE_STATUSES)
             
             cur.execute("""
                 UPDATE driver_orders dro
                 SET action = '完成'
                 WHERE order_id = %s and service = %s
             """, (order_id, 'agricultural_product'))
+        else:
+            raise HTTPException(status_code=400, detail="不支援的服務類型")
         
         conn.commit()
+        
+        # Notify the buyer only once the delivery is recorded
+        success = await line_service.send_message_to_user(buyer_id, message)
+        if not success:
+            logger.warning(f"買家 (ID: {buyer_id}) 未綁定 LINE 帳號或發送通知失敗")
+        else:
+            logger.info(f"LINE notification sent to buyer {buyer_id} for {service} order {order_id}")
+        
         log_event("ORDER_COMPLETED", {
             "order_id": order_id,
             "service": service,
             "status": "success"
         })
-        return {"status": "success", "message": "訂單已完成"}
+        return {"status": "success", "message": "訂單已完成", "location_check": location_check}
         
+    except TransitionError as te:
+        # Status changed by a concurrent request after it was read above
+        conn.rollback()
+        log_event("ORDER_COMPLETION_FAILED", {
+            "order_id": order_id,
+            "service": service,
+            "reason": te.reason,
+            "current_status": te.current_status
+        })
+        raise HTTPException(status_code=te.status_code, detail=te.detail) from te
     except HTTPException as e:
         conn.rollback()
         if e.status_code == 400:
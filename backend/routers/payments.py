@@ -1,12 +1,31 @@
 # backend/routers/payments.py
-from fastapi import APIRouter, HTTPException, UploadFile, File, Header
-from pydantic import BaseModel
-from typing import Literal, Optional
+from fastapi import APIRouter, HTTPException, Header, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
+import hmac
 import os
 from backend.database import get_db_connection, return_db_connection
+from backend.services.idempotency import claim_key, store_response, request_fingerprint, REPLAY_HEADER
+from backend.services.media_store import proof_store, PROOF_TYPES, MAX_PROOF_BYTES, MediaError, sniff_content_type
+from backend.services.ledger import post_entries, LedgerEntry, ESCROW_ACCOUNT
+from backend.routers.media import serve_stored_file
 
 router = APIRouter(prefix="/api/payments", tags=["payments"])
 
+PROOF_URL_PREFIX = "/api/payments/proofs/"
+# Proofs are only served to admins: cacheable by the reviewer's browser, never by shared caches
+PROOF_CACHE_CONTROL = "private, max-age=31536000, immutable"
+# When set, nginx serves proofs via X-Accel-Redirect from an internal location mapped to PAYMENT_PROOF_ROOT
+PROOF_ACCEL_REDIRECT_PREFIX = os.getenv("PAYMENT_PROOF_ACCEL_REDIRECT_PREFIX")
+MAX_VERIFY_BATCH = int(os.getenv("PAYMENT_VERIFY_BATCH_MAX", "500"))
+
+
+def require_admin(x_admin_key: Optional[str]):
+    admin_key = os.getenv("ADMIN_API_KEY")
+    if not admin_key or not x_admin_key or not hmac.compare_digest(x_admin_key, admin_key):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
 @router.get("/ping")
 def payments_ping():
     return {"ok": True, "service": "payments"}
@@ -18,11 +37,17 @@ class CreatePaymentIntentIn(BaseModel):
     currency: str = "TWD"
 
 @router.post("/intent")
-def create_payment_intent(payload: CreatePaymentIntentIn):
+def create_payment_intent(payload: CreatePaymentIntentIn, response: Response, idempotency_key: Optional[str] = Header(None)):
     conn = None
     try:
         conn = get_db_connection()
         cur = conn.cursor()
+        claim = claim_key(cur, "payments:intent", idempotency_key, request_fingerprint(payload))
+        if claim and claim.replay:
+            conn.rollback()
+            response.headers[REPLAY_HEADER] = "true"
+            return claim.body
+
         cur.execute("SELECT id, payment_status FROM orders WHERE id=%s", (payload.order_id,))
         row = cur.fetchone()
         if not row:
@@ -39,9 +64,11 @@ def create_payment_intent(payload: CreatePaymentIntentIn):
             RETURNING id, status
         """, (payload.order_id, payload.method, payload.amount, payload.currency, status))
         pid, st = cur.fetchone()
+        result = {"payment_id": pid, "status": st}
+        store_response(cur, claim, result)
         conn.commit()
         cur.close()
-        return {"payment_id": pid, "status": st}
+        return result
     except HTTPException:
         raise
     except Exception as e:
@@ -52,28 +79,40 @@ def create_payment_intent(payload: CreatePaymentIntentIn):
         if conn:
             return_db_connection(conn)
 
-@router.post("/{payment_id}/proof")
-def upload_payment_proof(payment_id: int, image: UploadFile = File(...), note: str = "", uploaded_by: Optional[int] = None):
-    # TODO: 換成你們的實際檔案儲存流程；此處暫存檔名
-    image_url = f"/uploads/{payment_id}_{image.filename}"
+def _ensure_awaiting_proof(cur, payment_id: int, lock: bool = False):
+    cur.execute("SELECT status FROM payments WHERE id=%s" + (" FOR UPDATE" if lock else ""), (payment_id,))
+    row = cur.fetchone()
+    if not row:
+        raise HTTPException(404, "Payment not found")
+    if row[0] not in ("AWAITING_VERIFICATION", "PENDING"):
+        raise HTTPException(400, "Payment not awaiting proof")
+
+def _check_payment_awaiting_proof(payment_id: int):
     conn = None
     try:
         conn = get_db_connection()
         cur = conn.cursor()
-        cur.execute("SELECT status FROM payments WHERE id=%s", (payment_id,))
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(404, "Payment not found")
-        if row[0] not in ("AWAITING_VERIFICATION", "PENDING"):
-            raise HTTPException(400, "Payment not awaiting proof")
+        _ensure_awaiting_proof(cur, payment_id)
+        conn.rollback()
+        cur.close()
+    finally:
+        if conn:
+            return_db_connection(conn)
 
+def _record_payment_proof(payment_id: int, image_url: str, note: str, uploaded_by: Optional[int]):
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        _ensure_awaiting_proof(cur, payment_id, lock=True)
         cur.execute("""INSERT INTO payment_proofs(payment_id, image_url, note, uploaded_by)
                        VALUES (%s,%s,%s,%s)""",
                     (payment_id, image_url, note, uploaded_by))
         conn.commit()
         cur.close()
-        return {"ok": True, "image_url": image_url}
     except HTTPException:
+        if conn:
+            conn.rollback()
         raise
     except Exception as e:
         if conn:
@@ -83,38 +122,151 @@ def upload_payment_proof(payment_id: int, image: UploadFile = File(...), note: s
         if conn:
             return_db_connection(conn)
 
+@router.post("/{payment_id}/proof")
+async def upload_payment_proof(payment_id: int, request: Request, note: str = "", uploaded_by: Optional[int] = None):
+    """
+    Upload a payment proof as multipart/form-data (field "image": JPEG, PNG,
+    WebP, GIF or PDF). The file is streamed to disk in chunks and hashed while
+    it is written; the type is detected from its content.
+    """
+    # Reject unknown / settled payments before reading the body
+    try:
+        await run_in_threadpool(_check_payment_awaiting_proof, payment_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(500, f"Error uploading payment proof: {str(e)}")
+
+    try:
+        stored = await proof_store.receive_upload(
+            request, field_name="image", max_bytes=MAX_PROOF_BYTES,
+            allowed_types=PROOF_TYPES, sniff=sniff_content_type
+        )
+    except MediaError as e:
+        raise HTTPException(e.status_code, str(e))
+
+    image_url = PROOF_URL_PREFIX + stored.filename
+    await run_in_threadpool(_record_payment_proof, payment_id, image_url, note, uploaded_by)
+    return {
+        "ok": True,
+        "image_url": image_url,
+        "sha256": stored.digest,
+        "size": stored.size,
+        "content_type": stored.content_type
+    }
+
+@router.get("/proofs/{filename}")
+def get_payment_proof(filename: str, x_admin_key: Optional[str] = Header(None)):
+    """
+    Serve a stored payment proof to an admin ('<sha256><ext>' from image_url).
+    """
+    require_admin(x_admin_key)
+    return serve_stored_file(proof_store, filename, cache_control=PROOF_CACHE_CONTROL, accel_prefix=PROOF_ACCEL_REDIRECT_PREFIX)
+
 class VerifyIn(BaseModel):
     approve: bool
     reason: Optional[str] = None
 
+class BatchVerifyItem(VerifyIn):
+    payment_id: int
+
+class BatchVerifyIn(BaseModel):
+    items: List[BatchVerifyItem] = Field(..., min_length=1, max_length=MAX_VERIFY_BATCH)
+
+VERIFIABLE_STATUSES = ("AWAITING_VERIFICATION", "PENDING")
+
+def apply_verifications(cur, items: List[BatchVerifyItem]) -> List[dict]:
+    """
+    Approve / reject payments in the caller's transaction with a fixed number
+    of statements: lock the payments, post the escrow entries of all
+    approvals, update payments and orders.
+
+    Returns:
+        List[dict]: One result per item, in request order; items that cannot
+        be applied carry `error` and `status_code` and change nothing.
+    """
+    ids = [item.payment_id for item in items]
+    cur.execute("""SELECT id, order_id, amount, currency, status FROM payments
+                   WHERE id = ANY(%s) ORDER BY id FOR UPDATE""", (ids,))
+    payments = {row[0]: row[1:] for row in cur.fetchall()}
+
+    results, decisions, entries, seen = [], [], [], set()
+    for item in items:
+        result = {"payment_id": item.payment_id}
+        payment = payments.get(item.payment_id)
+        if item.payment_id in seen:
+            result.update(ok=False, status_code=400, error="Duplicate payment in batch")
+        elif payment is None:
+            result.update(ok=False, status_code=404, error="Payment not found")
+        elif payment[3] not in VERIFIABLE_STATUSES:
+            result.update(ok=False, status_code=400, error="Invalid payment state", status=payment[3])
+        else:
+            order_id, amount, currency, _ = payment
+            status = "PAID_ESCROW" if item.approve else "REJECTED"
+            decisions.append((item.payment_id, status))
+            if item.approve:
+                entries.append(LedgerEntry('ORDER', order_id, ESCROW_ACCOUNT, amount, currency))
+            result.update(ok=True, status=status, order_id=order_id)
+            if item.reason:
+                result["reason"] = item.reason
+        seen.add(item.payment_id)
+        results.append(result)
+
+    if decisions:
+        post_entries(cur, entries)
+        values = ", ".join(["(%s::int, %s::varchar)"] * len(decisions))
+        cur.execute(f"""
+            WITH decisions (id, status) AS (VALUES {values}),
+            updated AS (
+                UPDATE payments p SET status = d.status, updated_at = NOW()
+                FROM decisions d WHERE p.id = d.id
+                RETURNING p.order_id, p.status
+            )
+            UPDATE orders o SET payment_status = 'ESCROWED'
+            FROM updated u WHERE o.id = u.order_id AND u.status = 'PAID_ESCROW'
+        """, [value for decision in decisions for value in decision])
+    return results
+
+@router.post("/verify/batch")
+def verify_payments_batch(body: BatchVerifyIn, x_admin_key: Optional[str] = Header(None)):
+    """
+    Approve or reject up to MAX_VERIFY_BATCH payments in one transaction.
+    Invalid items are reported per payment and skipped; the rest commit together.
+    """
+    require_admin(x_admin_key)
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        results = apply_verifications(cur, body.items)
+        conn.commit()
+        cur.close()
+        applied = sum(1 for result in results if result["ok"])
+        return {"applied": applied, "failed": len(results) - applied, "results": results}
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        raise HTTPException(500, f"Error verifying payments: {str(e)}")
+    finally:
+        if conn:
+            return_db_connection(conn)
+
 @router.post("/{payment_id}/verify")
 def verify_payment(payment_id: int, body: VerifyIn, x_admin_key: Optional[str] = Header(None)):
-    if x_admin_key != os.getenv("ADMIN_API_KEY"):
-        raise HTTPException(status_code=401, detail="Unauthorized")
+    require_admin(x_admin_key)
 
     conn = None
     try:
         conn = get_db_connection()
         cur = conn.cursor()
-        cur.execute("SELECT order_id, amount, currency, status FROM payments WHERE id=%s", (payment_id,))
-        p = cur.fetchone()
-        if not p:
-            raise HTTPException(404, "Payment not found")
-        order_id, amount, currency, status = p
-        if status not in ("AWAITING_VERIFICATION", "PENDING"):
-            raise HTTPException(400, "Invalid payment state")
-
-        if body.approve:
-            cur.execute("""INSERT INTO ledger_entries(ref_type, ref_id, account, delta, currency)
-                           VALUES ('ORDER', %s, 'PLATFORM_ESCROW', %s, %s)""",
-                        (order_id, amount, currency))
-            cur.execute("UPDATE payments SET status='PAID_ESCROW', updated_at=NOW() WHERE id=%s", (payment_id,))
-            cur.execute("UPDATE orders SET payment_status='ESCROWED' WHERE id=%s", (order_id,))
-        else:
-            cur.execute("UPDATE payments SET status='REJECTED', updated_at=NOW() WHERE id=%s", (payment_id,))
+        result = apply_verifications(cur, [BatchVerifyItem(payment_id=payment_id, **body.model_dump())])[0]
+        if not result["ok"]:
+            conn.rollback()
+            raise HTTPException(result["status_code"], result["error"])
         conn.commit()
         cur.close()
-        return {"status": "PAID_ESCROW" if body.approve else "REJECTED"}
+        return {"status": result["status"]}
     except HTTPException:
         raise
     except Exception as e:
@@ -6,6 +6,7 @@ It uses FastAPI for defining the API routes and psycopg2 for database interactio
 
 Endpoints:
 - POST /upload_image: Upload photo which is base 64 data
+- POST /upload_image/file: Upload photo as multipart/form-data (streamed, content-addressed)
 - POST /: Upload item
 - GET /{sellerId}: Get seller's product information with {sellerId}
 - GET /product/{productId}: Get seller's product information with {productId}
@@ -14,10 +15,13 @@ Endpoints:
 - DELETE /{productId}: Delete product with {productId}.
 - PATCH /product/offshelf_date/{productId}: Update offshelf date with id {productId}
 """
-from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Depends, Request
 from psycopg2.extensions import connection as Connection
 from backend.models.seller import UploadImageResponse, UploadImageRequset, UploadItemRequest, ProductBasicInfo, ProductInfo, ProductOrderInfo, IsPutRequest, UpdateOffShelfDateRequest
-from backend.database import get_db_connection, return_db_connection
+from backend.database import get_read_connection, return_db_connection
+from backend.services.catalog_cache import catalog_cache
+from backend.services.media_store import media_store, MediaError
+from backend.services.image_variants import schedule_variants, variant_url
 from dotenv import load_dotenv
 import os
 import requests
@@ -56,11 +60,12 @@ def log_event(event_type: str, data: dict):
 def get_db():
     """
     Get a database connection.
+    GET requests may be served by the read replica (database.get_read_connection).
     
     Yields:
         psycopg2.extensions.connection: A PostgreSQL database connection.
     """
-    conn = get_db_connection()
+    conn = get_read_connection()
     try:
         yield conn
     finally:
@@ -126,6 +131,44 @@ async def upload_image(request: UploadImageRequset, req: Request):
             "img_link": "https://i.ibb.co/Z7Fdr1V/15902c9f532f.jpg"
         }
 
+@router.post("/upload_image/file", response_model=UploadImageResponse)
+async def upload_image_file(req: Request, background_tasks: BackgroundTasks):
+    """
+    Upload photo as multipart/form-data (field "image").
+    The file is streamed into the local content-addressed store; identical
+    photos are stored once. New files are pushed to the external image host
+    in the background.
+
+    Args:
+        req(Request): The multipart request.
+        background_tasks(BackgroundTasks): Runs the remote push after the response.
+
+    Returns:
+        dict: The image data.
+    """
+    try:
+        stored = await media_store.receive_upload(req, field_name="image")
+    except MediaError as e:
+        log_event("IMAGE_UPLOAD_ERROR", {
+            "error": str(e)
+        })
+        raise HTTPException(status_code=e.status_code, detail=str(e)) from e
+
+    log_event("IMAGE_UPLOADED", {
+        "digest": stored.digest,
+        "size": stored.size,
+        "content_type": stored.content_type,
+        "deduplicated": stored.deduplicated
+    })
+    # Thumbnail / medium variants in the image process pool
+    schedule_variants(stored.digest, stored.path)
+    if not stored.deduplicated:
+        background_tasks.add_task(media_store.push_to_remote, stored)
+    return {
+        "img_id": stored.img_id,
+        "img_link": stored.url
+    }
+
 @router.post('/')
 async def upload_item(req: UploadItemRequest, conn: Connection = Depends(get_db)):
     """
@@ -156,6 +199,7 @@ async def upload_item(req: UploadItemRequest, conn: Connection = Depends(get_db)
             (req.name, req.price, req.total_quantity, req.category, str(datetime.date.today()), req.off_shelf_date, req.img_link, req.img_id, req.seller_id, req.unit, req.location)
         )
         conn.commit()
+        catalog_cache.invalidate()
         log_event("ITEM_UPLOADED", {
             "seller_id": req.seller_id,
             "name": req.name,
@@ -240,7 +284,8 @@ async def get_product_info(productId: int, conn: Connection=Depends(get_db)):
             "img_link": product[7],
             "img_id": product[8],
             "unit":product[9],
-            "location":product[10]
+            "location":product[10],
+            "thumb_link": variant_url(product[7])
         }
         return _product
     except Exception as e:
@@ -354,6 +399,7 @@ async def delete_agri_product(productId: int, conn: Connection=Depends(get_db)):
             """DELETE FROM agricultural_produce
             WHERE id = %s""", (productId, ))
         conn.commit()
+        catalog_cache.invalidate()
         return {"success":"delete"}
     except Exception as e:
         conn.rollback()
@@ -385,6 +431,7 @@ async def update_offshelf_date(productId: int, req: UpdateOffShelfDateRequest, c
             raise HTTPException(status_code=404, detail="Item not found")
         
         conn.commit()
+        catalog_cache.invalidate()
         return {"status": "success"}
     except Exception as e:
         conn.rollback()
@@ -1,67 +1,46 @@
-# backend/routers/settlement.py
+# backend/routers/settlements.py
 from fastapi import APIRouter, HTTPException, Header
-from collections import defaultdict
-from datetime import datetime
-import pytz, os
+from datetime import date
+from typing import Optional
+import hmac
+import os
 from backend.database import get_db_connection, return_db_connection
+from backend.services.settlement import settle_range, local_today, DEFAULT_CHUNK_DAYS
 
 router = APIRouter(prefix="/api/settlement", tags=["settlement"])
-TZ = pytz.timezone("Asia/Taipei")
 
 @router.get("/ping")
 def settlement_ping():
     return {"ok": True, "service": "settlement"}
 
 @router.post("/run")
-def run_settlement(x_job_key: str | None = Header(None)):
-    if x_job_key != os.getenv("SETTLEMENT_JOB_KEY"):
+def run_settlement(
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    chunk_days: int = DEFAULT_CHUNK_DAYS,
+    resume: bool = False,
+    x_job_key: Optional[str] = Header(None)
+):
+    """
+    Settle driver payouts for date_from..date_to (Asia/Taipei days; default
+    today). Safe to rerun: only the difference to what is already on the
+    ledger is posted. resume=true skips dates that already have a checkpoint.
+    """
+    job_key = os.getenv("SETTLEMENT_JOB_KEY")
+    if not job_key or not x_job_key or not hmac.compare_digest(x_job_key, job_key):
         raise HTTPException(401, "Unauthorized")
 
-    today = datetime.now(TZ).date()
-    start = datetime.combine(today, datetime.min.tJime()).astimezone(TZ)
-    end   = datetime.combine(today, datetime.max.time()).astimezone(TZ)
+    first = date_from or date_to or local_today()
+    last = date_to or first
 
     conn = None
     try:
         conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT o.id, o.driver_id, p.amount
-            FROM orders o
-            JOIN payments p ON p.order_id = o.id
-            WHERE o.delivery_status='DELIVERED'
-              AND o.delivered_at >= %s AND o.delivered_at <= %s
-              AND p.status='PAID_ESCROW'
-        """, (start, end))
-        rows = cur.fetchall()
-
-        sums = defaultdict(lambda: 0.0)
-        for oid, did, amt in rows:
-            sums[did] += float(amt)
-
-        for driver_id, total in sums.items():
-            cur.execute("""
-              INSERT INTO driver_payouts(driver_id, settle_date, amount, status)
-              VALUES (%s, %s, %s, 'SCHEDULED')
-              ON CONFLICT (driver_id, settle_date)
-              DO UPDATE SET amount=EXCLUDED.amount, status='SCHEDULED'
-              RETURNING id
-            """, (driver_id, today, total))
-            payout_id = cur.fetchone()[0]
-
-            cur.execute("""INSERT INTO ledger_entries(ref_type, ref_id, account, delta, currency)
-                           VALUES ('PAYOUT', %s, 'PLATFORM_ESCROW', %s, 'TWD')""",
-                        (payout_id, -total))
-            cur.execute("""INSERT INTO ledger_entries(ref_type, ref_id, account, delta, currency)
-                           VALUES ('PAYOUT', %s, 'DRIVER_WALLET', %s, 'TWD')""",
-                        (payout_id, total))
-
-        conn.commit()
-        cur.close()
-        return {"settled_drivers": len(sums), "total_amount": sum(sums.values())}
+        result = settle_range(conn, first, last, chunk_days=chunk_days, resume=resume)
+        return result.describe()
+    except ValueError as e:
+        raise HTTPException(400, str(e))
     except Exception as e:
-        if conn:
-            conn.rollback()
         raise HTTPException(500, f"Error running settlement: {str(e)}")
     finally:
         if conn:
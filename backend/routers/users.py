@@ -16,7 +16,8 @@ from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
 from psycopg2.extensions import connection as Connection
 from backend.models.user import User, UpdateLocationRequest, LineBindingRequest
-from backend.database import get_db_connection, return_db_connection
+from backend.database import get_db_connection, get_read_connection, return_db_connection
+from backend.services.prepared_statements import prepared
 import logging
 import json
 from datetime import datetime
@@ -55,14 +56,18 @@ class LoginRequest(BaseModel):
 
 router = APIRouter()
 
+# Hot-path statements, prepared once per pooled connection
+LOGIN_USER = prepared("users_login_by_phone", "SELECT id, name, phone, location, is_driver FROM users WHERE phone = %s")
+
 def get_db():
     """
     Get a database connection.
+    GET requests may be served by the read replica (database.get_read_connection).
     
     Yields:
         psycopg2.extensions.connection: A PostgreSQL database connection.
     """
-    conn = get_db_connection()
+    conn = get_read_connection()
     try:
         yield conn
     finally:
@@ -96,7 +101,7 @@ async def login(request: LoginRequest, conn: Connection = Depends(get_db)):
         # Use asyncio timeout to ensure query completes within 5 seconds
         try:
             # Execute query with explicit timeout handling
-            cur.execute("SELECT id, name, phone, location, is_driver FROM users WHERE phone = %s", (phone,))
+            LOGIN_USER.execute(cur, (phone,))
             user = cur.fetchone()
         except OperationalError as db_error:
             logging.error(f"Database error during login: {str(db_error)}")
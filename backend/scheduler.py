@@ -1,54 +1,184 @@
 """
-Automatic History Cleanup Scheduler
-Runs cleanup tasks periodically to maintain database performance
+Background Job Registration
+Jobs run inside the FastAPI process on the in-process async scheduler
+(backend/services/job_scheduler.py); main.py starts and stops it.
+Only the elected leader worker runs leader-only jobs.
 """
-import asyncio
-import schedule
-import time
-from datetime import datetime
 import logging
-from routers.history_management import cleanup_old_history
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('logs/scheduler.log'),
-        logging.StreamHandler()
-    ]
-)
+import os
+from backend.database import get_db_connection, return_db_connection
+from backend.services.job_scheduler import JobScheduler
 
 logger = logging.getLogger(__name__)
 
+SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+
+scheduler = JobScheduler()
+
 async def run_cleanup_task():
     """Run the automatic cleanup task"""
+    from backend.routers.history_management import cleanup_old_history
+
+    logger.info("Starting automatic history cleanup...")
+    result = await cleanup_old_history()
+
+    if result.get("success"):
+        logger.info(f"Cleanup completed successfully: {result.get('message')}")
+    else:
+        raise RuntimeError(f"Cleanup failed: {result.get('error')}")
+    return result.get("message")
+
+def run_expire_orders_task():
+    """Mark stale unaccepted / accepted orders as expired"""
+    from backend.routers.orders import expire_stale_orders
+
+    conn = get_db_connection()
+    try:
+        return expire_stale_orders(conn)
+    finally:
+        return_db_connection(conn)
+
+def run_idempotency_sweep_task():
+    """Delete expired idempotency keys"""
+    from backend.services.idempotency import sweep_expired_keys
+
+    conn = get_db_connection()
+    try:
+        return sweep_expired_keys(conn)
+    finally:
+        return_db_connection(conn)
+
+def run_catalog_rollover_task():
+    """Rebuild the product catalog cache for the new day"""
+    from backend.services.catalog_cache import catalog_cache
+
+    return catalog_cache.rollover()
+
+def run_daily_settlement_task():
+    """Settle yesterday's driver payouts (Asia/Taipei), picking up late deliveries"""
+    from datetime import timedelta
+    from backend.services.settlement import settle_range, local_today
+
+    yesterday = local_today() - timedelta(days=1)
+    conn = get_db_connection()
     try:
-        logger.info("Starting automatic history cleanup...")
-        result = await cleanup_old_history()
-        
-        if result.get("success"):
-            logger.info(f"Cleanup completed successfully: {result.get('message')}")
-        else:
-            logger.error(f"Cleanup failed: {result.get('error')}")
-            
-    except Exception as e:
-        logger.error(f"Error during automatic cleanup: {str(e)}")
-
-def schedule_cleanup_task():
-    """Schedule the cleanup task to run weekly"""
-    # Schedule cleanup every Sunday at 2:00 AM
-    schedule.every().sunday.at("02:00").do(lambda: asyncio.create_task(run_cleanup_task()))
-    logger.info("Scheduled automatic cleanup for every Sunday at 2:00 AM")
-
-def run_scheduler():
-    """Run the scheduler in a loop"""
-    logger.info("Starting history cleanup scheduler...")
-    schedule_cleanup_task()
-    
-    while True:
-        schedule.run_pending()
-        time.sleep(60)  # Check every minute
-
-if __name__ == "__main__":
-    run_scheduler()
+        result = settle_range(conn, yesterday)
+        summary = result.describe()
+        return f"{yesterday}: {summary['settled_drivers']} drivers, {summary['total_amount']} TWD, {summary['ledger_entries']} ledger entries"
+    finally:
+        return_db_connection(conn)
+
+def run_partition_maintenance_task():
+    """Create upcoming monthly order partitions and retire expired months"""
+    from backend.services.partitions import maintain_partitions
+
+    conn = get_db_connection()
+    try:
+        report = maintain_partitions(conn)
+        if report.errors:
+            raise RuntimeError(f"{report.describe()}: {'; '.join(report.errors)}")
+        return report.describe()
+    finally:
+        return_db_connection(conn)
+
+def run_ledger_snapshot_task():
+    """Snapshot the account balances that changed since the last snapshot"""
+    from backend.services.ledger import take_snapshot
+
+    conn = get_db_connection()
+    try:
+        return f"{take_snapshot(conn)} snapshot rows"
+    finally:
+        return_db_connection(conn)
+
+def run_ledger_verify_task():
+    """Reconcile account balances and the latest snapshot against the raw ledger"""
+    from backend.services.ledger import verify_balances
+
+    repair = os.getenv('LEDGER_VERIFIER_REPAIR', 'false').lower() in ('1', 'true', 'yes')
+    conn = get_db_connection()
+    try:
+        mismatches = verify_balances(conn, repair=repair)
+    finally:
+        return_db_connection(conn)
+    if mismatches:
+        for mismatch in mismatches[:20]:
+            logger.error(f"Ledger balance mismatch: {mismatch.describe()}")
+        raise RuntimeError(f"{len(mismatches)} ledger balance mismatches" + (" (account_balances rebuilt)" if repair else ""))
+    return "balances match the ledger"
+
+async def run_dispatch_task():
+    """Assign waiting orders to available drivers and notify buyers and drivers"""
+    import asyncio
+    from backend.services.dispatch import dispatch_once
+    from backend.handlers.send_message import LineMessageService
+
+    def dispatch():
+        conn = get_db_connection()
+        try:
+            return dispatch_once(conn)
+        finally:
+            return_db_connection(conn)
+
+    result = await asyncio.to_thread(dispatch)
+    if result.assignments:
+        from backend.services.order_index import order_index
+        order_index.invalidate()
+
+    line_service = LineMessageService()
+    for assignment in result.assignments:
+        logger.info(f"Dispatched {assignment.service} order {assignment.order_id} to driver {assignment.driver_id} ({assignment.distance_km:.2f} km)")
+        if assignment.buyer_id:
+            message = "系統已為您的訂單指派司機，請等待司機送貨👍🏻\n\n"
+            message += f"📦 訂單 #{assignment.order_id}\n"
+            message += f"📍 送貨地點：{assignment.location}\n"
+            message += f"📱 司機電話：{assignment.driver_phone or '無'}"
+            if not await line_service.send_message_to_user(assignment.buyer_id, message):
+                logger.warning(f"買家 (ID: {assignment.buyer_id}) 未綁定 LINE 帳號或發送通知失敗")
+        if assignment.driver_user_id:
+            message = f"系統已將訂單 #{assignment.order_id} 指派給您🚚\n\n"
+            if assignment.pickup_locations:
+                message += f"🏪 取貨地點：{'、'.join(assignment.pickup_locations)}\n"
+            message += f"📍 送貨地點：{assignment.location}"
+            if not await line_service.send_message_to_user(assignment.driver_user_id, message):
+                logger.warning(f"司機 (ID: {assignment.driver_id}) 未綁定 LINE 帳號或發送通知失敗")
+
+    summary = result.describe()
+    return (f"{summary['assigned']}/{summary['open_orders']} orders assigned to {summary['available_drivers']} drivers, "
+            f"{summary['lost_races']} lost races, solver {summary['solver']} {summary['solve_ms']} ms")
+
+def register_jobs():
+    """Register the default background jobs"""
+    # History cleanup every Sunday at 2:00 AM
+    scheduler.add_job("history_cleanup", run_cleanup_task, cron="0 2 * * 0", jitter_seconds=300)
+    # Order expiry every minute
+    scheduler.add_job("expire_orders", run_expire_orders_task, every_seconds=60, jitter_seconds=5, timeout_seconds=120)
+    # Expired idempotency keys, hourly
+    scheduler.add_job("idempotency_sweep", run_idempotency_sweep_task, cron="15 * * * *", jitter_seconds=60)
+    # Catalog cache rollover at midnight; every worker has its own cache
+    scheduler.add_job("catalog_rollover", run_catalog_rollover_task, cron="0 0 * * *", leader_only=False)
+    # Driver settlement for the previous day at 00:30
+    scheduler.add_job("daily_settlement", run_daily_settlement_task, cron="30 0 * * *", jitter_seconds=60, timeout_seconds=1800)
+    # Ledger balance snapshot after settlement, and a nightly reconciliation
+    scheduler.add_job("ledger_snapshot", run_ledger_snapshot_task, cron="0 1 * * *", jitter_seconds=60)
+    scheduler.add_job("ledger_verify", run_ledger_verify_task, cron="30 3 * * *", jitter_seconds=300, timeout_seconds=1800)
+    # Monthly order partitions, daily so a failed run is retried well before the month turns
+    scheduler.add_job("order_partitions", run_partition_maintenance_task, cron="10 4 * * *", jitter_seconds=300, timeout_seconds=600)
+    # Batch dispatch of waiting orders, opt-in
+    from backend.services.dispatch import AUTO_DISPATCH_ENABLED, DISPATCH_INTERVAL_SECONDS
+    if AUTO_DISPATCH_ENABLED:
+        scheduler.add_job("auto_dispatch", run_dispatch_task, every_seconds=DISPATCH_INTERVAL_SECONDS, jitter_seconds=5, timeout_seconds=300)
+
+def start_scheduler():
+    """Register jobs and start the scheduler in the running event loop"""
+    if not SCHEDULER_ENABLED:
+        logger.info("Background scheduler disabled (SCHEDULER_ENABLED=false)")
+        return
+    if not scheduler.jobs:
+        register_jobs()
+    scheduler.start()
+
+async def stop_scheduler():
+    """Stop the scheduler and release leadership"""
+    if SCHEDULER_ENABLED:
+        await scheduler.stop()
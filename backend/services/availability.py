@@ -0,0 +1,202 @@
+"""
+Driver availability lookup by (date, location).
+
+driver_time.locations is free text ("木柵、政大"). When a slot is saved, its
+locations are split into places and normalized (services/geocode.normalize)
+into driver_time_locations rows, indexed by (date, location_key,
+start_time), so "who drives to X on day D" is an index range scan instead of
+a client-side scan of every slot.
+
+Reads go through a per-day snapshot cache: one indexed query builds a day's
+slots and a sorted (location_key, slot) list, and a location query is a
+bisect over that list (prefix match, so "政大" also finds "政大正門").
+Adding or deleting a slot invalidates its day; a TTL bounds staleness across
+worker processes.
+"""
+import bisect
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date, time as dtime
+from typing import List, Optional, Tuple
+
+from backend.database import get_db_connection, return_db_connection
+from backend.services.geocode import normalize
+
+logger = logging.getLogger(__name__)
+
+AVAILABILITY_CACHE_TTL_SECONDS = float(os.getenv('AVAILABILITY_CACHE_TTL_SECONDS', '60'))
+AVAILABILITY_CACHE_MAX_DAYS = int(os.getenv('AVAILABILITY_CACHE_MAX_DAYS', '62'))
+
+_LOCATION_SPLIT_RE = re.compile(r'[、,，;；/|]+')
+
+DAY_SLOTS_QUERY = """
+    SELECT dt.id, dt.date, dt.start_time, dt.locations, d.id, d.driver_name, d.driver_phone,
+           COALESCE(array_agg(l.location_key) FILTER (WHERE l.location_key IS NOT NULL), '{}')
+    FROM driver_time dt
+    JOIN drivers d ON d.id = dt.driver_id
+    LEFT JOIN driver_time_locations l ON l.slot_id = dt.id
+    WHERE dt.date = %s
+    GROUP BY dt.id, d.id
+    ORDER BY dt.start_time, dt.id
+"""
+
+
+def split_locations(text: Optional[str]) -> List[str]:
+    """
+    Individual places of a free-text locations string ("木柵、政大" -> ["木柵", "政大"]).
+    """
+    if not text:
+        return []
+    parts = [part.strip() for part in _LOCATION_SPLIT_RE.split(text) if part.strip()]
+    return list(dict.fromkeys(parts or [text.strip()]))
+
+
+def location_keys(text: Optional[str]) -> List[str]:
+    keys = (normalize(part) for part in split_locations(text))
+    return list(dict.fromkeys(key for key in keys if key))
+
+
+def index_slot(cur, slot_id: int, day, start_time, locations: Optional[str]) -> int:
+    """
+    (Re)write the driver_time_locations rows of a slot in the caller's transaction.
+    """
+    cur.execute("DELETE FROM driver_time_locations WHERE slot_id = %s", (slot_id,))
+    keys = location_keys(locations) if day is not None else []
+    if keys:
+        values = ", ".join(["(%s, %s, %s, %s)"] * len(keys))
+        cur.execute(
+            f"INSERT INTO driver_time_locations (slot_id, date, start_time, location_key) VALUES {values}",
+            [value for key in keys for value in (slot_id, day, start_time, key)]
+        )
+    return len(keys)
+
+
+@dataclass(frozen=True)
+class DaySnapshot:
+    day: date
+    version: int
+    built_at: float
+    slots: List[dict]
+    # (location_key, index into slots), sorted for prefix range scans
+    keys: List[Tuple[str, int]]
+
+
+def _slot_from_row(row) -> dict:
+    return {
+        "id": row[0],
+        "date": row[1].isoformat(),
+        "start_time": str(row[2])[:5],
+        "locations": row[3],
+        "driver_id": row[4],
+        "driver_name": row[5],
+        "driver_phone": row[6]
+    }
+
+
+class AvailabilityCache:
+    """
+    Per-day slot snapshots; least recently used days are evicted.
+    """
+
+    def __init__(self, ttl_seconds: float = AVAILABILITY_CACHE_TTL_SECONDS, max_days: int = AVAILABILITY_CACHE_MAX_DAYS):
+        self.ttl_seconds = ttl_seconds
+        self.max_days = max_days
+        self._versions = {}
+        self._snapshots: "OrderedDict[date, DaySnapshot]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self.hits = 0
+        self.rebuilds = 0
+
+    def invalidate(self, day: Optional[date] = None):
+        """
+        Drop one day's snapshot, or all of them.
+        """
+        with self._lock:
+            if day is None:
+                for cached in list(self._snapshots):
+                    self._versions[cached] = self._versions.get(cached, 0) + 1
+                self._snapshots.clear()
+            else:
+                self._versions[day] = self._versions.get(day, 0) + 1
+                self._snapshots.pop(day, None)
+
+    def _fresh(self, snapshot: Optional[DaySnapshot]) -> bool:
+        return (
+            snapshot is not None
+            and snapshot.version == self._versions.get(snapshot.day, 0)
+            and time.monotonic() - snapshot.built_at < self.ttl_seconds
+        )
+
+    def _build(self, day: date, version: int) -> DaySnapshot:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            try:
+                cur.execute(DAY_SLOTS_QUERY, (day,))
+                rows = cur.fetchall()
+            finally:
+                cur.close()
+            conn.rollback()
+        finally:
+            return_db_connection(conn)
+        slots = [_slot_from_row(row) for row in rows]
+        keys = sorted((key, index) for index, row in enumerate(rows) for key in row[7])
+        return DaySnapshot(day, version, time.monotonic(), slots, keys)
+
+    def get(self, day: date) -> DaySnapshot:
+        snapshot = self._snapshots.get(day)
+        if self._fresh(snapshot):
+            self.hits += 1
+            return snapshot
+        with self._build_lock:
+            snapshot = self._snapshots.get(day)
+            if self._fresh(snapshot):
+                self.hits += 1
+                return snapshot
+            version = self._versions.get(day, 0)
+            snapshot = self._build(day, version)
+            self.rebuilds += 1
+            with self._lock:
+                # Don't publish a snapshot that was invalidated while building
+                if self._versions.get(day, 0) == version:
+                    self._snapshots[day] = snapshot
+                    self._snapshots.move_to_end(day)
+                    while len(self._snapshots) > self.max_days:
+                        self._snapshots.popitem(last=False)
+            return snapshot
+
+
+def match_slots(snapshot: DaySnapshot, location: Optional[str] = None,
+                time_from: Optional[dtime] = None, time_to: Optional[dtime] = None) -> List[dict]:
+    """
+    Slots of one day whose locations start with `location` (normalized) and
+    whose start time is within [time_from, time_to], by start time.
+    """
+    if location:
+        key = normalize(location)
+        if not key:
+            return []
+        start = bisect.bisect_left(snapshot.keys, (key, -1))
+        indexes = set()
+        for candidate, index in snapshot.keys[start:]:
+            if not candidate.startswith(key):
+                break
+            indexes.add(index)
+        slots = [snapshot.slots[index] for index in sorted(indexes)]
+    else:
+        slots = snapshot.slots
+    low = time_from.strftime('%H:%M') if time_from else None
+    high = time_to.strftime('%H:%M') if time_to else None
+    return [
+        slot for slot in slots
+        if (low is None or slot["start_time"] >= low) and (high is None or slot["start_time"] <= high)
+    ]
+
+
+availability_cache = AvailabilityCache()
@@ -0,0 +1,219 @@
+"""
+Versioned in-memory cache of the on-sale agricultural product catalog.
+
+The catalog only changes when sellers upload, delete or re-date products, so
+GET /api/consumer/ serves a prebuilt JSON body instead of querying and
+rebuilding the list on every page load.
+
+- invalidate() bumps the version; the seller write endpoints call it.
+- set_stock() patches one product's stock into the current snapshot (and
+  into a rebuild in progress), so purchases and cancellations don't force a
+  rebuild of the whole catalog.
+- The snapshot is keyed by date, so the `off_shelf_date >= today` filter
+  rolls over at midnight (a scheduler job also pre-warms it at 00:00).
+- A strong ETag (hash of the body) lets browsers revalidate and get
+  304 Not Modified.
+- Category facet counts are computed with the snapshot, so catalog search
+  can return them without a GROUP BY per request.
+- Each worker process has its own cache; a short TTL bounds how long another
+  worker can serve a catalog that was invalidated elsewhere.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, replace
+from datetime import date
+from typing import Dict, List, Optional
+
+from backend.database import get_db_connection, return_db_connection
+from backend.models.consumer import ProductInfo
+from backend.services.image_variants import variant_url
+
+logger = logging.getLogger(__name__)
+
+CATALOG_CACHE_TTL_SECONDS = float(os.getenv('CATALOG_CACHE_TTL_SECONDS', '60'))
+
+CATALOG_QUERY = """
+    SELECT id, name, price, total_quantity, category, upload_date, off_shelf_date,
+           img_link, img_id, seller_id, unit
+    FROM agricultural_produce
+    WHERE off_shelf_date >= %s
+    ORDER BY id
+"""
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    """
+    An immutable, serialized view of the catalog for one day and version.
+    """
+    version: int
+    day: date
+    built_at: float
+    products: List[dict]
+    body: bytes
+    etag: str
+    facets: List[dict]
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Check an If-None-Match header against an ETag (weak comparison, as
+    required for If-None-Match).
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    bare = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == bare:
+            return True
+    return False
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def _with_stock(snapshot: CatalogSnapshot, stock: Dict[int, int]) -> CatalogSnapshot:
+    products = [
+        {**product, "total_quantity": str(stock[product["id"]])} if product["id"] in stock else product
+        for product in snapshot.products
+    ]
+    body = json.dumps(products, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return replace(snapshot, products=products, body=body, etag=_etag(body))
+
+
+def _product_from_row(row) -> dict:
+    return ProductInfo(
+        id=row[0],
+        name=row[1],
+        price=str(row[2]),
+        total_quantity=str(row[3]),
+        category=row[4],
+        upload_date=str(row[5]),
+        off_shelf_date=str(row[6]),
+        img_link=row[7],
+        img_id=row[8],
+        seller_id=row[9],
+        unit=row[10],
+        thumb_link=variant_url(row[7])
+    ).model_dump()
+
+
+class CatalogCache:
+    """
+    Thread-safe catalog cache. A connection is only taken from the pool when
+    the snapshot has to be rebuilt.
+    """
+
+    def __init__(self, ttl_seconds: float = CATALOG_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._version = 0
+        self._snapshot: Optional[CatalogSnapshot] = None
+        # produce_id -> stock set since the running rebuild started
+        self._stock_patches: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self.hits = 0
+        self.rebuilds = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def invalidate(self):
+        """
+        Drop the current snapshot; the next read rebuilds it.
+        """
+        with self._lock:
+            self._version += 1
+            self._snapshot = None
+
+    def set_stock(self, produce_id: int, total_quantity: int):
+        """
+        Patch the stock of one product into the current snapshot, after the
+        purchase or cancellation committed. A rebuild that is running applies
+        the patch before it publishes, in case it read the old stock.
+        """
+        with self._lock:
+            self._stock_patches[produce_id] = total_quantity
+            if self._snapshot is not None:
+                self._snapshot = _with_stock(self._snapshot, {produce_id: total_quantity})
+
+    def _fresh(self, snapshot: Optional[CatalogSnapshot], today: date) -> bool:
+        return (
+            snapshot is not None
+            and snapshot.version == self._version
+            and snapshot.day == today
+            and time.monotonic() - snapshot.built_at < self.ttl_seconds
+        )
+
+    def _build(self, version: int, today: date) -> CatalogSnapshot:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            try:
+                cur.execute(CATALOG_QUERY, (today,))
+                rows = cur.fetchall()
+            finally:
+                cur.close()
+            # Read-only: end the transaction before the connection goes back
+            conn.rollback()
+        finally:
+            return_db_connection(conn)
+
+        products = [_product_from_row(row) for row in rows]
+        body = json.dumps(products, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        etag = _etag(body)
+        counts = Counter(product["category"] for product in products)
+        facets = [{"category": category, "count": count} for category, count in counts.most_common()]
+        return CatalogSnapshot(version, today, time.monotonic(), products, body, etag, facets)
+
+    def get(self) -> CatalogSnapshot:
+        """
+        Return the current catalog snapshot, rebuilding it if stale.
+        """
+        today = date.today()
+        snapshot = self._snapshot
+        if self._fresh(snapshot, today):
+            self.hits += 1
+            return snapshot
+
+        # Only one thread rebuilds; the others wait and reuse its result
+        with self._build_lock:
+            snapshot = self._snapshot
+            if self._fresh(snapshot, today):
+                self.hits += 1
+                return snapshot
+            with self._lock:
+                version = self._version
+                self._stock_patches = {}
+            snapshot = self._build(version, today)
+            self.rebuilds += 1
+            with self._lock:
+                if self._stock_patches:
+                    snapshot = _with_stock(snapshot, self._stock_patches)
+                # Don't publish a snapshot that was invalidated while building
+                if self._version == version:
+                    self._snapshot = snapshot
+            logger.info(f"Catalog cache rebuilt: {len(snapshot.products)} products, version {version}, etag {snapshot.etag}")
+            return snapshot
+
+    def rollover(self):
+        """
+        Invalidate and pre-build the catalog (scheduled at midnight).
+        """
+        self.invalidate()
+        return len(self.get().products)
+
+
+catalog_cache = CatalogCache()
@@ -0,0 +1,380 @@
+"""
+Automatic batch dispatch of unaccepted orders to available drivers.
+
+A driver is available when they have a driver_time slot today (DISPATCH_TZ)
+that starts within the dispatch window, no overdue orders (the rule
+accept_order enforces) and fewer than DISPATCH_MAX_ACTIVE_ORDERS active
+orders. Each run:
+
+1. loads a batch of orders that have waited on the board for at least
+   DISPATCH_MIN_ORDER_AGE_SECONDS (urgent first, then oldest), and the
+   available drivers with their slot locations
+2. builds an orders x driver-capacity cost matrix: the distance from the
+   driver's slot locations to the order's nearest pickup or delivery point,
+   plus a penalty for non-urgent orders; pairs farther than
+   DISPATCH_MAX_DISTANCE_KM, or where the driver is the buyer, are
+   infeasible
+3. solves it as one assignment problem (Hungarian algorithm; SciPy's
+   linear_sum_assignment when installed, a NumPy implementation otherwise),
+   so the batch gets the most orders assigned at the least total distance
+   instead of first-come greedy matching
+4. claims the assigned orders in one statement with order_claim's batched
+   claim, which applies the checks of a manual accept (order still
+   '未接單', driver not overdue, not the buyer), so orders a driver accepted
+   by hand in the meantime are skipped
+
+Metrics of recent runs are kept in memory (recent_runs).
+"""
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from backend.services.availability import split_locations
+from backend.services.geocode import geocode, haversine_km, normalize
+from backend.services.order_claim import DRIVER_WORK_CTE, STATUS_PARAMS, claim_orders
+from backend.services.partitions import OPEN_ORDERS_SINCE
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # pragma: no cover - optional dependency
+    linear_sum_assignment = None
+
+logger = logging.getLogger(__name__)
+
+AUTO_DISPATCH_ENABLED = os.getenv('AUTO_DISPATCH_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+DISPATCH_INTERVAL_SECONDS = float(os.getenv('DISPATCH_INTERVAL_SECONDS', '60'))
+DISPATCH_TZ = ZoneInfo(os.getenv('DISPATCH_TZ', 'Asia/Taipei'))
+DISPATCH_BATCH_SIZE = int(os.getenv('DISPATCH_BATCH_SIZE', '200'))
+# Leave new orders on the board for drivers to accept by hand first
+DISPATCH_MIN_ORDER_AGE_SECONDS = int(os.getenv('DISPATCH_MIN_ORDER_AGE_SECONDS', '120'))
+DISPATCH_MAX_DISTANCE_KM = float(os.getenv('DISPATCH_MAX_DISTANCE_KM', '3'))
+DISPATCH_MAX_ACTIVE_ORDERS = int(os.getenv('DISPATCH_MAX_ACTIVE_ORDERS', '3'))
+DISPATCH_MAX_ORDERS_PER_RUN = int(os.getenv('DISPATCH_MAX_ORDERS_PER_RUN', '2'))
+# Slots that started up to this long ago, or start within the lookahead, are available
+DISPATCH_SLOT_GRACE_MINUTES = int(os.getenv('DISPATCH_SLOT_GRACE_MINUTES', '60'))
+DISPATCH_SLOT_LOOKAHEAD_MINUTES = int(os.getenv('DISPATCH_SLOT_LOOKAHEAD_MINUTES', '120'))
+# Added to non-urgent orders so urgent ones win contested drivers
+NON_URGENT_PENALTY_KM = 1.0
+INFEASIBLE = 1e6
+
+OPEN_ORDERS_SQL = f"""
+    SELECT 'necessities', o.id, o.buyer_id, o.location, o.is_urgent,
+           COALESCE(array_agg(DISTINCT oi.location) FILTER (WHERE oi.location IS NOT NULL AND oi.location <> ''), '{{}}'),
+           o.timestamp
+    FROM orders o
+    LEFT JOIN order_items oi ON oi.order_id = o.id
+    WHERE o.order_status = '未接單' AND o.timestamp <= NOW() - make_interval(secs => %(min_age)s)
+      AND o.timestamp >= {OPEN_ORDERS_SINCE}
+    GROUP BY o.id, o.timestamp
+    UNION ALL
+    SELECT 'agricultural_product', apo.id, apo.buyer_id, apo.end_point, FALSE, ARRAY[apo.starting_point], apo.timestamp
+    FROM agricultural_product_order apo
+    WHERE apo.status = '未接單' AND apo.timestamp <= NOW() - make_interval(secs => %(min_age)s)
+    ORDER BY 5 DESC, 7, 2
+    LIMIT %(limit)s
+"""
+
+# Work is aggregated once per driver with a slot, not once per slot row
+AVAILABLE_DRIVERS_SQL = f"""
+    WITH slots AS (
+        SELECT t.driver_id, array_agg(t.locations ORDER BY t.start_time) AS locations, MIN(t.start_time) AS first_start
+        FROM driver_time t
+        WHERE t.date = %(day)s AND t.start_time BETWEEN %(slot_from)s AND %(slot_to)s
+        GROUP BY t.driver_id
+    ),
+    candidates AS (
+        SELECT driver_id FROM slots
+    ),
+    {DRIVER_WORK_CTE}
+    SELECT d.id, d.user_id, d.driver_name, d.driver_phone, slots.locations, slots.first_start,
+           COALESCE(work.active, 0), COALESCE(work.overdue, 0)
+    FROM slots
+    JOIN drivers d ON d.id = slots.driver_id
+    LEFT JOIN work ON work.driver_id = d.id
+"""
+
+
+@dataclass
+class DispatchOrder:
+    service: str
+    order_id: int
+    buyer_id: Optional[int]
+    location: str
+    is_urgent: bool
+    pickup_locations: List[str]
+    points: np.ndarray
+
+
+@dataclass
+class AvailableDriver:
+    driver_id: int
+    user_id: Optional[int]
+    name: str
+    phone: str
+    locations: List[str]
+    capacity: int
+    points: np.ndarray
+    keys: List[str]
+
+
+@dataclass(frozen=True)
+class Assignment:
+    service: str
+    order_id: int
+    driver_id: int
+    driver_user_id: Optional[int]
+    driver_phone: str
+    buyer_id: Optional[int]
+    location: str
+    pickup_locations: Tuple[str, ...]
+    distance_km: float
+
+
+@dataclass
+class DispatchResult:
+    started_at: str
+    open_orders: int = 0
+    available_drivers: int = 0
+    driver_capacity: int = 0
+    feasible_pairs: int = 0
+    proposed: int = 0
+    lost_races: int = 0
+    solver: Optional[str] = None
+    solve_ms: float = 0.0
+    total_ms: float = 0.0
+    assignments: List[Assignment] = field(default_factory=list)
+
+    def describe(self) -> dict:
+        distances = [a.distance_km for a in self.assignments]
+        return {
+            "started_at": self.started_at,
+            "open_orders": self.open_orders,
+            "available_drivers": self.available_drivers,
+            "driver_capacity": self.driver_capacity,
+            "feasible_pairs": self.feasible_pairs,
+            "proposed": self.proposed,
+            "assigned": len(self.assignments),
+            "lost_races": self.lost_races,
+            "mean_distance_km": round(float(np.mean(distances)), 3) if distances else None,
+            "solver": self.solver,
+            "solve_ms": round(self.solve_ms, 3),
+            "total_ms": round(self.total_ms, 3)
+        }
+
+
+recent_runs: deque = deque(maxlen=50)
+
+
+def _points(texts) -> np.ndarray:
+    points = []
+    for text in texts:
+        result = geocode(text)
+        if result is not None:
+            points.extend(result.points)
+    return np.array(points, dtype=np.float64).reshape(-1, 2)
+
+
+def load_orders(rows) -> List[DispatchOrder]:
+    orders = []
+    for service, order_id, buyer_id, location, is_urgent, pickups, _ in rows:
+        pickups = [p for p in (pickups or []) if p]
+        orders.append(DispatchOrder(
+            service, order_id, buyer_id, location, bool(is_urgent), pickups, _points([location, *pickups])
+        ))
+    return orders
+
+
+def load_drivers(rows) -> List[AvailableDriver]:
+    drivers = []
+    for driver_id, user_id, name, phone, slot_texts, _, active, overdue in rows:
+        capacity = min(DISPATCH_MAX_ORDERS_PER_RUN, DISPATCH_MAX_ACTIVE_ORDERS - (active or 0))
+        if overdue or capacity <= 0:
+            continue
+        locations = list(dict.fromkeys(place for text in slot_texts or [] for place in split_locations(text)))
+        drivers.append(AvailableDriver(
+            driver_id, user_id, name, phone, locations, capacity,
+            _points(locations), [normalize(text) for text in locations if normalize(text)]
+        ))
+    return drivers
+
+
+def pair_distance(order: DispatchOrder, driver: AvailableDriver) -> Optional[float]:
+    """
+    Distance in km from the driver's slot locations to the order's nearest
+    stop; None if they do not overlap.
+    """
+    if order.buyer_id is not None and order.buyer_id == driver.user_id:
+        return None
+    if len(order.points) and len(driver.points):
+        distance = min(float(haversine_km(lat, lng, order.points).min()) for lat, lng in driver.points)
+        return distance if distance <= DISPATCH_MAX_DISTANCE_KM else None
+    # Locations outside the gazetteer: fall back to text overlap, ranked last
+    texts = [normalize(text) for text in [order.location, *order.pickup_locations] if text]
+    if any(key in text for key in driver.keys for text in texts):
+        return DISPATCH_MAX_DISTANCE_KM
+    return None
+
+
+def build_cost_matrix(orders: List[DispatchOrder], drivers: List[AvailableDriver]):
+    """
+    Returns:
+        (cost, distance, columns): one column per unit of driver capacity;
+        columns[j] is the index into drivers.
+    """
+    columns = [index for index, driver in enumerate(drivers) for _ in range(driver.capacity)]
+    distance = np.full((len(orders), len(drivers)), np.nan)
+    for i, order in enumerate(orders):
+        for k, driver in enumerate(drivers):
+            d = pair_distance(order, driver)
+            if d is not None:
+                distance[i, k] = d
+    penalty = np.array([0.0 if order.is_urgent else NON_URGENT_PENALTY_KM for order in orders])[:, None]
+    per_driver = np.where(np.isnan(distance), INFEASIBLE, distance + penalty)
+    cost = per_driver[:, columns] if columns else np.empty((len(orders), 0))
+    return cost, distance, columns
+
+
+def _hungarian(cost: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Minimum-cost assignment of every row of `cost` (rows <= columns), with
+    row / column potentials; the inner column scans are vectorized.
+    """
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=np.int64)  # row assigned to each column (1-based, 0 = none)
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[1:]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            better = free & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            used_columns = np.flatnonzero(used)
+            u[p[used_columns]] += delta
+            v[used_columns] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    cols = np.flatnonzero(p[1:])
+    rows = p[1:][cols] - 1
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+def solve_assignment(cost: np.ndarray) -> Tuple[np.ndarray, np.ndarray, str]:
+    """
+    Minimum-cost assignment for a rectangular cost matrix.
+
+    Returns:
+        (rows, cols, solver)
+    """
+    if cost.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), "none"
+    if linear_sum_assignment is not None:
+        rows, cols = linear_sum_assignment(cost)
+        return rows, cols, "scipy"
+    if cost.shape[0] <= cost.shape[1]:
+        rows, cols = _hungarian(cost)
+    else:
+        cols, rows = _hungarian(cost.T)
+    return rows, cols, "numpy"
+
+
+def plan_dispatch(orders: List[DispatchOrder], drivers: List[AvailableDriver], result: DispatchResult) -> List[Assignment]:
+    """
+    Assign orders to drivers; pairs that are infeasible are dropped.
+    """
+    cost, distance, columns = build_cost_matrix(orders, drivers)
+    result.driver_capacity = len(columns)
+    result.feasible_pairs = int(np.count_nonzero(~np.isnan(distance)))
+    if not result.feasible_pairs:
+        return []
+
+    started = time.perf_counter()
+    rows, cols, result.solver = solve_assignment(cost)
+    result.solve_ms = (time.perf_counter() - started) * 1000
+
+    assignments = []
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        if cost[i, j] >= INFEASIBLE:
+            continue
+        order, driver = orders[i], drivers[columns[j]]
+        assignments.append(Assignment(
+            order.service, order.order_id, driver.driver_id, driver.user_id, driver.phone,
+            order.buyer_id, order.location, tuple(order.pickup_locations), float(distance[i, columns[j]])
+        ))
+    return assignments
+
+
+def claim_assignments(cur, assignments: List[Assignment]) -> List[Assignment]:
+    """
+    Claim the assigned orders through order_claim, so they get the checks a
+    driver accepting by hand gets; orders that are no longer '未接單' (or
+    whose driver became overdue) are skipped.
+    """
+    claimed = set(claim_orders(cur, [(a.service, a.order_id, a.driver_id) for a in assignments]))
+    return [a for a in assignments if (a.service, a.order_id, a.driver_id) in claimed]
+
+
+def dispatch_once(conn, now: Optional[datetime] = None) -> DispatchResult:
+    """
+    Run one dispatch batch and commit the claimed assignments.
+    """
+    started = time.perf_counter()
+    now = now or datetime.now(DISPATCH_TZ)
+    result = DispatchResult(started_at=now.isoformat())
+
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    slot_from = max(now - timedelta(minutes=DISPATCH_SLOT_GRACE_MINUTES), day_start)
+    slot_to = min(now + timedelta(minutes=DISPATCH_SLOT_LOOKAHEAD_MINUTES), day_start + timedelta(days=1, microseconds=-1))
+
+    cur = conn.cursor()
+    try:
+        cur.execute(OPEN_ORDERS_SQL, {"min_age": DISPATCH_MIN_ORDER_AGE_SECONDS, "limit": DISPATCH_BATCH_SIZE})
+        orders = load_orders(cur.fetchall())
+        result.open_orders = len(orders)
+        drivers = []
+        if orders:
+            cur.execute(AVAILABLE_DRIVERS_SQL, {
+                **STATUS_PARAMS, "day": now.date(), "slot_from": slot_from.time(), "slot_to": slot_to.time()
+            })
+            drivers = load_drivers(cur.fetchall())
+        result.available_drivers = len(drivers)
+
+        proposed = plan_dispatch(orders, drivers, result) if drivers else []
+        result.proposed = len(proposed)
+        result.assignments = claim_assignments(cur, proposed)
+        result.lost_races = result.proposed - len(result.assignments)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    result.total_ms = (time.perf_counter() - started) * 1000
+    recent_runs.append(result.describe())
+    return result
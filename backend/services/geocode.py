@@ -0,0 +1,183 @@
+"""
+Local geocoding for delivery locations.
+
+Order locations (orders.location, agricultural_product_order.end_point) are
+free text. They are resolved to coordinates against a gazetteer file
+(GEOCODE_GAZETTEER_PATH, default backend/data/gazetteer.json) that is loaded
+once per process; lookups are memoized. Nothing here calls an external
+service, so it is safe on the request path.
+
+Resolution order for a location string:
+1. "lat,lng" literal
+2. exact place name or alias (after normalization)
+3. the longest place name or alias contained in the string
+   (e.g. "台北市文山區指南路二段64號 政大" -> 國立政治大學)
+
+A place can have several points (building entrances); distance checks use
+the nearest one. Only coordinates and exact matches (AUTHORITATIVE_MATCHES)
+are precise enough to reject a delivery; a contained match may be a short
+alias inside an unrelated address. Distances are computed with a vectorized haversine over all
+points at once.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import unicodedata
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+GAZETTEER_PATH = os.getenv(
+    'GEOCODE_GAZETTEER_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'gazetteer.json')
+)
+EARTH_RADIUS_KM = 6371.0088
+# Aliases shorter than this are only matched exactly, not as substrings
+MIN_CONTAINED_ALIAS_LENGTH = 2
+# Match kinds whose distance is trusted to enforce a delivery radius
+AUTHORITATIVE_MATCHES = ('coordinates', 'exact')
+
+_LATLNG_RE = re.compile(r'^\s*(-?\d{1,2}(?:\.\d+)?)\s*,\s*(-?\d{1,3}(?:\.\d+)?)\s*$')
+_STRIP_RE = re.compile(r'[\s,，、。．·\-_/()（）\[\]【】]+')
+
+
+@dataclass(frozen=True)
+class Place:
+    name: str
+    points: Tuple[Tuple[float, float], ...]
+
+
+@dataclass(frozen=True)
+class GeocodeResult:
+    query: str
+    place: Optional[str]
+    points: Tuple[Tuple[float, float], ...]
+    match: str  # 'coordinates' | 'exact' | 'contained'
+
+
+def normalize(text: str) -> str:
+    """
+    Canonical form for matching: NFKC (full-width -> half-width), lower case,
+    no whitespace or punctuation.
+    """
+    return _STRIP_RE.sub('', unicodedata.normalize('NFKC', text)).lower()
+
+
+class Gazetteer:
+    """
+    In-memory index of known places, loaded from a JSON file.
+    """
+
+    def __init__(self, by_key: Dict[str, Place]):
+        # normalized name or alias -> place
+        self.by_key = by_key
+        # Longest first, so the most specific contained name wins
+        self.contained_keys = sorted(
+            (key for key in by_key if len(key) >= MIN_CONTAINED_ALIAS_LENGTH),
+            key=len, reverse=True
+        )
+
+    @classmethod
+    def load(cls, path: str) -> 'Gazetteer':
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            logger.warning(f"Gazetteer {path} not found; delivery locations will not be geocoded")
+            return cls({})
+
+        by_key: Dict[str, Place] = {}
+        places = data.get('places', [])
+        for entry in places:
+            points = tuple((float(lat), float(lng)) for lat, lng in entry['points'])
+            if not points:
+                continue
+            place = Place(entry['name'], points)
+            for name in [entry['name'], *entry.get('aliases', [])]:
+                by_key.setdefault(normalize(name), place)
+        logger.info(f"Loaded gazetteer with {len(places)} places from {path}")
+        return cls(by_key)
+
+    def lookup(self, text: str) -> Optional[GeocodeResult]:
+        match = _LATLNG_RE.match(text)
+        if match:
+            lat, lng = float(match.group(1)), float(match.group(2))
+            if -90 <= lat <= 90 and -180 <= lng <= 180:
+                return GeocodeResult(text, None, ((lat, lng),), 'coordinates')
+
+        key = normalize(text)
+        if not key:
+            return None
+        place = self.by_key.get(key)
+        if place is not None:
+            return GeocodeResult(text, place.name, place.points, 'exact')
+        for candidate in self.contained_keys:
+            if candidate in key:
+                place = self.by_key[candidate]
+                return GeocodeResult(text, place.name, place.points, 'contained')
+        return None
+
+
+_gazetteer: Optional[Gazetteer] = None
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer() -> Gazetteer:
+    global _gazetteer
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                _gazetteer = Gazetteer.load(GAZETTEER_PATH)
+    return _gazetteer
+
+
+def reload_gazetteer(path: str = GAZETTEER_PATH) -> Gazetteer:
+    """
+    Reload the gazetteer file and drop memoized lookups.
+    """
+    global _gazetteer
+    with _gazetteer_lock:
+        _gazetteer = Gazetteer.load(path)
+    geocode.cache_clear()
+    return _gazetteer
+
+
+@lru_cache(maxsize=4096)
+def geocode(text: Optional[str]) -> Optional[GeocodeResult]:
+    """
+    Coordinates for a free-text location, or None if it is not in the gazetteer.
+    """
+    if not text:
+        return None
+    return get_gazetteer().lookup(text)
+
+
+def haversine_km(lat: float, lng: float, points) -> np.ndarray:
+    """
+    Distances in km from (lat, lng) to each row of `points` ([[lat, lng], ...]).
+    """
+    points = np.radians(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+    lat1, lng1 = np.radians(lat), np.radians(lng)
+    dlat = points[:, 0] - lat1
+    dlng = points[:, 1] - lng1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(points[:, 0]) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def distance_to_location(lat: float, lng: float, location: Optional[str]) -> Optional[Tuple[float, GeocodeResult]]:
+    """
+    Distance in km from a GPS fix to the nearest point of a geocoded location.
+
+    Returns:
+        (distance_km, GeocodeResult), or None if the location cannot be geocoded.
+    """
+    result = geocode(location)
+    if result is None:
+        return None
+    return float(haversine_km(lat, lng, result.points).min()), result
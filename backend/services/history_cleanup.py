@@ -0,0 +1,364 @@
+"""
+Batched history cleanup engine.
+
+Old delivered / cancelled orders are removed in bounded keyset batches
+(ordered by id) with a short commit after every batch and a throttle between
+batches, so the cleanup never holds row locks for long and WAL is written in
+small steps instead of one huge transaction.
+
+Every batch is archived to a gzip-compressed JSON Lines file before it is
+deleted. The archive contains the order rows together with their
+order_items, driver_orders and pending_transfers rows. driver_orders and
+pending_transfers have no foreign key to the order tables, so they are
+deleted explicitly alongside each batch, and a final orphan sweep removes any
+leftovers from earlier cleanups.
+
+Progress is written to a JSON state file after every batch. If a run is
+interrupted (restart, crash, deploy) the next run resumes from the last
+committed id with the same cutoff dates. A batch that cannot lock its rows
+within CLEANUP_LOCK_TIMEOUT (e.g. a driver is completing one of the orders)
+pauses its target without moving the cursor, so the rows are picked up by
+the next run instead of being passed over.
+"""
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from psycopg2 import errors
+
+from backend.database import get_db_connection, return_db_connection
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv(
+    'HISTORY_ARCHIVE_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'archive')
+)
+STATE_FILE = os.path.join(ARCHIVE_DIR, 'cleanup_state.json')
+BATCH_SIZE = int(os.getenv('HISTORY_CLEANUP_BATCH_SIZE', '500'))
+THROTTLE_SECONDS = float(os.getenv('HISTORY_CLEANUP_THROTTLE_SECONDS', '0.2'))
+# How long a batch waits for row locks held by live traffic before pausing
+CLEANUP_LOCK_TIMEOUT = os.getenv('HISTORY_CLEANUP_LOCK_TIMEOUT', '2s')
+
+
+@dataclass(frozen=True)
+class CleanupTarget:
+    """
+    One (table, status, retention) combination handled by the cleanup.
+    """
+    name: str
+    table: str
+    status_column: str
+    status: str
+    retention_days: int
+    service: str  # value of driver_orders.service / pending_transfers.service
+
+
+TARGETS = [
+    CleanupTarget('orders_delivered', 'orders', 'order_status', '已送達', 90, 'necessities'),
+    CleanupTarget('agri_delivered', 'agricultural_product_order', 'status', '已送達', 90, 'agricultural_product'),
+    CleanupTarget('orders_cancelled', 'orders', 'order_status', '已取消', 180, 'necessities'),
+    CleanupTarget('agri_cancelled', 'agricultural_product_order', 'status', '已取消', 180, 'agricultural_product'),
+]
+
+# Dependent tables without a foreign key to the order tables
+ORPHAN_TARGETS = [
+    ('driver_orders', 'necessities', 'orders'),
+    ('driver_orders', 'agricultural_product', 'agricultural_product_order'),
+    ('pending_transfers', 'necessities', 'orders'),
+    ('pending_transfers', 'agricultural_product', 'agricultural_product_order'),
+]
+
+_run_lock = threading.Lock()
+
+
+def _load_state() -> Optional[dict]:
+    if not os.path.exists(STATE_FILE):
+        return None
+    try:
+        with open(STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable cleanup state file: {str(e)}")
+        return None
+
+
+def _save_state(state: dict):
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    tmp_path = STATE_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, STATE_FILE)
+
+
+def get_cleanup_status() -> dict:
+    """
+    Return the progress / resume state of the current or last cleanup run.
+    """
+    state = _load_state()
+    return {
+        "running": _run_lock.locked(),
+        "state": state
+    }
+
+
+def _new_state(now: datetime) -> dict:
+    targets = {}
+    for target in TARGETS:
+        cutoff = now - timedelta(days=target.retention_days)
+        targets[target.name] = {
+            "cutoff": cutoff.strftime('%Y-%m-%d %H:%M:%S'),
+            "last_id": 0,
+            "deleted": 0,
+            "batches": 0,
+            "done": False
+        }
+    orphans = {f"{table}:{service}": {"last_id": 0, "deleted": 0, "done": False}
+               for table, service, _ in ORPHAN_TARGETS}
+    return {
+        "status": "running",
+        "started_at": now.isoformat(),
+        "finished_at": None,
+        "targets": targets,
+        "orphans": orphans
+    }
+
+
+def _write_archive(kind: str, first_id: int, last_id: int, records: List[dict]) -> str:
+    """
+    Write archived rows as gzip JSON Lines and fsync before returning,
+    so rows are never deleted before their archive is durable.
+    """
+    directory = os.path.join(ARCHIVE_DIR, kind)
+    os.makedirs(directory, exist_ok=True)
+    filename = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{first_id}-{last_id}.jsonl.gz"
+    path = os.path.join(directory, filename)
+    with open(path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as gz:
+            for record in records:
+                gz.write(json.dumps(record, ensure_ascii=False, default=str).encode('utf-8'))
+                gz.write(b'\n')
+        raw.flush()
+        os.fsync(raw.fileno())
+    return path
+
+
+def _fetch_json_rows(cur, query: str, params: tuple) -> List[dict]:
+    cur.execute(query, params)
+    return [row[0] for row in cur.fetchall()]
+
+
+def _cleanup_batch(conn, target: CleanupTarget, target_state: dict, batch_size: int) -> int:
+    """
+    Archive and delete one keyset batch of a target. Returns the number of
+    rows in the batch (0 when the target is exhausted).
+
+    Raises:
+        errors.LockNotAvailable: A row of the batch stayed locked for
+        CLEANUP_LOCK_TIMEOUT; nothing was deleted and the cursor is unchanged.
+    """
+    cur = conn.cursor()
+    try:
+        # Keyset batch: only rows after the last committed id. Locked rows are
+        # waited for (briefly) rather than skipped: the cursor moves past them.
+        cur.execute("SET LOCAL lock_timeout = %s", (CLEANUP_LOCK_TIMEOUT,))
+        cur.execute(
+            f"""
+            SELECT id FROM {target.table}
+            WHERE timestamp < %s AND {target.status_column} = %s AND id > %s
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE
+            """,
+            (target_state["cutoff"], target.status, target_state["last_id"], batch_size)
+        )
+        ids = [row[0] for row in cur.fetchall()]
+        if not ids:
+            conn.rollback()
+            return 0
+
+        records = []
+        for row in _fetch_json_rows(cur, f"SELECT row_to_json(t) FROM {target.table} t WHERE id = ANY(%s)", (ids,)):
+            records.append({"table": target.table, "row": row})
+        if target.table == 'orders':
+            for row in _fetch_json_rows(cur, "SELECT row_to_json(t) FROM order_items t WHERE order_id = ANY(%s)", (ids,)):
+                records.append({"table": "order_items", "row": row})
+        for dependent in ('driver_orders', 'pending_transfers'):
+            for row in _fetch_json_rows(
+                cur,
+                f"SELECT row_to_json(t) FROM {dependent} t WHERE service = %s AND order_id = ANY(%s)",
+                (target.service, ids)
+            ):
+                records.append({"table": dependent, "row": row})
+
+        archive_path = _write_archive(target.name, ids[0], ids[-1], records)
+
+        cur.execute("DELETE FROM driver_orders WHERE service = %s AND order_id = ANY(%s)", (target.service, ids))
+        cur.execute("DELETE FROM pending_transfers WHERE service = %s AND order_id = ANY(%s)", (target.service, ids))
+        # order_items are removed by ON DELETE CASCADE
+        cur.execute(f"DELETE FROM {target.table} WHERE id = ANY(%s)", (ids,))
+        deleted = cur.rowcount
+        conn.commit()
+
+        target_state["last_id"] = ids[-1]
+        target_state["deleted"] += deleted
+        target_state["batches"] += 1
+        logger.info(f"History cleanup {target.name}: deleted {deleted} rows (ids {ids[0]}-{ids[-1]}), archive {archive_path}")
+        return len(ids)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def _cleanup_orphans_batch(conn, table: str, service: str, parent: str, orphan_state: dict, batch_size: int) -> int:
+    """
+    Archive and delete one batch of dependent rows whose order no longer exists.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SET LOCAL lock_timeout = %s", (CLEANUP_LOCK_TIMEOUT,))
+        cur.execute(
+            f"""
+            SELECT d.id FROM {table} d
+            WHERE d.id > %s AND d.service = %s
+              AND NOT EXISTS (SELECT 1 FROM {parent} p WHERE p.id = d.order_id)
+            ORDER BY d.id
+            LIMIT %s
+            FOR UPDATE
+            """,
+            (orphan_state["last_id"], service, batch_size)
+        )
+        ids = [row[0] for row in cur.fetchall()]
+        if not ids:
+            conn.rollback()
+            return 0
+
+        records = [{"table": table, "row": row} for row in
+                   _fetch_json_rows(cur, f"SELECT row_to_json(t) FROM {table} t WHERE id = ANY(%s)", (ids,))]
+        _write_archive(f"orphans_{table}_{service}", ids[0], ids[-1], records)
+
+        cur.execute(f"DELETE FROM {table} WHERE id = ANY(%s)", (ids,))
+        deleted = cur.rowcount
+        conn.commit()
+
+        orphan_state["last_id"] = ids[-1]
+        orphan_state["deleted"] += deleted
+        logger.info(f"History cleanup orphans {table}/{service}: deleted {deleted} rows")
+        return len(ids)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def run_history_cleanup(batch_size: int = BATCH_SIZE, throttle_seconds: float = THROTTLE_SECONDS,
+                        max_batches: Optional[int] = None) -> Dict:
+    """
+    Run (or resume) the batched history cleanup.
+
+    Args:
+        batch_size (int): Maximum rows deleted per transaction.
+        throttle_seconds (float): Pause between batches to leave room for live traffic.
+        max_batches (Optional[int]): Stop after this many batches (the run stays resumable).
+
+    Returns:
+        dict: Summary of the run, including the resume state.
+    """
+    if not _run_lock.acquire(blocking=False):
+        return {"success": False, "error": "History cleanup is already running"}
+
+    conn = None
+    try:
+        state = _load_state()
+        if not state or state.get("status") == "finished":
+            state = _new_state(datetime.now())
+        else:
+            logger.info(f"Resuming history cleanup started at {state.get('started_at')}")
+            state["status"] = "running"
+        _save_state(state)
+
+        conn = get_db_connection()
+        batches = 0
+
+        def budget_left() -> bool:
+            return max_batches is None or batches < max_batches
+
+        for target in TARGETS:
+            target_state = state["targets"][target.name]
+            while not target_state["done"] and budget_left():
+                try:
+                    if _cleanup_batch(conn, target, target_state, batch_size) == 0:
+                        target_state["done"] = True
+                except errors.LockNotAvailable:
+                    logger.warning(f"History cleanup {target.name}: rows after id {target_state['last_id']} are locked, resuming next run")
+                    break
+                batches += 1
+                _save_state(state)
+                if not target_state["done"] and throttle_seconds > 0:
+                    time.sleep(throttle_seconds)
+
+        for table, service, parent in ORPHAN_TARGETS:
+            orphan_state = state["orphans"][f"{table}:{service}"]
+            while not orphan_state["done"] and budget_left():
+                try:
+                    if _cleanup_orphans_batch(conn, table, service, parent, orphan_state, batch_size) == 0:
+                        orphan_state["done"] = True
+                except errors.LockNotAvailable:
+                    logger.warning(f"History cleanup orphans {table}/{service}: rows after id {orphan_state['last_id']} are locked, resuming next run")
+                    break
+                batches += 1
+                _save_state(state)
+                if not orphan_state["done"] and throttle_seconds > 0:
+                    time.sleep(throttle_seconds)
+
+        finished = all(t["done"] for t in state["targets"].values()) and all(o["done"] for o in state["orphans"].values())
+        if finished:
+            state["status"] = "finished"
+            state["finished_at"] = datetime.now().isoformat()
+        else:
+            state["status"] = "paused"
+        _save_state(state)
+
+        targets = state["targets"]
+        deleted_completed = targets["orders_delivered"]["deleted"] + targets["agri_delivered"]["deleted"]
+        deleted_cancelled = targets["orders_cancelled"]["deleted"] + targets["agri_cancelled"]["deleted"]
+        deleted_orphans = sum(o["deleted"] for o in state["orphans"].values())
+        return {
+            "success": True,
+            "finished": finished,
+            "deleted_completed": deleted_completed,
+            "deleted_cancelled": deleted_cancelled,
+            "deleted_orphans": deleted_orphans,
+            "total_deleted": deleted_completed + deleted_cancelled,
+            "cutoff_date_completed": targets["orders_delivered"]["cutoff"],
+            "cutoff_date_cancelled": targets["orders_cancelled"]["cutoff"],
+            "batches": batches,
+            "archive_dir": ARCHIVE_DIR,
+            "state": state,
+            "message": f"Deleted {deleted_completed} completed orders (90+ days), {deleted_cancelled} cancelled orders (180+ days) and {deleted_orphans} orphaned rows"
+                       + ("" if finished else " (paused, run again to resume)")
+        }
+    except Exception as e:
+        logger.error(f"History cleanup failed: {str(e)}")
+        try:
+            state = _load_state()
+            if state:
+                state["status"] = "interrupted"
+                state["last_error"] = str(e)
+                _save_state(state)
+        except OSError:
+            pass
+        return {"success": False, "error": str(e)}
+    finally:
+        if conn:
+            return_db_connection(conn)
+        _run_lock.release()
@@ -0,0 +1,154 @@
+"""
+Idempotency-Key support for POST endpoints.
+
+A client sends `Idempotency-Key: <uuid>` with a create request and reuses the
+same key when it retries. The key is claimed with
+INSERT ... ON CONFLICT DO NOTHING on a unique (scope, key) index, inside the
+same transaction as the work itself, and the response is stored in that
+transaction too:
+
+- the work commits            -> key and stored response commit with it
+- the work fails / rolls back -> the key disappears, a retry runs normally
+- a concurrent duplicate      -> its INSERT waits on the unique index until
+                                 the first request commits, then replays the
+                                 stored response
+
+Reusing a key with a different request body is rejected with 422. Keys expire
+after IDEMPOTENCY_KEY_TTL_HOURS and are swept by a scheduler job.
+
+Table: backend/database/migrations/0006_create_idempotency_keys.sql
+"""
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from fastapi import HTTPException
+
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.getenv('IDEMPOTENCY_KEY_TTL_HOURS', '24'))
+MAX_KEY_LENGTH = 255
+REPLAY_HEADER = 'Idempotent-Replayed'
+
+
+@dataclass
+class IdempotencyClaim:
+    """
+    Result of claiming a key: either a fresh claim, or a stored response to replay.
+    """
+    scope: str
+    key: str
+    replay: bool = False
+    status_code: Optional[int] = None
+    body: Any = None
+
+
+def request_fingerprint(payload: Any) -> str:
+    """
+    Stable hash of a request payload (pydantic model or JSON-able value).
+    """
+    if hasattr(payload, 'model_dump'):
+        payload = payload.model_dump(mode='json')
+    data = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def claim_key(cur, scope: str, key: Optional[str], fingerprint: str) -> Optional[IdempotencyClaim]:
+    """
+    Claim an idempotency key in the caller's transaction.
+
+    Args:
+        cur: Cursor of the transaction that does the work.
+        scope (str): Endpoint scope, e.g. 'orders:create'.
+        key (Optional[str]): Value of the Idempotency-Key header.
+        fingerprint (str): request_fingerprint() of the request body.
+
+    Returns:
+        Optional[IdempotencyClaim]: None when no key was sent; otherwise the
+        claim, with replay=True if a stored response should be returned.
+    """
+    if key is None:
+        return None
+    key = key.strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters")
+
+    cur.execute("""
+        INSERT INTO idempotency_keys (scope, idempotency_key, request_hash, expires_at)
+        VALUES (%s, %s, %s, NOW() + make_interval(hours => %s))
+        ON CONFLICT (scope, idempotency_key) DO NOTHING
+        RETURNING id
+    """, (scope, key, fingerprint, IDEMPOTENCY_KEY_TTL_HOURS))
+    if cur.fetchone() is not None:
+        return IdempotencyClaim(scope, key)
+
+    cur.execute("""
+        SELECT request_hash, response_status, response_body, expires_at <= NOW()
+        FROM idempotency_keys
+        WHERE scope = %s AND idempotency_key = %s
+        FOR UPDATE
+    """, (scope, key))
+    row = cur.fetchone()
+    if row is None:
+        # Swept between the two statements; claim it again
+        return claim_key(cur, scope, key, fingerprint)
+
+    request_hash, status_code, body, expired = row
+    if expired:
+        # Not swept yet: reuse the row as a fresh claim
+        cur.execute("""
+            UPDATE idempotency_keys
+            SET request_hash = %s, response_status = NULL, response_body = NULL,
+                created_at = NOW(), expires_at = NOW() + make_interval(hours => %s)
+            WHERE scope = %s AND idempotency_key = %s
+        """, (fingerprint, IDEMPOTENCY_KEY_TTL_HOURS, scope, key))
+        return IdempotencyClaim(scope, key)
+    if request_hash != fingerprint:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+    return IdempotencyClaim(scope, key, replay=True, status_code=status_code, body=body)
+
+
+def store_response(cur, claim: Optional[IdempotencyClaim], body: Any, status_code: int = 200):
+    """
+    Save the response for a claimed key; commit it together with the work.
+    """
+    if claim is None or claim.replay:
+        return
+    cur.execute("""
+        UPDATE idempotency_keys
+        SET response_status = %s, response_body = %s::jsonb
+        WHERE scope = %s AND idempotency_key = %s
+    """, (status_code, json.dumps(body, ensure_ascii=False, default=str), claim.scope, claim.key))
+
+
+def sweep_expired_keys(conn, batch_size: int = 1000) -> int:
+    """
+    Delete expired keys in small batches.
+
+    Returns:
+        int: Number of deleted keys.
+    """
+    total = 0
+    cur = conn.cursor()
+    try:
+        while True:
+            cur.execute("""
+                DELETE FROM idempotency_keys
+                WHERE id IN (
+                    SELECT id FROM idempotency_keys
+                    WHERE expires_at <= NOW()
+                    ORDER BY expires_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+            """, (batch_size,))
+            deleted = cur.rowcount
+            conn.commit()
+            total += deleted
+            if deleted < batch_size:
+                return total
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
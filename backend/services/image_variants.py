@@ -0,0 +1,165 @@
+"""
+Responsive image variants for uploaded product photos.
+
+For every new upload a process pool (CPU-bound resizing stays off the event
+loop and out of the GIL) writes fixed-size variants next to the original in
+the media store:
+
+    <sha256>.jpg        original
+    <sha256>.thumb.webp 320px, product grid
+    <sha256>.medium.webp 960px, product detail
+
+Variant URLs are derived from the original URL, so listing endpoints can
+return `thumb_link` without touching the disk. If a variant does not exist
+(yet), the media endpoint serves the original with a short cache lifetime
+and queues the variant.
+
+Pillow is an optional dependency: without it no variants are generated and
+variant URLs fall back to the original.
+"""
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow not installed: variants disabled
+    Image = None
+
+from backend.services.media_store import IMAGE_TYPES, MEDIA_URL_PREFIX, media_store
+
+logger = logging.getLogger(__name__)
+
+# Longest edge in pixels
+VARIANTS: Dict[str, int] = {
+    "thumb": 320,
+    "medium": 960,
+}
+IMAGE_WORKERS = int(os.getenv('IMAGE_VARIANT_WORKERS', '2'))
+VARIANT_QUALITY = 80
+
+_MEDIA_URL_RE = re.compile(r'^' + re.escape(MEDIA_URL_PREFIX) + r'([0-9a-f]{64})\.[a-z0-9]{1,5}$')
+_VARIANT_FILENAME_RE = re.compile(r'^([0-9a-f]{64})\.(' + '|'.join(VARIANTS) + r')\.[a-z0-9]{1,5}$')
+
+_executor: Optional[ProcessPoolExecutor] = None
+_pending = set()
+
+
+def variants_enabled() -> bool:
+    return Image is not None
+
+
+def variant_extension() -> str:
+    return '.webp' if Image is not None and features.check('webp') else '.jpg'
+
+
+def variant_filename(digest: str, variant: str) -> str:
+    return f"{digest}.{variant}{variant_extension()}"
+
+
+def variant_url(img_link: Optional[str], variant: str = "thumb") -> Optional[str]:
+    """
+    URL of a variant of a media-store image; other URLs are returned unchanged.
+    """
+    if not img_link or not variants_enabled():
+        return img_link
+    match = _MEDIA_URL_RE.match(img_link)
+    if not match:
+        return img_link
+    return MEDIA_URL_PREFIX + variant_filename(match.group(1), variant)
+
+
+def parse_variant_filename(filename: str):
+    """
+    Split '<sha256>.<variant>.<ext>' into (digest, variant); None if not a variant.
+    """
+    match = _VARIANT_FILENAME_RE.match(filename)
+    return (match.group(1), match.group(2)) if match else None
+
+
+def render_variants(source_path: str, targets: Dict[str, str]) -> List[str]:
+    """
+    Resize one image into all variants. Runs in a worker process.
+
+    Args:
+        source_path (str): Original image.
+        targets (Dict[str, str]): variant name -> output path.
+
+    Returns:
+        List[str]: Written paths.
+    """
+    written = []
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        for variant, path in targets.items():
+            if os.path.exists(path):
+                continue
+            size = VARIANTS[variant]
+            resized = image.copy()
+            resized.thumbnail((size, size), Image.LANCZOS)
+            tmp_path = path + '.tmp'
+            if path.endswith('.webp'):
+                resized.save(tmp_path, 'WEBP', quality=VARIANT_QUALITY, method=4)
+            else:
+                resized.convert('RGB').save(tmp_path, 'JPEG', quality=VARIANT_QUALITY, optimize=True, progressive=True)
+            os.replace(tmp_path, path)
+            written.append(path)
+    return written
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _executor
+
+
+def _done(digest: str, future):
+    _pending.discard(digest)
+    try:
+        written = future.result()
+        if written:
+            logger.info(f"Generated {len(written)} image variants for {digest}")
+    except Exception as e:
+        logger.warning(f"Image variant generation for {digest} failed: {str(e)}")
+
+
+def schedule_variants(digest: str, source_path: str) -> bool:
+    """
+    Queue variant generation for an original image (non-blocking).
+
+    Returns:
+        bool: True if work was queued.
+    """
+    if not variants_enabled() or digest in _pending:
+        return False
+    targets = {variant: media_store.path_for(digest, f".{variant}{variant_extension()}") for variant in VARIANTS}
+    targets = {variant: path for variant, path in targets.items() if not os.path.exists(path)}
+    if not targets:
+        return False
+    _pending.add(digest)
+    future = _get_executor().submit(render_variants, source_path, targets)
+    future.add_done_callback(lambda f: _done(digest, f))
+    return True
+
+
+def find_original(digest: str) -> Optional[str]:
+    """
+    Path of the stored original for a digest, whatever its extension.
+    """
+    for extension in IMAGE_TYPES.values():
+        path = media_store.find(digest + extension)
+        if path:
+            return path
+    return None
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
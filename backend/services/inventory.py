@@ -0,0 +1,112 @@
+"""
+Inventory reservation for agricultural products.
+
+Stock is decremented with a single conditional UPDATE ... RETURNING:
+
+    UPDATE agricultural_produce
+    SET total_quantity = total_quantity - n
+    WHERE id = ? AND total_quantity >= n AND off_shelf_date >= CURRENT_DATE
+
+The row lock taken by the UPDATE serializes concurrent buyers of the same
+product for the duration of one statement only, and the WHERE clause is
+re-checked against the latest row version, so stock can never go negative
+and no explicit SELECT ... FOR UPDATE is needed.
+
+The functions take a cursor and run inside the caller's transaction, so the
+reservation commits or rolls back together with the order row. The order
+row records stock_reserved = TRUE; only those orders release stock when
+cancelled (orders placed before reservation existed never took any).
+"""
+from typing import Optional
+
+
+class InventoryError(Exception):
+    """
+    Base class for reservation failures.
+    """
+
+    def __init__(self, produce_id: int, message: str):
+        super().__init__(message)
+        self.produce_id = produce_id
+
+
+class ProductUnavailableError(InventoryError):
+    """
+    The product does not exist or is already off the shelf.
+    """
+
+
+class InsufficientStockError(InventoryError):
+    """
+    Not enough stock left for the requested quantity.
+    """
+
+    def __init__(self, produce_id: int, requested: int, available: int):
+        super().__init__(produce_id, f"Insufficient stock for product {produce_id}: requested {requested}, available {available}")
+        self.requested = requested
+        self.available = available
+
+
+def reserve_stock(cur, produce_id: int, quantity: int) -> int:
+    """
+    Atomically take `quantity` units of a product.
+
+    Args:
+        cur: Cursor of the caller's transaction.
+        produce_id (int): agricultural_produce id.
+        quantity (int): Units to reserve (must be positive).
+
+    Returns:
+        int: Remaining stock after the reservation.
+
+    Raises:
+        ProductUnavailableError: Product missing or off the shelf.
+        InsufficientStockError: Not enough stock.
+    """
+    if quantity <= 0:
+        raise ValueError("quantity must be positive")
+
+    cur.execute("""
+        UPDATE agricultural_produce
+        SET total_quantity = total_quantity - %s
+        WHERE id = %s AND total_quantity >= %s AND off_shelf_date >= CURRENT_DATE
+        RETURNING total_quantity
+    """, (quantity, produce_id, quantity))
+    row = cur.fetchone()
+    if row is not None:
+        return row[0]
+
+    # Losing path only: find out why the reservation failed
+    cur.execute("""
+        SELECT total_quantity, off_shelf_date >= CURRENT_DATE
+        FROM agricultural_produce
+        WHERE id = %s
+    """, (produce_id,))
+    current = cur.fetchone()
+    if current is None or not current[1]:
+        raise ProductUnavailableError(produce_id, f"Product {produce_id} is not available")
+    raise InsufficientStockError(produce_id, quantity, current[0])
+
+
+def release_stock(cur, produce_id: int, quantity: int) -> Optional[int]:
+    """
+    Return `quantity` units of a product to stock (e.g. on cancellation).
+
+    Args:
+        cur: Cursor of the caller's transaction.
+        produce_id (int): agricultural_produce id.
+        quantity (int): Units to give back.
+
+    Returns:
+        Optional[int]: New stock, or None if the product no longer exists.
+    """
+    if quantity <= 0:
+        return None
+    cur.execute("""
+        UPDATE agricultural_produce
+        SET total_quantity = total_quantity + %s
+        WHERE id = %s
+        RETURNING total_quantity
+    """, (quantity, produce_id))
+    row = cur.fetchone()
+    return row[0] if row else None
@@ -0,0 +1,385 @@
+"""
+In-process async job scheduler.
+
+Jobs run inside the FastAPI event loop (started / stopped by the app's
+startup and shutdown events) instead of a separate blocking process.
+
+Features:
+- cron-style schedules ("0 2 * * 0") or fixed intervals (every N seconds)
+- random start jitter so workers don't hit the database at the same instant
+- overlap prevention: a run is skipped while the previous run is still going
+  (a sync job that times out keeps its worker thread, which cannot be
+  stopped, so the job counts as running until that thread returns)
+- run history (last N runs per job) for monitoring
+- single-leader election through a Postgres session advisory lock, so when
+  the API is scaled out to several workers only the leader runs leader-only
+  jobs. If the leader dies its session ends, the lock is released and another
+  worker takes over on its next election check.
+"""
+import asyncio
+import hashlib
+import inspect
+import logging
+import os
+import random
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Union
+
+import psycopg2
+
+from backend.database import create_connection_with_keepalive
+
+logger = logging.getLogger(__name__)
+
+LEADER_CHECK_SECONDS = float(os.getenv('SCHEDULER_LEADER_CHECK_SECONDS', '15'))
+LEADER_ELECTION_ENABLED = os.getenv('SCHEDULER_LEADER_ELECTION', 'true').lower() not in ('0', 'false', 'no')
+HISTORY_SIZE = 50
+
+JobFunc = Callable[[], Union[Any, Awaitable[Any]]]
+
+
+def advisory_lock_key(name: str) -> int:
+    """
+    Map a lock name to a stable signed 64-bit key for pg_advisory_lock.
+    """
+    digest = hashlib.sha256(name.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+class CronSchedule:
+    """
+    Five-field cron expression: minute hour day-of-month month day-of-week.
+
+    Supports '*', '*/n', 'a-b', 'a-b/n' and comma separated lists.
+    Day-of-week uses 0 (or 7) for Sunday. As in cron, when both day-of-month
+    and day-of-week are restricted a day matches if either field matches.
+    """
+
+    _RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Invalid cron expression '{expression}': expected 5 fields")
+        self.expression = expression
+        parsed = [self._parse_field(f, lo, hi) for f, (lo, hi) in zip(fields, self._RANGES)]
+        self.minutes, self.hours, self.days, self.months, dows = parsed
+        self.dows = {0 if d == 7 else d for d in dows}
+        self.dom_restricted = fields[2] != '*'
+        self.dow_restricted = fields[4] != '*'
+
+    @staticmethod
+    def _parse_field(value: str, lo: int, hi: int) -> Set[int]:
+        result: Set[int] = set()
+        for part in value.split(','):
+            step = 1
+            if '/' in part:
+                part, step_str = part.split('/', 1)
+                step = int(step_str)
+                if step <= 0:
+                    raise ValueError(f"Invalid cron step '{step_str}'")
+            if part == '*':
+                start, end = lo, hi
+            elif '-' in part:
+                start_str, end_str = part.split('-', 1)
+                start, end = int(start_str), int(end_str)
+            else:
+                start = end = int(part)
+            if start < lo or end > hi or start > end:
+                raise ValueError(f"Cron field value '{value}' out of range {lo}-{hi}")
+            result.update(range(start, end + 1, step))
+        return result
+
+    def _day_matches(self, t: datetime) -> bool:
+        dom_ok = t.day in self.days
+        dow_ok = ((t.weekday() + 1) % 7) in self.dows
+        if self.dom_restricted and self.dow_restricted:
+            return dom_ok or dow_ok
+        return dom_ok and dow_ok
+
+    def next_after(self, after: datetime) -> datetime:
+        """
+        Return the first matching minute strictly after `after`.
+        """
+        t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = after + timedelta(days=366 * 5)
+        while t <= limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+                continue
+            if not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+                continue
+            if t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+                continue
+            return t
+        raise ValueError(f"Cron expression '{self.expression}' never matches")
+
+
+@dataclass
+class Job:
+    """
+    A registered background job and its runtime state.
+    """
+    name: str
+    func: JobFunc
+    cron: Optional[CronSchedule] = None
+    every_seconds: Optional[float] = None
+    jitter_seconds: float = 0.0
+    leader_only: bool = True
+    timeout_seconds: Optional[float] = None
+    running: bool = False
+    next_run_at: Optional[datetime] = None
+    runs: int = 0
+    failures: int = 0
+    skipped: int = 0
+    history: Deque[dict] = field(default_factory=lambda: deque(maxlen=HISTORY_SIZE))
+
+    def next_run_after(self, now: datetime) -> datetime:
+        if self.cron is not None:
+            return self.cron.next_after(now)
+        return now + timedelta(seconds=self.every_seconds)
+
+    def describe(self) -> dict:
+        last = self.history[-1] if self.history else None
+        return {
+            "name": self.name,
+            "schedule": self.cron.expression if self.cron else f"every {self.every_seconds:g}s",
+            "jitter_seconds": self.jitter_seconds,
+            "leader_only": self.leader_only,
+            "running": self.running,
+            "next_run_at": self.next_run_at.isoformat() if self.next_run_at else None,
+            "runs": self.runs,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "last_run": last,
+            "history": list(self.history)
+        }
+
+
+class LeaderElector:
+    """
+    Holds a session-level advisory lock on a dedicated connection.
+
+    The connection is kept outside the request pool so the lock lives exactly
+    as long as this worker's session.
+    """
+
+    def __init__(self, lock_name: str):
+        self.lock_name = lock_name
+        self.key = advisory_lock_key(lock_name)
+        self.is_leader = False
+        self._conn = None
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+        self.is_leader = False
+
+    def check(self) -> bool:
+        """
+        Acquire leadership if free, or verify the session still holds it.
+        Blocking; call from a worker thread.
+        """
+        try:
+            if self._conn is None or self._conn.closed:
+                self._conn = create_connection_with_keepalive()
+                self._conn.autocommit = True
+                self.is_leader = False
+            cur = self._conn.cursor()
+            if self.is_leader:
+                # Lock is held as long as the session is alive
+                cur.execute("SELECT 1")
+            else:
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (self.key,))
+                self.is_leader = bool(cur.fetchone()[0])
+                if self.is_leader:
+                    logger.info(f"Scheduler leadership acquired ({self.lock_name})")
+            cur.close()
+        except (psycopg2.Error, OSError) as e:
+            if self.is_leader:
+                logger.warning(f"Scheduler leadership lost: {str(e)}")
+            self._close()
+        return self.is_leader
+
+    def release(self):
+        if self._conn is not None and self.is_leader:
+            try:
+                cur = self._conn.cursor()
+                cur.execute("SELECT pg_advisory_unlock(%s)", (self.key,))
+                cur.close()
+            except psycopg2.Error:
+                pass
+        self._close()
+
+
+class JobScheduler:
+    """
+    Runs registered jobs as asyncio tasks in the current event loop.
+    """
+
+    def __init__(self, leader_lock_name: str = 'cloudtribe:scheduler:leader'):
+        self.jobs: Dict[str, Job] = {}
+        self.elector = LeaderElector(leader_lock_name)
+        self._tasks: List[asyncio.Task] = []
+        self._started = False
+
+    @property
+    def is_leader(self) -> bool:
+        return self.elector.is_leader if LEADER_ELECTION_ENABLED else True
+
+    def add_job(self, name: str, func: JobFunc, cron: Optional[str] = None, every_seconds: Optional[float] = None,
+                jitter_seconds: float = 0.0, leader_only: bool = True, timeout_seconds: Optional[float] = None) -> Job:
+        """
+        Register a job.
+
+        Args:
+            name (str): Unique job name.
+            func (JobFunc): Async function, or sync function (run in a worker thread).
+            cron (Optional[str]): Cron expression; mutually exclusive with every_seconds.
+            every_seconds (Optional[float]): Fixed interval between the end of one run and the next.
+            jitter_seconds (float): Random delay added before every run.
+            leader_only (bool): Run only on the elected leader worker.
+            timeout_seconds (Optional[float]): Cancel a run that takes longer than this
+                (sync jobs: record the timeout; the thread finishes on its own).
+
+        Returns:
+            Job: The registered job.
+        """
+        if (cron is None) == (every_seconds is None):
+            raise ValueError("Exactly one of cron or every_seconds is required")
+        if name in self.jobs:
+            raise ValueError(f"Job '{name}' is already registered")
+        job = Job(
+            name=name,
+            func=func,
+            cron=CronSchedule(cron) if cron else None,
+            every_seconds=every_seconds,
+            jitter_seconds=jitter_seconds,
+            leader_only=leader_only,
+            timeout_seconds=timeout_seconds
+        )
+        self.jobs[name] = job
+        if self._started:
+            self._tasks.append(asyncio.get_running_loop().create_task(self._job_loop(job)))
+        return job
+
+    def start(self):
+        """
+        Start the election loop and one task per job. Must be called from
+        within the running event loop (e.g. a startup handler).
+        """
+        if self._started:
+            return
+        loop = asyncio.get_running_loop()
+        self._started = True
+        if LEADER_ELECTION_ENABLED:
+            self._tasks.append(loop.create_task(self._election_loop()))
+        for job in self.jobs.values():
+            self._tasks.append(loop.create_task(self._job_loop(job)))
+        logger.info(f"Job scheduler started with {len(self.jobs)} jobs")
+
+    async def stop(self):
+        """
+        Cancel all job tasks and give up leadership.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._started = False
+        if LEADER_ELECTION_ENABLED:
+            await asyncio.to_thread(self.elector.release)
+        logger.info("Job scheduler stopped")
+
+    async def _election_loop(self):
+        while True:
+            await asyncio.to_thread(self.elector.check)
+            await asyncio.sleep(LEADER_CHECK_SECONDS)
+
+    async def _job_loop(self, job: Job):
+        while True:
+            now = datetime.now()
+            job.next_run_at = job.next_run_after(now)
+            delay = (job.next_run_at - now).total_seconds() + random.uniform(0, job.jitter_seconds)
+            await asyncio.sleep(max(delay, 0))
+            if job.leader_only and not self.is_leader:
+                continue
+            await self.run_job(job)
+
+    async def run_job(self, job: Job) -> Optional[dict]:
+        """
+        Run a job once, recording the outcome in its history.
+        """
+        if job.running:
+            job.skipped += 1
+            logger.warning(f"Job {job.name} skipped: previous run still in progress")
+            return None
+
+        job.running = True
+        started = datetime.now()
+        record = {"started_at": started.isoformat(), "status": "running"}
+        thread = None
+        try:
+            if inspect.iscoroutinefunction(job.func):
+                call = job.func()
+            else:
+                # Shielded: a timeout stops the wait, not the thread
+                thread = asyncio.ensure_future(asyncio.to_thread(job.func))
+                call = asyncio.shield(thread)
+            result = await asyncio.wait_for(call, timeout=job.timeout_seconds)
+            record["status"] = "success"
+            if result is not None:
+                record["result"] = str(result)[:500]
+        except asyncio.CancelledError:
+            record["status"] = "cancelled"
+            raise
+        except asyncio.TimeoutError:
+            job.failures += 1
+            record["status"] = "timeout"
+            logger.error(f"Job {job.name} timed out after {job.timeout_seconds}s")
+        except Exception as e:
+            job.failures += 1
+            record["status"] = "failed"
+            record["error"] = str(e)
+            logger.error(f"Job {job.name} failed: {str(e)}", exc_info=True)
+        finally:
+            finished = datetime.now()
+            record["finished_at"] = finished.isoformat()
+            record["duration_ms"] = round((finished - started).total_seconds() * 1000, 1)
+            job.runs += 1
+            job.history.append(record)
+            if thread is not None and not thread.done():
+                thread.add_done_callback(lambda future: self._thread_finished(job, future))
+            else:
+                job.running = False
+        return record
+
+    @staticmethod
+    def _thread_finished(job: Job, future: asyncio.Future):
+        """
+        Release a sync job whose run outlived its timeout once its thread returns.
+        """
+        job.running = False
+        error = None if future.cancelled() else future.exception()
+        if error is not None:
+            logger.error(f"Job {job.name} overran its timeout and then failed: {str(error)}")
+        else:
+            logger.warning(f"Job {job.name} overran its timeout; its thread has now finished")
+
+    def snapshot(self) -> dict:
+        return {
+            "leader": self.is_leader,
+            "leader_election": LEADER_ELECTION_ENABLED,
+            "jobs": [job.describe() for job in self.jobs.values()]
+        }
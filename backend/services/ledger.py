@@ -0,0 +1,252 @@
+"""
+Ledger postings with materialized account balances.
+
+ledger_entries is append-only. Every posting goes through posting_sql(),
+which wraps the INSERT INTO ledger_entries in one statement that also adds
+the posted deltas to account_balances (one row per account, owner and
+currency). The balance moves in the same statement, and so the same
+transaction, as the entries, so reading a balance is a primary-key lookup
+instead of a scan over the account's history.
+
+Accounts:
+- PLATFORM_ESCROW (owner_id 0): money held by the platform
+- DRIVER_WALLET (owner_id = driver id): money owed to a driver
+
+ledger_snapshots keeps periodic copies of the balances for point-in-time
+queries. A snapshot is taken under an EXCLUSIVE lock on account_balances, so
+it contains exactly the entries with id <= last_entry_id; balance_at() adds
+the entries after the latest snapshot before the requested time.
+verify_balances() reconciles account_balances and the latest snapshot rows
+against the raw entries.
+
+Tables: backend/database/migrations/0008_create_account_balances.sql
+"""
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+from typing import List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+ESCROW_ACCOUNT = 'PLATFORM_ESCROW'
+DRIVER_WALLET_ACCOUNT = 'DRIVER_WALLET'
+PLATFORM_OWNER = 0
+DEFAULT_CURRENCY = 'TWD'
+
+LEDGER_COLUMNS = "ref_type, ref_id, account, owner_id, delta, currency"
+
+
+@dataclass
+class LedgerEntry:
+    ref_type: str
+    ref_id: int
+    account: str
+    delta: Decimal
+    currency: str = DEFAULT_CURRENCY
+    owner_id: int = PLATFORM_OWNER
+
+
+def posting_sql(insert_sql: str, with_clause: str = "") -> str:
+    """
+    Wrap `INSERT INTO ledger_entries (LEDGER_COLUMNS) ...` (no RETURNING) so
+    the same statement updates account_balances. The statement returns one
+    row: the number of entries posted.
+
+    Args:
+        insert_sql (str): The ledger INSERT.
+        with_clause (str): Extra CTEs the INSERT reads from ("name AS (...)").
+    """
+    prefix = f"{with_clause.strip()}, " if with_clause else ""
+    return f"""
+        WITH {prefix}posted AS (
+            {insert_sql.strip()}
+            RETURNING id, account, owner_id, currency, delta
+        ),
+        balances AS (
+            INSERT INTO account_balances AS b (account, owner_id, currency, balance, entries, last_entry_id, updated_at)
+            SELECT account, owner_id, currency, SUM(delta), COUNT(*), MAX(id), NOW()
+            FROM posted
+            GROUP BY account, owner_id, currency
+            ORDER BY account, owner_id, currency
+            ON CONFLICT (account, owner_id, currency) DO UPDATE
+              SET balance = b.balance + EXCLUDED.balance,
+                  entries = b.entries + EXCLUDED.entries,
+                  last_entry_id = GREATEST(b.last_entry_id, EXCLUDED.last_entry_id),
+                  updated_at = EXCLUDED.updated_at
+        )
+        SELECT COUNT(*) FROM posted
+    """
+
+
+def post_entries(cur, entries: Sequence[LedgerEntry]) -> int:
+    """
+    Post entries and update balances in the caller's transaction.
+
+    Returns:
+        int: Number of entries posted.
+    """
+    if not entries:
+        return 0
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(entries))
+    params = [value for e in entries for value in (e.ref_type, e.ref_id, e.account, e.owner_id, e.delta, e.currency)]
+    cur.execute(posting_sql(f"INSERT INTO ledger_entries ({LEDGER_COLUMNS}) VALUES {placeholders}"), params)
+    return cur.fetchone()[0]
+
+
+def get_balance(cur, account: str, owner_id: int = PLATFORM_OWNER, currency: str = DEFAULT_CURRENCY) -> Decimal:
+    """
+    Current balance of an account (primary-key lookup).
+    """
+    cur.execute(
+        "SELECT balance FROM account_balances WHERE account = %s AND owner_id = %s AND currency = %s",
+        (account, owner_id, currency)
+    )
+    row = cur.fetchone()
+    return row[0] if row else Decimal('0')
+
+
+def balance_at(cur, account: str, at: datetime, owner_id: int = PLATFORM_OWNER,
+               currency: str = DEFAULT_CURRENCY) -> Decimal:
+    """
+    Balance of an account at a point in time: the latest snapshot taken at or
+    before `at`, plus the entries posted after it up to `at`.
+    """
+    cur.execute("""
+        WITH snap AS (
+            SELECT balance, last_entry_id FROM ledger_snapshots
+            WHERE account = %(account)s AND owner_id = %(owner_id)s AND currency = %(currency)s
+              AND snapshot_at <= %(at)s
+            ORDER BY snapshot_at DESC
+            LIMIT 1
+        )
+        SELECT COALESCE((SELECT balance FROM snap), 0) + COALESCE((
+            SELECT SUM(delta) FROM ledger_entries
+            WHERE account = %(account)s AND owner_id = %(owner_id)s AND currency = %(currency)s
+              AND id > COALESCE((SELECT last_entry_id FROM snap), 0)
+              AND created_at <= %(at)s
+        ), 0)
+    """, {"account": account, "owner_id": owner_id, "currency": currency, "at": at})
+    return cur.fetchone()[0]
+
+
+def take_snapshot(conn) -> int:
+    """
+    Copy the balances that changed since the previous snapshot into
+    ledger_snapshots.
+
+    Returns:
+        int: Number of snapshot rows written.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SET LOCAL lock_timeout = '10s'")
+        # Waits for in-flight postings to commit and holds new ones until the snapshot commits
+        cur.execute("LOCK TABLE account_balances IN EXCLUSIVE MODE")
+        cur.execute("""
+            INSERT INTO ledger_snapshots (snapshot_at, last_entry_id, account, owner_id, currency, balance, entries)
+            SELECT NOW(), (SELECT COALESCE(MAX(id), 0) FROM ledger_entries),
+                   account, owner_id, currency, balance, entries
+            FROM account_balances
+            WHERE last_entry_id > (SELECT COALESCE(MAX(last_entry_id), 0) FROM ledger_snapshots)
+        """)
+        written = cur.rowcount
+        conn.commit()
+        return written
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+@dataclass
+class BalanceMismatch:
+    source: str
+    account: str
+    owner_id: int
+    currency: str
+    expected: Optional[Decimal]
+    actual: Optional[Decimal]
+
+    def describe(self) -> dict:
+        return {
+            "source": self.source,
+            "account": self.account,
+            "owner_id": self.owner_id,
+            "currency": self.currency,
+            "expected": float(self.expected) if self.expected is not None else None,
+            "actual": float(self.actual) if self.actual is not None else None
+        }
+
+
+def verify_balances(conn, repair: bool = False) -> List[BalanceMismatch]:
+    """
+    Reconcile account_balances and the latest snapshot rows against the raw
+    ledger entries.
+
+    Args:
+        conn: Database connection.
+        repair (bool): Rebuild account_balances from the raw entries when they differ.
+
+    Returns:
+        List[BalanceMismatch]: Differences found (before any repair).
+    """
+    cur = conn.cursor()
+    try:
+        # One statement sees entries and balances at the same instant
+        cur.execute("""
+            WITH raw AS (
+                SELECT account, owner_id, currency, SUM(delta) AS balance, COUNT(*) AS entries
+                FROM ledger_entries
+                GROUP BY account, owner_id, currency
+            )
+            SELECT account, owner_id, currency, raw.balance, b.balance
+            FROM account_balances b
+            FULL OUTER JOIN raw USING (account, owner_id, currency)
+            WHERE b.balance IS DISTINCT FROM raw.balance OR b.entries IS DISTINCT FROM raw.entries
+        """)
+        mismatches = [BalanceMismatch("account_balances", *row) for row in cur.fetchall()]
+
+        cur.execute("""
+            SELECT s.account, s.owner_id, s.currency, r.balance, s.balance
+            FROM ledger_snapshots s
+            CROSS JOIN LATERAL (
+                SELECT COALESCE(SUM(le.delta), 0) AS balance FROM ledger_entries le
+                WHERE le.account = s.account AND le.owner_id = s.owner_id AND le.currency = s.currency
+                  AND le.id <= s.last_entry_id
+            ) r
+            WHERE s.snapshot_at = (SELECT MAX(snapshot_at) FROM ledger_snapshots)
+              AND s.balance IS DISTINCT FROM r.balance
+        """)
+        mismatches += [BalanceMismatch("ledger_snapshots", *row) for row in cur.fetchall()]
+        conn.commit()
+
+        if repair and any(m.source == "account_balances" for m in mismatches):
+            cur.execute("LOCK TABLE account_balances IN EXCLUSIVE MODE")
+            cur.execute("""
+                INSERT INTO account_balances AS b (account, owner_id, currency, balance, entries, last_entry_id, updated_at)
+                SELECT account, owner_id, currency, SUM(delta), COUNT(*), MAX(id), NOW()
+                FROM ledger_entries
+                GROUP BY account, owner_id, currency
+                ON CONFLICT (account, owner_id, currency) DO UPDATE
+                  SET balance = EXCLUDED.balance,
+                      entries = EXCLUDED.entries,
+                      last_entry_id = EXCLUDED.last_entry_id,
+                      updated_at = EXCLUDED.updated_at
+            """)
+            cur.execute("""
+                DELETE FROM account_balances b
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM ledger_entries le
+                    WHERE le.account = b.account AND le.owner_id = b.owner_id AND le.currency = b.currency
+                )
+            """)
+            conn.commit()
+            logger.warning(f"Rebuilt account_balances after {len(mismatches)} mismatches")
+        return mismatches
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
@@ -0,0 +1,388 @@
+"""
+Local content-addressed media storage with streaming multipart uploads.
+
+Uploads are parsed straight from the request body stream (no base64, no
+buffering the whole file in memory). Each chunk is hashed and written to a
+temp file as it arrives, in the threadpool so disk writes never block the
+event loop, and the size limit is enforced while streaming: an oversized
+upload is cut off as soon as it passes the limit.
+
+Files are stored under <root>/<aa>/<bb>/<sha256><ext>, so identical photos
+are stored once. The final rename is atomic, so a half-written file is never
+visible under its content address.
+
+After a new file is stored, it can be pushed to an external host in the
+background through a pluggable uploader (MEDIA_UPLOADER=imgbb|none). The
+remote URL is recorded next to the file in a small JSON sidecar.
+
+Payment proofs use a separate store (proof_store) outside the public media
+root; their type is taken from the file's magic bytes, not the client.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Optional
+
+import requests
+from starlette.concurrency import run_in_threadpool
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+logger = logging.getLogger(__name__)
+
+MEDIA_ROOT = os.getenv('MEDIA_ROOT', os.path.join(os.getcwd(), 'backend', 'media'))
+MEDIA_URL_PREFIX = os.getenv('MEDIA_URL_PREFIX', '/api/media/')
+MAX_UPLOAD_BYTES = int(os.getenv('MEDIA_MAX_UPLOAD_BYTES', str(10 * 1024 * 1024)))
+# Multipart headers and boundaries on top of the file itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+IMAGE_TYPES: Dict[str, str] = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+    'image/gif': '.gif',
+}
+
+CONTENT_TYPES_BY_EXTENSION = {extension: content_type for content_type, extension in IMAGE_TYPES.items()}
+CONTENT_TYPES_BY_EXTENSION['.pdf'] = 'application/pdf'
+
+# Payment proofs (bank transfer screenshots / PDF receipts) live outside the public media root
+PAYMENT_PROOF_ROOT = os.getenv('PAYMENT_PROOF_ROOT', os.path.join(os.getcwd(), 'backend', 'payment_proofs'))
+MAX_PROOF_BYTES = int(os.getenv('PAYMENT_PROOF_MAX_BYTES', str(5 * 1024 * 1024)))
+PROOF_TYPES: Dict[str, str] = {**IMAGE_TYPES, 'application/pdf': '.pdf'}
+
+# Leading bytes of each accepted file type
+_MAGIC_NUMBERS = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF-', 'application/pdf'),
+)
+
+# '<sha256><ext>', or '<sha256>.<variant><ext>' for generated image variants
+_FILENAME_RE = re.compile(r'^([0-9a-f]{64})((?:\.[a-z]{1,10})?\.[a-z0-9]{1,5})$')
+
+
+def sniff_content_type(head: bytes) -> Optional[str]:
+    """
+    Detect the content type from the first bytes of a file; None if unknown.
+    """
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for magic, content_type in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return content_type
+    return None
+
+
+def _limit_text(max_bytes: int) -> str:
+    if max_bytes >= 1024 * 1024:
+        return f"{max_bytes / (1024 * 1024):g} MB"
+    return f"{max_bytes / 1024:g} KB"
+
+
+class MediaError(Exception):
+    """
+    Upload rejected; status_code is the HTTP status to return.
+    """
+    status_code = 400
+
+
+class MediaTooLargeError(MediaError):
+    status_code = 413
+
+
+class UnsupportedMediaError(MediaError):
+    status_code = 415
+
+
+@dataclass
+class StoredMedia:
+    """
+    A file in the content-addressed store.
+    """
+    digest: str
+    extension: str
+    size: int
+    content_type: str
+    path: str
+    deduplicated: bool = False
+
+    @property
+    def filename(self) -> str:
+        return self.digest + self.extension
+
+    @property
+    def url(self) -> str:
+        return MEDIA_URL_PREFIX + self.filename
+
+    @property
+    def img_id(self) -> str:
+        # agricultural_produce.img_id is VARCHAR(36)
+        return self.digest[:32]
+
+
+class _HashingWriter:
+    """
+    Writes one file part to a temp file, hashing and counting as it goes.
+    """
+
+    def __init__(self, tmp_dir: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hasher = hashlib.sha256()
+        self.file = tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)
+        self.head = b''
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise MediaTooLargeError(f"File exceeds the {_limit_text(self.max_bytes)} limit")
+        if len(self.head) < 16:
+            self.head += data[:16 - len(self.head)]
+        self.hasher.update(data)
+        self.file.write(data)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def discard(self):
+        self.close()
+        try:
+            os.unlink(self.file.name)
+        except FileNotFoundError:
+            pass
+
+
+class MediaStore:
+    """
+    A content-addressed directory of files.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+
+    def path_for(self, digest: str, extension: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + extension)
+
+    def find(self, filename: str) -> Optional[str]:
+        """
+        Resolve a stored filename ('<sha256><ext>') to its path, if present.
+        """
+        match = _FILENAME_RE.match(filename)
+        if not match:
+            return None
+        path = self.path_for(match.group(1), match.group(2))
+        return path if os.path.isfile(path) else None
+
+    def _commit(self, writer: _HashingWriter, extension: str, content_type: str) -> StoredMedia:
+        writer.close()
+        digest = writer.hasher.hexdigest()
+        path = self.path_for(digest, extension)
+        deduplicated = os.path.exists(path)
+        if deduplicated:
+            writer.discard()
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(writer.file.name, path)
+        return StoredMedia(digest, extension, writer.size, content_type, path, deduplicated)
+
+    async def receive_upload(self, request, field_name: str = 'image', max_bytes: int = MAX_UPLOAD_BYTES,
+                             allowed_types: Dict[str, str] = IMAGE_TYPES, sniff=None) -> StoredMedia:
+        """
+        Stream the file field `field_name` of a multipart request into the store.
+
+        Args:
+            request (Request): The incoming request.
+            field_name (str): Name of the multipart file field.
+            max_bytes (int): Size limit for the file.
+            allowed_types (Dict[str, str]): Allowed content types and their extensions.
+            sniff (Optional[Callable[[bytes], Optional[str]]]): Detects the real content
+                type from the first bytes. When given, the declared part Content-Type
+                is ignored and files it cannot identify are rejected.
+
+        Returns:
+            StoredMedia: The stored (or already existing) file.
+        """
+        content_type, params = parse_options_header(request.headers.get('content-type', ''))
+        boundary = params.get(b'boundary')
+        if content_type != b'multipart/form-data' or not boundary:
+            raise MediaError("Expected multipart/form-data")
+
+        content_length = request.headers.get('content-length')
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes + MULTIPART_OVERHEAD_BYTES:
+            raise MediaTooLargeError(f"File exceeds the {_limit_text(max_bytes)} limit")
+
+        await run_in_threadpool(os.makedirs, self.tmp_dir, exist_ok=True)
+        state = {'headers': {}, 'field': b'', 'value': b'', 'writer': None, 'part_type': None, 'done': False}
+
+        def on_part_begin():
+            state['headers'] = {}
+
+        def on_header_field(data, start, end):
+            state['field'] += data[start:end]
+
+        def on_header_value(data, start, end):
+            state['value'] += data[start:end]
+
+        def on_header_end():
+            state['headers'][state['field'].lower()] = state['value']
+            state['field'] = b''
+            state['value'] = b''
+
+        def on_headers_finished():
+            _, disposition = parse_options_header(state['headers'].get(b'content-disposition', b''))
+            if state['done'] or state['writer'] is not None:
+                return
+            if disposition.get(b'name', b'').decode('utf-8', 'replace') != field_name or b'filename' not in disposition:
+                return
+            part_type = state['headers'].get(b'content-type', b'application/octet-stream').decode('latin-1').split(';')[0].strip().lower()
+            state['part_type'] = part_type
+            state['writer'] = _HashingWriter(self.tmp_dir, max_bytes)
+
+        def on_part_data(data, start, end):
+            writer = state['writer']
+            if writer is not None and not state['done']:
+                writer.write(data[start:end])
+
+        def on_part_end():
+            if state['writer'] is not None:
+                state['done'] = True
+
+        parser = MultipartParser(boundary, {
+            'on_part_begin': on_part_begin,
+            'on_header_field': on_header_field,
+            'on_header_value': on_header_value,
+            'on_header_end': on_header_end,
+            'on_headers_finished': on_headers_finished,
+            'on_part_data': on_part_data,
+            'on_part_end': on_part_end,
+        })
+
+        # Parsing writes to disk from the part callbacks; keep that off the event loop
+        try:
+            async for chunk in request.stream():
+                await run_in_threadpool(parser.write, chunk)
+            await run_in_threadpool(parser.finalize)
+            writer = state['writer']
+            if writer is None or not state['done']:
+                raise MediaError(f"Missing file field '{field_name}'")
+            if writer.size == 0:
+                raise MediaError("Empty file")
+
+            content_type = sniff(writer.head) if sniff else state['part_type']
+            if content_type not in allowed_types:
+                raise UnsupportedMediaError(f"Unsupported file type: {content_type or 'unrecognized content'}")
+            return await run_in_threadpool(self._commit, writer, allowed_types[content_type], content_type)
+        except MediaError:
+            if state['writer'] is not None:
+                await run_in_threadpool(state['writer'].discard)
+            raise
+        except Exception as e:
+            if state['writer'] is not None:
+                await run_in_threadpool(state['writer'].discard)
+            raise MediaError(f"Malformed upload: {str(e)}") from e
+
+    # Remote copies
+
+    def _sidecar_path(self, path: str) -> str:
+        return path + '.remote.json'
+
+    def remote_url(self, filename: str) -> Optional[str]:
+        match = _FILENAME_RE.match(filename)
+        if not match:
+            return None
+        sidecar = self._sidecar_path(self.path_for(match.group(1), match.group(2)))
+        try:
+            with open(sidecar, 'r', encoding='utf-8') as f:
+                return json.load(f).get('url')
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def push_to_remote(self, stored: StoredMedia):
+        """
+        Copy a stored file to the external host (run as a background task).
+        """
+        uploader = get_uploader()
+        sidecar = self._sidecar_path(stored.path)
+        if uploader is None or os.path.exists(sidecar):
+            return
+        try:
+            url = uploader.upload(stored)
+        except Exception as e:
+            logger.warning(f"Remote upload of {stored.filename} via {uploader.name} failed: {str(e)}")
+            return
+        if not url:
+            return
+        with open(sidecar + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({"url": url, "uploader": uploader.name, "pushed_at": datetime.now().isoformat()}, f)
+        os.replace(sidecar + '.tmp', sidecar)
+        logger.info(f"Pushed {stored.filename} to {uploader.name}: {url}")
+
+
+class ImgbbUploader:
+    """
+    Uploads files to ImgBB (IMGBB_API_KEY).
+    """
+    name = 'imgbb'
+    url = 'https://api.imgbb.com/1/upload'
+
+    def __init__(self, api_key: str, timeout: float = 30):
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def upload(self, stored: StoredMedia) -> Optional[str]:
+        with open(stored.path, 'rb') as f:
+            response = requests.post(
+                self.url,
+                data={'key': self.api_key, 'name': stored.digest},
+                files={'image': (stored.filename, f, stored.content_type)},
+                timeout=self.timeout
+            )
+        response.raise_for_status()
+        return response.json().get('data', {}).get('url')
+
+
+_uploader = None
+_uploader_configured = False
+
+
+def get_uploader():
+    """
+    Uploader selected by MEDIA_UPLOADER (imgbb | none); None disables pushing.
+    """
+    global _uploader, _uploader_configured
+    if not _uploader_configured:
+        choice = os.getenv('MEDIA_UPLOADER', 'none').lower()
+        api_key = os.getenv('IMGBB_API_KEY')
+        if choice == 'imgbb' and api_key:
+            _uploader = ImgbbUploader(api_key)
+        elif choice == 'imgbb':
+            logger.warning("MEDIA_UPLOADER=imgbb but IMGBB_API_KEY is not set; remote push disabled")
+        _uploader_configured = True
+    return _uploader
+
+
+def set_uploader(uploader):
+    """
+    Replace the uploader (any object with `name` and `upload(stored) -> url`),
+    e.g. with a stub in development.
+    """
+    global _uploader, _uploader_configured
+    _uploader = uploader
+    _uploader_configured = True
+
+
+media_store = MediaStore(MEDIA_ROOT)
+proof_store = MediaStore(PAYMENT_PROOF_ROOT)
@@ -0,0 +1,269 @@
+"""
+Single-statement order claiming.
+
+When several drivers accept the same order at once, the winner is decided
+by one conditional UPDATE ... WHERE status = '未接單' RETURNING. Postgres
+re-checks the condition against the latest row version after waiting for
+a concurrent claimer, so exactly one driver gets the row and the others
+get no row back. The driver checks (exists, no overdue orders, not the
+buyer), the status update, the driver_orders insert and the details
+needed for the buyer notification all happen in that one statement. The
+order row is therefore locked only for that one round trip.
+
+Losers learn why from the same statement: driver missing, overdue
+orders, own order, order missing, or already taken.
+
+claim_orders() is the batched variant used by automatic dispatch: the same
+checks, for many (order, driver) pairs in one statement.
+"""
+import json
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Tuple
+
+from backend.services.order_state import UNACCEPTED, ACCEPTED, IN_DELIVERY, UNDELIVERED
+
+# Status parameters of every statement below
+STATUS_PARAMS = {
+    "unaccepted": UNACCEPTED,
+    "accepted": ACCEPTED,
+    "active": [ACCEPTED, IN_DELIVERY],
+    "undelivered": sorted(UNDELIVERED),
+}
+
+# Orders held by a driver (order_state.UNDELIVERED). Few at any time, so
+# they are read through the status indexes and joined to driver_orders,
+# instead of looking up every order a driver ever accepted.
+HELD_ORDERS = """
+    SELECT 'necessities' AS service, id, order_status AS status
+    FROM orders
+    WHERE order_status = ANY(%(undelivered)s)
+    UNION ALL
+    SELECT 'agricultural_product', id, status
+    FROM agricultural_product_order
+    WHERE status = ANY(%(undelivered)s)
+"""
+
+# Held orders of the drivers in `candidates (driver_id)`, aggregated once per
+# driver: how many are in delivery now, and how many were accepted more than
+# 2 hours ago (overdue; such drivers may not take new orders). Drivers
+# without held orders have no row.
+DRIVER_WORK_CTE = f"""
+    work AS (
+        SELECT dro.driver_id,
+               COUNT(*) FILTER (WHERE held.status = ANY(%(active)s)) AS active,
+               COUNT(*) FILTER (WHERE dro.timestamp < NOW() - INTERVAL '2 hours') AS overdue
+        FROM candidates c
+        JOIN driver_orders dro ON dro.driver_id = c.driver_id AND dro.action = %(accepted)s
+        JOIN ({HELD_ORDERS}) held ON held.service = dro.service AND held.id = dro.order_id
+        GROUP BY dro.driver_id
+    )"""
+
+_DRIVER_CTE = f"""
+    candidates AS (
+        SELECT %(driver_id)s::int AS driver_id
+    ),
+    {DRIVER_WORK_CTE},
+    driver AS (
+        SELECT d.id, d.user_id, d.driver_phone, COALESCE(work.overdue, 0) AS overdue
+        FROM drivers d
+        LEFT JOIN work ON work.driver_id = d.id
+        WHERE d.id = %(driver_id)s
+    )"""
+
+_LOG_CTE = """
+    logged AS (
+        INSERT INTO driver_orders (driver_id, order_id, action, timestamp, previous_driver_id,
+                                   previous_driver_name, previous_driver_phone, service, order_timestamp)
+        SELECT %(driver_id)s, id, %(accepted)s, COALESCE(%(timestamp)s::timestamp, NOW()), %(previous_driver_id)s,
+               %(previous_driver_name)s, %(previous_driver_phone)s, %(service)s, order_timestamp
+        FROM claimed
+    )"""
+
+CLAIM_NECESSITIES_SQL = f"""
+    WITH {_DRIVER_CTE},
+    claimed AS (
+        UPDATE orders o SET order_status = %(accepted)s
+        FROM driver
+        WHERE o.id = %(order_id)s
+          AND o.order_status = %(unaccepted)s
+          AND driver.overdue = 0
+          AND o.buyer_id IS DISTINCT FROM driver.user_id
+        RETURNING o.id, o.buyer_id, o.location, o.total_price, o.timestamp AS order_timestamp
+    ),
+    {_LOG_CTE}
+    SELECT (SELECT id FROM driver), (SELECT overdue FROM driver), (SELECT user_id FROM driver),
+           (SELECT driver_phone FROM driver),
+           current.order_status, current.buyer_id,
+           claimed.id, claimed.buyer_id, claimed.location, claimed.total_price::float,
+           (SELECT json_agg(json_build_object('name', oi.item_name, 'quantity', oi.quantity, 'price', oi.price) ORDER BY oi.id)
+            FROM order_items oi WHERE oi.order_id = claimed.id)
+    FROM (SELECT 1) one
+    LEFT JOIN claimed ON TRUE
+    LEFT JOIN orders current ON current.id = %(order_id)s
+"""
+
+CLAIM_AGRICULTURAL_SQL = f"""
+    WITH {_DRIVER_CTE},
+    claimed AS (
+        UPDATE agricultural_product_order a SET status = %(accepted)s
+        FROM driver
+        WHERE a.id = %(order_id)s
+          AND a.status = %(unaccepted)s
+          AND driver.overdue = 0
+          AND a.buyer_id IS DISTINCT FROM driver.user_id
+        RETURNING a.id, a.buyer_id, a.end_point, a.produce_id, a.quantity, a.timestamp AS order_timestamp
+    ),
+    {_LOG_CTE}
+    SELECT (SELECT id FROM driver), (SELECT overdue FROM driver), (SELECT user_id FROM driver),
+           (SELECT driver_phone FROM driver),
+           current.status, current.buyer_id,
+           claimed.id, claimed.buyer_id, claimed.end_point, (p.price * claimed.quantity)::float,
+           CASE WHEN claimed.id IS NOT NULL
+                THEN json_build_array(json_build_object('name', p.name, 'quantity', claimed.quantity, 'price', p.price))
+           END
+    FROM (SELECT 1) one
+    LEFT JOIN claimed ON TRUE
+    LEFT JOIN agricultural_produce p ON p.id = claimed.produce_id
+    LEFT JOIN agricultural_product_order current ON current.id = %(order_id)s
+"""
+
+CLAIM_SQL = {
+    'necessities': CLAIM_NECESSITIES_SQL,
+    'agricultural_product': CLAIM_AGRICULTURAL_SQL,
+}
+
+# Same checks as above, for arrays of (service, order_id, driver_id) picks;
+# picks that fail them are skipped and simply not returned
+CLAIM_BATCH_SQL = f"""
+    WITH picks AS (
+        SELECT *
+        FROM unnest(%(services)s::varchar[], %(order_ids)s::int[], %(driver_ids)s::int[]) AS p(service, order_id, driver_id)
+    ),
+    candidates AS (
+        SELECT DISTINCT driver_id FROM picks
+    ),
+    {DRIVER_WORK_CTE},
+    driver AS (
+        SELECT d.id, d.user_id, COALESCE(work.overdue, 0) AS overdue
+        FROM drivers d
+        JOIN candidates c ON c.driver_id = d.id
+        LEFT JOIN work ON work.driver_id = d.id
+    ),
+    claimed_necessities AS (
+        UPDATE orders o SET order_status = %(accepted)s
+        FROM picks p
+        JOIN driver ON driver.id = p.driver_id
+        WHERE p.service = 'necessities'
+          AND o.id = p.order_id
+          AND o.order_status = %(unaccepted)s
+          AND driver.overdue = 0
+          AND o.buyer_id IS DISTINCT FROM driver.user_id
+        RETURNING o.id, p.driver_id, o.timestamp AS order_timestamp
+    ),
+    claimed_agricultural AS (
+        UPDATE agricultural_product_order a SET status = %(accepted)s
+        FROM picks p
+        JOIN driver ON driver.id = p.driver_id
+        WHERE p.service = 'agricultural_product'
+          AND a.id = p.order_id
+          AND a.status = %(unaccepted)s
+          AND driver.overdue = 0
+          AND a.buyer_id IS DISTINCT FROM driver.user_id
+        RETURNING a.id, p.driver_id, a.timestamp AS order_timestamp
+    ),
+    claimed AS (
+        SELECT 'necessities'::varchar AS service, id, driver_id, order_timestamp FROM claimed_necessities
+        UNION ALL
+        SELECT 'agricultural_product', id, driver_id, order_timestamp FROM claimed_agricultural
+    ),
+    logged AS (
+        INSERT INTO driver_orders (driver_id, order_id, action, timestamp, service, order_timestamp)
+        SELECT driver_id, id, %(accepted)s, NOW(), service, order_timestamp FROM claimed
+    )
+    SELECT service, id, driver_id FROM claimed
+"""
+
+
+class ClaimError(Exception):
+    """
+    The order was not claimed; status_code / detail follow accept_order.
+    """
+
+    def __init__(self, status_code: int, detail: str, reason: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.reason = reason
+
+
+@dataclass
+class ClaimedOrder:
+    service: str
+    order_id: int
+    buyer_id: Optional[int]
+    delivery_address: str
+    total_price: float
+    driver_phone: Optional[str]
+    items: List[dict] = field(default_factory=list)
+
+
+def claim_order(cur, service: str, order_id: int, driver_id: int, timestamp: Optional[str] = None,
+                previous_driver_id: Optional[int] = None, previous_driver_name: Optional[str] = None,
+                previous_driver_phone: Optional[str] = None) -> ClaimedOrder:
+    """
+    Claim an unaccepted order for a driver in one statement, in the caller's
+    transaction.
+
+    Raises:
+        ClaimError: The driver lost the race or may not take the order.
+    """
+    sql = CLAIM_SQL.get(service)
+    if sql is None:
+        raise ClaimError(400, "不支援的服務類型", "invalid_service")
+    cur.execute(sql, {
+        **STATUS_PARAMS,
+        "order_id": order_id,
+        "driver_id": driver_id,
+        "timestamp": timestamp,
+        "previous_driver_id": previous_driver_id,
+        "previous_driver_name": previous_driver_name,
+        "previous_driver_phone": previous_driver_phone,
+        "service": service,
+    })
+    (found_driver, overdue, driver_user_id, driver_phone, current_status, current_buyer_id,
+     claimed_id, buyer_id, delivery_address, total_price, items) = cur.fetchone()
+
+    if claimed_id is None:
+        if found_driver is None:
+            raise ClaimError(404, "司機不存在", "driver_not_found")
+        if overdue:
+            raise ClaimError(403, f"您有 {overdue} 筆訂單超過 2 小時未完成配送，請先完成已接受的訂單後再接受新訂單", "overdue_orders")
+        if current_status is None:
+            raise ClaimError(404, "訂單未找到", "order_not_found")
+        if current_status == UNACCEPTED and current_buyer_id is not None and current_buyer_id == driver_user_id:
+            raise ClaimError(400, "無法接取自己的訂單", "own_order")
+        # Taken before this statement started, or by a concurrent claimer while it waited
+        raise ClaimError(400, "訂單已被接", "already_accepted")
+
+    if isinstance(items, str):
+        items = json.loads(items)
+    return ClaimedOrder(service, claimed_id, buyer_id, delivery_address, float(total_price or 0), driver_phone, items or [])
+
+
+def claim_orders(cur, picks: Sequence[Tuple[str, int, int]]) -> List[Tuple[str, int, int]]:
+    """
+    Claim several (service, order_id, driver_id) picks in one statement, in
+    the caller's transaction, with the checks claim_order applies.
+
+    Returns:
+        List[Tuple[str, int, int]]: The picks that were claimed.
+    """
+    if not picks:
+        return []
+    cur.execute(CLAIM_BATCH_SQL, {
+        **STATUS_PARAMS,
+        "services": [service for service, _, _ in picks],
+        "order_ids": [order_id for _, order_id, _ in picks],
+        "driver_ids": [driver_id for _, _, driver_id in picks],
+    })
+    return [tuple(row) for row in cur.fetchall()]
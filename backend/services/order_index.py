@@ -0,0 +1,295 @@
+"""
+In-memory spatial index of open orders for "orders near me" queries.
+
+Open orders (orders.order_status / agricultural_product_order.status =
+'未接單') are geocoded with the local gazetteer (services/geocode.py): the
+delivery address and every pickup location (order item stores, or the
+agricultural starting point) become points. Points go into a uniform grid
+of GRID_CELL_DEGREES cells; a query only looks at the cells around the
+driver and computes distances for those points with one vectorized
+haversine.
+
+- radius queries read the cells overlapping the radius' bounding box
+- k-nearest queries widen ring by ring until the k-th order is closer than
+  the distance the scanned rings are guaranteed to cover
+
+The index follows the catalog cache pattern: it is rebuilt lazily from one
+query, write endpoints (create / accept / cancel / complete / expire) call
+invalidate(), and a short TTL bounds how long another worker process can
+serve an order that was accepted elsewhere. Orders whose addresses cannot
+be geocoded are counted but not returned.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from backend.database import get_db_connection, return_db_connection
+from backend.services.geocode import geocode, haversine_km
+from backend.services.partitions import OPEN_ORDERS_SINCE
+
+logger = logging.getLogger(__name__)
+
+ORDER_INDEX_TTL_SECONDS = float(os.getenv('ORDER_INDEX_TTL_SECONDS', '15'))
+# ~1.1 km north-south
+GRID_CELL_DEGREES = float(os.getenv('ORDER_INDEX_CELL_DEGREES', '0.01'))
+KM_PER_DEGREE_LAT = 111.195
+
+OPEN_ORDERS_QUERY = f"""
+    SELECT 'necessities', o.id, o.location, o.is_urgent, o.total_price::float, o.timestamp,
+           COALESCE(array_agg(DISTINCT oi.location) FILTER (WHERE oi.location IS NOT NULL AND oi.location <> ''), '{{}}')
+    FROM orders o
+    LEFT JOIN order_items oi ON oi.order_id = o.id
+    WHERE o.order_status = '未接單' AND o.timestamp >= {OPEN_ORDERS_SINCE}
+    GROUP BY o.id, o.timestamp
+    UNION ALL
+    SELECT 'agricultural_product', apo.id, apo.end_point, FALSE, (p.price * apo.quantity)::float, apo.timestamp,
+           ARRAY[apo.starting_point]
+    FROM agricultural_product_order apo
+    JOIN agricultural_produce p ON p.id = apo.produce_id
+    WHERE apo.status = '未接單'
+"""
+
+
+@dataclass(frozen=True)
+class IndexedOrder:
+    service: str
+    order_id: int
+    location: str
+    pickup_locations: Tuple[str, ...]
+    is_urgent: bool
+    total_price: float
+    timestamp: Optional[str]
+
+    def describe(self) -> dict:
+        return {
+            "service": self.service,
+            "id": self.order_id,
+            "location": self.location,
+            "pickup_locations": list(self.pickup_locations),
+            "is_urgent": self.is_urgent,
+            "total_price": self.total_price,
+            "timestamp": self.timestamp
+        }
+
+
+class GridIndex:
+    """
+    Immutable uniform-grid index over points that belong to orders.
+    """
+
+    def __init__(self, orders: List[IndexedOrder], points: List[Tuple[float, float, int, str]],
+                 cell_degrees: float = GRID_CELL_DEGREES):
+        """
+        Args:
+            orders (List[IndexedOrder]): Indexed orders.
+            points (List[Tuple[float, float, int, str]]): (lat, lng, index into orders, 'pickup' | 'delivery').
+            cell_degrees (float): Grid cell size.
+        """
+        self.orders = orders
+        self.cell_degrees = cell_degrees
+        self.coords = np.array([(lat, lng) for lat, lng, _, _ in points], dtype=np.float64).reshape(-1, 2)
+        self.owner = np.array([owner for _, _, owner, _ in points], dtype=np.int64)
+        self.kinds = [kind for _, _, _, kind in points]
+        cells = defaultdict(list)
+        for i, (lat, lng, _, _) in enumerate(points):
+            cells[self._cell(lat, lng)].append(i)
+        self.cells: Dict[Tuple[int, int], np.ndarray] = {key: np.array(ids, dtype=np.int64) for key, ids in cells.items()}
+        if self.cells:
+            rows = [key[0] for key in self.cells]
+            cols = [key[1] for key in self.cells]
+            self.bounds = (min(rows), max(rows), min(cols), max(cols))
+        else:
+            self.bounds = None
+
+    def __len__(self):
+        return len(self.orders)
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_degrees), math.floor(lng / self.cell_degrees)
+
+    def _points_in(self, keys) -> np.ndarray:
+        found = [self.cells[key] for key in keys if key in self.cells]
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+    def _ring(self, center: Tuple[int, int], ring: int):
+        row, col = center
+        if ring == 0:
+            yield center
+            return
+        for c in range(col - ring, col + ring + 1):
+            yield row - ring, c
+            yield row + ring, c
+        for r in range(row - ring + 1, row + ring):
+            yield r, col - ring
+            yield r, col + ring
+
+    def _nearest_per_order(self, lat: float, lng: float, candidates: np.ndarray):
+        """
+        Distance to the nearest point of each candidate order, sorted by distance.
+        """
+        if candidates.size == 0:
+            return []
+        distances = haversine_km(lat, lng, self.coords[candidates])
+        best: Dict[int, Tuple[float, str]] = {}
+        for point, distance in zip(candidates.tolist(), distances.tolist()):
+            owner = int(self.owner[point])
+            if owner not in best or distance < best[owner][0]:
+                best[owner] = (distance, self.kinds[point])
+        return sorted(((distance, owner, kind) for owner, (distance, kind) in best.items()), key=lambda item: item[0])
+
+    def within(self, lat: float, lng: float, radius_km: float, limit: Optional[int] = None):
+        """
+        Orders with a pickup or delivery point within radius_km, nearest first.
+        """
+        if self.bounds is None:
+            return []
+        dlat = radius_km / KM_PER_DEGREE_LAT
+        dlng = radius_km / (KM_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 1e-6))
+        row_min, col_min = self._cell(lat - dlat, lng - dlng)
+        row_max, col_max = self._cell(lat + dlat, lng + dlng)
+        # Clamp the box to the occupied cells
+        row_min, row_max = max(row_min, self.bounds[0]), min(row_max, self.bounds[1])
+        col_min, col_max = max(col_min, self.bounds[2]), min(col_max, self.bounds[3])
+        keys = [(r, c) for r in range(row_min, row_max + 1) for c in range(col_min, col_max + 1)]
+        results = [item for item in self._nearest_per_order(lat, lng, self._points_in(keys)) if item[0] <= radius_km]
+        return results[:limit] if limit else results
+
+    def nearest(self, lat: float, lng: float, k: int, max_radius_km: Optional[float] = None):
+        """
+        The k orders with the nearest pickup or delivery point.
+        """
+        if self.bounds is None or k <= 0:
+            return []
+        center = self._cell(lat, lng)
+        # A point outside the scanned rings is at least this far per ring (the narrower lng side)
+        cell_km = self.cell_degrees * KM_PER_DEGREE_LAT * max(math.cos(math.radians(abs(lat) + self.cell_degrees)), 1e-6)
+        max_ring = max(
+            abs(center[0] - self.bounds[0]), abs(center[0] - self.bounds[1]),
+            abs(center[1] - self.bounds[2]), abs(center[1] - self.bounds[3])
+        )
+        candidates = []
+        results = []
+        for ring in range(max_ring + 1):
+            ids = self._points_in(self._ring(center, ring))
+            if ids.size:
+                candidates.append(ids)
+            covered_km = ring * cell_km
+            if max_radius_km is not None and covered_km > max_radius_km:
+                break
+            if not candidates:
+                continue
+            results = self._nearest_per_order(lat, lng, np.concatenate(candidates))
+            if len(results) >= k and results[k - 1][0] <= covered_km:
+                break
+        else:
+            if candidates:
+                results = self._nearest_per_order(lat, lng, np.concatenate(candidates))
+        if max_radius_km is not None:
+            results = [item for item in results if item[0] <= max_radius_km]
+        return results[:k]
+
+
+def _build_index(rows) -> Tuple[GridIndex, int]:
+    orders: List[IndexedOrder] = []
+    points: List[Tuple[float, float, int, str]] = []
+    unlocated = 0
+    for service, order_id, location, is_urgent, total_price, timestamp, pickups in rows:
+        pickups = tuple(p for p in (pickups or []) if p)
+        order = IndexedOrder(
+            service, order_id, location, pickups, bool(is_urgent), float(total_price or 0),
+            timestamp.isoformat() if timestamp else None
+        )
+        order_points = []
+        for kind, text in [('delivery', location)] + [('pickup', p) for p in pickups]:
+            result = geocode(text)
+            if result is not None:
+                order_points.extend((lat, lng, len(orders), kind) for lat, lng in result.points)
+        if not order_points:
+            unlocated += 1
+            continue
+        points.extend(order_points)
+        orders.append(order)
+    return GridIndex(orders, points), unlocated
+
+
+@dataclass(frozen=True)
+class IndexSnapshot:
+    version: int
+    built_at: float
+    grid: GridIndex
+    unlocated: int
+
+
+class OpenOrderIndex:
+    """
+    Thread-safe, lazily rebuilt spatial index of open orders.
+    """
+
+    def __init__(self, ttl_seconds: float = ORDER_INDEX_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._version = 0
+        self._snapshot: Optional[IndexSnapshot] = None
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self.hits = 0
+        self.rebuilds = 0
+
+    def invalidate(self):
+        """
+        Drop the index; the next query rebuilds it.
+        """
+        with self._lock:
+            self._version += 1
+            self._snapshot = None
+
+    def _fresh(self, snapshot: Optional[IndexSnapshot]) -> bool:
+        return (
+            snapshot is not None
+            and snapshot.version == self._version
+            and time.monotonic() - snapshot.built_at < self.ttl_seconds
+        )
+
+    def _build(self, version: int) -> IndexSnapshot:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            try:
+                cur.execute(OPEN_ORDERS_QUERY)
+                rows = cur.fetchall()
+            finally:
+                cur.close()
+            conn.rollback()
+        finally:
+            return_db_connection(conn)
+        grid, unlocated = _build_index(rows)
+        return IndexSnapshot(version, time.monotonic(), grid, unlocated)
+
+    def get(self) -> IndexSnapshot:
+        snapshot = self._snapshot
+        if self._fresh(snapshot):
+            self.hits += 1
+            return snapshot
+        with self._build_lock:
+            snapshot = self._snapshot
+            if self._fresh(snapshot):
+                self.hits += 1
+                return snapshot
+            version = self._version
+            snapshot = self._build(version)
+            self.rebuilds += 1
+            with self._lock:
+                # Don't publish an index that was invalidated while building
+                if self._version == version:
+                    self._snapshot = snapshot
+            logger.info(f"Order index rebuilt: {len(snapshot.grid)} orders, {snapshot.unlocated} without coordinates")
+            return snapshot
+
+
+order_index = OpenOrderIndex()
@@ -0,0 +1,193 @@
+"""
+Order state machine shared by orders (order_status) and
+agricultural_product_order (status).
+
+TRANSITIONS lists every legal status change once. transition() performs a
+change as one statement: the row is locked, the current status and any
+guard columns (e.g. buyer_id) are checked, and the new status is written,
+all in a single round trip that reports the status the row really had.
+Concurrent requests therefore can't both pass a check that was read
+before the other one's write (cancel vs. pickup, double complete, ...).
+
+The seller orders page keeps its own preparation statuses (已接單, 準備完成,
+已配送). They are only reachable from 未接單, so a seller can't move an order
+a driver already holds.
+"""
+import re
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, Iterable, Optional, Sequence
+
+UNACCEPTED = '未接單'
+ACCEPTED = '接單'
+IN_DELIVERY = '配送中'
+DELIVERED = '已送達'
+CONFIRMED = '已確認'
+COMPLETED = '已完成'
+CANCELLED = '已取消'
+EXPIRED = '已過期'
+DELIVERY_OVERDUE = '配送逾時'
+RETURNED_TO_SELLER = '已退回賣家'
+DISPOSED = '已丟棄'
+DONATED = '已捐贈'
+
+# Seller orders page
+SELLER_ACCEPTED = '已接單'
+SELLER_READY = '準備完成'
+SELLER_SHIPPED = '已配送'
+SELLER_STATUSES = frozenset({SELLER_ACCEPTED, SELLER_READY, SELLER_SHIPPED})
+
+# What a driver may do with an order whose products expired on the way
+EXPIRED_HANDLING = frozenset({RETURNED_TO_SELLER, DISPOSED, DONATED, COMPLETED})
+
+# Held by a driver: accepted and not delivered yet
+UNDELIVERED = frozenset({ACCEPTED, IN_DELIVERY, DELIVERY_OVERDUE})
+
+# Orders still being worked on: on the board (or being prepared by the
+# seller) or held by a driver
+IN_PROGRESS = frozenset({UNACCEPTED}) | UNDELIVERED | SELLER_STATUSES
+
+TRANSITIONS: Dict[str, FrozenSet[str]] = {
+    UNACCEPTED: frozenset({ACCEPTED, CANCELLED, EXPIRED}) | SELLER_STATUSES,
+    ACCEPTED: frozenset({UNACCEPTED, IN_DELIVERY, DELIVERED, CANCELLED, DELIVERY_OVERDUE}) | EXPIRED_HANDLING,
+    IN_DELIVERY: frozenset({DELIVERED, DELIVERY_OVERDUE}) | EXPIRED_HANDLING,
+    DELIVERY_OVERDUE: frozenset({DELIVERED}) | EXPIRED_HANDLING,
+    EXPIRED: EXPIRED_HANDLING,
+    DELIVERED: frozenset({CONFIRMED, COMPLETED}),
+    SELLER_ACCEPTED: frozenset({UNACCEPTED, SELLER_READY, SELLER_SHIPPED}),
+    SELLER_READY: frozenset({UNACCEPTED, SELLER_ACCEPTED, SELLER_SHIPPED}),
+    SELLER_SHIPPED: frozenset({UNACCEPTED, SELLER_ACCEPTED, SELLER_READY}),
+    CONFIRMED: frozenset(),
+    COMPLETED: frozenset(),
+    CANCELLED: frozenset(),
+    RETURNED_TO_SELLER: frozenset(),
+    DISPOSED: frozenset(),
+    DONATED: frozenset(),
+}
+
+ORDER_TABLES = {
+    'necessities': ('orders', 'order_status'),
+    'agricultural_product': ('agricultural_product_order', 'status'),
+}
+
+_IDENTIFIER_RE = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+
+def can_transition(from_status: Optional[str], to_status: str) -> bool:
+    return to_status in TRANSITIONS.get(from_status, frozenset())
+
+
+def sources(to_status: str) -> FrozenSet[str]:
+    """
+    Statuses an order may move to `to_status` from.
+    """
+    return frozenset(status for status, targets in TRANSITIONS.items() if to_status in targets)
+
+
+class TransitionError(Exception):
+    """
+    The status was not changed; status_code / detail are ready for an HTTPException.
+    """
+
+    def __init__(self, status_code: int, detail: str, reason: str,
+                 current_status: Optional[str] = None, row: Optional[dict] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.reason = reason
+        self.current_status = current_status
+        self.row = row or {}
+
+
+@dataclass
+class Transition:
+    service: str
+    order_id: int
+    old_status: str
+    new_status: str
+    # Requested columns, as they were before the update
+    row: dict = field(default_factory=dict)
+
+
+def _identifiers(names: Iterable[str]) -> list:
+    names = list(dict.fromkeys(names))
+    for name in names:
+        if not _IDENTIFIER_RE.match(name):
+            raise ValueError(f"invalid column name: {name!r}")
+    return names
+
+
+def transition_sql(service: str, columns: Sequence[str] = (), guard: Sequence[str] = (),
+                   append_note: bool = False) -> str:
+    table, status_column = ORDER_TABLES[service]
+    columns = _identifiers([*columns, *guard])
+    selected = "".join(f", {name}" for name in columns)
+    guards = "".join(f"\n              AND current.{name} IS NOT DISTINCT FROM %(guard_{name})s" for name in guard)
+    note = ", note = CONCAT(COALESCE(t.note, ''), %(note)s)" if append_note else ""
+    returned = "".join(f", current.{name}" for name in columns)
+    # FOR UPDATE waits for a concurrent writer and then reads its committed
+    # version, so current.status is the status this update actually replaced
+    return f"""
+        WITH current AS (
+            SELECT id, {status_column} AS status{selected}
+            FROM {table}
+            WHERE id = %(order_id)s
+            FOR UPDATE
+        ),
+        moved AS (
+            UPDATE {table} t
+            SET {status_column} = %(to_status)s{note}
+            FROM current
+            WHERE t.id = current.id
+              AND current.status = ANY(%(from_statuses)s){guards}
+            RETURNING t.id
+        )
+        SELECT current.status, moved.id IS NOT NULL{returned}
+        FROM current
+        LEFT JOIN moved ON TRUE
+    """
+
+
+def transition(cur, service: str, order_id: int, to_status: str, *,
+               from_statuses: Optional[Iterable[str]] = None,
+               guard: Optional[Dict[str, object]] = None,
+               columns: Sequence[str] = (),
+               append_note: Optional[str] = None) -> Transition:
+    """
+    Move an order to `to_status` in the caller's transaction.
+
+    Args:
+        from_statuses: Narrow the legal source statuses for this call.
+        guard: Columns that must equal the given values (e.g. {"buyer_id": 3}).
+        columns: Extra columns to return from the row as it was before the update.
+        append_note: Text appended to the order's note.
+
+    Raises:
+        TransitionError: Unknown service or status (400), order missing (404),
+            guard mismatch (403) or illegal transition (400).
+    """
+    if service not in ORDER_TABLES:
+        raise TransitionError(400, "不支援的服務類型", "invalid_service")
+    if to_status not in TRANSITIONS:
+        raise TransitionError(400, f"未知的訂單狀態 '{to_status}'", "unknown_status")
+    allowed = sources(to_status)
+    if from_statuses is not None:
+        allowed &= frozenset(from_statuses)
+    guard = guard or {}
+    columns = list(columns)
+
+    params = {"order_id": order_id, "to_status": to_status, "from_statuses": sorted(allowed), "note": append_note}
+    params.update({f"guard_{name}": value for name, value in guard.items()})
+    cur.execute(transition_sql(service, columns, list(guard), append_note is not None), params)
+    result = cur.fetchone()
+    if result is None:
+        raise TransitionError(404, "訂單不存在", "order_not_found")
+
+    current_status, moved = result[0], result[1]
+    row = dict(zip(_identifiers([*columns, *guard]), result[2:]))
+    if not moved:
+        if any(row[name] != value for name, value in guard.items()):
+            raise TransitionError(403, "無權限變更此訂單", "guard_mismatch", current_status, row)
+        raise TransitionError(
+            400, f"訂單狀態為 '{current_status}'，無法變更為 '{to_status}'", "illegal_transition", current_status, row
+        )
+    return Transition(service, order_id, current_status, to_status, row)
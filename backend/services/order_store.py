@@ -0,0 +1,62 @@
+"""
+Order persistence helpers.
+
+insert_order writes an order and all of its items with one statement: the
+orders INSERT runs in a CTE and its RETURNING id, timestamp feeds a
+multi-row INSERT INTO order_items ... SELECT FROM (VALUES ...). Creating an
+order is one round trip regardless of how many items it has (plus the
+commit). Items are written with their order's timestamp, the other half of
+the (order_id, timestamp) foreign key of the partitioned tables.
+"""
+import json
+
+ORDER_COLUMNS = (
+    "buyer_id", "buyer_name", "buyer_phone", "seller_id", "seller_name", "seller_phone", "date", "time",
+    "location", "is_urgent", "total_price", "order_type", "order_status", "note", "shipment_count",
+    "required_orders_count", "previous_driver_id", "previous_driver_name", "previous_driver_phone"
+)
+
+# Explicit casts so the VALUES list types don't depend on the first row (NULLs, ints vs floats)
+ITEM_ROW_TEMPLATE = "(%s::varchar, %s::varchar, %s::float, %s::int, %s::varchar, %s::varchar, %s::varchar, %s::jsonb)"
+
+
+def _order_values(order) -> tuple:
+    return tuple(getattr(order, column) for column in ORDER_COLUMNS)
+
+
+def _item_values(item) -> tuple:
+    selected_options = json.dumps(item.selectedOptions) if item.selectedOptions else None
+    return (item.item_id, item.item_name, item.price, item.quantity, item.img, item.location, item.category, selected_options)
+
+
+def insert_order(cur, order) -> int:
+    """
+    Insert an order and its items in a single statement.
+
+    Args:
+        cur: Cursor of the caller's transaction.
+        order (DetailedOrder): The order to insert.
+
+    Returns:
+        int: The new order id.
+    """
+    columns = ", ".join(ORDER_COLUMNS)
+    placeholders = ", ".join(["%s"] * len(ORDER_COLUMNS))
+    insert_order_sql = f"INSERT INTO orders ({columns}) VALUES ({placeholders}) RETURNING id, timestamp"
+
+    if not order.items:
+        cur.execute(insert_order_sql, _order_values(order))
+        return cur.fetchone()[0]
+
+    item_rows = b",".join(cur.mogrify(ITEM_ROW_TEMPLATE, _item_values(item)) for item in order.items)
+    order_sql = cur.mogrify(insert_order_sql, _order_values(order))
+    cur.execute(
+        b"WITH new_order AS (" + order_sql + b"), "
+        b"new_items AS ("
+        b"INSERT INTO order_items (order_id, timestamp, item_id, item_name, price, quantity, img, location, category, selected_options) "
+        b"SELECT new_order.id, new_order.timestamp, v.item_id, v.item_name, v.price, v.quantity, v.img, v.location, v.category, v.selected_options "
+        b"FROM new_order CROSS JOIN (VALUES " + item_rows + b") "
+        b"AS v (item_id, item_name, price, quantity, img, location, category, selected_options)"
+        b") SELECT id FROM new_order"
+    )
+    return cur.fetchone()[0]
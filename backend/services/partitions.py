@@ -0,0 +1,277 @@
+"""
+Monthly partitions of the order tables.
+
+Migration 0010_create_order_partitions.sql turns orders, order_items,
+agricultural_product_order and driver_orders into tables range-partitioned
+by month on "timestamp" (<table>_pYYYY_MM, plus <table>_default). This
+module keeps that layout going:
+
+- Partitions for the current month and the next PARTITION_MONTHS_AHEAD
+  months are created ahead of time, so inserts never land in the default
+  partition.
+- Retention works on whole months instead of DELETEs. Months that ended more
+  than PARTITION_RETENTION_MONTHS ago are detached and renamed
+  <partition>_retired, ready to be dumped and dropped by hand. With
+  PARTITION_RETENTION_ACTION=drop they are dropped directly.
+- A month is only retired once nothing in it is still going on: no order in
+  progress (order_state.IN_PROGRESS), no payment of its orders that is not
+  settled into a paid-out driver payout, and no driver acceptance of an
+  order in progress. Otherwise it is kept, logged, and checked again on the
+  next run.
+
+Hot open-order queries on orders bound "timestamp" with OPEN_ORDERS_SINCE,
+so the planner prunes them to the latest partition(s) instead of probing
+every month. Agricultural orders never expire, so their board can't be
+bounded that way; it reads the status index of every month instead.
+
+Tables that are not partitioned (migration not applied) are left alone.
+"""
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from datetime import date
+from functools import partial
+from typing import List, Optional
+
+from backend.services.order_state import IN_PROGRESS
+from backend.services.settlement import SETTLEMENT_TIMEZONE
+
+logger = logging.getLogger(__name__)
+
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', '2'))
+PARTITION_RETENTION_MONTHS = int(os.getenv('PARTITION_RETENTION_MONTHS', '6'))
+PARTITION_RETENTION_ACTION = os.getenv('PARTITION_RETENTION_ACTION', 'detach').lower()
+PARTITION_LOCK_TIMEOUT = os.getenv('PARTITION_LOCK_TIMEOUT', '5s')
+
+# Unaccepted necessities orders expire after 2 hours (expire_stale_orders),
+# so a day of history is enough for the board
+OPEN_ORDER_WINDOW_DAYS = int(os.getenv('OPEN_ORDER_WINDOW_DAYS', '1'))
+OPEN_ORDERS_SINCE = f"NOW() - INTERVAL '{OPEN_ORDER_WINDOW_DAYS} days'"
+
+# Referencing tables first: an order_items month must go before its orders month
+PARTITIONED_TABLES = ('order_items', 'orders', 'agricultural_product_order', 'driver_orders')
+
+_PARTITION_RE = re.compile(r'_p(\d{4})_(\d{2})$')
+
+
+def month_start(day: date, offset: int = 0) -> date:
+    """
+    First day of the month `offset` months after the month of `day`.
+    """
+    index = day.year * 12 + day.month - 1 + offset
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month.year:04d}_{month.month:02d}"
+
+
+@dataclass
+class PartitionReport:
+    created: List[str] = field(default_factory=list)
+    retired: List[str] = field(default_factory=list)
+    # Old enough to retire, but still holding live orders or payments
+    kept: List[str] = field(default_factory=list)
+    skipped: List[str] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
+
+    def describe(self) -> str:
+        parts = [f"created {len(self.created)}", f"retired {len(self.retired)}"]
+        if self.kept:
+            parts.append(f"kept {', '.join(self.kept)}")
+        if self.skipped:
+            parts.append(f"skipped {', '.join(self.skipped)}")
+        if self.errors:
+            parts.append(f"{len(self.errors)} errors")
+        return ", ".join(parts)
+
+
+def is_partitioned(cur, table: str) -> bool:
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def list_partitions(cur, table: str) -> List[str]:
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        ORDER BY c.relname
+    """, (table,))
+    return [row[0] for row in cur.fetchall()]
+
+
+def partition_month(name: str) -> Optional[date]:
+    match = _PARTITION_RE.search(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def partition_exists(cur, name: str) -> bool:
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+    return cur.fetchone()[0]
+
+
+def retire_blockers(cur, table: str, month: date) -> List[str]:
+    """
+    Why a month of `table` can't be retired yet; empty when it can.
+
+    order_items months go with their orders month, so both are checked
+    against the orders partition.
+    """
+    in_progress = sorted(IN_PROGRESS)
+    blockers = []
+    if table in ('orders', 'order_items'):
+        orders = partition_name('orders', month)
+        if not partition_exists(cur, orders):
+            return blockers
+        cur.execute(f"SELECT COUNT(*) FROM {orders} WHERE order_status = ANY(%s)", (in_progress,))
+        count = cur.fetchone()[0]
+        if count:
+            blockers.append(f"{count} orders in progress")
+        # Settled: rejected, or part of a driver payout that left SCHEDULED
+        cur.execute(f"""
+            SELECT COUNT(*)
+            FROM {orders} o
+            JOIN payments p ON p.order_id = o.id
+            WHERE p.status <> 'REJECTED'
+              AND NOT EXISTS (
+                  SELECT 1 FROM driver_payouts dp
+                  WHERE dp.driver_id = o.driver_id
+                    AND dp.settle_date = (o.delivered_at AT TIME ZONE %s)::date
+                    AND dp.status <> 'SCHEDULED'
+              )
+        """, (SETTLEMENT_TIMEZONE,))
+        count = cur.fetchone()[0]
+        if count:
+            blockers.append(f"{count} unsettled payments")
+    elif table == 'agricultural_product_order':
+        cur.execute(f"SELECT COUNT(*) FROM {partition_name(table, month)} WHERE status = ANY(%s)", (in_progress,))
+        count = cur.fetchone()[0]
+        if count:
+            blockers.append(f"{count} orders in progress")
+    elif table == 'driver_orders':
+        # The overdue check and the driver's order list read these rows
+        cur.execute(f"""
+            SELECT COUNT(*)
+            FROM {partition_name(table, month)} dro
+            JOIN (
+                SELECT 'necessities' AS service, id FROM orders WHERE order_status = ANY(%(in_progress)s)
+                UNION ALL
+                SELECT 'agricultural_product', id FROM agricultural_product_order WHERE status = ANY(%(in_progress)s)
+            ) live ON live.service = dro.service AND live.id = dro.order_id
+        """, {"in_progress": in_progress})
+        count = cur.fetchone()[0]
+        if count:
+            blockers.append(f"{count} acceptances of orders in progress")
+    return blockers
+
+
+def _run_ddl(conn, report: PartitionReport, label: str, statements, lock: Optional[str] = None,
+             blockers=None) -> bool:
+    """
+    Run a few DDL statements in their own short transaction. A lock_timeout
+    keeps a busy table from queueing the app's queries behind the DDL; the
+    next run retries.
+
+    With `lock` and `blockers`, that table is locked against writes first and
+    blockers(cur) is asked whether the DDL may run; if it returns reasons,
+    nothing is changed and the label is reported as kept.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SET LOCAL lock_timeout = %s", (PARTITION_LOCK_TIMEOUT,))
+        if lock is not None:
+            cur.execute(f'LOCK TABLE {lock} IN SHARE MODE')
+        reasons = blockers(cur) if blockers is not None else []
+        if reasons:
+            conn.rollback()
+            logger.info(f"Keeping partition {label}: {', '.join(reasons)}")
+            report.kept.append(label)
+            return False
+        for sql, params in statements:
+            cur.execute(sql, params)
+        conn.commit()
+        return True
+    except Exception as e:
+        conn.rollback()
+        logger.warning(f"Partition maintenance failed for {label}: {str(e)}")
+        report.errors.append(f"{label}: {str(e)}")
+        return False
+    finally:
+        cur.close()
+
+
+def create_partitions(conn, table: str, today: date, report: PartitionReport):
+    cur = conn.cursor()
+    try:
+        existing = set(list_partitions(cur, table))
+    finally:
+        cur.close()
+    conn.commit()
+    for offset in range(PARTITION_MONTHS_AHEAD + 1):
+        start = month_start(today, offset)
+        name = partition_name(table, start)
+        if name in existing:
+            continue
+        # Fails (and is reported) if the default partition already holds rows
+        # of this month; those have to be moved by hand first
+        if _run_ddl(conn, report, name, [(
+            f'CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)',
+            (start, month_start(start, 1))
+        )]):
+            report.created.append(name)
+
+
+def retire_partitions(conn, table: str, today: date, report: PartitionReport):
+    if PARTITION_RETENTION_MONTHS <= 0:
+        return
+    cutoff = month_start(today, -PARTITION_RETENTION_MONTHS)
+    cur = conn.cursor()
+    try:
+        partitions = list_partitions(cur, table)
+    finally:
+        cur.close()
+    conn.commit()
+    for name in partitions:
+        month = partition_month(name)
+        # A month is retired once all of it is older than the cutoff
+        if month is None or month_start(month, 1) > cutoff:
+            continue
+        statements = [(f'ALTER TABLE {table} DETACH PARTITION {name}', None)]
+        if table == 'order_items':
+            # The detached month keeps a foreign key to orders, which would
+            # block detaching the matching orders month
+            statements.append((f'ALTER TABLE {name} DROP CONSTRAINT IF EXISTS order_items_order_fkey', None))
+        if PARTITION_RETENTION_ACTION == 'drop':
+            statements.append((f'DROP TABLE {name}', None))
+        else:
+            statements.append((f'ALTER TABLE {name} RENAME TO {name}_retired', None))
+        blockers = partial(retire_blockers, table=table, month=month)
+        if _run_ddl(conn, report, name, statements, lock=name, blockers=blockers):
+            report.retired.append(name)
+            logger.info(f"Retired partition {name} ({PARTITION_RETENTION_ACTION})")
+
+
+def maintain_partitions(conn, today: Optional[date] = None) -> PartitionReport:
+    """
+    Create upcoming monthly partitions and retire expired ones for every
+    partitioned order table.
+    """
+    today = today or date.today()
+    report = PartitionReport()
+    for table in PARTITIONED_TABLES:
+        cur = conn.cursor()
+        try:
+            partitioned = is_partitioned(cur, table)
+        finally:
+            cur.close()
+        conn.commit()
+        if not partitioned:
+            report.skipped.append(table)
+            continue
+        create_partitions(conn, table, today, report)
+        retire_partitions(conn, table, today, report)
+    return report
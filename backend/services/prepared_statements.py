@@ -0,0 +1,223 @@
+"""
+Server-side prepared statements for hot queries.
+
+Hot-path statements (login, order board, driver lookups, LINE id lookup) are
+registered once at import time with prepared(name, sql). The first time a
+pooled connection runs a statement it sends `PREPARE name AS ...; EXECUTE`
+in one round trip; after that only `EXECUTE name(...)` goes over the wire,
+so Postgres skips parsing and analysis (and planning, once it settles on a
+generic plan).
+
+Prepared statements belong to a database session. The set of names already
+prepared is tracked on the connection object itself
+(database.PooledConnection), so it lives and dies with the pooled connection:
+a connection that is closed and replaced starts with an empty set. If the
+server no longer knows a statement (e.g. the session was reset), the
+statement is re-prepared, transparently when nothing else ran in the
+transaction yet.
+
+Statistics (prepare / execute / re-prepare counts and an estimate of planning
+time saved, from a sampled EXPLAIN) are exposed via registry.stats().
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Sequence
+
+import psycopg2
+from psycopg2 import errors
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+
+logger = logging.getLogger(__name__)
+
+# Disable behind a transaction-pooling proxy (e.g. PgBouncer in transaction mode)
+PREPARED_STATEMENTS_ENABLED = os.getenv('PREPARED_STATEMENTS_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+
+_NAME_RE = re.compile(r'^[a-z_][a-z0-9_]*$')
+_PLACEHOLDER_RE = re.compile(r'%(s|%)')
+
+
+@dataclass
+class StatementStats:
+    prepares: int = 0
+    executes: int = 0
+    reprepares: int = 0
+    errors: int = 0
+    planning_ms: Optional[float] = None
+    execute_ms_total: float = 0.0
+
+    def describe(self) -> dict:
+        reused = max(self.executes - self.prepares, 0)
+        return {
+            "prepares": self.prepares,
+            "executes": self.executes,
+            "reprepares": self.reprepares,
+            "errors": self.errors,
+            "sampled_planning_ms": self.planning_ms,
+            "estimated_planning_ms_saved": round(self.planning_ms * reused, 2) if self.planning_ms is not None else None,
+            "avg_execute_ms": round(self.execute_ms_total / self.executes, 3) if self.executes else None
+        }
+
+
+@dataclass
+class PreparedStatement:
+    """
+    A named statement. `sql` uses the usual %s placeholders.
+    """
+    name: str
+    sql: str
+    param_count: int
+    server_sql: str
+    stats: StatementStats = field(default_factory=StatementStats)
+
+    def execute(self, cur, params: Sequence = ()):
+        """
+        Execute the statement on `cur` by name, preparing it on this
+        connection first if needed. Fetch results from `cur` as usual.
+        """
+        registry.execute(cur, self, params)
+
+
+class StatementRegistry:
+    """
+    Process-wide registry of named statements and their statistics.
+    """
+
+    def __init__(self):
+        self.statements: Dict[str, PreparedStatement] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, sql: str) -> PreparedStatement:
+        if not _NAME_RE.match(name):
+            raise ValueError(f"Invalid prepared statement name '{name}'")
+        existing = self.statements.get(name)
+        if existing is not None:
+            if existing.sql != sql:
+                raise ValueError(f"Prepared statement '{name}' is already registered with different SQL")
+            return existing
+
+        count = 0
+
+        def to_positional(match):
+            nonlocal count
+            if match.group(1) == '%':
+                return '%%'
+            count += 1
+            return f'${count}'
+
+        server_sql = _PLACEHOLDER_RE.sub(to_positional, sql.strip())
+        statement = PreparedStatement(name, sql, count, server_sql)
+        self.statements[name] = statement
+        return statement
+
+    @staticmethod
+    def _prepared_names(conn) -> Optional[set]:
+        return getattr(conn, 'prepared_statements', None)
+
+    def _sample_planning_time(self, cur, statement: PreparedStatement, params: Sequence):
+        """
+        Measure planning time of the plain query once per process.
+        """
+        try:
+            cur.execute("EXPLAIN (SUMMARY ON, FORMAT JSON) " + statement.sql, tuple(params))
+            plan = cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            statement.stats.planning_ms = float(plan[0].get("Planning Time", 0.0))
+        except psycopg2.Error as e:
+            logger.debug(f"Planning time sample for {statement.name} failed: {str(e)}")
+            statement.stats.planning_ms = 0.0
+            raise
+
+    def execute(self, cur, statement: PreparedStatement, params: Sequence = ()):
+        if len(params) != statement.param_count:
+            raise ValueError(f"Prepared statement '{statement.name}' expects {statement.param_count} parameters, got {len(params)}")
+
+        conn = cur.connection
+        prepared = self._prepared_names(conn)
+        if prepared is None or not PREPARED_STATEMENTS_ENABLED:
+            # Disabled, or connection not created through the pool factory: run the plain query
+            cur.execute(statement.sql, tuple(params))
+            return
+
+        placeholders = ", ".join(["%s"] * statement.param_count)
+        execute_sql = f"EXECUTE {statement.name}" + (f" ({placeholders})" if placeholders else "")
+        status = conn.info.transaction_status
+        idle_before = status == TRANSACTION_STATUS_IDLE
+
+        if statement.name not in prepared and statement.stats.planning_ms is None and status in (TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS):
+            # Inside the caller's transaction a failed sample only undoes its savepoint
+            if not idle_before:
+                cur.execute("SAVEPOINT planning_sample")
+            try:
+                self._sample_planning_time(cur, statement, params)
+                if not idle_before:
+                    cur.execute("RELEASE SAVEPOINT planning_sample")
+            except psycopg2.Error:
+                if idle_before:
+                    conn.rollback()
+                else:
+                    cur.execute("ROLLBACK TO SAVEPOINT planning_sample")
+                    cur.execute("RELEASE SAVEPOINT planning_sample")
+
+        for attempt in range(2):
+            needs_prepare = statement.name not in prepared
+            query = execute_sql
+            if needs_prepare:
+                query = f"PREPARE {statement.name} AS {statement.server_sql}; {execute_sql}"
+            started = time.perf_counter()
+            try:
+                cur.execute(query, tuple(params))
+            except (errors.InvalidSqlStatementName, errors.DuplicatePreparedStatement) as e:
+                # Session state differs from what we tracked (e.g. the session was reset)
+                with self._lock:
+                    statement.stats.reprepares += 1
+                if isinstance(e, errors.DuplicatePreparedStatement):
+                    prepared.add(statement.name)
+                else:
+                    prepared.discard(statement.name)
+                if attempt == 0 and idle_before:
+                    conn.rollback()
+                    continue
+                raise
+            except psycopg2.Error:
+                with self._lock:
+                    statement.stats.errors += 1
+                raise
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if needs_prepare:
+                prepared.add(statement.name)
+            with self._lock:
+                if needs_prepare:
+                    statement.stats.prepares += 1
+                statement.stats.executes += 1
+                statement.stats.execute_ms_total += elapsed_ms
+            return
+
+    def stats(self) -> dict:
+        with self._lock:
+            statements = {name: statement.stats.describe() for name, statement in self.statements.items()}
+        executes = sum(s["executes"] for s in statements.values())
+        prepares = sum(s["prepares"] for s in statements.values())
+        saved = sum(s["estimated_planning_ms_saved"] or 0 for s in statements.values())
+        return {
+            "enabled": PREPARED_STATEMENTS_ENABLED,
+            "statements": statements,
+            "total_prepares": prepares,
+            "total_executes": executes,
+            "estimated_planning_ms_saved": round(saved, 2)
+        }
+
+
+registry = StatementRegistry()
+
+
+def prepared(name: str, sql: str) -> PreparedStatement:
+    """
+    Register (or look up) a named hot-path statement.
+    """
+    return registry.register(name, sql)
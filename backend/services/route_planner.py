@@ -0,0 +1,328 @@
+"""
+Multi-stop route planning for a driver's accepted orders.
+
+Every active order (status '接單', or '配送中' once picked up) contributes
+stops: one pickup per distinct pickup location (order item stores, or the
+agricultural starting point) unless it was already picked up, and one
+delivery. Pickups of an order must come before its delivery.
+
+The route is an open path (the driver does not return), optionally starting
+at the driver's current position:
+
+1. A haversine distance matrix over all stops is built with NumPy.
+2. Nearest insertion: repeatedly take the order whose stops are closest to
+   the route so far and insert its pickups, then its delivery (after the
+   last pickup), at the cheapest positions.
+3. 2-opt: reverse segments while that shortens the path, skipping
+   reversals that would put a delivery before its own pickup (i.e. the
+   segment contains both).
+
+Plans are cached per driver, keyed by a fingerprint of the order set (and
+the rounded start position), so polling the route is cheap until an order
+is accepted, picked up, completed or dropped.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from backend.services.geocode import geocode, EARTH_RADIUS_KM
+
+logger = logging.getLogger(__name__)
+
+ROUTE_CACHE_MAX_DRIVERS = int(os.getenv('ROUTE_CACHE_MAX_DRIVERS', '1000'))
+# Start positions are rounded to ~100 m so GPS jitter does not defeat the cache
+START_PRECISION = 3
+PICKED_UP_STATUS = '配送中'
+
+ACTIVE_ORDER_STOPS_QUERY = """
+    SELECT 'necessities', o.id, o.order_status, o.location,
+           COALESCE(array_agg(DISTINCT oi.location ORDER BY oi.location)
+                    FILTER (WHERE oi.location IS NOT NULL AND oi.location <> ''), '{}')
+    FROM driver_orders d
+    JOIN orders o ON o.id = d.order_id
+    LEFT JOIN order_items oi ON oi.order_id = o.id
+    WHERE d.driver_id = %s AND d.service = 'necessities' AND o.order_status IN ('接單', '配送中')
+    GROUP BY o.id, o.timestamp
+    UNION ALL
+    SELECT 'agricultural_product', apo.id, apo.status, apo.end_point, ARRAY[apo.starting_point]
+    FROM driver_orders d
+    JOIN agricultural_product_order apo ON apo.id = d.order_id
+    WHERE d.driver_id = %s AND d.service = 'agricultural_product' AND apo.status IN ('接單', '配送中')
+    ORDER BY 1, 2
+"""
+
+
+@dataclass(frozen=True)
+class Stop:
+    service: str
+    order_id: int
+    kind: str  # 'pickup' | 'delivery'
+    location: str
+    lat: float
+    lng: float
+
+    @property
+    def order_key(self) -> Tuple[str, int]:
+        return self.service, self.order_id
+
+
+@dataclass(frozen=True)
+class RoutePlan:
+    stops: List[Stop]
+    legs_km: List[float]
+    total_km: float
+    unlocated: List[dict]
+    solve_ms: float
+
+    def describe(self) -> dict:
+        cumulative = 0.0
+        stops = []
+        for stop, leg in zip(self.stops, self.legs_km):
+            cumulative += leg
+            stops.append({
+                "service": stop.service,
+                "order_id": stop.order_id,
+                "kind": stop.kind,
+                "location": stop.location,
+                "lat": stop.lat,
+                "lng": stop.lng,
+                "leg_km": round(leg, 3),
+                "cumulative_km": round(cumulative, 3)
+            })
+        return {
+            "stops": stops,
+            "total_km": round(self.total_km, 3),
+            "unlocated": self.unlocated,
+            "solve_ms": round(self.solve_ms, 3)
+        }
+
+
+def stops_from_rows(rows) -> Tuple[List[Stop], List[dict]]:
+    """
+    Geocode the rows of ACTIVE_ORDER_STOPS_QUERY into stops.
+
+    Returns:
+        (stops, unlocated): locations that cannot be geocoded are reported
+        instead of routed.
+    """
+    stops: List[Stop] = []
+    unlocated: List[dict] = []
+    for service, order_id, status, location, pickups in rows:
+        wanted = [] if status == PICKED_UP_STATUS else [('pickup', p) for p in dict.fromkeys(pickups or []) if p]
+        wanted.append(('delivery', location))
+        for kind, text in wanted:
+            result = geocode(text)
+            if result is None:
+                unlocated.append({"service": service, "order_id": order_id, "kind": kind, "location": text})
+                continue
+            lat, lng = result.points[0]
+            stops.append(Stop(service, order_id, kind, text, lat, lng))
+    return stops, unlocated
+
+
+def distance_matrix(coords: np.ndarray) -> np.ndarray:
+    """
+    Pairwise haversine distances in km between rows of `coords` ([[lat, lng], ...]).
+    """
+    radians = np.radians(np.asarray(coords, dtype=np.float64).reshape(-1, 2))
+    lat = radians[:, 0][:, None]
+    lng = radians[:, 1][:, None]
+    a = np.sin((lat - lat.T) / 2) ** 2 + np.cos(lat) * np.cos(lat.T) * np.sin((lng - lng.T) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+class _Solver:
+    """
+    Nearest insertion + 2-opt over nodes 0..n-1, with an optional fixed start
+    node n. `must_precede[d]` lists the pickup nodes that must come before
+    delivery node d.
+    """
+
+    def __init__(self, dist: np.ndarray, groups: List[List[int]], must_precede: Dict[int, List[int]], start: Optional[int]):
+        self.dist = dist
+        self.groups = groups
+        self.must_precede = must_precede
+        self.start = start
+
+    def _insertion_costs(self, route: List[int], node: int) -> np.ndarray:
+        """
+        Cost of inserting `node` at each position 0..len(route).
+        """
+        d = self.dist
+        prev = ([self.start] if self.start is not None else [None]) + route
+        nxt = route + [None]
+        costs = np.empty(len(route) + 1)
+        for p, (a, b) in enumerate(zip(prev, nxt)):
+            cost = 0.0
+            if a is not None:
+                cost += d[a, node]
+            if b is not None:
+                cost += d[node, b]
+            if a is not None and b is not None:
+                cost -= d[a, b]
+            costs[p] = cost
+        return costs
+
+    def _insert(self, route: List[int], node: int, first: int = 0):
+        costs = self._insertion_costs(route, node)
+        position = first + int(np.argmin(costs[first:]))
+        route.insert(position, node)
+
+    def insertion(self) -> List[int]:
+        route: List[int] = []
+        remaining = list(range(len(self.groups)))
+        while remaining:
+            anchors = route + ([self.start] if self.start is not None else [])
+            if anchors:
+                nearest = [self.dist[np.ix_(anchors, self.groups[g])].min() for g in remaining]
+                chosen = remaining.pop(int(np.argmin(nearest)))
+            else:
+                chosen = remaining.pop(0)
+            group = self.groups[chosen]
+            pickups = [node for node in group if node not in self.must_precede]
+            deliveries = [node for node in group if node in self.must_precede]
+            for node in pickups:
+                self._insert(route, node)
+            for node in deliveries:
+                after = max((route.index(p) for p in self.must_precede[node]), default=-1)
+                self._insert(route, node, first=after + 1)
+        return route
+
+    def _reversal_feasible(self, position: np.ndarray, route: List[int], i: int, j: int) -> bool:
+        for node in route[i:j + 1]:
+            for pickup in self.must_precede.get(node, ()):
+                if i <= position[pickup] <= j:
+                    return False
+        return True
+
+    def two_opt(self, route: List[int], max_passes: int = 50) -> List[int]:
+        n = len(route)
+        if n < 3:
+            return route
+        d = self.dist
+        position = np.empty(len(d), dtype=np.int64)
+        for _ in range(max_passes):
+            improved = False
+            for i in range(n - 1):
+                r = np.array(route)
+                position[r] = np.arange(n)
+                a = route[i - 1] if i > 0 else self.start
+                js = np.arange(i + 1, n)
+                head = d[a, r[js]] - d[a, r[i]] if a is not None else np.zeros(len(js))
+                tail = np.zeros(len(js))
+                inner = js < n - 1
+                c = r[js[inner] + 1]
+                tail[inner] = d[r[i], c] - d[r[js[inner]], c]
+                delta = head + tail
+                for k in np.argsort(delta):
+                    if delta[k] >= -1e-9:
+                        break
+                    j = int(js[k])
+                    if self._reversal_feasible(position, route, i, j):
+                        route[i:j + 1] = route[i:j + 1][::-1]
+                        improved = True
+                        break
+            if not improved:
+                break
+        return route
+
+
+def plan_route(stops: Sequence[Stop], start: Optional[Tuple[float, float]] = None,
+               unlocated: Optional[List[dict]] = None) -> RoutePlan:
+    """
+    Order stops so each order's pickups come before its delivery, minimizing
+    the path length from `start` (or from the first stop).
+    """
+    started = time.perf_counter()
+    stops = list(stops)
+    unlocated = unlocated or []
+    if not stops:
+        return RoutePlan([], [], 0.0, unlocated, 0.0)
+
+    coords = [(stop.lat, stop.lng) for stop in stops]
+    start_node = None
+    if start is not None:
+        coords.append(start)
+        start_node = len(stops)
+    dist = distance_matrix(np.array(coords))
+
+    by_order: Dict[Tuple[str, int], List[int]] = defaultdict(list)
+    for node, stop in enumerate(stops):
+        by_order[stop.order_key].append(node)
+    must_precede: Dict[int, List[int]] = {}
+    for nodes in by_order.values():
+        pickups = [node for node in nodes if stops[node].kind == 'pickup']
+        for node in nodes:
+            if stops[node].kind == 'delivery':
+                must_precede[node] = pickups
+
+    solver = _Solver(dist, list(by_order.values()), must_precede, start_node)
+    route = solver.two_opt(solver.insertion())
+
+    legs = []
+    previous = start_node
+    for node in route:
+        legs.append(float(dist[previous, node]) if previous is not None else 0.0)
+        previous = node
+    return RoutePlan([stops[node] for node in route], legs, sum(legs), unlocated,
+                     (time.perf_counter() - started) * 1000)
+
+
+def route_fingerprint(rows, start: Optional[Tuple[float, float]]) -> str:
+    rounded = None if start is None else (round(start[0], START_PRECISION), round(start[1], START_PRECISION))
+    payload = repr((sorted((tuple(row[:4]) + (tuple(row[4] or ()),)) for row in rows), rounded))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class RouteCache:
+    """
+    Per-driver plans, reused while the driver's order set (and rounded start)
+    is unchanged. Least recently used drivers are evicted.
+    """
+
+    def __init__(self, max_drivers: int = ROUTE_CACHE_MAX_DRIVERS):
+        self.max_drivers = max_drivers
+        self._plans: "OrderedDict[int, Tuple[str, RoutePlan]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, driver_id: int, rows, start: Optional[Tuple[float, float]] = None) -> Tuple[RoutePlan, bool]:
+        """
+        Returns:
+            (plan, cached)
+        """
+        fingerprint = route_fingerprint(rows, start)
+        with self._lock:
+            entry = self._plans.get(driver_id)
+            if entry is not None and entry[0] == fingerprint:
+                self._plans.move_to_end(driver_id)
+                self.hits += 1
+                return entry[1], True
+            self.misses += 1
+
+        stops, unlocated = stops_from_rows(rows)
+        plan = plan_route(stops, start, unlocated)
+        with self._lock:
+            self._plans[driver_id] = (fingerprint, plan)
+            self._plans.move_to_end(driver_id)
+            while len(self._plans) > self.max_drivers:
+                self._plans.popitem(last=False)
+        return plan, False
+
+    def invalidate(self, driver_id: Optional[int] = None):
+        with self._lock:
+            if driver_id is None:
+                self._plans.clear()
+            else:
+                self._plans.pop(driver_id, None)
+
+
+route_cache = RouteCache()
@@ -0,0 +1,231 @@
+"""
+Set-based daily driver settlement.
+
+For each settlement date (Asia/Taipei calendar day) a driver is paid the sum
+of the escrowed payments of the orders they delivered that day. A chunk of
+consecutive dates is settled in one transaction with three statements:
+
+1. INSERT ... SELECT ... GROUP BY driver, day into driver_payouts
+   (upsert on the unique (driver_id, settle_date); paid payouts are frozen)
+2. INSERT ... SELECT of both ledger legs (PLATFORM_ESCROW -x, DRIVER_WALLET +x)
+   for the part of each payout that is not on the ledger yet; the same
+   statement updates account_balances (services/ledger.py)
+3. upsert of one settlement_checkpoints row per date
+
+Settling the same (driver, date) again is idempotent: step 2 only posts the
+difference between the payout amount and what its DRIVER_WALLET leg already
+holds, so a rerun posts nothing and a late delivery posts an adjustment.
+Runs are serialized with a transaction-level advisory lock.
+
+A date range (backfill) is settled in chunks of `chunk_days`, each committed
+on its own; with resume=True dates that already have a checkpoint are skipped,
+so an interrupted backfill continues where it stopped.
+
+Tables: backend/database/migrations/0007_create_settlement_tables.sql
+"""
+import logging
+import os
+from dataclasses import dataclass, field
+from datetime import date, datetime, time, timedelta
+from typing import List, Optional
+from zoneinfo import ZoneInfo
+
+from backend.services.ledger import posting_sql, LEDGER_COLUMNS, ESCROW_ACCOUNT, DRIVER_WALLET_ACCOUNT, PLATFORM_OWNER
+
+logger = logging.getLogger(__name__)
+
+SETTLEMENT_TIMEZONE = os.getenv('SETTLEMENT_TIMEZONE', 'Asia/Taipei')
+SETTLEMENT_TZ = ZoneInfo(SETTLEMENT_TIMEZONE)
+SETTLEMENT_CURRENCY = 'TWD'
+DEFAULT_CHUNK_DAYS = int(os.getenv('SETTLEMENT_CHUNK_DAYS', '7'))
+MAX_RANGE_DAYS = 366
+
+# pg_advisory_xact_lock key ('cloudtribe:settlement')
+_LOCK_SQL = "SELECT pg_advisory_xact_lock(hashtext('cloudtribe:settlement'))"
+
+UPSERT_PAYOUTS_SQL = """
+    INSERT INTO driver_payouts (driver_id, settle_date, amount, status)
+    SELECT o.driver_id, (o.delivered_at AT TIME ZONE %(tz)s)::date, SUM(p.amount), 'SCHEDULED'
+    FROM orders o
+    JOIN payments p ON p.order_id = o.id
+    WHERE o.delivery_status = 'DELIVERED'
+      AND o.driver_id IS NOT NULL
+      AND o.delivered_at >= %(start)s AND o.delivered_at < %(end)s
+      AND p.status = 'PAID_ESCROW'
+    GROUP BY 1, 2
+    ON CONFLICT (driver_id, settle_date) DO UPDATE
+      SET amount = EXCLUDED.amount
+      WHERE driver_payouts.status = 'SCHEDULED'
+        AND driver_payouts.amount IS DISTINCT FROM EXCLUDED.amount
+"""
+
+# Both legs of the not-yet-posted part of each payout; account_balances moves in the same statement
+POST_LEDGER_SQL = posting_sql(
+    f"""
+    INSERT INTO ledger_entries ({LEDGER_COLUMNS})
+    SELECT 'PAYOUT', pending.id, leg.account,
+           CASE WHEN leg.account = '{DRIVER_WALLET_ACCOUNT}' THEN pending.driver_id ELSE {PLATFORM_OWNER} END,
+           leg.sign * pending.delta, %(currency)s
+    FROM pending
+    CROSS JOIN (VALUES ('{ESCROW_ACCOUNT}', -1), ('{DRIVER_WALLET_ACCOUNT}', 1)) AS leg (account, sign)
+    WHERE pending.delta <> 0
+    """,
+    with_clause=f"""
+    pending AS (
+        SELECT dp.id, dp.driver_id,
+               dp.amount - COALESCE((
+                   SELECT SUM(le.delta) FROM ledger_entries le
+                   WHERE le.ref_type = 'PAYOUT' AND le.ref_id = dp.id AND le.account = '{DRIVER_WALLET_ACCOUNT}'
+               ), 0) AS delta
+        FROM driver_payouts dp
+        WHERE dp.settle_date BETWEEN %(first)s AND %(last)s
+          AND dp.status = 'SCHEDULED'
+    )
+    """
+)
+
+CHECKPOINT_SQL = """
+    INSERT INTO settlement_checkpoints (settle_date, drivers, total_amount, settled_at)
+    SELECT day::date, COUNT(dp.id), COALESCE(SUM(dp.amount), 0), NOW()
+    FROM generate_series(%(first)s::date, %(last)s::date, interval '1 day') AS day
+    LEFT JOIN driver_payouts dp ON dp.settle_date = day::date
+    GROUP BY day
+    ON CONFLICT (settle_date) DO UPDATE
+      SET drivers = EXCLUDED.drivers,
+          total_amount = EXCLUDED.total_amount,
+          settled_at = EXCLUDED.settled_at
+    RETURNING settle_date, drivers, total_amount
+"""
+
+
+@dataclass
+class SettlementDay:
+    settle_date: date
+    drivers: int
+    total_amount: float
+
+
+@dataclass
+class SettlementResult:
+    days: List[SettlementDay] = field(default_factory=list)
+    skipped_dates: List[date] = field(default_factory=list)
+    payouts_changed: int = 0
+    ledger_entries: int = 0
+    chunks: int = 0
+
+    def describe(self) -> dict:
+        return {
+            "settled_dates": [day.settle_date.isoformat() for day in self.days],
+            "skipped_dates": [d.isoformat() for d in self.skipped_dates],
+            "settled_drivers": sum(day.drivers for day in self.days),
+            "total_amount": round(sum(day.total_amount for day in self.days), 2),
+            "payouts_changed": self.payouts_changed,
+            "ledger_entries": self.ledger_entries,
+            "chunks": self.chunks,
+            "days": [
+                {"date": day.settle_date.isoformat(), "drivers": day.drivers, "total_amount": day.total_amount}
+                for day in self.days
+            ]
+        }
+
+
+def local_today() -> date:
+    return datetime.now(SETTLEMENT_TZ).date()
+
+
+def day_bounds(first: date, last: date):
+    """
+    [start, end) instants covering local days first..last.
+    """
+    start = datetime.combine(first, time.min, tzinfo=SETTLEMENT_TZ)
+    end = datetime.combine(last + timedelta(days=1), time.min, tzinfo=SETTLEMENT_TZ)
+    return start, end
+
+
+def _chunks(dates: List[date], chunk_days: int):
+    """
+    Group sorted dates into runs of consecutive days, at most chunk_days long.
+    """
+    chunk = []
+    for d in dates:
+        if chunk and (d - chunk[-1] != timedelta(days=1) or len(chunk) >= chunk_days):
+            yield chunk
+            chunk = []
+        chunk.append(d)
+    if chunk:
+        yield chunk
+
+
+def settle_chunk(cur, first: date, last: date):
+    """
+    Settle local days first..last in the caller's transaction.
+
+    Returns:
+        (payouts_changed, ledger_entries, List[SettlementDay])
+    """
+    start, end = day_bounds(first, last)
+    cur.execute(_LOCK_SQL)
+    cur.execute(UPSERT_PAYOUTS_SQL, {"tz": SETTLEMENT_TIMEZONE, "start": start, "end": end})
+    payouts_changed = cur.rowcount
+    cur.execute(POST_LEDGER_SQL, {"first": first, "last": last, "currency": SETTLEMENT_CURRENCY})
+    ledger_entries = cur.fetchone()[0]
+    cur.execute(CHECKPOINT_SQL, {"first": first, "last": last})
+    days = [SettlementDay(row[0], row[1], float(row[2])) for row in cur.fetchall()]
+    days.sort(key=lambda day: day.settle_date)
+    return payouts_changed, ledger_entries, days
+
+
+def settle_range(conn, first: date, last: Optional[date] = None, chunk_days: int = DEFAULT_CHUNK_DAYS,
+                 resume: bool = False) -> SettlementResult:
+    """
+    Settle local days first..last, committing after every chunk.
+
+    Args:
+        conn: Database connection (not in a transaction).
+        first (date): First settlement date.
+        last (Optional[date]): Last settlement date (defaults to first).
+        chunk_days (int): Days per transaction.
+        resume (bool): Skip dates that already have a checkpoint.
+
+    Returns:
+        SettlementResult: Per-day totals and counts of what changed.
+    """
+    last = last or first
+    if last < first:
+        raise ValueError("date_to must not be before date_from")
+    if (last - first).days + 1 > MAX_RANGE_DAYS:
+        raise ValueError(f"Cannot settle more than {MAX_RANGE_DAYS} days at once")
+    chunk_days = max(1, chunk_days)
+
+    dates = [first + timedelta(days=offset) for offset in range((last - first).days + 1)]
+    result = SettlementResult()
+    cur = conn.cursor()
+    try:
+        if resume:
+            cur.execute(
+                "SELECT settle_date FROM settlement_checkpoints WHERE settle_date BETWEEN %s AND %s",
+                (first, last)
+            )
+            done = {row[0] for row in cur.fetchall()}
+            conn.commit()
+            result.skipped_dates = [d for d in dates if d in done]
+            dates = [d for d in dates if d not in done]
+
+        for chunk in _chunks(dates, chunk_days):
+            try:
+                payouts_changed, ledger_entries, days = settle_chunk(cur, chunk[0], chunk[-1])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            result.chunks += 1
+            result.payouts_changed += payouts_changed
+            result.ledger_entries += ledger_entries
+            result.days.extend(days)
+            logger.info(
+                f"Settled {chunk[0]}..{chunk[-1]}: {sum(day.drivers for day in days)} drivers, "
+                f"{payouts_changed} payouts changed, {ledger_entries} ledger entries"
+            )
+    finally:
+        cur.close()
+    return result
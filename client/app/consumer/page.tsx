@@ -216,7 +216,7 @@ export default function Page() {
                   {/* Product Image */}
                   <div className="relative overflow-hidden">
                     <img 
-                      src={product.img_link} 
+                      src={product.thumb_link || product.img_link} 
                       alt={product.name} 
                       className="w-full h-48 object-cover group-hover:scale-105 transition-transform duration-300"
                     />
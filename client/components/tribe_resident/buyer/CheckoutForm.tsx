@@ -68,6 +68,9 @@ const CheckoutForm: React.FC<CheckoutFormProps> = ({ onClose, clearCart, cartIte
   const autocompleteService = useRef<google.maps.places.AutocompleteService | null>(null);
   const placesService = useRef<google.maps.places.PlacesService | null>(null);
 
+  // Idempotency key of the last submit; reused when the same order is retried after a failure
+  const idempotency = useRef<{ body: string; key: string } | null>(null);
+
   const { isLoaded, loadError } = useJsApiLoader({
     googleMapsApiKey: process.env.NEXT_PUBLIC_GOOGLE_MAPS_API_KEY || '',
     libraries,
@@ -238,6 +241,14 @@ const CheckoutForm: React.FC<CheckoutFormProps> = ({ onClose, clearCart, cartIte
     };
 
     try {
+      const body = JSON.stringify(orderData);
+      if (!idempotency.current || idempotency.current.body !== body) {
+        // crypto.randomUUID is only available in secure contexts (https / localhost)
+        const key = typeof crypto !== 'undefined' && crypto.randomUUID
+          ? crypto.randomUUID()
+          : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+        idempotency.current = { body, key };
+      }
       // Use relative URL - Next.js rewrites will handle routing to backend
       // In dev: routes to http://localhost:8000/api/orders/
       // In production: routes to https://cloudtribe.site/api/orders/
@@ -245,8 +256,9 @@ const CheckoutForm: React.FC<CheckoutFormProps> = ({ onClose, clearCart, cartIte
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          'Idempotency-Key': idempotency.current.key,
         },
-        body: JSON.stringify(orderData),
+        body,
       });
 
       if (!response.ok) {
@@ -256,6 +268,7 @@ const CheckoutForm: React.FC<CheckoutFormProps> = ({ onClose, clearCart, cartIte
       }
 
       const result = await response.json();
+      idempotency.current = null;
 
       setShowAlert(true);
       clearCart();
@@ -144,7 +144,7 @@ export const SellerDialog = () => {
 
     setIsUploading(true);
     try {
-      const res_img = await SellerService.upload_image(imgBase64);
+      const res_img = await SellerService.upload_image(imgBase64, fileType);
       const item: UploadItem = {
         name: itemName,
         price: itemPrice,
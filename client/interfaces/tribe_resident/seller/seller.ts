@@ -44,6 +44,7 @@ export interface UploadItem {
     img_link: string
     img_id: string  
     unit: string
+    thumb_link?: string
   }
   
   export interface ProductOrderInfo {
@@ -1,13 +1,15 @@
 import { UploadItem, IsPutRequest } from '@/interfaces/tribe_resident/seller/seller';
 
 class SellerService {
-  async upload_image(img: string) {
-    const res = await fetch('/api/seller/upload_image', {
+  async upload_image(img: string, type: string) {
+    // Send the raw bytes as multipart/form-data instead of base64 JSON
+    const bytes = Uint8Array.from(atob(img), (c) => c.charCodeAt(0));
+    const blob = new Blob([bytes], { type });
+    const form = new FormData();
+    form.append('image', blob, 'image');
+    const res = await fetch('/api/seller/upload_image/file', {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-      },
-      body: JSON.stringify({ img }),
+      body: form,
     });
     if (!res.ok) {
       let errorMessage = 'Unknown error';
@@ -1,30 +1,23 @@
 #!/bin/bash
 
 # CloudTribe Startup Script with History Management Scheduler
-# This script starts both the FastAPI server and the cleanup scheduler
+# The cleanup scheduler runs inside the FastAPI process (backend/scheduler.py),
+# so only the server needs to be started
 
 echo "🚀 Starting CloudTribe with History Management..."
 
 # Activate virtual environment
 source venv/bin/activate
 
-# Start the scheduler in the background
-echo "📅 Starting history cleanup scheduler..."
-cd backend
-python scheduler.py &
-SCHEDULER_PID=$!
-echo "Scheduler started with PID: $SCHEDULER_PID"
-
 # Start the FastAPI server
 echo "🌐 Starting FastAPI server..."
-python main.py &
+python -m uvicorn backend.main:app --host 0.0.0.0 --port 8000 &
 SERVER_PID=$!
 echo "Server started with PID: $SERVER_PID"
 
 # Function to handle cleanup on exit
 cleanup() {
     echo "🛑 Shutting down services..."
-    kill $SCHEDULER_PID 2>/dev/null
     kill $SERVER_PID 2>/dev/null
     echo "✅ Services stopped"
     exit 0
@@ -40,5 +33,5 @@ echo "📚 API Docs: http://localhost:8000/docs"
 echo ""
 echo "Press Ctrl+C to stop all services"
 
-# Wait for both processes
+# Wait for the server process
 wait